@@ -6,9 +6,17 @@
    message payloads."""
 
 import operator
+import os
 import sys
+import tempfile
 import types
 
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5 and earlier
+    multiprocessing = None
+
 import mixminion.Crypto as Crypto
 import mixminion.Fragments
 from mixminion.Packet import *
@@ -22,7 +30,8 @@ if sys.version_info[:3] < (2,2,0):
 
 __all__ = ['buildForwardPacket', 'buildEncryptedForwardPacket',
            'buildReplyPacket', 'buildReplyBlock', 'checkPathLength',
-           'encodeMessage', 'decodePayload', 'getNPacketsToEncode' ]
+           'encodeMessage', 'decodePayload', 'getNPacketsToEncode',
+           'MessageEncoder', 'PacketBuildPool' ]
 
 def getNPacketsToEncode(message, overhead, uncompressedFragmentPrefix=""):
     """Return the number of packets that would be needed to encode 'message'.
@@ -100,6 +109,300 @@ def encodeMessage(message, overhead, uncompressedFragmentPrefix="",
         rawFragments[i] = None
     return fragments
 
+class MessageEncoder:
+    """Streaming counterpart to encodeMessage: reads a message from a file
+       object, and returns its payloads a few chunks at a time, so that
+       neither the message nor its payloads ever need to be held in memory
+       all at once.  The payloads are exactly those that encodeMessage
+       would return for the same message and PRNGs, in the same order.
+
+       We compress the message into a temporary file the first time we
+       need to know its compressed length, and remember the result: so
+       getNPackets, getLength, and getNextPayloads all share the work.
+    """
+    ## Fields:
+    # inFile -- file object holding the message to encode.  Set to None
+    #    once we've compressed it.
+    # overhead, uncompressedFragmentPrefix, paddingPRNG -- as for
+    #    encodeMessage.
+    # origLength -- the length of the message before compression, or None
+    #    if we haven't compressed it yet.
+    # compressedLength -- the length of the message after compression, or
+    #    None if we haven't compressed it yet.
+    # compressedFile -- None, or a temporary file holding
+    #    uncompressedFragmentPrefix followed by the compressed message.
+    # whitenedFile -- None, or a temporary file holding the whitened
+    #    contents of compressedFile.  Only used for fragmented messages.
+    # params -- None, or a FragmentationParams object for this message.
+    # messageid -- the fragment message ID, if the message is fragmented.
+    # nextChunk -- the index of the next chunk to encode.
+    # done -- true iff we've returned every payload.
+    def __init__(self, inFile, overhead, uncompressedFragmentPrefix="",
+                 paddingPRNG=None):
+        """Create a new MessageEncoder to encode the message in the file
+           object 'inFile'.  Other arguments are as for encodeMessage."""
+        assert overhead in (0, ENC_FWD_OVERHEAD)
+        if paddingPRNG is None:
+            paddingPRNG = Crypto.getCommonPRNG()
+        self.inFile = inFile
+        self.overhead = overhead
+        self.uncompressedFragmentPrefix = uncompressedFragmentPrefix
+        self.paddingPRNG = paddingPRNG
+        self.origLength = self.compressedLength = None
+        self.compressedFile = self.whitenedFile = None
+        self.params = None
+        self.messageid = None
+        self.nextChunk = 0
+        self.done = 0
+
+    def _compress(self):
+        """Helper: compress the message into self.compressedFile, if we
+           haven't done so already."""
+        if self.origLength is not None:
+            return
+        self.compressedFile = tempfile.TemporaryFile()
+        self.compressedFile.write(self.uncompressedFragmentPrefix)
+        self.origLength, self.compressedLength = compressFile(
+            self.inFile, self.compressedFile)
+        self.inFile = None
+        if (self.compressedLength > 1024 and
+            self.compressedLength*20 <= self.origLength):
+            LOG.warn("Message is very compressible and will look like a zlib bomb")
+
+    def _isSingleton(self):
+        """Helper: return true iff the message fits in a single payload."""
+        self._compress()
+        return self.compressedLength <= (PAYLOAD_LEN -
+                           SINGLETON_PAYLOAD_OVERHEAD - self.overhead)
+
+    def _getParams(self):
+        """Helper: return the FragmentationParams for this message.  Only
+           valid if the message doesn't fit in a single payload."""
+        if self.params is None:
+            self.params = mixminion.Fragments.FragmentationParams(
+                len(self.uncompressedFragmentPrefix)+self.compressedLength,
+                self.overhead)
+        return self.params
+
+    def getLength(self):
+        """Return the length of the message, before compression."""
+        self._compress()
+        return self.origLength
+
+    def getNPackets(self):
+        """Return the number of payloads that this message will take."""
+        if self._isSingleton():
+            return 1
+        p = self._getParams()
+        return p.n * p.nChunks
+
+    def getNextPayloads(self):
+        """Return a list of the next few payloads for this message, or an
+           empty list if we've already returned them all.  (As with
+           encodeMessage, be sure to shuffle all the payloads before
+           transmitting them.)"""
+        if self.done:
+            return []
+
+        if self._isSingleton():
+            length = self.compressedLength
+            self.compressedFile.seek(len(self.uncompressedFragmentPrefix))
+            payload = self.compressedFile.read(length)
+            assert len(payload) == length
+            payload += self.paddingPRNG.getBytes(PAYLOAD_LEN -
+                   SINGLETON_PAYLOAD_OVERHEAD - self.overhead - length)
+            p = SingletonPayload(length, None, payload)
+            p.computeHash()
+            self.close()
+            return [ p.pack() ]
+
+        p = self._getParams()
+        if self.whitenedFile is None:
+            # This is the first batch of fragments.  Generate the message
+            # ID and whiten the message in the same order as
+            # encodeMessage would.
+            self.messageid = Crypto.getCommonPRNG().getBytes(
+                FRAGMENT_MESSAGEID_LEN)
+            self.whitenedFile = tempfile.TemporaryFile()
+            tmpFile = tempfile.TemporaryFile()
+            try:
+                n = Crypto.whiten_file(self.compressedFile, self.whitenedFile,
+                                       tmpFile)
+                assert n == p.length
+            finally:
+                tmpFile.close()
+            self.compressedFile.close()
+            self.compressedFile = None
+            self.whitenedFile.seek(0)
+
+        # Encode as many chunks at once as we have FEC threads to encode
+        # them with.
+        firstChunk = self.nextChunk
+        lastChunk = min(firstChunk+mixminion.Fragments.getFECThreads(),
+                        p.nChunks)
+        chunks = []
+        for i in xrange(firstChunk, lastChunk):
+            chunk = self.whitenedFile.read(p.chunkSize)
+            if i == p.nChunks-1:
+                # Only the last chunk gets padding.  (Like
+                # FragmentationParams.getFragments, we take it from the
+                # common PRNG.)
+                chunk += Crypto.getCommonPRNG().getBytes(p.paddingLen)
+            assert len(chunk) == p.chunkSize
+            blocks = []
+            for j in xrange(p.k):
+                blocks.append(chunk[j*p.fragCapacity:(j+1)*p.fragCapacity])
+            chunks.append(blocks)
+        self.nextChunk = lastChunk
+
+        payloads = []
+        idx = firstChunk * p.n
+        for fs in mixminion.Fragments.encodeChunks(p.k, p.n, chunks):
+            for f in fs:
+                pyld = FragmentPayload(idx, None, self.messageid, p.length, f)
+                pyld.computeHash()
+                payloads.append(pyld.pack())
+                idx += 1
+
+        if self.nextChunk == p.nChunks:
+            self.close()
+        return payloads
+
+    def close(self):
+        """Release the temporary files held by this encoder.  No more
+           payloads will be returned."""
+        self.done = 1
+        for f in self.compressedFile, self.whitenedFile:
+            if f is not None:
+                f.close()
+        self.compressedFile = self.whitenedFile = None
+
+# State for the worker processes of every open PacketBuildPool: a map from
+# each pool's key to a tuple of (paths, routingType, routingInfo,
+# suppressTag, replyBlocks), as for PacketBuildPool.__init__.  The entry is
+# made in the parent before the workers are forked, and kept until the pool
+# is closed, so that every worker inherits it -- including any worker that
+# the pool starts later to replace one that died -- rather than needing to
+# pickle ServerInfo objects.
+_BUILD_STATES = {}
+# The key to use for the next PacketBuildPool.
+_NEXT_POOL_KEY = 0
+
+def _initBuildWorker():
+    """Called in each worker process of a PacketBuildPool when it starts."""
+    # Every worker is forked with its parent's RNG state: if we didn't
+    # reseed, the workers would all pick the same keys and padding.
+    Crypto.reinit_after_fork()
+
+def _workerBuildPacket((key, idx, payload)):
+    """Called in a worker process: build the packet for 'payload' along
+       path number 'idx' of the pool with key 'key', and return it."""
+    try:
+        state = _BUILD_STATES[key]
+    except KeyError:
+        # Only possible if this worker was forked after the pool was
+        # closed.
+        raise MixFatalError("No packet building state for pool %s" % key)
+    return _buildPacketFromState(state, idx, payload, None)
+
+def _buildPacketFromState(state, idx, payload, prng):
+    """Helper: build the packet for 'payload' along path number 'idx' in
+       'state', a tuple as stored in _BUILD_STATES."""
+    paths, routingType, routingInfo, suppressTag, replyBlocks = state
+    path1, path2 = paths[idx]
+    if replyBlocks is None:
+        return buildForwardPacket(payload, routingType, routingInfo,
+                                  path1, path2, prng, suppressTag=suppressTag)
+    else:
+        return buildReplyPacket(payload, path1, replyBlocks[idx], prng)
+
+class PacketBuildPool:
+    """Builds the packets for a single message in a pool of worker
+       processes, so that the RSA and LIONESS work for a long message can
+       use more than one CPU.
+
+       The paths (and reply blocks, if any) are chosen by the caller and
+       handed to the pool when it's created; the workers inherit them when
+       they fork.  After that, the caller only needs to send each payload
+       along with the index of its path.  Results come back in the order
+       the payloads were given, so the caller sees the same packet order
+       whether or not it uses workers.  (As always, the caller must shuffle
+       the packets before sending them.)
+    """
+    ## Fields:
+    # state -- a tuple of (paths, routingType, routingInfo, suppressTag,
+    #    replyBlocks), as described in __init__.
+    # prng -- the PRNG to use when building packets in this process.
+    # pool -- a multiprocessing.Pool, or None if we're building packets in
+    #    this process.
+    # key -- this pool's key in _BUILD_STATES, or None if we're building
+    #    packets in this process.
+    def __init__(self, nWorkers, paths, routingType=None, routingInfo=None,
+                 suppressTag=0, replyBlocks=None, prng=None):
+        """Create a new PacketBuildPool.
+
+              nWorkers: number of worker processes to use.  If 1, build
+                 packets in this process, without forking.
+              paths: a list of (path1, path2) tuples, one for each packet.
+              routingType, routingInfo, suppressTag: as for
+                 buildForwardPacket.
+              replyBlocks: None for a forward message; otherwise, a list of
+                 ReplyBlock objects, one for each packet.  (For reply
+                 messages, path2 must be empty.)
+              prng: PRNG to use when building packets in this process.
+                 Worker processes always use their own common PRNG.
+        """
+        global _NEXT_POOL_KEY
+        assert nWorkers >= 1
+        self.state = (paths, routingType, routingInfo, suppressTag,
+                      replyBlocks)
+        self.prng = prng
+        self.pool = self.key = None
+        if nWorkers == 1:
+            return
+        if multiprocessing is None or not hasattr(os, 'fork'):
+            raise UIError("Building packets in parallel requires Python 2.6 "
+                          "or later, on a system that supports fork()")
+        LOG.debug("Starting %s packet building workers", nWorkers)
+        self.key = _NEXT_POOL_KEY
+        _NEXT_POOL_KEY += 1
+        _BUILD_STATES[self.key] = self.state
+        try:
+            self.pool = multiprocessing.Pool(nWorkers, _initBuildWorker)
+        except:
+            del _BUILD_STATES[self.key]
+            self.key = None
+            raise
+
+    def buildPackets(self, jobs):
+        """Given a list of (path index, payload) tuples, build the packet for
+           each payload, and return a list of (packet, first hop) tuples in
+           the same order."""
+        if self.pool is None:
+            pkts = []
+            for idx, payload in jobs:
+                pkts.append(_buildPacketFromState(self.state, idx, payload,
+                                                  self.prng))
+        else:
+            pkts = self.pool.map(_workerBuildPacket,
+                                 [ (self.key, idx, payload)
+                                   for idx, payload in jobs ])
+        paths = self.state[0]
+        result = []
+        for i in xrange(len(jobs)):
+            result.append( (pkts[i], paths[jobs[i][0]][0][0]) )
+        return result
+
+    def close(self):
+        """Stop all worker processes."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.key is not None:
+            del _BUILD_STATES[self.key]
+            self.key = None
+
 def buildRandomPayload(paddingPRNG=None):
     """Return a new random payload, suitable for use in a DROP packet."""
     if not paddingPRNG:
@@ -25,10 +25,13 @@ __all__ = [ "MixError", "ClientEnv", "Mix", "PathSpec", "Path",
             "AddrMsgDest", "SURBMsgDest", "SURB", "ReceivedPacket",
             ]
 
+import mixminion.BuildMessage
 import mixminion.Config
 import mixminion.ClientUtils
 import mixminion.ClientDirectory
+import mixminion.Crypto
 import os
+import time
 
 # The operations in this file raise 'MixError' on failure.
 from mixminion.Common import MixError
@@ -108,7 +111,8 @@ class ClientEnv:
         self._logHandler = None
         self._statusLogHandler = None
         self._clientDirectory = None
-        
+        self.lifetime = None
+
     # ------------------------------------------------------------
     # Configuration functions
     def loadConfig(self, location=None):
@@ -342,7 +346,7 @@ class ClientEnv:
         if pathSpec._forReply and not messageDest.isSURB():
             raise MixError(
                 "Can't use a non-SURB destination for a reply message")
-        elif messageDest.isSURB() and not pathSpec._forReply():
+        elif messageDest.isSURB() and not pathSpec._forReply:
             raise MixError(
                 "Can't use a SURB as a destination for a non-reply message")
 
@@ -356,15 +360,15 @@ class ClientEnv:
             isReply=pathSpec._forReply,
             isSURB=pathSpec._forSURB)
         # XXXX Some way to set isSSFragmented
-        d.validatePath(parsed, messageDest._getExitAdress(), startAt, endAt)
+        d.validatePath(parsed, messageDest._getExitAddress(), startAt, endAt)
         pathSpec._parsed = parsed
 
     def generatePaths(self, pathSpec, messageDest, n=1):
         """Given a PathSpec object and a MsgDest object, return a list of
            'n' Path objects conforming to chosen path spec and dest.
         """
-        if pathSpec._parsed is not None:
-            self.checkPaths(pathSpec, messageDest)
+        if pathSpec._parsed is None:
+            self.checkPathSpec(pathSpec, messageDest)
 
         duration = self._getPathDuration(messageDest)
         startAt = time.time()
@@ -388,7 +392,7 @@ class ClientEnv:
         prefix = ""
         overhead = 0
         return mixminion.BuildMessage.getNPacketsToEncode(
-            messge, overhead, prefix)
+            message, overhead, prefix)
 
     def encodeAndSplit(self, message, messageDest, headers=None):
         """Given a message (type string), a MsgDest object, and an optional
@@ -420,18 +424,57 @@ class ClientEnv:
         pass
 
     def encryptPackets(self, bodies, messageDest, pathSpec=None,
-                       surbList=None):
+                       surbList=None, nWorkers=1):
         """Given a sequence of PacketBody objects and a MsgDest object, generate
            corresponding Packet objects.  If 'pathSpec' is not provided,
            default ForwardPath or ReplyPath in the config file.  If
            'messageDest' indicates a reply, then SURBList should be a
            sequence of SURB objects.
 
+           If 'nWorkers' is more than 1, build the packets in that many
+           processes at once.  Either way, the packets are returned in a
+           random order, so they can be sent as-is.
+
            (High-level interface.  You can encrypt packets more directly
            using ClientEnv.generatePaths and encryptPacket.)
         """
-        #XXXX
-        pass
+        if not bodies:
+            return []
+        isReply = messageDest.isSURB()
+        if pathSpec is None:
+            if isReply:
+                path = self._getConfig()['Security']['ReplyPath']
+            else:
+                path = self._getConfig()['Security']['ForwardPath']
+            pathSpec = PathSpec(path, forReply=isReply)
+        paths = [ (p._path1, p._path2) for p in
+                  self.generatePaths(pathSpec, messageDest, len(bodies)) ]
+
+        if isReply:
+            if surbList is None or len(surbList) < len(bodies):
+                raise MixError("Not enough SURBs to encrypt %s packets"%
+                               len(bodies))
+            builder = mixminion.BuildMessage.PacketBuildPool(
+                min(nWorkers, len(bodies)), paths,
+                replyBlocks=[ s._replyBlock for s in surbList[:len(bodies)] ])
+        else:
+            exitAddress = messageDest._getExitAddress()
+            routingType, routingInfo, _ = exitAddress.getRouting()
+            builder = mixminion.BuildMessage.PacketBuildPool(
+                min(nWorkers, len(bodies)), paths, routingType, routingInfo,
+                exitAddress.suppressTag())
+        try:
+            built = builder.buildPackets(
+                [ (i, bodies[i]._contents) for i in xrange(len(bodies)) ])
+        finally:
+            builder.close()
+
+        # As in MixminionClient._sortPackets, don't let the order of the
+        # packets reveal the order of the fragments.
+        packets = [ Packet(pkt, PacketDest(firstHop.getRoutingInfo()))
+                    for pkt, firstHop in built ]
+        mixminion.Crypto.getCommonPRNG().shuffle(packets)
+        return packets
 
     # ------------------------------------------------------------
     # Sending and/or queueing packets
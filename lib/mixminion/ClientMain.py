@@ -8,6 +8,7 @@
 
 __all__ = [ 'Address', 'ClientKeyring', 'MixminionClient' ]
 
+import cStringIO
 import getopt
 import os
 import sys
@@ -209,6 +210,10 @@ DirectoryTimeout: 1 minute
 
 [Network]
 Timeout: 2 minutes
+## Largest number of servers to send packets to at once.
+#MaxConnections: 16
+## Largest number of connections to open to a single server at once.
+#ConnectionsPerServer: 1
 """ % fields)
 
 class MixminionClient:
@@ -269,14 +274,15 @@ class MixminionClient:
 
     def sendForwardMessage(self, directory, address, pathSpec, message,
                            startAt, endAt, forceQueue=0, forceNoQueue=0,
-                           forceNoServerSideFragments=0):
+                           forceNoServerSideFragments=0, nWorkers=1):
         """Generate and send a forward message.
             directory -- an instance of ClientDirectory; used to generate
                paths.
             address -- an instance of ExitAddress, used to tell where to
                deliver the message.
             pathSpec -- an instance of PathSpec, describing the path to use.
-            message -- the contents of the message to send
+            message -- the contents of the message to send, as a string or
+               as a file object open for reading.
             startAt, endAt -- an interval over which all servers in the path
                must be valid.
             forceQueue -- if true, do not try to send the message; simply
@@ -287,22 +293,37 @@ class MixminionClient:
                large to fit in a single packet, deliver fragment packets to
                the eventual recipient rather than having the exit server
                defragment them.
+            nWorkers -- the number of processes to use when building
+               packets.
         """
         assert not (forceQueue and forceNoQueue)
 
+        if forceQueue:
+            # We can queue the packets as soon as they're built, so that we
+            # never need to hold them all in memory.
+            handles = []
+            def queueBatch(packets, self=self, handles=handles):
+                handles.extend(self._queueSortedPackets(packets))
+            try:
+                self.generateForwardPackets(
+                    directory, address, pathSpec, message,
+                    forceNoServerSideFragments, startAt, endAt,
+                    packetFn=queueBatch, nWorkers=nWorkers)
+            except:
+                self._unqueuePackets(handles)
+                raise
+            return
+
         allPackets = self.generateForwardPackets(
             directory, address, pathSpec, message, forceNoServerSideFragments,
-            startAt, endAt)
+            startAt, endAt, nWorkers=nWorkers)
 
-        for routing, packets in self._sortPackets(allPackets):
-            if forceQueue:
-                self.queuePackets(packets, routing)
-            else:
-                self.sendPackets(packets, routing, noQueue=forceNoQueue)
+        self.sendPacketsToMany(self._sortPackets(allPackets),
+                               noQueue=forceNoQueue)
 
     def sendReplyMessage(self, directory, address, pathSpec, surbList, message,
                          startAt, endAt, forceQueue=0,
-                         forceNoQueue=0):
+                         forceNoQueue=0, nWorkers=1):
         """Generate and send a reply message.
             directory -- an instance of ClientDirectory; used to generate
                paths.
@@ -312,23 +333,64 @@ class MixminionClient:
             surbList -- a list of SURBs to consider using for the reply.  We
                use the first N that are neither expired nor used, and mark them
                used.
-            message -- the contents of the message to send
+            message -- the contents of the message to send, as a string or
+               as a file object open for reading.
             startAt, endAt -- an interval over which all servers in the path
                must be valid.
             forceQueue -- if true, do not try to send the message; simply
                queue it and exit.
             forceNoQueue -- if true, do not queue the message even if delivery
                fails.
+            nWorkers -- the number of processes to use when building
+               packets.
         """
         #XXXX write unit tests
+        if forceQueue:
+            handles = []
+            def queueBatch(packets, self=self, handles=handles):
+                handles.extend(self._queueSortedPackets(packets))
+            try:
+                self.generateReplyPackets(
+                    directory, address, pathSpec, message, surbList, startAt,
+                    endAt, packetFn=queueBatch, nWorkers=nWorkers)
+            except:
+                self._unqueuePackets(handles)
+                raise
+            return
+
         allPackets = self.generateReplyPackets(
-            directory, address, pathSpec, message, surbList, startAt, endAt)
+            directory, address, pathSpec, message, surbList, startAt, endAt,
+            nWorkers=nWorkers)
+
+        self.sendPacketsToMany(self._sortPackets(allPackets),
+                               noQueue=forceNoQueue)
+
+    def _queueSortedPackets(self, packets):
+        """Helper function.  Takes a list of tuples as for _sortPackets,
+           and queues all the packets in a scrambled order.  Since queued
+           packets are stored under random handles, queueing a message's
+           packets a batch at a time reveals no more than queueing them all
+           at once.  Returns a list of the new packets' handles."""
+        handles = []
+        for routing, pktList in self._sortPackets(packets):
+            handles.extend(self.queuePackets(pktList, routing))
+        return handles
 
-        for routing, packets in self._sortPackets(allPackets):
-            if forceQueue:
-                self.queuePackets(packets, routing)
-            else:
-                self.sendPackets(packets, routing, noQueue=forceNoQueue)
+    def _unqueuePackets(self, handles):
+        """Helper function.  Remove the packets with the handles in
+           'handles' from the queue.  We use this when we fail partway
+           through queueing a message, since a message missing some of
+           its packets could never be reassembled."""
+        if not handles:
+            return
+        LOG.info("Removing %s partially queued packets", len(handles))
+        clientLock()
+        try:
+            for h in handles:
+                self.queue.removePacket(h)
+            self.queue.cleanQueue()
+        finally:
+            clientUnlock()
 
     def generateReplyBlock(self, address, servers, name="", expiryTime=0):
         """Generate an return a new ReplyBlock object.
@@ -350,7 +412,8 @@ class MixminionClient:
         return block
 
     def generateForwardPackets(self, directory, address, pathSpec, message,
-                               noSSFragments, startAt, endAt):
+                               noSSFragments, startAt, endAt, packetFn=None,
+                               nWorkers=1):
         """Generate packets for a forward message, but do not send
            them.  Return a list of tuples of (the packet body, a
            ServerInfo for the first hop.)
@@ -360,12 +423,20 @@ class MixminionClient:
             address -- an instance of ExitAddress, used to tell where to
                deliver the message.
             pathSpec -- an instance of PathSpec, describing the path to use.
-            message -- the contents of the message to send
+            message -- the contents of the message to send, as a string or
+               as a file object open for reading.
             noSSFragments -- if true, and the message is too large to fit in a
                single packet, deliver fragment packets to the eventual
                recipient rather than having the exit server defragment them.
             startAt, endAt -- an interval over which all servers in the path
                must be valid.
+            packetFn -- if provided, a function to call with each batch of
+               tuples as soon as it is generated.  In this case, we return
+               an empty list, and never hold more than one batch of packets
+               in memory at once.
+            nWorkers -- the number of processes to use when building
+               packets.  If more than 1, we build packets in a
+               PacketBuildPool.
             """
         #XXXX we need to factor more of this long-message logic out to the
         #XXXX common code.  For now, this is a temporary measure.
@@ -375,34 +446,57 @@ class MixminionClient:
         else:
             fragmentedMessagePrefix = address.getFragmentedMessagePrefix()
         LOG.info("Generating payload(s)...")
-        r = []
         if address.hasPayload():
-            payloads = mixminion.BuildMessage.encodeMessage(message, 0,
-                                fragmentedMessagePrefix)
-            if len(payloads) > 1:
-                address.setFragmented(not noSSFragments, len(payloads))
+            encoder = _getMessageEncoder(message, fragmentedMessagePrefix)
+            nPackets = encoder.getNPackets()
+            if nPackets > 1:
+                address.setFragmented(not noSSFragments, nPackets)
             else:
                 address.setFragmented(0,1)
         else:
-            payloads = [ mixminion.BuildMessage.buildRandomPayload() ]
+            encoder = None
+            nPackets = 1
             address.setFragmented(0,1)
         routingType, routingInfo, _ = address.getRouting()
 
         directory.validatePath(pathSpec, address, startAt, endAt,
                                warnUnrecommended=0)
 
-        for p, (path1,path2) in zip(payloads, directory.generatePaths(
-            len(payloads), pathSpec, address, startAt, endAt)):
-
-            pkt = mixminion.BuildMessage.buildForwardPacket(
-                p, routingType, routingInfo, path1, path2,
-                self.prng, suppressTag=address.suppressTag())
-            r.append( (pkt, path1[0]) )
+        paths = directory.generatePaths(nPackets, pathSpec, address,
+                                        startAt, endAt)
+        r = []
+        i = 0
+        builder = None
+        try:
+            builder = mixminion.BuildMessage.PacketBuildPool(
+                min(nWorkers, nPackets), paths, routingType, routingInfo,
+                address.suppressTag(), prng=self.prng)
+            while i < nPackets:
+                if encoder is None:
+                    payloads = [ mixminion.BuildMessage.buildRandomPayload() ]
+                else:
+                    payloads = encoder.getNextPayloads()
+                assert payloads
+                jobs = []
+                for p in payloads:
+                    jobs.append( (i, p) )
+                    i += 1
+                batch = builder.buildPackets(jobs)
+                if packetFn is not None:
+                    packetFn(batch)
+                else:
+                    r.extend(batch)
+        finally:
+            if builder is not None:
+                builder.close()
+            if encoder is not None:
+                encoder.close()
 
         return r
 
     def generateReplyPackets(self, directory, address, pathSpec, message,
-                             surbList, startAt, endAt):
+                             surbList, startAt, endAt, packetFn=None,
+                             nWorkers=1):
         """Generate a reply message, but do not send it.  Returns
            a tuple of (packet body, ServerInfo for the first hop.)
 
@@ -411,40 +505,61 @@ class MixminionClient:
             address -- an instance of ExitAddress, used to tell where to
                deliver the message.
             pathSpec -- an instance of PathSpec, describing the path to use.
-            message -- the contents of the message to send
+            message -- the contents of the message to send, as a string or
+               as a file object open for reading.
             surbList -- a list of SURBs to consider using for the reply.  We
                use the first N that are neither expired nor used, and mark them
                used.
             startAt, endAt -- an interval over which all servers in the path
                must be valid.
+            packetFn, nWorkers -- as for generateForwardPackets.
             """
         #XXXX write unit tests
         assert address.isReply
 
-        payloads = mixminion.BuildMessage.encodeMessage(message, 0, "")
-
-        surbLog = self.openSURBLog() # implies lock
-        result = []
+        encoder = _getMessageEncoder(message, "")
         try:
-            surbs = surbLog.findUnusedSURBs(surbList, len(payloads),
-                                           verbose=1, now=startAt)
-            if len(surbs) < len(payloads):
-                raise UIError("Not enough usable reply blocks found; all were used or expired.")
-
-
-            for (surb,payload,(path1,path2)) in zip(surbs,payloads,
-                  directory.generatePaths(len(payloads),pathSpec, address,
-                                          startAt,endAt)):
-                assert path1 and not path2
-                LOG.info("Generating packet...")
-                pkt = mixminion.BuildMessage.buildReplyPacket(
-                    payload, path1, surb, self.prng)
+            nPackets = encoder.getNPackets()
 
-                surbLog.markSURBUsed(surb)
-                result.append( (pkt, path1[0]) )
+            surbLog = self.openSURBLog() # implies lock
+            result = []
+            try:
+                surbs = surbLog.findUnusedSURBs(surbList, nPackets,
+                                               verbose=1, now=startAt)
+                if len(surbs) < nPackets:
+                    raise UIError("Not enough usable reply blocks found; all were used or expired.")
+
+                paths = directory.generatePaths(nPackets, pathSpec, address,
+                                                startAt, endAt)
+                for path1, path2 in paths:
+                    assert path1 and not path2
+                builder = mixminion.BuildMessage.PacketBuildPool(
+                    min(nWorkers, nPackets), paths, replyBlocks=surbs,
+                    prng=self.prng)
+                try:
+                    i = 0
+                    while i < nPackets:
+                        payloads = encoder.getNextPayloads()
+                        assert payloads
+                        LOG.info("Generating %s packet(s)...", len(payloads))
+                        jobs = []
+                        for payload in payloads:
+                            jobs.append( (i, payload) )
+                            i += 1
+                        batch = builder.buildPackets(jobs)
+                        for idx, _ in jobs:
+                            surbLog.markSURBUsed(surbs[idx])
+                        if packetFn is not None:
+                            packetFn(batch)
+                        else:
+                            result.extend(batch)
+                finally:
+                    builder.close()
 
+            finally:
+                surbLog.close() #implies unlock
         finally:
-            surbLog.close() #implies unlock
+            encoder.close()
 
         return result
 
@@ -482,76 +597,105 @@ class MixminionClient:
 
            XXXX return 1 if all delivered
            """
-        #XXXX write unit tests
-        timeout = self.config.getTimeout()
-
-        if noQueue or lazyQueue:
-            handles = []
-        else:
-            handles = self.queuePackets(pktList, routingInfo)
+        return self.sendPacketsToMany([ (routingInfo, pktList) ],
+                                      noQueue=noQueue, lazyQueue=lazyQueue,
+                                      alreadyQueued=alreadyQueued,
+                                      warnIfLost=warnIfLost)
+
+    def sendPacketsToMany(self, batches, noQueue=0, lazyQueue=0,
+                          alreadyQueued=0, warnIfLost=1):
+        """As sendPackets, but takes a list of (routingInfo, packet list)
+           tuples, as returned by _sortPackets, and delivers to all of the
+           servers at once.  Each server's packets succeed or fail on their
+           own: the ones that a server acknowledges are removed from the
+           queue (or never queued) even if other servers fail.  Returns
+           the total number of packets delivered.
+           """
+        network = self.config.get('Network', {})
+        engine = mixminion.MMTPClient.ClientDeliveryEngine(
+            self.config.getTimeout(),
+            maxConnections=network.get('MaxConnections', 16),
+            maxPerServer=network.get('ConnectionsPerServer', 1))
+
+        handlesByBatch = []
+        sentByBatch = []
+        for routingInfo, pktList in batches:
+            if noQueue or lazyQueue:
+                handles = []
+            else:
+                handles = self.queuePackets(pktList, routingInfo)
+            handlesByBatch.append(handles)
 
-        packetsSentByIndex = {}
-        def callback(idx, packetsSentByIndex=packetsSentByIndex):
-            packetsSentByIndex[idx] = 1
+            packetsSentByIndex = {}
+            def callback(idx, packetsSentByIndex=packetsSentByIndex):
+                packetsSentByIndex[idx] = 1
+            sentByBatch.append(packetsSentByIndex)
+            engine.addPackets(routingInfo, pktList, callback=callback)
 
         try:
-            # May raise TimeoutError
             LOG.info("Connecting...")
-            mixminion.MMTPClient.sendPackets(routingInfo,
-                                             pktList,
-                                             timeout,
-                                             callback=callback)
-
+            results = engine.run()
         except:
             exc = sys.exc_info()
-        else:
-            exc = None
-        nGood = len(packetsSentByIndex)
-        nBad = len(pktList)-nGood
+            results = [ (r, None, str(exc[1])) for r, _ in batches ]
 
+        nGoodTotal = 0
         clientLock()
         try:
-            if nGood:
-                LOG.info("... %s sent", nGood)
-                LOG.trace("Removing %s successful packets from queue", nGood)
-            for idx in packetsSentByIndex.keys():
-                if handles and handles[idx]:
-                    self.queue.removePacket(handles[idx])
-                elif hasattr(pktList[idx], 'remove'):
-                    pktList[idx].remove()
-            if nGood:
+            for i in xrange(len(batches)):
+                routingInfo, pktList = batches[i]
+                handles = handlesByBatch[i]
+                packetsSentByIndex = sentByBatch[i]
+                error = results[i][2]
+                serverName = displayServerByRouting(routingInfo)
+
+                nGood = len(packetsSentByIndex)
+                nBad = len(pktList)-nGood
+                nGoodTotal += nGood
+
+                if nGood:
+                    LOG.info("... %s sent to %s", nGood, serverName)
+                    LOG.trace("Removing %s successful packets from queue",
+                              nGood)
+                for idx in packetsSentByIndex.keys():
+                    if handles and handles[idx]:
+                        self.queue.removePacket(handles[idx])
+                    elif hasattr(pktList[idx], 'remove'):
+                        pktList[idx].remove()
+
+                if nBad and noQueue:
+                    if warnIfLost:
+                        LOG.error("Error with queueing disabled: %s/%s lost",
+                                  nBad, nGood+nBad)
+                    elif alreadyQueued:
+                        LOG.info("Error while delivering packets; %s/%s left in queue",
+                                 nBad,nGood+nBad)
+                elif nBad and lazyQueue:
+                    LOG.info("Error while delivering packets; %s/%s left in queue",
+                             nBad,nGood+nBad)
+                    badPackets = [ pktList[idx] for idx in xrange(len(pktList))
+                                   if not packetsSentByIndex.has_key(idx) ]
+
+                    self.queuePackets(badPackets, routingInfo)
+                elif nBad:
+                    assert not (noQueue or lazyQueue)
+                    LOG.info("Error while delivering packets; leaving %s/%s in queue",
+                             nBad, nBad+nGood)
+                if error and not nBad:
+                    LOG.info("Got error after all packets were delivered.")
+                if error:
+                    LOG.info("Error was: %s", error)
+
+            if nGoodTotal:
                 try:
                     self.queue.cleanQueue()
                 except:
                     e2 = sys.exc_info()
                     LOG.error("Error while cleaning queue: %s",e2[1])
-
-            if nBad and noQueue:
-                if warnIfLost:
-                    LOG.error("Error with queueing disabled: %s/%s lost",
-                              nBad, nGood+nBad)
-                elif alreadyQueued:
-                    LOG.info("Error while delivering packets; %s/%s left in queue",
-                             nBad,nGood+nBad)
-            elif nBad and lazyQueue:
-                LOG.info("Error while delivering packets; %s/%s left in queue",
-                         nBad,nGood+nBad)
-                badPackets = [ pktList[idx] for idx in xrange(len(pktList))
-                               if not packetsSentByIndex.has_key(idx) ]
-
-                self.queuePackets(badPackets, routingInfo)
-            elif nBad:
-                assert not (noQueue or lazyQueue)
-                LOG.info("Error while delivering packets; leaving %s/%s in queue",
-                         nBad, nBad+nGood)
-            if exc and not nBad:
-                LOG.info("Got error after all packets were delivered.")
-            if exc:
-                LOG.info("Error was: %s", exc[1])
         finally:
             clientUnlock()
 
-        return nGood
+        return nGoodTotal
 
     def flushQueue(self, maxPackets=None, handles=None):
         """Try to send packets in the queue to their destinations.  Do not try
@@ -595,16 +739,15 @@ class MixminionClient:
 
         nPackets = len(packets)
         nSent = 0
-        for routing, packets in self._sortPackets(packets):
+        batches = self._sortPackets(packets)
+        for routing, packets in batches:
             LOG.info("Sending %s packets to %s...",
                      len(packets), displayServerByRouting(routing))
-            try:
-                ok = self.sendPackets(packets, routing, noQueue=1,
-                                      warnIfLost=0, alreadyQueued=1)
-                nSent += ok
-            except MixError, e:
-                LOG.error("Can't deliver packets to %s: %s; leaving in queue",
-                          displayServerByRouting(routing), str(e))
+        try:
+            nSent = self.sendPacketsToMany(batches, noQueue=1,
+                                           warnIfLost=0, alreadyQueued=1)
+        except MixError, e:
+            LOG.error("Can't deliver packets: %s; leaving in queue", str(e))
 
         if nSent == nPackets:
             LOG.info("Queue flushed")
@@ -708,6 +851,52 @@ class MixminionClient:
             self.pool.process()
         return results
 
+class _PrefixedFile:
+    """Helper class: a read-only file object that returns a string,
+       followed by the contents of another file object.  We use it to
+       prepend headers to a message without reading the message into
+       memory."""
+    ## Fields:
+    # prefix -- the part of the string we have yet to return.
+    # f -- the underlying file object.
+    def __init__(self, prefix, f):
+        self.prefix = prefix
+        self.f = f
+    def read(self, n=-1):
+        if not self.prefix:
+            return self.f.read(n)
+        if n < 0:
+            s = self.prefix + self.f.read()
+            self.prefix = ""
+            return s
+        s = self.prefix[:n]
+        self.prefix = self.prefix[n:]
+        if len(s) < n:
+            s += self.f.read(n-len(s))
+        return s
+    def close(self):
+        self.f.close()
+
+def _getMessageEncoder(message, fragmentedMessagePrefix):
+    """Helper function: return a new MessageEncoder for 'message', which may
+       be either a string or a file object open for reading."""
+    if type(message) == StringType:
+        message = cStringIO.StringIO(message)
+    return mixminion.BuildMessage.MessageEncoder(message, 0,
+                                                 fragmentedMessagePrefix)
+
+def _openMessage(inFile, headerStr):
+    """Helper function: return a tuple of (file object, length) for the
+       message in the file 'inFile', preceded by 'headerStr'.  We don't read
+       the file into memory, so that we can handle long messages."""
+    f = open(inFile, 'r')
+    try:
+        length = os.fstat(f.fileno()).st_size
+    except:
+        f.close()
+        raise
+    return _PrefixedFile(headerStr, f), len(headerStr)+length
+
 def readConfigFile(configFile):
     """Given a configuration file (possibly none) as specified on the command
        line, return a ClientConfig object.
@@ -1120,6 +1309,8 @@ Options:
                              to the recipient instead of having the server
                              reassemble the message.
   --reply-block-fd=<N>       Read reply blocks from file descriptor <N>.
+  --build-workers=<N>        Build packets in <N> processes at once.  (Useful
+                             for long messages.)
 %(extra)s
 
 EXAMPLES:
@@ -1187,7 +1378,8 @@ def runClient(cmd, args):
     ###
     # Parse and validate our options.
     options, args = getOptions(args, "",
-                               ["queue", "no-queue", "deliver-fragments"],
+                               ["queue", "no-queue", "deliver-fragments",
+                                "build-workers="],
                                dir=1,reply=1,path=1,headers=1,dest=1,input=1)
 
     if not options:
@@ -1196,6 +1388,7 @@ def runClient(cmd, args):
     inFile = '-'
     h_subject = h_from = h_irt = h_references = h_newsgroups = None
     no_ss_fragment = 0
+    nWorkers = 1
     for opt,val in options:
         if opt in ('-i', '--input'):
             inFile = val
@@ -1211,6 +1404,13 @@ def runClient(cmd, args):
             h_newsgroups = val
         elif opt == '--deliver-fragments':
             no_ss_fragment = 1
+        elif opt == '--build-workers':
+            try:
+                nWorkers = int(val)
+            except ValueError:
+                nWorkers = 0
+            if nWorkers < 1:
+                raise UIError("Invalid number of build workers: %r"%val)
 
     try:
         parser = CLIArgumentParser(options, wantConfig=1,wantClientDirectory=1,
@@ -1281,27 +1481,27 @@ def runClient(cmd, args):
                 if os.isatty(sys.stdin.fileno()):
                     print "Enter your message.  Type %s when you are done."%(
                         EOF_STR)
-                message = sys.stdin.read()
+                message = "%s%s" % (headerStr, sys.stdin.read())
+                length = len(message)
             else:
-                message = readFile(inFile)
+                message, length = _openMessage(inFile, headerStr)
         except KeyboardInterrupt:
             print "Interrupted.  Message not sent."
             sys.exit(1)
 
-        message = "%s%s" % (headerStr, message)
-
-        address.setExitSize(len(message))
+        address.setExitSize(length)
 
     if parser.exitAddress.isReply:
         client.sendReplyMessage(
             parser.directory, parser.exitAddress, parser.pathSpec,
             parser.surbList, message,
-            parser.startAt, parser.endAt, forceQueue, forceNoQueue)
+            parser.startAt, parser.endAt, forceQueue, forceNoQueue,
+            nWorkers=nWorkers)
     else:
         client.sendForwardMessage(
             parser.directory, parser.exitAddress, parser.pathSpec,
             message, parser.startAt, parser.endAt, forceQueue, forceNoQueue,
-            forceNoServerSideFragments=no_ss_fragment)
+            forceNoServerSideFragments=no_ss_fragment, nWorkers=nWorkers)
 
 _COUNT_PACKETS_USAGE = """\
 Usage: mixminion count-packets [options] <-t address>|<--to=address>|
@@ -1396,22 +1596,26 @@ def countPackets(cmd,args):
                 if os.isatty(sys.stdin.fileno()):
                     print "Enter your message.  Type %s when you are done."%(
                         EOF_STR)
-                message = sys.stdin.read()
+                message = "%s%s"%(headerStr,sys.stdin.read())
+                length = len(message)
             else:
-                message = readFile(inFile)
+                message, length = _openMessage(inFile, headerStr)
         except KeyboardInterrupt:
             print "Interrupted."
             return
 
-        message = "%s%s"%(headerStr,message)
-        address.setExitSize(len(message))
+        address.setExitSize(length)
 
         if no_ss_fragment:
             prefix=""
         else:
             prefix=address.getFragmentedMessagePrefix()
 
-        n = mixminion.BuildMessage.getNPacketsToEncode(message, 0, prefix)
+        encoder = _getMessageEncoder(message, prefix)
+        try:
+            n = encoder.getNPackets()
+        finally:
+            encoder.close()
         print "%d packets needed" % n
         STATUS.log("COUNT_PACKETS", str(n))
 
@@ -11,13 +11,14 @@ __all__ = ['IntervalSet', 'Lockfile', 'LockfileLocked', 'LOG', 'LogStream',
            'createPrivateDir', 'disp64',
            'encodeBase64', 'englishSequence', 'floorDiv', 'formatBase64',
            'formatDate', 'formatFnameDate', 'formatFnameTime', 'formatTime',
-           'installSIGCHLDHandler', 'isSMTPMailbox', 'iterFileLines',
+           'getShredStats', 'installSIGCHLDHandler', 'isSMTPMailbox', 'iterFileLines',
            'openUnique', 'parseFnameDate',
            'previousMidnight', 'readFile', 'readPickled',
            'readPossiblyGzippedFile', 'secureDelete', 'stringContains',
            'succeedingMidnight', 'tryUnlink', 'unarmorText',
            'waitForChildren', 'writeFile', 'writePickled']
 
+import atexit
 import binascii
 import bisect
 import calendar
@@ -714,7 +715,8 @@ _SHRED_OPTS = None
 
 def configureShredCommand(conf):
     """Initialize the secure delete command from a given Config object.
-       If no object is provided, try some sane defaults."""
+       If no object is provided, or the object doesn't set ShredCommand,
+       use our internal ShredEngine."""
     global _SHRED_CMD
     global _SHRED_OPTS
     cmd, opts = None, None
@@ -723,13 +725,6 @@ def configureShredCommand(conf):
         if val is not None:
             cmd, opts = val
 
-    if cmd is None:
-        if os.path.exists("/usr/bin/shred"):
-            cmd, opts = "/usr/bin/shred", ["-uz", "-n0"]
-        else:
-            # Use built-in _overwriteFile
-            cmd, opts = None, None
-
     _SHRED_CMD, _SHRED_OPTS = cmd, opts
 
 
@@ -740,24 +735,30 @@ _BLKSIZEMAP = {}
 _NILSTR = ""
 
 
-def _overwriteFile(f):
-    """Overwrite f with zeros, rounding up to the nearest block.  This is
-       used as the default implementation of secureDelete."""
+def _getBlockSize(parent):
+    """Return the block size of the filesystem holding the directory
+       'parent', making sure that _NILSTR is at least that long."""
     global _NILSTR
-    parent = os.path.split(f)[0]
     try:
-        sz = _BLKSIZEMAP[parent]
+        return _BLKSIZEMAP[parent]
     except KeyError:
-        if hasattr(os, 'statvfs'):
-            try:
-                sz = os.statvfs(parent)[statvfs.F_BSIZE]
-            except OSError:
-                sz = 8192  # Should be a safe guess? (????)
-        else:
+        pass
+    if hasattr(os, 'statvfs'):
+        try:
+            sz = os.statvfs(parent)[statvfs.F_BSIZE]
+        except OSError:
             sz = 8192  # Should be a safe guess? (????)
-        _BLKSIZEMAP[parent] = sz
-        if sz > len(_NILSTR):
-            _NILSTR = '\x00' * sz
+    else:
+        sz = 8192  # Should be a safe guess? (????)
+    _BLKSIZEMAP[parent] = sz
+    if sz > len(_NILSTR):
+        _NILSTR = '\x00' * sz
+    return sz
+
+def _overwriteFile(f):
+    """Overwrite f with zeros, rounding up to the nearest block.  This is
+       used when we can't run the configured shred command."""
+    sz = _getBlockSize(os.path.split(f)[0])
     nil = _NILSTR[:sz]
     try:
         fd = os.open(f, os.O_WRONLY | O_BINARY)
@@ -774,6 +775,213 @@ def _overwriteFile(f):
         os.close(fd)
 
 
+# Number of worker threads used by the internal ShredEngine.
+SHRED_THREADS = 2
+# Largest number of files from a single directory that a ShredEngine thread
+# overwrites, flushes, and unlinks together.
+_SHRED_BATCH = 64
+# If more than this many files are waiting to be shredded, log a warning.
+_SHRED_BACKLOG_WARN = 10000
+
+# Function to flush a file's contents (but not necessarily its metadata) to
+# disk, or None if we can't.
+_fdatasync = getattr(os, 'fdatasync', None) or getattr(os, 'fsync', None)
+
+class _ShredJob:
+    """A group of files passed to ShredEngine.shred at the same time."""
+    ## Fields:
+    # remaining: the number of batches from this job that have not yet
+    #    been shredded.
+    def __init__(self):
+        self.remaining = 0
+
+class ShredEngine:
+    """A ShredEngine overwrites and unlinks files in-process, on a fixed
+       number of background threads.  It's used by secureDelete when no
+       external ShredCommand is configured.
+
+       To avoid flushing every file separately, each thread handles files
+       in batches from a single directory: it overwrites every file in the
+       batch with zeros, flushes them all to disk, unlinks them, and then
+       flushes the directory once.
+    """
+    ## Fields:
+    # nThreads: the number of worker threads to use.
+    # _cond: a threading.Condition protecting all the fields below.
+    # _batches: list of (job, directory, filenames) tuples for batches
+    #    waiting for a worker thread.
+    # _threads: list of running worker threads.
+    # _pid: the process ID that started the threads in _threads.  (After a
+    #    fork, the child has no threads, and needs to start its own.)
+    # backlog: the number of files submitted, but not yet shredded.
+    # nFiles, nBytes: the number of files and bytes shredded so far.
+    # busyTime: the total number of seconds spent shredding.
+    # _warned: true iff we have warned about the current backlog.
+    def __init__(self, nThreads=SHRED_THREADS):
+        self.nThreads = nThreads
+        self._cond = threading.Condition()
+        self._batches = []
+        self._threads = []
+        self._pid = None
+        self.backlog = 0
+        self.nFiles = self.nBytes = 0
+        self.busyTime = 0.0
+        self._warned = 0
+
+    def shred(self, fnames, blocking=0):
+        """Overwrite and remove all the files in the list 'fnames'.  If
+           'blocking' is true, don't return until they are all gone."""
+        byDir = {}
+        for fn in fnames:
+            byDir.setdefault(os.path.split(fn)[0], []).append(fn)
+        job = _ShredJob()
+        self._cond.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._startThreads()
+            for d, fns in byDir.items():
+                for i in xrange(0, len(fns), _SHRED_BATCH):
+                    self._batches.append((job, d, fns[i:i+_SHRED_BATCH]))
+                    job.remaining += 1
+            self.backlog += len(fnames)
+            if self.backlog > _SHRED_BACKLOG_WARN and not self._warned:
+                LOG.warn("%s files are waiting to be shredded", self.backlog)
+                self._warned = 1
+            self._cond.notifyAll()
+            if blocking:
+                while job.remaining:
+                    self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def wait(self):
+        """Block until every file submitted so far has been shredded."""
+        self._cond.acquire()
+        try:
+            while self.backlog and self._pid == os.getpid():
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def getStats(self):
+        """Return a map with the number of files and bytes shredded so far,
+           the number of files waiting to be shredded, and the average
+           throughput in bytes per second."""
+        self._cond.acquire()
+        try:
+            if self.busyTime:
+                rate = self.nBytes / self.busyTime
+            else:
+                rate = 0.0
+            return { 'files' : self.nFiles, 'bytes' : self.nBytes,
+                     'backlog' : self.backlog, 'bytesPerSecond' : rate }
+        finally:
+            self._cond.release()
+
+    def _startThreads(self):
+        """Helper: start our worker threads.  Caller must hold _cond."""
+        self._pid = os.getpid()
+        self._threads = []
+        for _ in xrange(self.nThreads):
+            t = threading.Thread(target=self._run)
+            t.setDaemon(1)
+            t.start()
+            self._threads.append(t)
+
+    def _run(self):
+        """Main loop for worker threads."""
+        while 1:
+            self._cond.acquire()
+            try:
+                while not self._batches:
+                    self._cond.wait()
+                job, directory, fnames = self._batches.pop(0)
+            finally:
+                self._cond.release()
+
+            start = time.time()
+            nFiles = nBytes = 0
+            try:
+                nFiles, nBytes = self._shredBatch(directory, fnames)
+            except:
+                LOG.error_exc(sys.exc_info(),
+                              "Error while shredding files in %s", directory)
+
+            self._cond.acquire()
+            try:
+                self.busyTime += time.time() - start
+                self.nFiles += nFiles
+                self.nBytes += nBytes
+                self.backlog -= len(fnames)
+                if self.backlog <= _SHRED_BACKLOG_WARN:
+                    self._warned = 0
+                job.remaining -= 1
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def _shredBatch(self, directory, fnames):
+        """Overwrite and unlink every file in 'fnames', all of which are in
+           'directory'.  Return the number of files and bytes removed."""
+        sz = _getBlockSize(directory)
+        nil = _NILSTR[:sz]
+        nBytes = 0
+        fds = []
+        try:
+            for fn in fnames:
+                try:
+                    fd = os.open(fn, os.O_WRONLY | O_BINARY)
+                except OSError:
+                    continue
+                fds.append(fd)
+                blocks = ceilDiv(os.fstat(fd)[stat.ST_SIZE], sz)
+                for _ in xrange(blocks):
+                    os.write(fd, nil)
+                nBytes += blocks*sz
+            if _fdatasync is not None:
+                for fd in fds:
+                    _fdatasync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        nFiles = 0
+        for fn in fnames:
+            nFiles += tryUnlink(fn)
+        # Make the unlinks durable too.
+        if nFiles and hasattr(os, 'fsync'):
+            try:
+                fd = os.open(directory or ".", os.O_RDONLY)
+            except OSError:
+                pass
+            else:
+                try:
+                    try:
+                        os.fsync(fd)
+                    except OSError:
+                        pass
+                finally:
+                    os.close(fd)
+        return nFiles, nBytes
+
+# The ShredEngine used by secureDelete, or None if we haven't made one yet.
+_SHRED_ENGINE = None
+
+def _getShredEngine():
+    """Return the ShredEngine used by secureDelete, creating it if needed."""
+    global _SHRED_ENGINE
+    if _SHRED_ENGINE is None:
+        _SHRED_ENGINE = ShredEngine()
+        # Our threads are daemonic; don't exit with files left unshredded.
+        atexit.register(_SHRED_ENGINE.wait)
+    return _SHRED_ENGINE
+
+def getShredStats():
+    """Return a map of statistics from the internal ShredEngine, as
+       returned by ShredEngine.getStats(), or None if we haven't used it."""
+    if _SHRED_ENGINE is None:
+        return None
+    return _SHRED_ENGINE.getStats()
+
 def secureDelete(fnames, blocking=0):
     """Given a list of filenames, removes the contents of all of those
        files, from the disk, 'securely'.  If blocking=1, does not
@@ -799,11 +1007,14 @@ def secureDelete(fnames, blocking=0):
        against a well-funded adversary with access to your hard drive
        and a bunch of sensitive magnetic equipment.
 
-       XXXX Currently, we use shred from GNU fileutils.  Shred's 'unlink'
-       XXXX operation has the regrettable property that two shred commands
-       XXXX running in the same directory can sometimes get into a race.
-       XXXX The source to shred.c seems to imply that this is harmless, but
-       XXXX let's try to avoid that, to be on the safe side.
+       By default, we use an internal ShredEngine.  If ShredCommand is
+       configured, we use that command instead.
+
+       XXXX Shred's 'unlink' operation (from GNU fileutils) has the
+       XXXX regrettable property that two shred commands running in the
+       XXXX same directory can sometimes get into a race.  The source to
+       XXXX shred.c seems to imply that this is harmless, but let's try to
+       XXXX avoid that, to be on the safe side.
     """
     if _SHRED_CMD == "---":
         configureShredCommand(None)
@@ -815,9 +1026,7 @@ def secureDelete(fnames, blocking=0):
         fnames = [fnames]
 
     if not _SHRED_CMD:
-        for f in fnames:
-            _overwriteFile(f)
-            os.unlink(f)
+        _getShredEngine().shred(fnames, blocking)
         return None
 
     # Some systems are unhappy when you call them with too many options.
@@ -1610,7 +1819,11 @@ def isSMTPMailbox(s):
 # Signal handling
 
 def waitForChildren(onceOnly=0, blocking=1):
-    """Wait until all subprocesses have finished.  Useful for testing."""
+    """Wait until all subprocesses have finished.  Useful for testing.
+       If 'blocking' is true, also wait for the internal ShredEngine to
+       finish shredding files."""
+    if blocking and _SHRED_ENGINE is not None:
+        _SHRED_ENGINE.wait()
     if sys.platform == 'win32':
         LOG.trace("Skipping waitForChildren")
         return
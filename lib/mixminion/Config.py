@@ -358,6 +358,18 @@ def _parseCommand(command):
 
         raise ConfigError("No match found for command %r" % cmd)
 
+def _parseShredCommand(command):
+    """Validation function.  Converts a config value to a shell command
+       as in _parseCommand, or to (None, []) if the value is 'internal'."""
+    if command.strip().lower() == "internal":
+        return None, []
+    return _parseCommand(command)
+
+def _unparseShredCommand((cmd, opts)):
+    """Inverse of _parseShredCommand."""
+    if cmd is None:
+        return "internal"
+    return " ".join([cmd]+opts)
 
 def _parseBase64(s, _hexmode=0):
     """Validation function.  Converts a base-64 encoded config value into
@@ -767,6 +779,7 @@ class _ConfigFile:
         "addressSet_allow": (_parseAddressSet_allow, str),  # XXXX
         "addressSet_deny": (_parseAddressSet_deny, str),  # XXXX
         "command": (_parseCommand, lambda c, o: " ".join([c, " ".join(o)])),
+        "shredCommand": (_parseShredCommand, _unparseShredCommand),
         "base64": (_parseBase64, mixminion.Common.formatBase64),
         "hex": (_parseHex, binascii.b2a_hex),
         "publicKey": (_parsePublicKey, lambda r: "<public key>"),
@@ -1027,7 +1040,7 @@ class ClientConfig(_ConfigFile):
     _syntax = {
         'Host':
             {'__SECTION__': ('ALLOW', None, None),
-             'ShredCommand': ('ALLOW', "command", None),
+             'ShredCommand': ('ALLOW', "shredCommand", None),
              'EntropySource': ('ALLOW', "filename", "/dev/urandom"),
              'TrustedUser': ('ALLOW*', "user", None),
              'FileParanoia': ('ALLOW', "boolean", "yes"),
@@ -1057,6 +1070,8 @@ class ClientConfig(_ConfigFile):
         'Network':
             {'ConnectionTimeout': ('ALLOW', "interval", None),
              'Timeout': ('ALLOW', "interval", None),
+             'MaxConnections': ('ALLOW', "int", "16"),
+             'ConnectionsPerServer': ('ALLOW', "int", "1"),
              }
 
         }
@@ -1092,6 +1107,10 @@ class ClientConfig(_ConfigFile):
             LOG.warn("Very short network timeout")
         elif int(t) > 120:
             LOG.warn("Very long network timeout")
+        if self['Network'].get('MaxConnections', 16) < 1:
+            raise ConfigError("MaxConnections must be at least 1.")
+        if self['Network'].get('ConnectionsPerServer', 1) < 1:
+            raise ConfigError("ConnectionsPerServer must be at least 1.")
 
         # XXXX008 safe to remove; has warned since 007rc2
         security = self.get('Security', {})
@@ -22,13 +22,16 @@ from mixminion.Common import MixError, MixFatalError, floorDiv, ceilDiv, LOG
 
 __all__ = ['AESCounterPRNG', 'CryptoError', 'Keyset', 'bear_decrypt',
            'bear_encrypt', 'ctr_crypt', 'getCommonPRNG', 'init_crypto',
-           'lioness_decrypt', 'lioness_encrypt', 'openssl_seed',
+           'lioness_decrypt', 'lioness_decrypt_file', 'lioness_encrypt',
+           'lioness_encrypt_file', 'openssl_seed',
            'pk_check_signature', 'pk_decode_private_key',
            'pk_decode_public_key', 'pk_decrypt', 'pk_encode_private_key',
            'pk_encode_public_key', 'pk_encrypt', 'pk_fingerprint',
            'pk_from_modulus', 'pk_generate', 'pk_get_modulus',
-           'pk_same_public_key', 'pk_sign', 'prng', 'sha1', 'strxor', 'trng',
-           'unwhiten', 'whiten',
+           'pk_same_public_key', 'pk_sign', 'prng', 'reinit_after_fork',
+           'sha1', 'sha1_new',
+           'sha1_with_suffix', 'strxor', 'trng',
+           'unwhiten', 'unwhiten_file', 'whiten', 'whiten_file',
            'AES_KEY_LEN', 'DIGEST_LEN', 'HEADER_SECRET_MODE', 'PRNG_MODE',
            'RANDOM_JUNK_MODE', 'HEADER_ENCRYPT_MODE', 'APPLICATION_KEY_MODE',
            'PAYLOAD_ENCRYPT_MODE', 'HIDE_HEADER_MODE']
@@ -37,11 +40,16 @@ __all__ = ['AESCounterPRNG', 'CryptoError', 'Keyset', 'bear_decrypt',
 CryptoError = _ml.CryptoError
 # Expose _minionlib.generate_cert
 generate_cert = _ml.generate_cert
+# Expose _minionlib.transform_packet, if this version of _minionlib has it.
+transform_packet = getattr(_ml, 'transform_packet', None)
 
 # Number of bytes in an AES key.
 AES_KEY_LEN = 128 >> 3
 # Number of bytes in a SHA1 digest
 DIGEST_LEN = 160 >> 3
+# Number of bytes that the file-based functions below read at a time.
+# Must be a multiple of the AES block size.
+FILE_BLOCK_LEN = 64*1024
 
 
 def init_crypto(config=None):
@@ -62,6 +70,19 @@ def sha1(s):
     """Return the SHA1 hash of a string"""
     return _ml.sha1(s)
 
+def sha1_new(s=""):
+    """Return a new incremental SHA1 object, with 's' already hashed.  The
+       object has update(s), copy(), and digest() methods."""
+    return _ml.sha1_new(s)
+
+def sha1_with_suffix(h, suffix):
+    """Given an incremental SHA1 object 'h', return the SHA1 hash of
+       everything passed to 'h', followed by 'suffix'.  'h' is not
+       changed."""
+    h = h.copy()
+    h.update(suffix)
+    return h.digest()
+
 
 def strxor(s1, s2):
     """Computes the bitwise xor of two strings.  Raises an exception if the
@@ -126,6 +147,65 @@ def lioness_encrypt(s, (key1, key2, key3, key4)):
     return left + right
 
 
+def lioness_encrypt_file(inFile, outFile, tmpFile,
+                         (key1, key2, key3, key4)):
+    """As lioness_encrypt, but reads the plaintext from the file object
+       'inFile' and writes the ciphertext to the file object 'outFile',
+       without ever holding more than FILE_BLOCK_LEN bytes of either in
+       memory.  'inFile' must support seek(0), and 'outFile' must start out
+       empty and support seek.  'tmpFile' must be a file open for reading
+       and writing; we use it to hold the intermediate right half of the
+       message.  Returns the number of bytes written.
+    """
+    assert len(key1) == len(key3) == DIGEST_LEN
+    assert len(key2) == len(key4) == DIGEST_LEN
+
+    # As in lioness_decrypt_file, we make several passes over 'right': one
+    # to encrypt it with the key derived from key1 (hashing the result with
+    # key2 as we go), and one to encrypt it with the key derived from key3
+    # (hashing the result with key4).  Since the final left half depends on
+    # the final right half, we write the right half first, and go back to
+    # fill in the left half at the end.
+    inFile.seek(0)
+    left = inFile.read(DIGEST_LEN)
+    assert len(left) == DIGEST_LEN
+    key = _ml.aes_key(_ml.sha1("".join((key1, left, key1)))[:AES_KEY_LEN])
+    h = _ml.sha1_new(key2)
+    idx = 0
+    while 1:
+        s = inFile.read(FILE_BLOCK_LEN)
+        if not s:
+            break
+        s = _ml.aes_ctr128_crypt(key, s, idx)
+        idx += len(s)
+        h.update(s)
+        tmpFile.write(s)
+    assert idx > 0
+    h.update(key2)
+    left = _ml.strxor(left, h.digest())
+
+    key = _ml.aes_key(_ml.sha1("".join((key3, left, key3)))[:AES_KEY_LEN])
+    outFile.write("\x00"*DIGEST_LEN)
+    tmpFile.flush()
+    tmpFile.seek(0)
+    h = _ml.sha1_new(key4)
+    idx = 0
+    while 1:
+        s = tmpFile.read(FILE_BLOCK_LEN)
+        if not s:
+            break
+        s = _ml.aes_ctr128_crypt(key, s, idx)
+        idx += len(s)
+        h.update(s)
+        outFile.write(s)
+    h.update(key4)
+    left = _ml.strxor(left, h.digest())
+    outFile.seek(0)
+    outFile.write(left)
+    outFile.seek(0, 2)
+
+    return DIGEST_LEN + idx
+
 def lioness_decrypt(s, (key1, key2, key3, key4)):
     """Given a 16-byte key2 and key4, and a 20-byte key1 and key3, decrypts
        s using the LIONESS super-pseudorandom permutation.
@@ -157,6 +237,68 @@ def lioness_decrypt(s, (key1, key2, key3, key4)):
 
     return left + right
 
+def lioness_decrypt_file(inFile, outFile, tmpFile,
+                         (key1, key2, key3, key4)):
+    """As lioness_decrypt, but reads the ciphertext from the file object
+       'inFile' and writes the plaintext to the file object 'outFile',
+       without ever holding more than FILE_BLOCK_LEN bytes of either in
+       memory.  'inFile' must support seek(0).  'tmpFile' must be a file
+       open for reading and writing; we use it to hold the intermediate
+       right half of the message.  Returns the number of bytes written.
+    """
+    assert len(key1) == len(key3) == DIGEST_LEN
+    assert len(key2) == len(key4) == DIGEST_LEN
+
+    # This is the same computation as lioness_decrypt, but since we can't
+    # keep 'right' in memory, we make three passes over it: one to hash it
+    # with key4, one to decrypt it with the key derived from key3 (hashing
+    # the result with key2 as we go), and one to decrypt it with the key
+    # derived from key1.
+    inFile.seek(0)
+    left = inFile.read(DIGEST_LEN)
+    assert len(left) == DIGEST_LEN
+    h = _ml.sha1_new(key4)
+    length = 0
+    while 1:
+        s = inFile.read(FILE_BLOCK_LEN)
+        if not s:
+            break
+        h.update(s)
+        length += len(s)
+    assert length > 0
+    h.update(key4)
+    left = _ml.strxor(left, h.digest())
+
+    key = _ml.aes_key(_ml.sha1("".join((key3, left, key3)))[:AES_KEY_LEN])
+    inFile.seek(0)
+    inFile.read(DIGEST_LEN)
+    h = _ml.sha1_new(key2)
+    idx = 0
+    while 1:
+        s = inFile.read(FILE_BLOCK_LEN)
+        if not s:
+            break
+        s = _ml.aes_ctr128_crypt(key, s, idx)
+        idx += len(s)
+        h.update(s)
+        tmpFile.write(s)
+    h.update(key2)
+    left = _ml.strxor(left, h.digest())
+
+    key = _ml.aes_key(_ml.sha1("".join((key1, left, key1)))[:AES_KEY_LEN])
+    outFile.write(left)
+    tmpFile.flush()
+    tmpFile.seek(0)
+    idx = 0
+    while 1:
+        s = tmpFile.read(FILE_BLOCK_LEN)
+        if not s:
+            break
+        outFile.write(_ml.aes_ctr128_crypt(key, s, idx))
+        idx += len(s)
+
+    return DIGEST_LEN + length
+
 
 def bear_encrypt(s, (key1, key2)):
     """Given four 20-byte keys, encrypts s using the BEAR
@@ -208,6 +350,20 @@ def unwhiten(s):
     return lioness_decrypt(s, keys)
 
 
+def whiten_file(inFile, outFile, tmpFile):
+    """As whiten, but reads the original string from 'inFile' and writes
+       the whitened string to 'outFile'.  See lioness_encrypt_file."""
+    keys = Keyset("WHITEN").getLionessKeys("WHITEN")
+    return lioness_encrypt_file(inFile, outFile, tmpFile, keys)
+
+
+def unwhiten_file(inFile, outFile, tmpFile):
+    """As unwhiten, but reads the whitened string from 'inFile' and writes
+       the original string to 'outFile'.  See lioness_decrypt_file."""
+    keys = Keyset("WHITEN").getLionessKeys("WHITEN")
+    return lioness_decrypt_file(inFile, outFile, tmpFile, keys)
+
+
 def openssl_seed(count):
     """Seeds the openssl rng with 'count' bytes of real entropy."""
     _ml.openssl_seed(trng(count))
@@ -720,6 +876,16 @@ def getCommonPRNG():
         thisThread.minion_shared_PRNG = AESCounterPRNG()
         return thisThread.minion_shared_PRNG
 
+def reinit_after_fork():
+    """Called in a newly forked child process that will generate random
+       values.  The child starts out with the same read-ahead entropy,
+       common PRNG state, and OpenSSL RNG state as its parent and any
+       siblings; throw all of that away and reseed from the true RNG."""
+    if _theTrueRNG is not None:
+        _theTrueRNG.bytes = ""
+    threading.currentThread().minion_shared_PRNG = AESCounterPRNG()
+    openssl_seed(40)
+
 # ----------------------------------------------------------------------
 # TRNG implementation
 
@@ -15,30 +15,55 @@
 import anydbm
 import binascii
 import cPickle
+import cStringIO
 import dumbdbm
 import errno
 import os
 import stat
+import struct
 import threading
 import time
 import types
 import whichdb
 
 from mixminion.Common import MixError, MixFatalError, secureDelete, LOG, \
-     createPrivateDir, readFile, replaceFile, tryUnlink, writePickled
+     ceilDiv, createPrivateDir, readFile, replaceFile, tryUnlink, writeFile, \
+     writePickled
 from mixminion.Crypto import getCommonPRNG
 
 __all__ = [ "StringStore", "StringMetadataStore",
             "ObjectStore", "ObjectMetadataStore",
             "MixedStore", "MixedMetadataStore",
             "DBBase", "JournaledDBBase", "BooleanJournaledDBBase",
-            "CorruptedFile",
+            "CorruptedFile", "BACKEND_FILES", "BACKEND_SEGMENTS",
+            "configureStoreBackend", "PickleCodec",
             ]
 
 class CorruptedFile(MixError):
     """Raised when a pickled object cannot be properly decoded."""
     pass
 
+class PickleCodec:
+    """A PickleCodec converts the objects held in an object store (and
+       their metadata) to and from strings.  This default implementation
+       uses cPickle; subclasses can provide more compact encodings for
+       the classes they know about, so long as they can still decode
+       whatever earlier versions wrote.
+    """
+    def encode(self, obj):
+        """Return a string encoding of 'obj'."""
+        return cPickle.dumps(obj, 1)
+
+    def decode(self, s):
+        """Return the object encoded in the string 's'.  Raise
+           cPickle.UnpicklingError, EOFError, ValueError, or struct.error
+           if 's' is damaged."""
+        return cPickle.loads(s)
+
+# Exceptions that a codec may raise when asked to decode a damaged string.
+_CODEC_ERRORS = (cPickle.UnpicklingError, EOFError, ValueError,
+                 struct.error)
+
 # ======================================================================
 # Filestores.
 
@@ -46,6 +71,24 @@ class CorruptedFile(MixError):
 # trash.
 INPUT_TIMEOUT = 6000
 
+# Name of the backend that stores every message in a file of its own.
+BACKEND_FILES = "files"
+# Name of the backend that packs messages into preallocated segment files.
+BACKEND_SEGMENTS = "segments"
+
+# Backend to use for filestores that don't specify one.
+_DEFAULT_BACKEND = BACKEND_FILES
+
+def configureStoreBackend(conf):
+    """Set the default backend for new filestores from a given server
+       Config object.  If no object is provided, store one file per
+       message."""
+    global _DEFAULT_BACKEND
+    backend = None
+    if conf is not None:
+        backend = conf['Server'].get('QueueBackend')
+    _DEFAULT_BACKEND = backend or BACKEND_FILES
+
 class BaseStore:
     """A BaseStore is an unordered collection of files with secure insert,
        move, and delete operations.
@@ -75,6 +118,11 @@ class BaseStore:
              inpm_HANDLE
              crpm_HANDLE
 
+       Alternatively, when using the BACKEND_SEGMENTS backend, messages
+       and their metadata are packed into preallocated segment files; see
+       _SegmentSet for details.  Such stores provide the same interface,
+       except that getMessagePath does not work.
+
        Threading notes:  Although BaseStore itself is threadsafe, you'll want
        to synchronize around any multistep operations that you want to
        run atomically.  Use BaseStore.lock() and BaseStore.unlock() for this.
@@ -82,20 +130,40 @@ class BaseStore:
        In the Mixminion server, no queue currently has more than one producer
        or more than one consumer ... so synchronization turns out to be
        fairly easy.
+
+       We keep an in-memory index of the messages in the store, built when
+       the store is opened and updated as messages change state.  The
+       directory itself is only listed when auditing the index.
        """
 
     # Fields:   dir--the location of the file store.
-    #           n_entries: the number of complete messages in the queue.
-    #                 <0 if we haven't counted yet.
+    #           _handles: A list of the handles of all complete messages
+    #                 in the store, in no particular order.
+    #           _handlePos: A map from each handle in _handles to its
+    #                 position in _handles.
+    #           _removed: A list of filenames that we've moved to rmv_ or
+    #                 rmvm_ state, but not yet passed to secure deletion.
+    #           _lastAudit: The last time we listed the directory to check
+    #                 for stale files.
     #           _lock: A lock that must be held while modifying or accessing
     #                 the queue object.  Filesystem operations are allowed
     #                 without holding the lock, but they must not be visible
     #                 to users of the queue.
-    def __init__(self, location, create=0, scrub=0):
+    #           _segments: A _SegmentSet holding our messages, or None if
+    #                 we store one file per message.
+    #           codec: A PickleCodec used by the object and metadata mixins
+    #                 to encode stored objects.
+    codec = PickleCodec()
+
+    def __init__(self, location, create=0, scrub=0, backend=None):
         """Creates a file store object for a given directory, 'location'.  If
            'create' is true, creates the directory if necessary.  If 'scrub'
            is true, removes any incomplete or invalidated messages from the
-           store."""
+           store.  'backend' is one of BACKEND_FILES or BACKEND_SEGMENTS;
+           if it is None, we use the backend set by configureStoreBackend.
+
+           If the directory holds messages written by the other backend,
+           they are moved into this one."""
         secureDelete([]) # Make sure secureDelete is configured. HACK!
 
         self._lock = threading.RLock()
@@ -109,12 +177,25 @@ class BaseStore:
 
         createPrivateDir(location, nocreate=(not create))
 
+        if backend is None:
+            backend = _DEFAULT_BACKEND
+        if backend == BACKEND_SEGMENTS:
+            self._segments = _SegmentSet(location)
+            self._importFiles()
+        elif backend == BACKEND_FILES:
+            self._segments = None
+            if [fn for fn in os.listdir(location) if fn.startswith("seg_")]:
+                self._exportSegments()
+        else:
+            raise MixFatalError("Unknown filestore backend %r" % backend)
+
+        self._removed = []
+        self._lastAudit = 0
+        self._rescan()
+
         if scrub:
             self.cleanQueue()
 
-        # Count messages on first time through.
-        self.n_entries = -1
-
     def lock(self):
         """Prevent access to this filestore from other threads."""
         self._lock.acquire()
@@ -124,18 +205,13 @@ class BaseStore:
         self._lock.release()
 
     def count(self, recount=0):
-        """Returns the number of complete messages in the filestore."""
+        """Returns the number of complete messages in the filestore.  If
+           'recount' is true, rebuild our index of messages first."""
         try:
             self._lock.acquire()
-            if self.n_entries >= 0 and not recount:
-                return self.n_entries
-            else:
-                res = 0
-                for fn in os.listdir(self.dir):
-                    if fn.startswith("msg_"):
-                        res += 1
-                self.n_entries = res
-                return res
+            if recount:
+                self._rescan()
+            return len(self._handles)
         finally:
             self._lock.release()
 
@@ -145,24 +221,89 @@ class BaseStore:
 
            If there are fewer than 'count' messages in the filestore,
            all the messages will be included."""
-        handles = self.getAllMessages() # handles locking
-
-        return getCommonPRNG().shuffle(handles, count)
+        try:
+            self._lock.acquire()
+            hs = self._handles
+            size = len(hs)
+            if count is None or count >= size:
+                return getCommonPRNG().shuffle(hs[:])
+            # Rather than copying the whole index, permute the first 'count'
+            # entries of the index in place, as in Crypto.RNG.shuffle.
+            getInt = getCommonPRNG().getInt
+            pos = self._handlePos
+            for i in xrange(count):
+                swap = i + getInt(size - i)
+                hs[swap], hs[i] = hs[i], hs[swap]
+                pos[hs[swap]] = swap
+                pos[hs[i]] = i
+            return hs[:count]
+        finally:
+            self._lock.release()
 
     def getAllMessages(self):
         """Returns handles for all messages currently in the filestore.
            Note: this ordering is not guaranteed to be random."""
         self._lock.acquire()
-        hs = [fn[4:] for fn in os.listdir(self.dir) if fn.startswith("msg_")]
+        hs = self._handles[:]
         self._lock.release()
         return hs
 
     def messageExists(self, handle):
         """Return true iff this filestore contains a message with the handle
            'handle'."""
-        return os.path.exists(os.path.join(self.dir, "msg_"+handle))
+        return self._handlePos.has_key(handle)
+
+    def _rescan(self):
+        """Helper method: rebuild our index of complete messages from the
+           contents of the directory (or of our segments)."""
+        try:
+            self._lock.acquire()
+            if self._segments is not None:
+                hs = self._segments.index.keys()
+            else:
+                hs = [fn[4:] for fn in os.listdir(self.dir)
+                      if fn.startswith("msg_")]
+            self._handles = hs
+            self._handlePos = pos = {}
+            for i in xrange(len(hs)):
+                pos[hs[i]] = i
+        finally:
+            self._lock.release()
+
+    def _addHandle(self, handle):
+        """Helper method: add 'handle' to our index of complete messages.
+           Caller must hold the lock."""
+        if not self._handlePos.has_key(handle):
+            self._handlePos[handle] = len(self._handles)
+            self._handles.append(handle)
+
+    def _removeHandle(self, handle):
+        """Helper method: remove 'handle' from our index of complete messages.
+           Caller must hold the lock."""
+        try:
+            i = self._handlePos[handle]
+        except KeyError:
+            return
+        del self._handlePos[handle]
+        last = self._handles.pop()
+        if i < len(self._handles):
+            self._handles[i] = last
+            self._handlePos[last] = i
 
     def _doRemove(self, handle, newState):
+        if self._segments is not None:
+            try:
+                self._lock.acquire()
+                try:
+                    self._segments.setState(handle, newState)
+                except KeyError:
+                    LOG.error("Error while trying to change %s to %s: "
+                              "no such message in %s", handle, newState,
+                              self.dir)
+                self._removeHandle(handle)
+            finally:
+                self._lock.release()
+            return
         self._changeState(handle, "msg", newState)
 
     def _preserveCorrupted(self, handle):
@@ -178,12 +319,8 @@ class BaseStore:
         """Removes all messages from this filestore."""
         try:
             self._lock.acquire()
-            for m in os.listdir(self.dir):
-                if m[:4] in ('inp_', 'msg_'):
-                    self._changeState(m[4:], m[:3], "rmv")
-                elif m[:4] in ('inpm_', 'meta_'):
-                    self._changeState(m[5:], m[:4], "rmvm")
-            self.n_entries = 0
+            for h in self._handles[:]:
+                self._doRemove(h, "rmv")
             self.cleanQueue(secureDeleteFn)
         finally:
             self._lock.release()
@@ -191,12 +328,21 @@ class BaseStore:
     def getMessagePath(self, handle):
         """Given a handle for an existing message, return the name of the
            file that contains that message."""
+        if self._segments is not None:
+            raise MixError("Filestore %s does not keep messages in files"
+                           % self.dir)
         # We don't need to lock here: the handle is still valid, or it isn't.
         return os.path.join(self.dir, "msg_"+handle)
 
     def openMessage(self, handle):
         """Given a handle for an existing message, returns a file descriptor
            open to read that message."""
+        if self._segments is not None:
+            try:
+                self._lock.acquire()
+                return cStringIO.StringIO(self._segments.read(handle))
+            finally:
+                self._lock.release()
         # We don't need to lock here; the handle is still valid, or it isn't.
         return open(os.path.join(self.dir, "msg_"+handle), 'rb')
 
@@ -204,6 +350,12 @@ class BaseStore:
         """Returns (file, handle) tuple to create a new message.  Once
            you're done writing, you must call finishMessage to
            commit your changes, or abortMessage to reject them."""
+        if self._segments is not None:
+            try:
+                self._lock.acquire()
+                return cStringIO.StringIO(), self._segments.newHandle()
+            finally:
+                self._lock.release()
         while 1:
             f, handle = getCommonPRNG().openNewFile(self.dir, "inp_", 1,
                                                        "msg_")
@@ -215,6 +367,17 @@ class BaseStore:
            commits the corresponding message."""
         # if '_ismeta' is true, we're finishing not a message, but the
         # metadata for a message
+        if self._segments is not None:
+            assert not _ismeta
+            data = f.getvalue()
+            f.close()
+            try:
+                self._lock.acquire()
+                self._segments.store(handle, data)
+                self._addHandle(handle)
+            finally:
+                self._lock.release()
+            return
         f.close()
         if _ismeta:
             self._changeState(handle, "inpm", "meta")
@@ -227,6 +390,13 @@ class BaseStore:
         # if '_ismeta' is true, we're finishing not a message, but the
         # metadata for a message
         f.close()
+        if self._segments is not None:
+            try:
+                self._lock.acquire()
+                self._segments.release(handle)
+            finally:
+                self._lock.release()
+            return
         if _ismeta:
             self._changeState(handle, "inpm", "rmvm")
         else:
@@ -237,35 +407,72 @@ class BaseStore:
 
            If secureDeleteFn is provided, it is called with a list of
            filenames to be removed.  Otherwise, files are removed using
-           secureDelete.
+           secureDelete.  (Segment-backed stores ignore secureDeleteFn,
+           and overwrite removed messages in place.)
 
            Returns 1 if a clean is already in progress; otherwise
            returns 0.
         """
-        # We don't need to hold the lock here; we synchronize via the
-        # filesystem.
+        if self._segments is not None:
+            try:
+                self._lock.acquire()
+                self._segments.wipeDead()
+            finally:
+                self._lock.release()
+            return 0
+
+        # Every INPUT_TIMEOUT seconds, we list the directory to find files
+        # that our index doesn't know about: timed-out inp_ files, and rmv_
+        # files left over from before a restart.
+        now = int(time.time())
+        try:
+            self._lock.acquire()
+            if self._lastAudit + INPUT_TIMEOUT <= now:
+                self._lastAudit = now
+                rmv = self._audit(now - INPUT_TIMEOUT)
+            else:
+                rmv = self._removed
+            self._removed = []
+        finally:
+            self._lock.release()
 
+        if secureDeleteFn:
+            secureDeleteFn(rmv)
+        else:
+            secureDelete(rmv, blocking=1)
+        return 0
+
+    def _audit(self, allowedTime):
+        """Helper method: list the directory, and return a list of all the
+           files in it that should be deleted.  Any inp_ files not modified
+           since 'allowedTime' are moved to rmv_ state.  Warn and rebuild our
+           index if it does not match the contents of the directory.  Caller
+           must hold the lock."""
         rmv = []
-        allowedTime = int(time.time()) - INPUT_TIMEOUT
+        hs = {}
         for m in os.listdir(self.dir):
             if m.startswith("rmv_") or m.startswith("rmvm_"):
                 rmv.append(os.path.join(self.dir, m))
+            elif m.startswith("msg_"):
+                hs[m[4:]] = 1
             elif m.startswith("inp_"):
                 try:
-                    s = os.stat(m)
+                    s = os.stat(os.path.join(self.dir, m))
                     if s[stat.ST_MTIME] < allowedTime:
                         self._changeState(m[4:], "inp", "rmv")
-                        rmv.append(os.path.join(self.dir, m))
+                        rmv.append(os.path.join(self.dir, "rmv_"+m[4:]))
                 except OSError:
                     pass
-        if secureDeleteFn:
-            secureDeleteFn(rmv)
-        else:
-            secureDelete(rmv, blocking=1)
+        if len(hs) != len(self._handles) or \
+               [h for h in self._handles if not hs.has_key(h)]:
+            LOG.warn("Index of filestore %s was out of date; rescanning.",
+                     self.dir)
+            self._rescan()
+        return rmv
 
     def _changeState(self, handle, s1, s2):
         """Helper method: changes the state of message 'handle' from 's1'
-           to 's2', and changes the internal count."""
+           to 's2', and updates the index."""
         try:
             self._lock.acquire()
             try:
@@ -279,15 +486,61 @@ class BaseStore:
                 self.count(1)
                 return
 
-            if self.n_entries < 0:
-                return
             if s1 == 'msg' and s2 != 'msg':
-                self.n_entries -= 1
+                self._removeHandle(handle)
             elif s1 != 'msg' and s2 == 'msg':
-                self.n_entries += 1
+                self._addHandle(handle)
+            if s2 in ('rmv', 'rmvm'):
+                self._removed.append(os.path.join(self.dir, s2+"_"+handle))
         finally:
             self._lock.release()
 
+    def _importFiles(self):
+        """Helper method: move any messages stored one-per-file in our
+           directory into our segments, and delete their files."""
+        rmv = []
+        n = 0
+        for fn in os.listdir(self.dir):
+            if fn.startswith("msg_"):
+                h = fn[4:]
+                mfn = os.path.join(self.dir, "meta_"+h)
+                meta = None
+                if os.path.exists(mfn):
+                    meta = readFile(mfn, 1)
+                    rmv.append(mfn)
+                self._segments.reserve(h)
+                self._segments.writeMetadata(h, meta)
+                self._segments.store(h, readFile(os.path.join(self.dir,fn),1))
+                rmv.append(os.path.join(self.dir, fn))
+                n += 1
+            elif fn[:4] in ("inp_", "rmv_") or fn[:5] in ("inpm_", "rmvm_"):
+                rmv.append(os.path.join(self.dir, fn))
+        if n:
+            LOG.info("Moved %s messages from files into segments in %s",
+                     n, self.dir)
+        if rmv:
+            secureDelete(rmv, blocking=1)
+
+    def _exportSegments(self):
+        """Helper method: move any messages stored in segment files in our
+           directory into files of their own, and delete the segments."""
+        segs = _SegmentSet(self.dir)
+        handles = segs.index.keys()
+        for h in handles:
+            try:
+                meta = segs.readMetadata(h)
+            except KeyError:
+                meta = None
+            if meta is not None:
+                writeFile(os.path.join(self.dir, "meta_"+h), meta, binary=1)
+            writeFile(os.path.join(self.dir, "msg_"+h), segs.read(h),
+                      binary=1)
+            segs.setState(h, "rmv")
+        LOG.info("Moved %s messages from segments into files in %s",
+                 len(handles), self.dir)
+        segs.wipeDead()
+        segs.destroy()
+
 class StringStoreMixin:
     """Combine the 'StringStoreMixin' class with a BaseStore in order
        to implement a BaseStore that stores strings.
@@ -298,6 +551,8 @@ class StringStoreMixin:
            message."""
         try:
             self._lock.acquire()
+            if self._segments is not None:
+                return self._segments.read(handle)
             return readFile(os.path.join(self.dir, "msg_"+handle), 1)
         finally:
             self._lock.release()
@@ -323,12 +578,12 @@ class ObjectStoreMixin:
            """
         try:
             self._lock.acquire()
-            f = open(os.path.join(self.dir, "msg_"+handle), 'rb')
+            f = self.openMessage(handle)
             try:
-                res = cPickle.load(f)
+                res = self.codec.decode(f.read())
                 f.close()
                 return res
-            except (cPickle.UnpicklingError, EOFError, IOError), e:
+            except _CODEC_ERRORS+(IOError,), e:
                 LOG.error("Found damaged object %s in filestore %s: %s",
                           handle, self.dir, str(e))
                 self._preserveCorrupted(handle)
@@ -337,10 +592,10 @@ class ObjectStoreMixin:
             self._lock.release()
 
     def queueObject(self, object):
-        """Queue an object using cPickle, and return a handle to that
-           object."""
+        """Queue an object using this store's codec, and return a handle
+           to that object."""
         f, handle = self.openNewMessage()
-        cPickle.dump(object, f, 1)
+        f.write(self.codec.encode(object))
         self.finishMessage(f, handle) # handles locking
         return handle
 
@@ -359,16 +614,21 @@ class BaseMetadataStore(BaseStore):
     ##Fields:
     # _metadata_cache: map from handle to cached metadata object.  This is
     #    a write-through cache.
-    def __init__(self, location, create=0, scrub=0):
+    def __init__(self, location, create=0, scrub=0, backend=None):
         """Create a new BaseMetadataStore to store files in 'location'. The
-           'create' and 'scrub' arguments are as for BaseStore(...)."""
-        BaseStore.__init__(self, location=location, create=create, scrub=scrub)
+           'create', 'scrub', and 'backend' arguments are as for
+           BaseStore(...)."""
+        BaseStore.__init__(self, location=location, create=create, scrub=scrub,
+                           backend=backend)
         self._metadata_cache = {}
         if scrub:
             self.cleanMetadata()
 
     def cleanMetadata(self,secureDeleteFn=None):
         """Find all orphaned metadata files and remove them."""
+        if self._segments is not None:
+            # Metadata lives in the same run as its message.
+            return
         hSet = {}
         for h in self.getAllMessages():
             hSet[h] = 1
@@ -407,7 +667,7 @@ class BaseMetadataStore(BaseStore):
         """Return the metadata associated with a given handle.  If the
            metadata is damaged, may raise CorruptedFile."""
         fname = os.path.join(self.dir, "meta_"+handle)
-        if not os.path.exists(fname):
+        if self._segments is None and not os.path.exists(fname):
             raise KeyError(handle)
         try:
             self._lock.acquire()
@@ -415,15 +675,17 @@ class BaseMetadataStore(BaseStore):
                 return self._metadata_cache[handle]
             except KeyError:
                 pass
-            f = open(fname, 'rb')
+            if self._segments is not None:
+                s = self._segments.readMetadata(handle)
+            else:
+                s = readFile(fname, 1)
             try:
-                res = cPickle.load(f)
-            except cPickle.UnpicklingError, e:
+                res = self.codec.decode(s)
+            except _CODEC_ERRORS, e:
                 LOG.error("Found damaged metadata for %s in filestore %s: %s",
                           handle, self.dir, str(e))
                 self._preserveCorrupted(handle)
                 raise CorruptedFile()
-            f.close()
             self._metadata_cache[handle] = res
             return res
         finally:
@@ -436,9 +698,13 @@ class BaseMetadataStore(BaseStore):
         flags = os.O_WRONLY|os.O_CREAT|os.O_TRUNC|O_BINARY
         try:
             self._lock.acquire()
+            if self._segments is not None:
+                self._segments.writeMetadata(handle, self.codec.encode(object))
+                self._metadata_cache[handle] = object
+                return handle
             fname = os.path.join(self.dir, "inpm_"+handle)
             f = os.fdopen(os.open(fname, flags, 0600), "wb")
-            cPickle.dump(object, f, 1)
+            f.write(self.codec.encode(object))
             self.finishMessage(f, handle, _ismeta=1)
             self._metadata_cache[handle] = object
             return handle
@@ -451,7 +717,8 @@ class BaseMetadataStore(BaseStore):
             # Remove the message before the metadata, so we don't have
             # a message without metadata.
             BaseStore._doRemove(self, handle, newState)
-            if os.path.exists(os.path.join(self.dir, "meta_"+handle)):
+            if (self._segments is None and
+                os.path.exists(os.path.join(self.dir, "meta_"+handle))):
                 self._changeState(handle, "meta", newState+"m")
 
             try:
@@ -486,44 +753,454 @@ class ObjectMetadataStoreMixin(ObjectStoreMixin):
         return self.queueObjectAndMetadata(object, None)
     def queueObjectAndMetadata(self, object, metadata):
         f, handle = self.openNewMessage()
-        cPickle.dump(object, f, 1)
+        f.write(self.codec.encode(object))
         self.setMetadata(handle, metadata)
         self.finishMessage(f, handle) # handles locking
         return handle
 
 class StringStore(BaseStore, StringStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, backend=None):
+        BaseStore.__init__(self, location, create, scrub, backend)
         StringStoreMixin.__init__(self)
 
 class StringMetadataStore(BaseMetadataStore, StringMetadataStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseMetadataStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, backend=None):
+        BaseMetadataStore.__init__(self, location, create, scrub, backend)
         StringMetadataStoreMixin.__init__(self)
 
 class ObjectStore(BaseStore, ObjectStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, backend=None):
+        BaseStore.__init__(self, location, create, scrub, backend)
         ObjectStoreMixin.__init__(self)
 
 class ObjectMetadataStore(BaseMetadataStore, ObjectMetadataStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseMetadataStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, backend=None):
+        BaseMetadataStore.__init__(self, location, create, scrub, backend)
         ObjectMetadataStoreMixin.__init__(self)
 
 class MixedStore(BaseStore, StringStoreMixin, ObjectStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, backend=None):
+        BaseStore.__init__(self, location, create, scrub, backend)
         StringStoreMixin.__init__(self)
         ObjectStoreMixin.__init__(self)
 
 class MixedMetadataStore(BaseMetadataStore, StringMetadataStoreMixin,
                          ObjectMetadataStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseMetadataStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, backend=None):
+        BaseMetadataStore.__init__(self, location, create, scrub, backend)
         StringMetadataStoreMixin.__init__(self)
         ObjectMetadataStoreMixin.__init__(self)
 
+# ======================================================================
+# Segment files
+
+# Magic string at the start of every segment file.
+_SEG_MAGIC = "MMSEG001"
+# Format of a segment file's header: magic, slot size, number of slots.
+_SEG_HEADER_FMT = "!8sLL"
+# Number of bytes reserved for the header at the start of each segment file.
+_SEG_HEADER_LEN = 4096
+# Default slot size for new segments: large enough to hold a pickled 32K
+# packet along with its metadata.
+_SLOT_SIZE = 36*1024
+# Default number of slots in a new segment file.
+_SLOTS_PER_SEGMENT = 256
+# Magic string at the start of every run of slots that holds a message.
+_RUN_MAGIC = "SLOT"
+# Format of the header at the start of every run: magic, state, handle,
+# number of slots in the run, length of message, length of metadata.
+_RUN_HEADER_FMT = "!4sc8sLLL"
+_RUN_HEADER_LEN = struct.calcsize(_RUN_HEADER_FMT)
+# Metadata length to use for a message that has no metadata.
+_NO_METADATA = 0xFFFFFFFFL
+# Map from BaseStore state names to the state characters used in runs.  (A
+# run can also be in state 'n': a complete message that replaces the run in
+# state 'm' with the same handle.  See _SegmentSet.writeMetadata.)
+_RUN_STATES = { "inp" : "i", "msg" : "m", "rmv" : "r", "crp" : "c" }
+
+class _Segment:
+    """A single preallocated segment file, divided into fixed-size slots."""
+    ## Fields:
+    # fd -- a file descriptor open for reading and writing the segment.
+    # slotSize -- the size of each slot, in bytes.
+    # used -- a list of booleans, one for each slot, telling whether the
+    #     slot belongs to a run.
+    # nFree -- the number of unused slots.
+    def __init__(self, fd, slotSize, nSlots):
+        self.fd = fd
+        self.slotSize = slotSize
+        self.used = [0]*nSlots
+        self.nFree = nSlots
+
+    def offset(self, slot):
+        """Return the position within the file of a given slot."""
+        return _SEG_HEADER_LEN + slot*self.slotSize
+
+    def markRun(self, slot, nSlots, used):
+        """Mark nSlots slots starting with 'slot' as used or unused."""
+        for i in xrange(slot, slot+nSlots):
+            self.used[i] = used
+        if used:
+            self.nFree -= nSlots
+        else:
+            self.nFree += nSlots
+
+    def findRun(self, nSlots):
+        """Return the index of the first slot of nSlots consecutive unused
+           slots, or None if there is no such run."""
+        if self.nFree < nSlots:
+            return None
+        used = self.used
+        start = 0
+        for i in xrange(len(used)):
+            if used[i]:
+                start = i+1
+            elif i+1-start == nSlots:
+                return start
+        return None
+
+def _readAt(fd, offset, n):
+    """Read and return up to n bytes from fd, starting at 'offset'."""
+    os.lseek(fd, offset, 0)
+    res = []
+    while n > 0:
+        s = os.read(fd, n)
+        if not s:
+            break
+        res.append(s)
+        n -= len(s)
+    return "".join(res)
+
+def _writeAt(fd, offset, s):
+    """Write the string s to fd, starting at 'offset'."""
+    os.lseek(fd, offset, 0)
+    while s:
+        n = os.write(fd, s)
+        s = s[n:]
+
+class _SegmentSet:
+    """Storage for a BaseStore using the BACKEND_SEGMENTS backend.
+
+       Rather than giving each message a file of its own, we store
+       messages in runs of fixed-size slots within preallocated segment
+       files named seg_NNNNNN.  Each run begins with a header giving the
+       message's state and handle, along with the lengths of the message
+       and of its pickled metadata, which is stored just after the
+       message.  An in-memory index maps handles to runs, so that we never
+       list the directory or open a file to find a message.
+
+       Removing a message only rewrites the state in its header.  Later,
+       wipeDead() overwrites every removed run with zeros in place, and
+       makes its slots available for reuse.
+
+       We never rewrite metadata in place, since a crash partway through
+       would garble it.  Instead, we copy the message and its new metadata
+       to a new run, and switch from the old run to the new one by
+       changing one state byte at a time.
+
+       All methods must be called while holding the lock of the owning
+       store.
+       """
+    ## Fields:
+    # dir -- the directory that holds our segment files.
+    # slotSize -- the slot size to use for new segments.
+    # slotsPerSegment -- the number of slots to allocate for new segments.
+    # segments -- map from segment number to _Segment.
+    # index -- map from handle to (segno, slot, nSlots, msgLen, metaLen) for
+    #     every message in 'msg' state.
+    # corrupted -- map from handle to (segno, slot, nSlots) for every
+    #     message we're preserving as corrupted.
+    # dead -- list of (segno, slot, nSlots) for runs that have been removed,
+    #     but not yet overwritten.
+    # reserved -- map from handles we have given out with newHandle, but not
+    #     yet stored, to their pickled metadata (or None).
+    def __init__(self, location, slotSize=_SLOT_SIZE,
+                 slotsPerSegment=_SLOTS_PER_SEGMENT):
+        """Open the segment files in the directory 'location', and
+           build an index of their contents."""
+        self.dir = location
+        self.slotSize = slotSize
+        self.slotsPerSegment = slotsPerSegment
+        self.segments = {}
+        self.index = {}
+        self.corrupted = {}
+        self.dead = []
+        self.reserved = {}
+        replacing = {}
+        for fn in os.listdir(location):
+            if fn.startswith("seg_"):
+                try:
+                    segno = int(fn[4:])
+                except ValueError:
+                    continue
+                self._loadSegment(segno, replacing)
+        # Finish any switch between runs that we were making when we
+        # crashed.
+        for h, old in replacing.items():
+            if old is not None:
+                self._setRunState(old[0], old[1], "r")
+                self._sync(old[0])
+            self._setRunState(self.index[h][0], self.index[h][1], "m")
+
+    def _getFilename(self, segno):
+        """Return the name of the file for a given segment number."""
+        return os.path.join(self.dir, "seg_%06d" % segno)
+
+    def _setRunState(self, segno, slot, state):
+        """Change the state character of the run at 'slot' in segment
+           'segno'."""
+        seg = self.segments[segno]
+        _writeAt(seg.fd, seg.offset(slot)+4, state)
+
+    def _sync(self, segno):
+        """Flush everything we've written to segment 'segno' to disk."""
+        if hasattr(os, 'fsync'):
+            os.fsync(self.segments[segno].fd)
+
+    def _syncDir(self):
+        """Flush our directory to disk, so that new segment files survive
+           a crash."""
+        if not hasattr(os, 'fsync'):
+            return
+        try:
+            fd = os.open(self.dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+        finally:
+            os.close(fd)
+
+    def _loadSegment(self, segno, replacing):
+        """Open an existing segment file, and add its runs to the index.
+           'replacing' is a map from the handle of every run we've found in
+           'n' state to the (segno, slot, nSlots) of the 'm' run it
+           replaces, or None if we haven't found one."""
+        fname = self._getFilename(segno)
+        fd = os.open(fname, os.O_RDWR|getattr(os, 'O_BINARY', 0))
+        hdr = _readAt(fd, 0, struct.calcsize(_SEG_HEADER_FMT))
+        try:
+            magic, slotSize, nSlots = struct.unpack(_SEG_HEADER_FMT, hdr)
+        except struct.error:
+            magic = None
+        if magic != _SEG_MAGIC:
+            os.close(fd)
+            raise MixFatalError("Segment file %s is corrupt" % fname)
+        seg = self.segments[segno] = _Segment(fd, slotSize, nSlots)
+
+        slot = 0
+        while slot < nSlots:
+            hdr = _readAt(fd, seg.offset(slot), _RUN_HEADER_LEN)
+            if hdr[:4] != _RUN_MAGIC:
+                slot += 1
+                continue
+            _, state, h, n, msgLen, metaLen = \
+               struct.unpack(_RUN_HEADER_FMT, hdr)
+            if n < 1 or slot+n > nSlots:
+                LOG.warn("Bad run header in %s; erasing slot %s",
+                         fname, slot)
+                n = 1
+                state = "r"
+            seg.markRun(slot, n, 1)
+            if state == "n":
+                # This run was replacing the 'm' run for the same message.
+                old = self.index.get(h)
+                if old is not None:
+                    old = old[:3]
+                    self.dead.append(old)
+                replacing[h] = old
+                self.index[h] = (segno, slot, n, msgLen, metaLen)
+            elif state == "m" and not self.index.has_key(h):
+                self.index[h] = (segno, slot, n, msgLen, metaLen)
+            elif (state == "m" and replacing.has_key(h) and
+                  replacing[h] is None):
+                # The 'n' run that replaces this one came first.
+                replacing[h] = (segno, slot, n)
+                self.dead.append((segno, slot, n))
+            elif state == "c":
+                self.corrupted[h] = (segno, slot, n)
+            else:
+                # Incomplete, removed, or superseded.
+                self.dead.append((segno, slot, n))
+            slot += n
+
+    def _newSegment(self, nSlots):
+        """Create, preallocate, and return the number of a new segment file
+           with nSlots slots."""
+        if self.segments:
+            segnos = self.segments.keys()
+            segnos.sort()
+            segno = segnos[-1]+1
+        else:
+            segno = 0
+        fd = os.open(self._getFilename(segno),
+                     os.O_RDWR|os.O_CREAT|os.O_EXCL|getattr(os,'O_BINARY',0),
+                     0600)
+        hdr = struct.pack(_SEG_HEADER_FMT, _SEG_MAGIC, self.slotSize, nSlots)
+        _writeAt(fd, 0, hdr+"\0"*(_SEG_HEADER_LEN-len(hdr)))
+        zeros = "\0"*self.slotSize
+        for _ in xrange(nSlots):
+            os.write(fd, zeros)
+        self.segments[segno] = _Segment(fd, self.slotSize, nSlots)
+        self._sync(segno)
+        self._syncDir()
+        return segno
+
+    def _allocate(self, nBytes):
+        """Find or create a run of unused slots large enough to hold nBytes,
+           mark it as used, and return a (segno, slot, nSlots) tuple."""
+        segnos = self.segments.keys()
+        segnos.sort()
+        for segno in segnos:
+            seg = self.segments[segno]
+            n = ceilDiv(nBytes, seg.slotSize)
+            slot = seg.findRun(n)
+            if slot is not None:
+                seg.markRun(slot, n, 1)
+                return segno, slot, n
+        n = ceilDiv(nBytes, self.slotSize)
+        segno = self._newSegment(max(n, self.slotsPerSegment))
+        self.segments[segno].markRun(0, n, 1)
+        return segno, 0, n
+
+    def newHandle(self):
+        """Return a new, unused handle for a message we're about to store."""
+        while 1:
+            h = binascii.b2a_base64(getCommonPRNG().getBytes(6)).strip()
+            h = h.replace("/", "-")
+            if not (self.index.has_key(h) or self.reserved.has_key(h) or
+                    self.corrupted.has_key(h)):
+                self.reserve(h)
+                return h
+
+    def reserve(self, handle):
+        """Mark 'handle' as belonging to a message we're about to store."""
+        self.reserved[handle] = None
+
+    def release(self, handle):
+        """Forget about a handle returned by newHandle, for a message we
+           won't be storing after all."""
+        try:
+            del self.reserved[handle]
+        except KeyError:
+            pass
+
+    def store(self, handle, data, state="m", sync=0):
+        """Store the message 'data' under the handle 'handle', along with
+           any metadata we've been given for it.  Leave the new run in
+           'state'.  If 'sync' is true, flush the run to disk before
+           changing its state."""
+        meta = self.reserved.get(handle)
+        self.release(handle)
+        if meta is None:
+            metaLen = _NO_METADATA
+            meta = ""
+        else:
+            metaLen = len(meta)
+        segno, slot, n = self._allocate(_RUN_HEADER_LEN+len(data)+len(meta))
+        seg = self.segments[segno]
+        off = seg.offset(slot)
+        # Write the run as incomplete, then mark it complete, so that a
+        # crash can't leave a partial message in 'msg' state.
+        _writeAt(seg.fd, off, struct.pack(_RUN_HEADER_FMT, _RUN_MAGIC, "i",
+                                          handle, n, len(data), metaLen)
+                 + data + meta)
+        if sync:
+            self._sync(segno)
+        _writeAt(seg.fd, off+4, state)
+        self.index[handle] = (segno, slot, n, len(data), metaLen)
+
+    def read(self, handle):
+        """Return the contents of the message with a given handle.  Raise
+           IOError if there is no such message."""
+        try:
+            segno, slot, n, msgLen, metaLen = self.index[handle]
+        except KeyError:
+            raise IOError(errno.ENOENT, "No such message", handle)
+        seg = self.segments[segno]
+        return _readAt(seg.fd, seg.offset(slot)+_RUN_HEADER_LEN, msgLen)
+
+    def readMetadata(self, handle):
+        """Return the pickled metadata for the message with a given handle.
+           Raise KeyError if there is no such message, or if it has no
+           metadata."""
+        segno, slot, n, msgLen, metaLen = self.index[handle]
+        if metaLen == _NO_METADATA:
+            raise KeyError(handle)
+        seg = self.segments[segno]
+        return _readAt(seg.fd, seg.offset(slot)+_RUN_HEADER_LEN+msgLen,
+                       metaLen)
+
+    def writeMetadata(self, handle, meta):
+        """Replace the pickled metadata for the message with a given
+           handle."""
+        if self.reserved.has_key(handle):
+            self.reserved[handle] = meta
+            return
+        segno, slot, n = self.index[handle][:3]
+        data = self.read(handle)
+        # Write the new run in full, then mark it as replacing the old one,
+        # then remove the old one.  If we crash before the second step,
+        # the old run stays in effect; if we crash after it, the new one
+        # does.  We flush to disk after each step, so that the disk can't
+        # see a later step without the ones before it.
+        self.reserved[handle] = meta
+        self.store(handle, data, "n", sync=1)
+        newSegno, newSlot = self.index[handle][:2]
+        self._sync(newSegno)
+        self._setRunState(segno, slot, "r")
+        self._sync(segno)
+        self.dead.append((segno, slot, n))
+        self._setRunState(newSegno, newSlot, "m")
+
+    def setState(self, handle, state):
+        """Change the state of the message with a given handle to 'rmv' or
+           'crp'."""
+        segno, slot, n = self.index[handle][:3]
+        del self.index[handle]
+        seg = self.segments[segno]
+        _writeAt(seg.fd, seg.offset(slot)+4, _RUN_STATES[state])
+        if state == "crp":
+            self.corrupted[handle] = (segno, slot, n)
+        else:
+            self.dead.append((segno, slot, n))
+
+    def wipeDead(self):
+        """Overwrite every removed run with zeros, and mark its slots as
+           unused.  Delete any segment files (other than the first) that
+           no longer hold any runs."""
+        if not self.dead:
+            return
+        touched = {}
+        for segno, slot, n in self.dead:
+            seg = self.segments[segno]
+            _writeAt(seg.fd, seg.offset(slot), "\0"*(n*seg.slotSize))
+            seg.markRun(slot, n, 0)
+            touched[segno] = seg
+        self.dead = []
+        if hasattr(os, 'fsync'):
+            for seg in touched.values():
+                os.fsync(seg.fd)
+        segnos = self.segments.keys()
+        segnos.sort()
+        for segno in segnos[1:]:
+            seg = self.segments[segno]
+            if seg.nFree == len(seg.used):
+                os.close(seg.fd)
+                del self.segments[segno]
+                tryUnlink(self._getFilename(segno))
+
+    def destroy(self):
+        """Close and delete all of our segment files.  All runs must already
+           have been wiped."""
+        for segno, seg in self.segments.items():
+            os.close(seg.fd)
+            tryUnlink(self._getFilename(segno))
+        self.segments = {}
+
 # ======================================================================
 # Database wrappers
 
@@ -881,17 +1558,23 @@ class WritethroughDict:
     # db: A Python database object, as returned by openDB.
     # _syncLog: A function to call to flush the database to disk, if possible.
     # cache: A dictionary mapping strings to the objects in this mapping.
-    def __init__(self, filename, purpose):
+    # codec: A PickleCodec used to encode the values in this mapping.
+    def __init__(self, filename, purpose, codec=None):
         """Open a WritethroughDict to store a mapping in the file 'filename'.
-           Use the string 'purpose' in log and messages about this object."""
+           Use the string 'purpose' in log and messages about this object.
+           If 'codec' is provided, use it instead of cPickle to encode
+           values."""
         self.db, self._syncLog = openDB(filename,purpose)
+        if codec is None:
+            codec = PickleCodec()
+        self.codec = codec
         self.cache = {}
         self.load()
 
     def __setitem__(self, k, v):
         assert type(k) == types.StringType
         self.cache[k] = v
-        self.db[k] = cPickle.dumps(v,1)
+        self.db[k] = self.codec.encode(v)
 
     def __getitem__(self, k):
         assert type(k) == types.StringType
@@ -937,7 +1620,7 @@ class WritethroughDict:
         keys = self.db.keys()
         self.cache = cache = {}
         for k in keys:
-            cache[k] = cPickle.loads(self.db[k])
+            cache[k] = self.codec.decode(self.db[k])
 
 class PickleCache:
     """DOCDOC"""
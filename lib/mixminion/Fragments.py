@@ -6,16 +6,20 @@
 
 import binascii
 import math
+import sys
+import threading
 import time
 import mixminion._minionlib
 import mixminion.Filestore
-from mixminion.Crypto import ceilDiv, getCommonPRNG, sha1, whiten, unwhiten
+from mixminion.Crypto import ceilDiv, getCommonPRNG, sha1, sha1_new, whiten, \
+     unwhiten, unwhiten_file
 from mixminion.Common import disp64, LOG, previousMidnight, MixError, \
      MixFatalError
 from mixminion.Packet import ENC_FWD_OVERHEAD, PAYLOAD_LEN, \
      FRAGMENT_PAYLOAD_OVERHEAD
 
-__all__ = [ "FragmentPool", "FragmentationParams" ]
+__all__ = [ "FragmentPool", "FragmentationParams", "configureFEC",
+            "decodeChunks", "encodeChunks" ]
 
 # Largest number of allowed fragments in a single chunk.  Must be a power
 # of two.
@@ -87,7 +91,6 @@ class FragmentationParams:
         if paddingPRNG is None:
             paddingPRNG = getCommonPRNG()
 
-        self.getFEC()
         assert len(s) == self.length
         s = whiten(s)
         s += paddingPRNG.getBytes(self.paddingLen)
@@ -95,18 +98,17 @@ class FragmentationParams:
 
         chunks = []
         for i in xrange(self.nChunks):
-            chunks.append( s[i*self.chunkSize:(i+1)*self.chunkSize] )
+            chunk = s[i*self.chunkSize:(i+1)*self.chunkSize]
+            blocks = []
+            for j in xrange(self.k):
+                blocks.append( chunk[j*self.fragCapacity:
+                                     (j+1)*self.fragCapacity] )
+            chunks.append(blocks)
         del s
 
         fragments = []
-        for i in xrange(self.nChunks):
-            blocks = []
-            for j in xrange(self.k):
-                blocks.append( chunks[i][j*self.fragCapacity:
-                                         (j+1)*self.fragCapacity] )
-            chunks[i] = None
-            for j in xrange(self.n):
-                fragments.append( self.fec.encode(j, blocks) )
+        for fs in encodeChunks(self.k, self.n, chunks):
+            fragments.extend(fs)
         return fragments
 
 # ======================================================================
@@ -224,6 +226,23 @@ class FragmentPool:
         msg = unwhiten(msg[:s.params.length])
         return msg
 
+    def writeReadyMessage(self, msgid, outFile, tmpFile):
+        """As getReadyMessage, but write the message to the file object
+           'outFile' rather than returning it, reading only one chunk from
+           the store at a time.  'tmpFile' must be a file open for reading
+           and writing, for use as scratch space.  Returns the number of
+           bytes written, or None if no complete message is found."""
+        s = self.states.get(msgid)
+        if not s or not s.isDone():
+            return None
+
+        reader = _ChunkReader(self.store, s.getChunkHandles(),
+                              s.params.length)
+        try:
+            return unwhiten_file(reader, outFile, tmpFile)
+        finally:
+            reader.close()
+
     def markMessageCompleted(self, msgid, rejected=0):
         """Release all resources associated with the messageid 'msgid', and
            reject future packets for that messageid.  If 'rejected', the
@@ -601,24 +620,50 @@ class MessageState:
            reconstruct them in a given store."""
         if not self.readyChunks:
             return
-        for chunkno in self.readyChunks.keys():
-            # Get the first K fragments in the chunk. (list of h,fm)
+        # Decode as many chunks at once as we have FEC threads to decode
+        # them, so we keep every thread busy without loading every ready
+        # chunk into memory.
+        ready = self.readyChunks.keys()
+        batchSize = getFECThreads()
+        for i in xrange(0, len(ready), batchSize):
+            self._reconstructChunks(store, ready[i:i+batchSize])
+
+    def _reconstructChunks(self, store, chunkNums):
+        """Helper: reconstruct the chunks whose numbers are in 'chunkNums',
+           all of which must be ready for reconstruction."""
+        # For each chunk, the first K fragments in the chunk. (list of h,fm)
+        chs = []
+        # For each chunk, a list of (position-within-chunk,
+        # fragment-contents).
+        frags = []
+        for chunkno in chunkNums:
             ch = self.fragmentsByChunk[chunkno].values()[:self.params.k]
+            chs.append(ch)
+            frags.append([(self.params.getPosition(fm.idx)[1],
+                           store.messageContents(h)) for h,fm in ch])
+        decoded = decodeChunks(self.params.k, self.params.n, frags)
+        del frags
+
+        for i in xrange(len(chunkNums)):
+            chunkno, ch, blocks = chunkNums[i], chs[i], decoded[i]
+            decoded[i] = None
             minDate = min([fm.insertedDate for h, fm in ch])
-            # Build a list of (position-within-chunk, fragment-contents).
-            frags = [(self.params.getPosition(fm.idx)[1],
-                      store.messageContents(h)) for h,fm in ch]
-            chunkText = "".join(self.params.getFEC().decode(frags))
-            del frags
+            # Queue the chunk, writing it a block at a time rather than
+            # joining the blocks into one big string.
+            f, h2 = store.openNewMessage()
+            digest = sha1_new()
+            for b in blocks:
+                digest.update(b)
+                f.write(b)
+            del blocks
             fm2 = FragmentMetadata(messageid=self.messageid,
                                    idx=chunkno, size=self.params.length,
                                    isChunk=1, chunkNum=chunkno,
                                    overhead=self.overhead,
                                    insertedDate=minDate, nym=self.nym,
-                                   digest=sha1(chunkText))
-            # Queue the chunk.
-            h2 = store.queueMessageAndMetadata(chunkText, fm2)
-            del chunkText
+                                   digest=digest.digest())
+            store.setMetadata(h2, fm2)
+            store.finishMessage(f, h2)
             # Remove superceded fragments.
             for h, fm in ch:
                 store.removeMessage(h)
@@ -635,6 +680,58 @@ class MessageState:
             r.extend([ h for h,_ in self.fragmentsByChunk[chunkno].values()])
         return r
 
+class _ChunkReader:
+    """Helper class: a read-only file-like object whose contents are the
+       reconstructed chunks of a message, in order, truncated to the
+       length of the message.  Only one chunk is open at a time."""
+    ## Fields:
+    # store -- the store holding the chunks.
+    # handles -- an in-order list of the handles for the chunks.
+    # length -- the length of the message.
+    # pos -- the number of bytes we've returned so far.
+    # idx -- the index within 'handles' of the next chunk to open.
+    # f -- a file open to the current chunk, or None.
+    def __init__(self, store, handles, length):
+        self.store = store
+        self.handles = handles
+        self.length = length
+        self.pos = 0
+        self.idx = 0
+        self.f = None
+
+    def read(self, n):
+        """Return up to 'n' bytes from the message."""
+        n = min(n, self.length - self.pos)
+        pieces = []
+        while n > 0:
+            if self.f is None:
+                if self.idx >= len(self.handles):
+                    break
+                self.f = self.store.openMessage(self.handles[self.idx])
+                self.idx += 1
+            s = self.f.read(n)
+            if not s:
+                self.f.close()
+                self.f = None
+                continue
+            pieces.append(s)
+            n -= len(s)
+            self.pos += len(s)
+        return "".join(pieces)
+
+    def seek(self, pos):
+        """Rewind to the start of the message.  Only seek(0) is
+           supported."""
+        assert pos == 0
+        self.close()
+        self.pos = self.idx = 0
+
+    def close(self):
+        """Close the current chunk, if any."""
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
 class FragmentDB(mixminion.Filestore.DBBase):
     """Internal class. Uses a database background (such as dbm, berkely db,
        gdbm, etc.) to remember which message IDs have already been
@@ -670,28 +767,241 @@ class FragmentDB(mixminion.Filestore.DBBase):
         return status, tm
 
 # ======================================================================
-# Internal lazy-generated cache from (k,n) to _minionlib.FEC object.
-# Note that we only use k,n for a limited set of k,n.
-def _blankFECtable():
-    """Return a map from permissible k,n tuples to FEC objects"""
-    f = {}
-    k = 2
-    while k <= MAX_FRAGMENTS_PER_CHUNK:
-        f[(k, int(math.ceil(EXP_FACTOR*k)))] = None
-        k *= 2
-    return f
-
-# global map.
-_fectab = _blankFECtable()
+# FEC support.  Generating the code matrix for a given k,n is expensive, so
+# we keep the most recently used FEC objects in an LRU cache.  Our FEC code
+# releases the GIL while it encodes and decodes, so we can spread the
+# chunks of a message across several threads.
+
+# Default number of FEC objects to keep in the cache.  We normally only use
+# one (k,n) for each power of two up to MAX_FRAGMENTS_PER_CHUNK.
+DEFAULT_FEC_CACHE_SIZE = 8
+
+class _FECCache:
+    """Helper class: an LRU cache mapping (k,n) tuples to
+       _minionlib.FEC objects.  Safe to use from multiple threads."""
+    ## Fields:
+    # maxEntries -- the largest number of FEC objects to hold.
+    # fecs -- map from (k,n) to FEC object.
+    # lastUsed -- map from (k,n) to the value of 'clock' when we last
+    #    returned the corresponding FEC object.
+    # clock -- a counter, incremented on every lookup.
+    # lock -- a threading.Lock protecting the fields above.
+    def __init__(self, maxEntries=DEFAULT_FEC_CACHE_SIZE):
+        self.maxEntries = maxEntries
+        self.fecs = {}
+        self.lastUsed = {}
+        self.clock = 0
+        self.lock = threading.Lock()
+
+    def get(self, k, n):
+        """Return a FEC object for the parameters k and n, generating it
+           if we don't have it already."""
+        key = (k,n)
+        self.lock.acquire()
+        try:
+            self.clock += 1
+            f = self.fecs.get(key)
+            if f is not None:
+                self.lastUsed[key] = self.clock
+                return f
+        finally:
+            self.lock.release()
+
+        # Generate the FEC object without holding the lock.  There's a
+        # possible race condition here where two threads note that a given
+        # set of parameters haven't been generated, and both generate them.
+        # This is harmless.
+        f = mixminion._minionlib.FEC_generate(k,n)
+
+        self.lock.acquire()
+        try:
+            self.fecs[key] = f
+            self.lastUsed[key] = self.clock
+            self._shrink()
+        finally:
+            self.lock.release()
+        return f
+
+    def setMaxEntries(self, maxEntries):
+        """Change the largest number of FEC objects we hold."""
+        self.lock.acquire()
+        try:
+            self.maxEntries = maxEntries
+            self._shrink()
+        finally:
+            self.lock.release()
+
+    def _shrink(self):
+        """Helper: remove least recently used FEC objects until we have
+           no more than maxEntries.  Caller must hold self.lock."""
+        while len(self.fecs) > self.maxEntries:
+            oldest = None
+            for key, when in self.lastUsed.items():
+                if oldest is None or when < self.lastUsed[oldest]:
+                    oldest = key
+            del self.fecs[oldest]
+            del self.lastUsed[oldest]
+
+class _FECBatch:
+    """Helper class: tracks the results of a set of jobs submitted together
+       to a _FECWorkerPool."""
+    ## Fields:
+    # results -- a list of the return values of the jobs, in order.
+    # nLeft -- the number of jobs that haven't finished yet.
+    # exc -- None, or the sys.exc_info() for the first job to fail.
+    # cond -- a threading.Condition protecting the fields above.
+    def __init__(self, n):
+        self.results = [None]*n
+        self.nLeft = n
+        self.exc = None
+        self.cond = threading.Condition()
+
+    def done(self, idx, result, exc=None):
+        """Record the result of the idx'th job, or the exception it
+           raised."""
+        self.cond.acquire()
+        try:
+            self.results[idx] = result
+            if exc is not None and self.exc is None:
+                self.exc = exc
+            self.nLeft -= 1
+            if self.nLeft == 0:
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def wait(self):
+        """Wait for all the jobs to finish, and return their results.  If
+           any of them failed, re-raise the first exception instead."""
+        self.cond.acquire()
+        try:
+            while self.nLeft:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+        if self.exc is not None:
+            raise self.exc[0], self.exc[1], self.exc[2]
+        return self.results
+
+class _FECWorkerPool:
+    """Helper class: a set of threads that run FEC jobs in parallel.  The
+       threads are started when first needed, and run in the background
+       until the process exits."""
+    ## Fields:
+    # nThreads -- the number of threads to use.
+    # threads -- a list of the threading.Thread objects we've started.
+    # cond -- a threading.Condition protecting 'jobs' and 'stopping'.
+    # jobs -- a list of (function, args, _FECBatch, index) tuples waiting
+    #    for a thread.
+    # stopping -- true iff our threads should exit.
+    def __init__(self, nThreads=1):
+        self.nThreads = nThreads
+        self.threads = []
+        self.cond = threading.Condition()
+        self.jobs = []
+        self.stopping = 0
+
+    def map(self, fn, argsList):
+        """Return a list of fn(*args) for every args in argsList, computing
+           them in parallel where possible.  If any call raises an
+           exception, re-raise it."""
+        if self.nThreads <= 1 or len(argsList) <= 1:
+            return [ fn(*args) for args in argsList ]
+
+        batch = _FECBatch(len(argsList))
+        self.cond.acquire()
+        try:
+            if not self.threads:
+                for i in xrange(self.nThreads):
+                    t = threading.Thread(target=self._run,
+                                         name="FEC worker %s" % i)
+                    t.setDaemon(1)
+                    self.threads.append(t)
+                    t.start()
+            for i in xrange(len(argsList)):
+                self.jobs.append((fn, argsList[i], batch, i))
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        return batch.wait()
+
+    def shutdown(self):
+        """Tell our threads to exit once the jobs already submitted to
+           them are done."""
+        self.cond.acquire()
+        try:
+            self.stopping = 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        """Main loop for our threads."""
+        while 1:
+            self.cond.acquire()
+            try:
+                while not self.jobs and not self.stopping:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                fn, args, batch, idx = self.jobs.pop(0)
+            finally:
+                self.cond.release()
+            try:
+                result = fn(*args)
+            except:
+                batch.done(idx, None, sys.exc_info())
+            else:
+                batch.done(idx, result)
+
+# Global cache of FEC objects.
+_fecCache = _FECCache()
+# Global pool of FEC threads.
+_fecPool = _FECWorkerPool()
+
+def configureFEC(nThreads=None, cacheSize=None):
+    """Change the number of threads used to encode and decode chunks, and
+       the number of FEC objects we remember.  Arguments that are None are
+       left unchanged."""
+    global _fecPool
+    if nThreads is not None and nThreads != _fecPool.nThreads:
+        if nThreads < 1:
+            raise MixError("Number of FEC threads must be at least 1")
+        old = _fecPool
+        _fecPool = _FECWorkerPool(nThreads)
+        old.shutdown()
+    if cacheSize is not None:
+        if cacheSize < 1:
+            raise MixError("FEC cache size must be at least 1")
+        _fecCache.setMaxEntries(cacheSize)
+
+def getFECThreads():
+    """Return the number of threads we use to encode and decode chunks."""
+    return _fecPool.nThreads
 
 def _getFEC(k,n):
     """Given k and n parameters, return a FEC object to fragment and
        reconstruct messages given those parameters."""
-    # There's a possible race condition here where two threads note
-    # that a given set of parameters haven't been generated, and both
-    # generate them.  This is harmless.
-    f = _fectab[(k,n)]
-    if f is None:
-        f = _fectab[(k,n)] = mixminion._minionlib.FEC_generate(k,n)
-    return f
-
+    return _fecCache.get(k,n)
+
+def _encodeChunk(fec, n, blocks):
+    """Helper: return all n FEC-encoded fragments for a list of blocks."""
+    return [ fec.encode(i, blocks) for i in xrange(n) ]
+
+def encodeChunks(k, n, chunks):
+    """Given a list of chunks, each of which is a list of k equally long
+       blocks, return a list containing, for each chunk, a list of its n
+       FEC-encoded fragments.  Different chunks are encoded in parallel if
+       configureFEC has given us more than one thread."""
+    fec = _getFEC(k,n)
+    return _fecPool.map(_encodeChunk, [ (fec, n, blocks)
+                                        for blocks in chunks ])
+
+def decodeChunks(k, n, chunks):
+    """Given a list of chunks, each of which is a list of k (index,
+       fragment) tuples, return a list containing, for each chunk, the k
+       blocks that make up its original contents.  Different chunks are
+       decoded in parallel if configureFEC has given us more than one
+       thread."""
+    fec = _getFEC(k,n)
+    return _fecPool.map(fec.decode, [ (frags,) for frags in chunks ])
@@ -12,8 +12,13 @@
    easy-to-verify reference implementation of the protocol.)
    """
 
-__all__ = [ "MMTPClientConnection", "sendPackets", "DeliverableMessage" ]
+__all__ = [ "MMTPClientConnection", "sendPackets", "DeliverableMessage",
+            "TLSSessionCache", "ClientDeliveryEngine" ]
 
+import calendar
+import cPickle
+import os
+import select
 import socket
 import sys
 import time
@@ -21,10 +26,10 @@ import mixminion._minionlib as _ml
 import mixminion.NetUtils
 import mixminion.ServerInfo
 import mixminion.TLSConnection
-from mixminion.Crypto import sha1, getCommonPRNG
+from mixminion.Crypto import sha1, sha1_new, sha1_with_suffix, getCommonPRNG
 from mixminion.Common import MixProtocolError, MixProtocolReject, \
      MixProtocolBadAuth, LOG, MixError, formatBase64, stringContains, \
-     TimeoutError
+     TimeoutError, readPickled, writePickled
 from mixminion.Packet import IPV4Info, MMTPHostInfo
 
 def _noop(*k,**v): pass
@@ -68,6 +73,8 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     #   server we're trying to connect to.
     # certCache: an instance of PeerCertificateCache to use to check the
     #   peer server's certificate
+    # sessionCache: an instance of TLSSessionCache holding TLS sessions we
+    #   may resume with the peer server, or None.
     # packets: a list of DeliverableMessage objects that have not yet been
     #   sent to the TLS connection, in the order they should be sent.
     # pendingPackets: a list of DeliverableMessage objects that have been
@@ -82,13 +89,22 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     # _isFailed: flag: has this connection encountered any errors?
     # _isAlive: flag: if we put another packet on this connection, will the
     #   packet maybe get delivered?
+    # _isIdle: flag: is this connection open, with all of its packets
+    #   acknowledged, waiting for more packets?
+    # keepAlive: flag: should we stay connected once all of our packets
+    #   are acknowledged?  If false, we shut down as soon as we're done.
 
     ####
     # External interface
     ####
     def __init__(self, targetFamily, targetAddr, targetPort, targetKeyID,
-                 serverName=None, context=None, certCache=None):
-        """Initialize a new MMTPClientConnection."""
+                 serverName=None, context=None, certCache=None, keepAlive=0,
+                 sessionCache=None):
+        """Initialize a new MMTPClientConnection.  If 'keepAlive' is true,
+           the connection stays open after its last packet is acknowledged,
+           until startIdleShutdown is called.  If 'sessionCache' is
+           provided, try to resume an earlier TLS session with the same
+           server, and remember the new session once we've connected."""
         assert targetFamily in (mixminion.NetUtils.AF_INET,
                                 mixminion.NetUtils.AF_INET6)
         if context is None:
@@ -121,6 +137,20 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         else:
             self.targetKeyID = None
         self.certCache = certCache
+        self.sessionCache = sessionCache
+        # A resumed session doesn't carry the server's certificate chain,
+        # so we can only check who we're talking to if we have already
+        # verified the server's current link certificate.
+        if (sessionCache is not None and self.targetKeyID is not None and
+            certCache.knows(self.targetKeyID)):
+            session = sessionCache.get(self.targetKeyID)
+            if session is not None:
+                try:
+                    tls.set_session(session)
+                except _ml.TLSError, e:
+                    LOG.debug("Couldn't resume TLS session with %s: %s",
+                              serverName, e)
+                    sessionCache.remove(self.targetKeyID)
 
         self.packets = []
         self.pendingPackets = []
@@ -129,6 +159,8 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         self._isConnected = 0
         self._isFailed = 0
         self._isAlive = 1
+        self._isIdle = 0
+        self.keepAlive = keepAlive
         EventStats.log.attemptedConnect()
         LOG.debug("Opening client connection to %s",self.address)
         self.beginConnecting()
@@ -143,6 +175,17 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         # If we're connected, maybe start sending the packet we just added.
         self._updateRWState()
 
+    def startIdleShutdown(self):
+        """Close this connection if it is idle.  Return true iff we did."""
+        if not self._isIdle:
+            return 0
+        LOG.debug("Closing idle connection to %s", self.address)
+        self._isConnected = 0
+        self._isAlive = 0
+        self._isIdle = 0
+        self.startShutdown()
+        return 1
+
     ####
     # Implementation
     ####
@@ -151,6 +194,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         # There _is_ a next available packet, right?
         assert self.packets and self._isConnected
         pkt = self.packets.pop(0)
+        self._isIdle = 0
 
         if pkt.isJunk():
             control = "JUNK\r\n"
@@ -169,14 +213,17 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             # Renegotiate has been removed from the spec.
             return
 
-        data = "".join([control, m, sha1(m+hashExtra)])
-        assert len(data) == self.MESSAGE_LEN
-        acceptedAck = serverControl + sha1(m+serverHashExtra)
-        rejectedAck = "REJECTED\r\n" + sha1(m+"REJECTED")
+        # Hash the packet once, and finish each digest from a copy.
+        h = sha1_new(m)
+        digest = sha1_with_suffix(h, hashExtra)
+        assert len(control)+len(m)+len(digest) == self.MESSAGE_LEN
+        acceptedAck = serverControl + sha1_with_suffix(h, serverHashExtra)
+        rejectedAck = "REJECTED\r\n" + sha1_with_suffix(h, "REJECTED")
         assert len(acceptedAck) == len(rejectedAck) == self.ACK_LEN
         self.expectedAcks.append( (acceptedAck, rejectedAck) )
         self.pendingPackets.append(pkt)
-        self.beginWriting(data)
+        # Queue the frame in pieces, so we don't copy the packet to join it.
+        self.beginWriting(control, m, digest)
         self.nPacketsSent += 1
 
     def _updateRWState(self):
@@ -192,8 +239,13 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             LOG.trace("Queueing new packet for %s",self.address)
             self._startSendingNextPacket()
 
-        if self.nPacketsAcked == self.nPacketsSent:
+        if self.nPacketsAcked == self.nPacketsSent and not self._isIdle:
             LOG.debug("Successfully relayed all packets to %s",self.address)
+            if self.keepAlive:
+                # Wait for more packets.
+                self._isIdle = 1
+                self.allPacketsSent()
+                return
             self.allPacketsSent()
             self._isConnected = 0
             self._isAlive = 0
@@ -204,6 +256,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         self._isConnected = 0
         self._isFailed = 1
         self._isAlive = 0
+        self._isIdle = 0
         pkts = self.pendingPackets + self.packets
         self.pendingPackets = []
         self.packets = []
@@ -222,6 +275,10 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             self.certCache.check(self.tls, self.targetKeyID, self.address)
         except MixProtocolBadAuth, e:
             LOG.warn("Certificate error: %s. Shutting down connection.", e)
+            if (self.tls.session_reused() and
+                self.sessionCache is not None):
+                # Don't try this session again.
+                self.sessionCache.remove(self.targetKeyID)
             self._failPendingPackets()
             self.startShutdown()
             return
@@ -229,6 +286,11 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             LOG.debug("KeyID is valid from %s", self.address)
 
         EventStats.log.successfulConnect()
+        if self.tls.session_reused():
+            LOG.trace("Resumed TLS session with %s", self.address)
+            EventStats.log.resumedHandshake()
+        else:
+            EventStats.log.fullHandshake()
 
         # The certificate is fine; start protocol negotiation.
         self.beginWriting("MMTP %s\r\n" % ",".join(self.PROTOCOL_VERSIONS))
@@ -272,6 +334,13 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         LOG.debug("MMTP protocol negotiated with %s: version %s",
                   self.address, self.protocol)
 
+        # The server is who we expected: remember the session so that our
+        # next connection can skip the full key exchange.
+        if self.sessionCache is not None and self.targetKeyID is not None:
+            session = self.tls.get_session()
+            if session is not None:
+                self.sessionCache.add(self.targetKeyID, session)
+
         # Now that we're connected, optimize for throughput.
         mixminion.NetUtils.optimizeThroughput(self.sock)
 
@@ -293,6 +362,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             if not self.expectedAcks:
                 LOG.warn("Received acknowledgment from %s with no corresponding message", self.address)
                 self._failPendingPackets()
+                self.clearInbuf()
                 self.startShutdown()
                 return
             ack = self.getInbuf(self.ACK_LEN, clear=1)
@@ -316,6 +386,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
                 # or rejected packet!
                 LOG.warn("Bad acknowledgement received from %s",self.address)
                 self._failPendingPackets()
+                self.clearInbuf()
                 self.startShutdown()
                 return
         # Start sending more packets, if we were waiting for an ACK to do so.
@@ -328,6 +399,10 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         # If we got an error, fail all our packets and don't accept any more.
         if not self._isConnected:
             EventStats.log.failedConnect()
+            # Maybe the session we tried to resume is no good; don't try
+            # it again.
+            if self.sessionCache is not None and self.targetKeyID is not None:
+                self.sessionCache.remove(self.targetKeyID)
         self._isConnected = 0
         self._failPendingPackets()
     def onTimeout(self):
@@ -335,7 +410,10 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     def onClosed(self): pass
     def doneWriting(self): pass
     def receivedShutdown(self):
-        LOG.warn("Received unexpected shutdown from %s", self.address)
+        if self._isIdle:
+            LOG.debug("%s closed our idle connection", self.address)
+        else:
+            LOG.warn("Received unexpected shutdown from %s", self.address)
         self._failPendingPackets()
     def shutdownFinished(self): pass
 
@@ -347,11 +425,19 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         """Return a 3-tuple of address,port,keyid for this connection"""
         return self.targetAddr, self.targetPort, self.targetKeyID
 
+    def getPeer(self):
+        return self.targetAddr
+
     def isActive(self):
         """Return true iff packets sent with this connection may be delivered.
         """
         return self._isAlive
 
+    def isIdle(self):
+        """Return true iff this connection is open and waiting for more
+           packets to send."""
+        return self._isIdle
+
 class DeliverableString(DeliverableMessage):
     """Subclass of DeliverableMessage suitable for use by ClientMain and
        sendPackets.  Sends str(s) for some object s; invokes a callback on
@@ -378,6 +464,211 @@ class DeliverableString(DeliverableMessage):
         self.s = None
         self._failed = 1
 
+class _Destination:
+    """Helper class for ClientDeliveryEngine: tracks the packets we're
+       delivering to a single server."""
+    ## Fields:
+    # routing -- the IPV4Info or MMTPHostInfo for the server.
+    # serverName -- a displayable name for the server.
+    # deliverables -- a list of all the DeliverableString objects we're
+    #    sending to this server.
+    # groups -- a list of lists of DeliverableString: each one will be
+    #    sent over its own connection, once there is room for one.
+    # nActive -- the number of connections we have open to this server.
+    # error -- None, or a string describing the first error we got while
+    #    delivering to this server.
+    # family, addr -- the address family and address to connect to, or
+    #    None if we haven't resolved the server's hostname yet.
+    def __init__(self, routing, deliverables, nConnections):
+        self.routing = routing
+        self.serverName = mixminion.ServerInfo.displayServerByRouting(routing)
+        if isinstance(routing, IPV4Info):
+            self.family, self.addr = socket.AF_INET, routing.ip
+        else:
+            assert isinstance(routing, MMTPHostInfo)
+            self.family = self.addr = None
+        self.deliverables = deliverables
+        self.groups = []
+        for i in xrange(nConnections):
+            self.groups.append([])
+        for i in xrange(len(deliverables)):
+            self.groups[i % nConnections].append(deliverables[i])
+        self.nActive = 0
+        self.error = None
+
+    def fail(self, error):
+        """Note that delivering to this server failed because of 'error'."""
+        if self.error is None:
+            self.error = error
+
+    def getResult(self):
+        """Return a tuple of the number of packets delivered to this server,
+           and None or a string describing why the others weren't."""
+        nGood = 0
+        for d in self.deliverables:
+            if d._succeeded:
+                nGood += 1
+        error = self.error
+        if nGood < len(self.deliverables) and error is None:
+            error = "Error occurred while delivering packets to %s" % (
+                self.serverName)
+        return nGood, error
+
+class ClientDeliveryEngine:
+    """Delivers packets to many servers at once, by running up to
+       'maxConnections' MMTPClientConnections from a single select loop.
+       No more than 'maxPerServer' of those connections go to the same
+       server.  Flushing packets to many servers this way takes about as
+       long as the slowest one, rather than the sum of all of them.
+
+       Use addPackets to say what to send where, and then call run.
+    """
+    ## Fields:
+    # timeout -- number of seconds of inactivity after which we give up on
+    #    a connection.
+    # maxConnections -- the largest number of connections to have open at
+    #    once.
+    # maxPerServer -- the largest number of connections to have open to
+    #    any single server.
+    # destinations -- a list of _Destination, in the order they were added.
+    # active -- a map from fd to (MMTPClientConnection, _Destination) for
+    #    all open connections.
+    def __init__(self, timeout=300, maxConnections=16, maxPerServer=1):
+        assert maxConnections >= 1 and maxPerServer >= 1
+        self.timeout = timeout
+        self.maxConnections = maxConnections
+        self.maxPerServer = maxPerServer
+        self.destinations = []
+        self.active = {}
+
+    def addPackets(self, routing, packetList, callback=None):
+        """Arrange to send a list of packets to a server.
+
+           routing -- an instance of mixminion.Packet.IPV4Info or
+                  mixminion.Packet.MMTPHostInfo.
+           packetList -- a list of 32KB packets and control strings, as for
+                  sendPackets.
+           callback -- None, or a function to call with an index into
+                  packetList after each successful packet delivery.
+
+           If the same server is given more than once, each list is
+           delivered and reported separately.
+        """
+        deliverables = []
+        for idx in xrange(len(packetList)):
+            p = packetList[idx]
+            if p == 'JUNK':
+                pkt = DeliverableString(isJunk=1)
+            elif p == 'RENEGOTIATE':
+                continue #XXXX no longer supported.
+            else:
+                if callback is not None:
+                    def cb(idx=idx,callback=callback): callback(idx)
+                else:
+                    cb = None
+                pkt = DeliverableString(s=p,callback=cb)
+            deliverables.append(pkt)
+        nConnections = max(1, min(self.maxPerServer, len(deliverables)))
+        self.destinations.append(
+            _Destination(routing, deliverables, nConnections))
+
+    def run(self):
+        """Deliver all the packets we've been given.  Return a list of
+           (routing, number of packets delivered, error) tuples, one for
+           each call to addPackets, in the same order.  'error' is None if
+           every packet was delivered; otherwise it is a string describing
+           what went wrong."""
+        # Look up every hostname before we open any connections, so that
+        # a slow lookup can't stall connections that are already open.
+        self._resolveHostnames()
+        while 1:
+            self._startConnections()
+            if not self.active:
+                break
+
+            rfds, wfds, xfds = [], [], []
+            for fd, (con, _) in self.active.items():
+                wr, ww, isopen = con.getStatus()
+                if wr:
+                    rfds.append(fd)
+                if ww:
+                    wfds.append(fd)
+                if ww == 2:
+                    xfds.append(fd)
+
+            rfds,wfds,xfds = select.select(rfds,wfds,xfds,3)
+            now = time.time()
+            for fd, (con, dest) in self.active.items():
+                _,_,isopen,_ = con.process(fd in rfds, fd in wfds, 0)
+                if isopen and con.tryTimeout(now-self.timeout):
+                    isopen = 0
+                if not isopen:
+                    del self.active[fd]
+                    dest.nActive -= 1
+                    if con._isFailed:
+                        dest.fail("Error occurred on connection to %s" %
+                                  dest.serverName)
+
+        result = []
+        for dest in self.destinations:
+            nGood, error = dest.getResult()
+            result.append((dest.routing, nGood, error))
+        return result
+
+    def _resolveHostnames(self):
+        """Helper: find the address of every destination that was given
+           by hostname, looking up each hostname only once.  Fail the
+           packets for any destination we can't resolve."""
+        cache = {}
+        for dest in self.destinations:
+            if dest.family is not None or not dest.groups:
+                continue
+            hostname = dest.routing.hostname
+            if not cache.has_key(hostname):
+                LOG.trace("Looking up %s...",hostname)
+                cache[hostname] = mixminion.NetUtils.getIP(hostname)
+            family, addr, _ = cache[hostname]
+            if family == "NOENT":
+                dest.fail("Couldn't resolve hostname %s: %s" % (
+                    hostname, addr))
+                for group in dest.groups:
+                    for pkt in group:
+                        pkt.failed(1)
+                dest.groups = []
+            else:
+                dest.family, dest.addr = family, addr
+
+    def _startConnections(self):
+        """Helper: open new connections for waiting packets, as long as we
+           have room for them."""
+        for dest in self.destinations:
+            while (dest.groups and dest.nActive < self.maxPerServer and
+                   len(self.active) < self.maxConnections):
+                group = dest.groups.pop(0)
+                con = self._connect(dest)
+                if con is None:
+                    for pkt in group:
+                        pkt.failed(1)
+                    continue
+                for pkt in group:
+                    con.addPacket(pkt)
+                self.active[con.fileno()] = (con, dest)
+                dest.nActive += 1
+            if len(self.active) >= self.maxConnections:
+                break
+
+    def _connect(self, dest):
+        """Helper: open and return a new MMTPClientConnection to 'dest'.  On
+           failure, record the error and return None."""
+        routing = dest.routing
+        try:
+            return MMTPClientConnection(dest.family, dest.addr, routing.port,
+                                        routing.keyinfo,
+                                        serverName=dest.serverName)
+        except socket.error, e:
+            dest.fail(str(e))
+            return None
+
 def sendPackets(routing, packetList, timeout=300, callback=None):
     """Sends a list of packets to a server.  Raise MixProtocolError on
        failure.
@@ -394,76 +685,11 @@ def sendPackets(routing, packetList, timeout=300, callback=None):
        callback -- None, or a function to call with a index into packetList
            after each successful packet delivery.
     """
-    # Find out where we're connecting to.
-    serverName = mixminion.ServerInfo.displayServerByRouting(routing)
-    if isinstance(routing, IPV4Info):
-        family, addr = socket.AF_INET, routing.ip
-    else:
-        assert isinstance(routing, MMTPHostInfo)
-        LOG.trace("Looking up %s...",routing.hostname)
-        family, addr, _ = mixminion.NetUtils.getIP(routing.hostname)
-        if family == "NOENT":
-            raise MixProtocolError("Couldn't resolve hostname %s: %s" % (
-                                   routing.hostname, addr))
-
-    # Create an MMTPClientConnection
-    try:
-        con = MMTPClientConnection(
-            family, addr, routing.port, routing.keyinfo, serverName=serverName)
-    except socket.error, e:
-        raise MixProtocolError(str(e))
-
-    # Queue the items on the list.
-    deliverables = []
-    for idx in xrange(len(packetList)):
-        p = packetList[idx]
-        if p == 'JUNK':
-            pkt = DeliverableString(isJunk=1)
-        elif p == 'RENEGOTIATE':
-            continue #XXXX no longer supported.
-        else:
-            if callback is not None:
-                def cb(idx=idx,callback=callback): callback(idx)
-            else:
-                cb = None
-            pkt = DeliverableString(s=p,callback=cb)
-        deliverables.append(pkt)
-        con.addPacket(pkt)
-
-    # Use select to run the connection until it's done.
-    import select
-    fd = con.fileno()
-    wr,ww,isopen = con.getStatus()
-    while isopen:
-        if wr:
-            rfds = [fd]
-        else:
-            rfds = []
-        if ww:
-            wfds = [fd]
-        else:
-            wfds = []
-        if ww==2:
-            xfds = [fd]
-        else:
-            xfds = []
-
-        rfds,wfds,xfds=select.select(rfds,wfds,xfds,3)
-        now = time.time()
-        wr,ww,isopen,_=con.process(fd in rfds, fd in wfds, 0)
-        if isopen:
-            if con.tryTimeout(now-timeout):
-                isopen = 0
-
-    # If anything wasn't delivered, raise MixProtocolError.
-    for d in deliverables:
-        if d._failed:
-            raise MixProtocolError("Error occurred while delivering packets to %s"%
-                                   serverName)
-
-    # If the connection failed, raise MixProtocolError.
-    if con._isFailed:
-        raise MixProtocolError("Error occurred on connection to %s"%serverName)
+    engine = ClientDeliveryEngine(timeout, maxConnections=1, maxPerServer=1)
+    engine.addPackets(routing, packetList, callback)
+    (_, _, error), = engine.run()
+    if error is not None:
+        raise MixProtocolError(error)
 
 def pingServer(routing, timeout=60):
     """Try to connect to a server and send a junk packet.
@@ -472,13 +698,139 @@ def pingServer(routing, timeout=60):
        isn't up."""
     sendPackets(routing, ["JUNK"], timeout=timeout)
 
+class TLSSessionCache:
+    """A TLSSessionCache remembers the TLS sessions we've negotiated with
+       MMTP servers, so that later connections to the same server can
+       resume them rather than performing a full DH handshake."""
+    ## Fields
+    # sessions: A map from server KeyID to a tuple of (encoded session,
+    #   time at which we stop trying to resume it).
+    # lifetime: How long, in seconds, do we try to resume a session?
+    def __init__(self, lifetime=30*60):
+        self.sessions = {}
+        self.lifetime = lifetime
+
+    def add(self, keyID, session, now=None):
+        """Remember that 'session' was negotiated with the server whose
+           KeyID is 'keyID'."""
+        if now is None:
+            now = time.time()
+        self.sessions[keyID] = (session, now+self.lifetime)
+
+    def get(self, keyID, now=None):
+        """Return the encoded session to resume with the server whose KeyID
+           is 'keyID', or None if we have no current session."""
+        try:
+            session, expires = self.sessions[keyID]
+        except KeyError:
+            return None
+        if now is None:
+            now = time.time()
+        if expires <= now:
+            del self.sessions[keyID]
+            return None
+        return session
+
+    def remove(self, keyID):
+        """Forget any session with the server whose KeyID is 'keyID'."""
+        try:
+            del self.sessions[keyID]
+        except KeyError:
+            pass
+
+    def clean(self, now=None):
+        """Forget all sessions that are too old to resume."""
+        if now is None:
+            now = time.time()
+        for keyID, (_, expires) in self.sessions.items():
+            if expires <= now:
+                del self.sessions[keyID]
+
+def _parseCertTime(s):
+    """Helper: convert a time as returned by get_cert_lifetime (e.g.,
+       'Jan  5 12:00:00 2003 GMT') into seconds since the epoch.  Return
+       None if we can't parse it."""
+    try:
+        return calendar.timegm(time.strptime(s, "%b %d %H:%M:%S %Y GMT"))
+    except (ValueError, OverflowError):
+        return None
+
 class PeerCertificateCache:
     """A PeerCertificateCache validates certificate chains from MMTP servers,
-       and remembers which chains we've already seen and validated."""
+       and remembers which chains we've already seen and validated.  If
+       given a filename, it remembers them across restarts too."""
     ## Fields
-    # cache: A map from peer (temporary) KeyID's to a (signing) KeyID.
-    def __init__(self):
+    # cache: A map from (signing KeyID, peer (temporary) KeyID) to the time
+    #   at which the certificate for the peer key expires.
+    # filename: The file where we store 'cache', or None if we don't store
+    #   it.
+    # _dirty: flag: has 'cache' changed since we last saved it?
+    MAGIC = "PeerCertificateCache-1"
+    def __init__(self, filename=None):
         self.cache = {}
+        self.filename = filename
+        self._dirty = 0
+        if filename is not None:
+            self._load()
+
+    def _load(self):
+        """Helper: read the cache from self.filename, discarding any expired
+           certificates."""
+        if not os.path.exists(self.filename):
+            return
+        try:
+            magic, cache = readPickled(self.filename)
+        except (OSError, IOError, ValueError, TypeError, EOFError,
+                cPickle.UnpicklingError), e:
+            LOG.warn("Couldn't read certificate cache from %s: %s",
+                     self.filename, e)
+            return
+        if magic != self.MAGIC:
+            LOG.warn("Unrecognized certificate cache version in %s",
+                     self.filename)
+            return
+        self.cache = cache
+        self.clean()
+        LOG.debug("Loaded %s cached certificates", len(self.cache))
+
+    def save(self):
+        """Write this cache to disk, if it has changed since we last saved
+           it."""
+        if self.filename is None or not self._dirty:
+            return
+        self.clean()
+        writePickled(self.filename, (self.MAGIC, self.cache))
+        self._dirty = 0
+
+    def clean(self, now=None):
+        """Forget all certificates that have expired."""
+        if now is None:
+            now = time.time()
+        for key, expires in self.cache.items():
+            if expires <= now:
+                del self.cache[key]
+                self._dirty = 1
+
+    def knows(self, targetKeyID, now=None):
+        """Return true iff we have a current certificate signed by the
+           identity key whose hash is 'targetKeyID'."""
+        if now is None:
+            now = time.time()
+        for (hashed_identity, _), expires in self.cache.items():
+            if hashed_identity == targetKeyID and expires > now:
+                return 1
+        return 0
+
+    def _remember(self, hashed_identity, hashed_peer_pk, expires):
+        """Helper: note that the identity key with hash 'hashed_identity'
+           has signed a certificate for the peer key with hash
+           'hashed_peer_pk', valid until 'expires'.  The server has rotated
+           its link key, so forget the certificates for its old keys."""
+        for key in self.cache.keys():
+            if key[0] == hashed_identity:
+                del self.cache[key]
+        self.cache[(hashed_identity, hashed_peer_pk)] = expires
+        self._dirty = 1
 
     def check(self, tls, targetKeyID, serverName):
         """Check whether the certificate chain on the TLS connection 'tls'
@@ -523,18 +875,13 @@ class PeerCertificateCache:
             raise MixProtocolBadAuth(
                "Pre-0.0.4 (non-rotatable) certificate from %s" % serverName)
 
-        try:
-            if targetKeyID == self.cache[hashed_peer_pk]:
-                # We recognize the key, and have already seen it to be
-                # signed by the target identity.
-                LOG.trace("Got a cached certificate from %s", serverName)
-                return # All is well.
-            else:
-                # We recognize the key, but some other identity signed it.
-                raise MixProtocolBadAuth(
-                    "Mismatch between expected and actual key ID")
-        except KeyError:
-            pass
+        now = time.time()
+        expires = self.cache.get((targetKeyID, hashed_peer_pk))
+        if expires is not None and expires > now:
+            # We recognize the key, and have already seen it to be
+            # signed by the target identity.
+            LOG.trace("Got a cached certificate from %s", serverName)
+            return # All is well.
 
         # We haven't found an identity for this pk yet.  Try to check the
         # signature on it.
@@ -542,12 +889,9 @@ class PeerCertificateCache:
             identity = tls.verify_cert_and_get_identity_pk()
         except _ml.TLSError, e:
             raise MixProtocolBadAuth("Invalid KeyID (allegedly) from %s: %s"
-                                   %serverName)
+                                   % (serverName, e))
 
-        # Okay, remember who has signed this certificate.
         hashed_identity = sha1(identity.encode_key(public=1))
-        LOG.trace("Remembering valid certificate for %s", serverName)
-        self.cache[hashed_peer_pk] = hashed_identity
 
         # Note: we don't need to worry about two identities signing the
         # same certificate.  While this *is* possible to do, it's useless:
@@ -558,3 +902,13 @@ class PeerCertificateCache:
         # Was the signer the right person?
         if hashed_identity != targetKeyID:
             raise MixProtocolBadAuth("Invalid KeyID for %s" % serverName)
+
+        # Okay, remember who has signed this certificate, for as long as
+        # the certificate is valid.
+        expires = _parseCertTime(tls.get_cert_lifetime()[1])
+        if expires is None:
+            LOG.warn("Couldn't parse expiry time on certificate from %s",
+                     serverName)
+            return
+        LOG.trace("Remembering valid certificate for %s", serverName)
+        self._remember(hashed_identity, hashed_peer_pk, expires)
@@ -8,7 +8,7 @@
    packets, see BuildMessage.py.  For functions that handle
    server-side processing of packets, see PacketHandler.py."""
 
-__all__ = [ 'compressData', 'CompressedDataTooLong', 'DROP_TYPE',
+__all__ = [ 'compressData', 'compressFile', 'CompressedDataTooLong', 'DROP_TYPE',
             'ENC_FWD_OVERHEAD', 'ENC_SUBHEADER_LEN',
             'encodeMailHeaders', 'encodeMessageHeaders',
             'FRAGMENT_PAYLOAD_OVERHEAD', 'FWD_HOST_TYPE', 'FWD_IPV4_TYPE',
@@ -27,7 +27,7 @@ __all__ = [ 'compressData', 'CompressedDataTooLong', 'DROP_TYPE',
             'parsePayload', 'parseRelayInfoByType', 'parseReplyBlock',
             'parseReplyBlocks', 'parseSMTPInfo', 'parseSubheader',
             'parseTextEncodedMessages', 'parseTextReplyBlocks',
-            'uncompressData'
+            'uncompressData', 'uncompressFile'
             ]
 
 import binascii
@@ -952,6 +952,43 @@ def compressData(payload):
     assert s[1] == '\xda' # no dict, max compression
     return s
 
+# Number of bytes that compressFile reads at a time.
+COMPRESS_BLOCK_LEN = 64*1024
+
+def compressFile(inFile, outFile):
+    """As compressData, but read the data to compress from the file object
+       'inFile' and write the compressed data to the file object 'outFile',
+       so that neither needs to fit in memory.  Returns a tuple of the
+       number of bytes read and the number of bytes written.  The output
+       is exactly the string that compressData would return for the
+       contents of 'inFile'."""
+    if not _ZLIB_LIBRARY_OK:
+        _validateZlib()
+
+    # These options must stay the same as in compressData.
+    zobj = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED,
+                            zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                            zlib.Z_DEFAULT_STRATEGY)
+    inLen = outLen = 0
+    head = ""
+    while 1:
+        s = inFile.read(COMPRESS_BLOCK_LEN)
+        if s:
+            inLen += len(s)
+            d = zobj.compress(s)
+        else:
+            d = zobj.flush()
+        if len(head) < 2:
+            head += d[:2-len(head)]
+        outLen += len(d)
+        outFile.write(d)
+        if not s:
+            break
+
+    # See compressData for why we check these.
+    assert head == '\x78\xda'
+    return inLen, outLen
+
 class CompressedDataTooLong(MixError):
     """Exception: raised when try to uncompress data that turns out to be
        longer than we had expected."""
@@ -1005,6 +1042,54 @@ def uncompressData(payload, maxLength=None):
     except (IOError, ValueError), e:
         raise ParseError("Error in compressed data: %s"%e)
 
+# Number of bytes that uncompressFile reads or writes at a time.
+UNCOMPRESS_BLOCK_LEN = 64*1024
+
+def uncompressFile(inFile, outFile, maxLength=None):
+    """As uncompressData, but read the compressed data from the file object
+       'inFile' and write the expanded data to the file object 'outFile',
+       so that neither needs to fit in memory.  Returns the number of
+       bytes written.  If the expanded data is longer than maxLength, we
+       raise 'CompressedDataTooLong', and 'outFile' holds a prefix of it."""
+    if sys.version_info[:3] < (2,2,0):
+        # Before Python 2.2, we can't bound the size of each piece that
+        # zlib returns, so we can't do any better than uncompressData.
+        d = uncompressData(inFile.read(), maxLength)
+        outFile.write(d)
+        return len(d)
+
+    s = inFile.read(UNCOMPRESS_BLOCK_LEN)
+    if len(s) < 6 or s[0:2] != '\x78\xDA':
+        raise ParseError("Invalid zlib header")
+
+    length = 0
+    try:
+        zobj = zlib.decompressobj(zlib.MAX_WBITS)
+        while s:
+            # Never ask zlib for more than a block at a time, no matter
+            # how much the input expands.
+            while s:
+                d = zobj.decompress(s, UNCOMPRESS_BLOCK_LEN)
+                s = zobj.unconsumed_tail
+                length += len(d)
+                if maxLength is not None and length > maxLength:
+                    raise CompressedDataTooLong()
+                outFile.write(d)
+            s = inFile.read(UNCOMPRESS_BLOCK_LEN)
+
+        d = zobj.flush()
+        length += len(d)
+        if maxLength is not None and length > maxLength:
+            raise CompressedDataTooLong()
+        outFile.write(d)
+        return length
+    except zlib.error:
+        raise ParseError("Error in compressed data")
+    except ValueError, e:
+        # (We don't catch IOError here, as uncompressData does: it would
+        # come from our files, not from zlib.)
+        raise ParseError("Error in compressed data: %s"%e)
+
 def _validateZlib():
     """Internal function:  Make sure that zlib is a recognized version, and
        that it compresses things as expected.  (This check is important,
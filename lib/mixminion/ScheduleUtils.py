@@ -6,6 +6,7 @@
    Simple implementation of a block-until-it's-time-to-do-something scheduler.
    """
 
+import heapq
 import time
 import threading
 
@@ -132,30 +133,72 @@ class RecurringComplexBackgroundEvent(RecurringBackgroundEvent):
             self.lock.release()
 
 class Scheduler:
-    """Base class: used to run a bunch of events periodically."""
+    """Base class: used to run a bunch of events periodically.
+
+       Events are kept in a heap ordered by the time they last reported
+       from getNextTime(), so finding the next event and running the
+       events that are due cost O(log n) per event rather than a scan of
+       every event.  Events may postpone themselves freely (we notice when
+       they reach the front of the heap), but must not move themselves
+       earlier without being rescheduled."""
     ##Fields:
-    # scheduledEvents: a list of ScheduledEvent objects.
-    # schedLock: a threading.RLock object to protect the list scheduledEvents
+    # scheduledEvents: a heap of (time, seqno, ScheduledEvent) tuples,
+    #   where 'time' is the last value we got from the event's getNextTime.
+    # unknownEvents: a list of ScheduledEvent objects whose next time was
+    #   'None' (currently unknown) when we last checked.
+    # nextSeqno: a counter used to break ties between events in
+    #   scheduledEvents.
+    # schedLock: a threading.RLock object to protect the fields above
     #   (but not the events themselves).
     #XXXX008 needs more tests
     def __init__(self):
         """Create a new scheduler."""
         self.scheduledEvents = []
+        self.unknownEvents = []
+        self.nextSeqno = 0
         self.schedLock = threading.RLock()
 
+    def _insertEvent(self, event, when=None):
+        """Helper: add 'event' to the heap or to the list of unknown events,
+           depending on its next time. Drop it if it will never run again.
+           Caller must hold schedLock."""
+        if when is None:
+            when = event.getNextTime()
+        if when == -1:
+            return
+        elif when is None:
+            self.unknownEvents.append(event)
+        else:
+            heapq.heappush(self.scheduledEvents, (when, self.nextSeqno, event))
+            self.nextSeqno += 1
+
+    def _refresh(self):
+        """Helper: recheck all events whose next time was unknown, and make
+           sure that the first event in the heap is really due when the heap
+           says it is.  Caller must hold schedLock."""
+        if self.unknownEvents:
+            unknown = self.unknownEvents
+            self.unknownEvents = []
+            for e in unknown:
+                self._insertEvent(e)
+        heap = self.scheduledEvents
+        while heap:
+            t, _, e = heap[0]
+            when = e.getNextTime()
+            if when == t:
+                return
+            heapq.heappop(heap)
+            self._insertEvent(e, when)
+
     def firstEventTime(self):
-        """Return the time at which an event will first occur."""
+        """Return the time at which an event will first occur, or -1 if no
+           event has a known time."""
         self.schedLock.acquire()
         try:
+            self._refresh()
             if not self.scheduledEvents:
                 return -1
-            first = 0
-            for e in self.scheduledEvents:
-                t = e.getNextTime()
-                if t in (-1,None): continue
-                if not first or t < first:
-                    first = t
-            return first
+            return self.scheduledEvents[0][0]
         finally:
             self.schedLock.release()
 
@@ -166,9 +209,9 @@ class Scheduler:
             return
         self.schedLock.acquire()
         try:
-            self.scheduledEvents.append(event)
+            self._insertEvent(event, when)
         finally:
-            self.schedLock.acquire()
+            self.schedLock.release()
 
     #XXXX008 -- these are only used for testing.
     def scheduleOnce(self, when, name, cb):
@@ -184,14 +227,30 @@ class Scheduler:
         """Run all events that need to get called at the time 'now'."""
         if now is None:
             now = time.time()
+        runnable = []
         self.schedLock.acquire()
         try:
-            events = [(e.getNextTime(),e) for e in self.scheduledEvents]
-            self.scheduledEvents = [e for t,e in events if t != -1]
-            runnable = [(t,e) for t,e in events
-                        if t not in (-1,None) and t <= now]
+            self._refresh()
+            heap = self.scheduledEvents
+            while heap and heap[0][0] <= now:
+                _, _, e = heapq.heappop(heap)
+                when = e.getNextTime()
+                if when not in (-1, None) and when <= now:
+                    runnable.append(e)
+                else:
+                    self._insertEvent(e, when)
         finally:
             self.schedLock.release()
-        runnable.sort()
-        for _,e in runnable:
-            e()
+        # (The events come off the heap in order, so we run them in order.
+        # Each event runs at most once per call, even if it becomes due
+        # again while we're running.)
+        try:
+            for e in runnable:
+                e()
+        finally:
+            self.schedLock.acquire()
+            try:
+                for e in runnable:
+                    self._insertEvent(e)
+            finally:
+                self.schedLock.release()
@@ -5,6 +5,7 @@
 """
 
 #XXXX implement renegotiate
+import array
 import sys
 import time
 
@@ -13,6 +14,87 @@ from mixminion.Common import LOG, stringContains
 
 # Number of bytes to try reading at once.
 _READLEN = 1024
+# Initial size of each connection's input buffer.  This is big enough to hold
+# two full MMTP frames.
+_INBUF_SIZE = 1<<16
+# When the first chunk of the output buffer is shorter than this, we gather
+# it together with the chunks that follow it, so we don't send tiny TLS
+# records.  (This is the largest TLS record size.)
+_GATHER_LEN = 1<<14
+
+try:
+    _newByteArray = bytearray
+except NameError:
+    # Python before 2.6 has no bytearray; an array of chars supports the
+    # same buffer operations.
+    def _newByteArray(n):
+        return array.array('c', "\0"*n)
+
+class _InputBuffer:
+    """Helper class: a preallocated buffer that TLS reads write into
+       directly.  Data is appended at the end and consumed from the front;
+       when we run out of room at the end, we slide the unconsumed data
+       back to the start of the buffer.  (Because we never wrap around,
+       every frame we hand out is contiguous, and can be exposed as a
+       buffer() view without copying.)"""
+    ## Fields:
+    # buf -- a bytearray (or array of chars) holding our data.
+    # start -- index of the first unconsumed byte in buf.
+    # end -- index just past the last byte in buf.
+    def __init__(self, size=_INBUF_SIZE):
+        self.buf = _newByteArray(size)
+        self.start = self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def readFrom(self, tls, maxBytes):
+        """Read up to 'maxBytes' bytes from the TLS socket 'tls' into this
+           buffer.  Return as for tls.read_into()."""
+        if len(self.buf) - self.end < _READLEN:
+            self._makeRoom()
+        n = min(len(self.buf) - self.end, maxBytes)
+        r = tls.read_into(self.buf, self.end, n)
+        if r:
+            self.end += r
+        return r
+
+    def _makeRoom(self):
+        """Helper: make room for at least _READLEN more bytes at the end of
+           the buffer, by sliding our data to the front of the buffer or,
+           if the buffer is mostly full, by growing it."""
+        n = self.end - self.start
+        if n + _READLEN > len(self.buf) // 2:
+            newBuf = _newByteArray(len(self.buf)*2)
+        else:
+            newBuf = self.buf
+        newBuf[0:n] = self.buf[self.start:self.end]
+        self.buf = newBuf
+        self.start = 0
+        self.end = n
+
+    def view(self, offset, length):
+        """Return a read-only buffer() object for 'length' bytes starting
+           'offset' bytes into the unconsumed data.  The view is only valid
+           until the next call to readFrom."""
+        assert offset+length <= self.end-self.start
+        return buffer(self.buf, self.start+offset, length)
+
+    def get(self, length):
+        """Return the first 'length' unconsumed bytes as a string."""
+        return str(self.view(0, length))
+
+    def consume(self, length):
+        """Discard the first 'length' unconsumed bytes."""
+        assert length <= self.end-self.start
+        self.start += length
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def clear(self):
+        """Discard all unconsumed bytes."""
+        self.start = self.end = 0
+
 
 class _Closing(Exception):
     """Helper class: exception raised by state functions that want the
@@ -42,11 +124,13 @@ class TLSConnection:
     #   events on self.sock?  (As a special case, if wantWrite is 2, we're
     #   currently waiting for socket.connect.)
     # lastActivity -- When did this connection last get any activity?
+    # bytesRead, bytesWritten -- the total number of raw bytes we have
+    #   read from and written to self.sock.
     #
-    # inbuf -- a list of strings received from self.tls
-    # inbuflen -- the total length of the strings in self.inbuf
-    # outbuf -- a list of strings to write to self.tls
-    # outbuflen -- the total length of the strings in self.outbuf
+    # inbuf -- an _InputBuffer holding the data received from self.tls
+    # inbuflen -- the number of bytes in self.inbuf
+    # outbuf -- a list of strings and buffer() objects to write to self.tls
+    # outbuflen -- the total length of the chunks in self.outbuf
     #
     # __setup -- have we finished the TLS handshake.
     # __stateFn -- a function that should be invoked when this connection
@@ -70,6 +154,7 @@ class TLSConnection:
         self.address = address
         self.wantRead = self.wantWrite = 0
         self.lastActivity = time.time()
+        self.bytesRead = self.bytesWritten = 0
 
         self.__stateFn = None
         self.__setup = 0
@@ -77,7 +162,7 @@ class TLSConnection:
 
         self.__blockedWriteLen = 0
 
-        self.inbuf = []
+        self.inbuf = _InputBuffer()
         self.inbuflen = 0
         self.outbuf = []
         self.outbuflen = 0
@@ -128,12 +213,16 @@ class TLSConnection:
             self.wantRead = 0
         self.__reading = 0
 
-    def beginWriting(self, data):
-        """Queue 'data' to be written to self.tls.  When any is written,
-           onWrite is invoked."""
+    def beginWriting(self, *data):
+        """Queue one or more strings to be written to self.tls, in order.
+           When any is written, onWrite is invoked.  (Passing several
+           strings instead of joining them saves a copy: short chunks get
+           gathered into TLS records as they are sent.)"""
         self.__stateFn = self.__dataFn
-        self.outbuf.append(data)
-        self.outbuflen += len(data)
+        for d in data:
+            if d:
+                self.outbuf.append(d)
+                self.outbuflen += len(d)
         if not self.__writeBlockedOnRead:
             self.wantWrite = 1
 
@@ -169,6 +258,33 @@ class TLSConnection:
             return 1
         return 0
 
+    def getLastActivity(self):
+        """Return the time when this connection last saw any activity."""
+        return self.lastActivity
+
+    def getBytesTransferred(self):
+        """Return a 2-tuple of the total number of bytes that this
+           connection has read and written on the network."""
+        return self.bytesRead, self.bytesWritten
+
+    def getPeer(self):
+        """Return a key identifying the host on the other side of this
+           connection, for bandwidth accounting."""
+        return self.address
+
+    def getBandwidthWeight(self):
+        """Return this connection's share of the available bandwidth,
+           relative to other connections.  The default is 1."""
+        return 1
+
+    def __countBytes(self):
+        """Helper: update bytesRead and bytesWritten from self.tls, and
+           return the total number of bytes transferred."""
+        if self.tls is not None:
+            self.bytesRead, self.bytesWritten = \
+                            self.tls.get_num_bytes_read_written()
+        return self.bytesRead + self.bytesWritten
+
     def getInbuf(self, maxBytes=None, clear=0):
         """Return up to 'maxBytes' bytes from the front of the input buffer.
            If 'maxBytes' is not provided, return a string containing the
@@ -176,39 +292,19 @@ class TLSConnection:
            the input buffer.
            """
         if maxBytes is None or maxBytes >= self.inbuflen:
-            # We're returning the entire input buffer.
-            if len(self.inbuf) > 1:
-                self.inbuf = [ "".join(self.inbuf) ]
-            elif len(self.inbuf) == 0:
-                return ""
-            r = self.inbuf[0]
-            if clear:
-                del self.inbuf[:]
-                self.inbuflen = 0
-            return r
-        else:
-            # maxBytes < self.inbuflen; There are more bytes than we
-            # asked for.
-            n = 0
-            ln = 0
-            while 1:
-                # Expand until self.inbuf[:n] is ln bytes long, and
-                # ln is long enough to return maxBytes bytes.
-                ln += len(self.inbuf[n])
-                n += 1
-                if ln >= maxBytes:
-                    self.inbuf[:n] = [ "".join(self.inbuf[:n]) ]
-                    assert len(self.inbuf[0]) == ln
-                    r = self.inbuf[0][:maxBytes]
-                    if clear:
-                        if ln > maxBytes:
-                            self.inbuf[0] = self.inbuf[0][maxBytes:]
-                        else:
-                            del self.inbuf[0]
-                        self.inbuflen -= maxBytes
-                    return r
-
-            raise AssertionError # unreached; appease pychecker
+            maxBytes = self.inbuflen
+        r = self.inbuf.get(maxBytes)
+        if clear:
+            self.inbuf.consume(maxBytes)
+            self.inbuflen -= maxBytes
+        return r
+
+    def getInbufView(self, offset, length):
+        """Return a read-only buffer() object for 'length' bytes starting at
+           'offset' in the input buffer, without copying them.  The view is
+           only valid until the connection next reads data, so callers that
+           need to keep the bytes must convert the view with str()."""
+        return self.inbuf.view(offset, length)
 
     def getInbufLine(self, maxBytes=None, terminator="\r\n", clear=0,
                      allowExtra=0):
@@ -234,10 +330,15 @@ class TLSConnection:
 
         return self.getInbuf(idx+len(terminator), clear=clear)
 
-    def clearInbuf(self):
-        """Remove all pending data from the input buffer."""
-        del self.inbuf[:]
-        self.inbuflen = 0
+    def clearInbuf(self, nBytes=None):
+        """Remove the first 'nBytes' bytes (by default, all pending data)
+           from the input buffer."""
+        if nBytes is None or nBytes >= self.inbuflen:
+            self.inbuf.clear()
+            self.inbuflen = 0
+        else:
+            self.inbuf.consume(nBytes)
+            self.inbuflen -= nBytes
 
     def isShutdown(self):
         """Return true iff this TLSConnection has been completely shut down,
@@ -353,11 +454,16 @@ class TLSConnection:
                 # length, or else OpenSSL will give an error.
                 span = self.__blockedWriteLen
             else:
-                # Otherwise, we try to write as much of the first string on
+                # Otherwise, we try to write as much of the first chunk on
                 # the output buffer as our bandwidth cap will allow.
+                if len(self.outbuf[0]) < _GATHER_LEN and len(self.outbuf) > 1:
+                    self.__gatherOutbuf()
                 span = min(len(self.outbuf[0]),cap)
+            chunk = self.outbuf[0]
+            if span < len(chunk):
+                chunk = buffer(chunk, 0, span)
             try:
-                n = self.tls.write(self.outbuf[0][:span])
+                n = self.tls.write(chunk)
             except _ml.TLSWantRead:
                 self.__blockedWriteLen = span
                 self.__writeBlockedOnRead = 1
@@ -376,7 +482,7 @@ class TLSConnection:
                 if n == len(self.outbuf[0]):
                     del self.outbuf[0]
                 else:
-                    self.outbuf[0] = self.outbuf[0][n:]
+                    self.outbuf[0] = buffer(self.outbuf[0], n)
                 self.outbuflen -= n
                 cap -= n
                 self.onWrite(n)
@@ -387,6 +493,23 @@ class TLSConnection:
             self.doneWriting()
         return cap
 
+    def __gatherOutbuf(self):
+        """Helper function: replace the first few chunks of self.outbuf with
+           a single chunk of up to _GATHER_LEN bytes."""
+        pieces = []
+        total = 0
+        while self.outbuf and total < _GATHER_LEN:
+            chunk = self.outbuf[0]
+            want = _GATHER_LEN - total
+            if len(chunk) <= want:
+                del self.outbuf[0]
+            else:
+                self.outbuf[0] = buffer(chunk, want)
+                chunk = buffer(chunk, 0, want)
+            pieces.append(str(chunk))
+            total += len(chunk)
+        self.outbuf.insert(0, "".join(pieces))
+
     def __doRead(self, cap):
         "Helper function: read as much data as we can."
         self.__readBlockedOnWrite = 0
@@ -395,20 +518,23 @@ class TLSConnection:
         #     [2] we get a shutdown.)
         while self.__reading and cap > 0:
             try:
-                s = self.tls.read(min(_READLEN,cap))
-                if s == 0:
+                n = self.inbuf.readFrom(self.tls, cap)
+                if n == 0:
                     # The other side sent us a shutdown; we'll shutdown too.
                     self.receivedShutdown()
                     LOG.trace("read returned 0: shutting down connection to %s"
                               , self.address)
                     self.startShutdown()
                     break
+                elif n is None:
+                    # Nothing read, but no error either; wait for more.
+                    self.wantRead = 1
+                    break
                 else:
-                    # We got some data; add it to the inbuf.
-                    LOG.trace("Read got %s bytes from %s",len(s), self.address)
-                    self.inbuf.append(s)
-                    self.inbuflen += len(s)
-                    cap -= len(s)
+                    # We got some data; it's already on the inbuf.
+                    LOG.trace("Read got %s bytes from %s",n, self.address)
+                    self.inbuflen += n
+                    cap -= n
                     if (not self.tls.pending()) and cap > 0:
                         # Only call onRead when we've got all the pending
                         # data from self.tls, or we've just run out of
@@ -436,7 +562,7 @@ class TLSConnection:
         if not (r or w):
             return self.wantRead, self.wantWrite, (self.sock is not None),0
 
-        bytesAtStart = bytesNow = self.tls.get_num_bytes_raw()
+        bytesAtStart = bytesNow = self.__countBytes()
         if maxBytes is None:
             bytesCutoff = sys.maxint
             maxBytes = sys.maxint-bytesNow
@@ -448,7 +574,7 @@ class TLSConnection:
                 # If __stateFn returns 1, then the state has changed, and
                 # we should try __stateFn again.
                 if self.tls is not None:
-                    bytesNow = self.tls.get_num_bytes_raw()
+                    bytesNow = self.__countBytes()
                     maxBytes = bytesCutoff-bytesNow
         except _ml.TLSWantRead:
             self.wantRead = 1
@@ -463,16 +589,14 @@ class TLSConnection:
             # state functions that want to close the connection should
             # raise '_Closing', so we can count the bytes used before we
             # call 'close'.
-            if self.tls is not None:
-                bytesNow = self.tls.get_num_bytes_raw()
+            bytesNow = self.__countBytes()
             self.__close()
         except _ml.TLSClosed:
             # We get this error if the socket unexpectedly closes underneath
             # the TLS connection.
             self.__close(gotClose=1)
         except _ml.TLSError, e:
-            if self.tls is not None:
-                bytesNow = self.tls.get_num_bytes_raw()
+            bytesNow = self.__countBytes()
             if not (self.__awaitingShutdown or self.__stateFn == self.__shutdownFn):
                 e = str(e)
                 if stringContains(e, 'wrong version number'):
@@ -487,6 +611,10 @@ class TLSConnection:
                 self.onTLSError()
                 self.__close()
 
+        # Count the bytes used by the last call to __stateFn, if it didn't
+        # change our state.
+        bytesNow = self.__countBytes()
+
         return (self.wantRead, self.wantWrite, (self.sock is not None),
                 bytesNow-bytesAtStart)
 
@@ -20,6 +20,8 @@ import threading
 from time import time
 
 import mixminion._minionlib as _ml
+import mixminion.Crypto
+import mixminion.Fragments
 import mixminion.server.ServerQueue
 
 from mixminion.BuildMessage import _buildHeader, buildForwardPacket, \
@@ -315,7 +317,7 @@ def hashlogTiming():
         try:
             _hashlogTiming(fname,load)
         finally:
-            for suffix in ("", ".dat", ".bak", ".dir"):
+            for suffix in ("", "_jrnl"):
                 try:
                     os.unlink(fname+suffix)
                 except OSError:
@@ -363,7 +365,7 @@ def _hashlogTiming(fname, load):
 
     h.close()
     size = 0
-    for suffix in ("", ".dat", ".bak", ".dir"):
+    for suffix in ("", "_jrnl"):
         if not os.path.exists(fname+suffix):
             continue
         size += os.stat(fname+suffix)[stat.ST_SIZE]
@@ -564,6 +566,19 @@ def serverProcessTiming():
     print "Server process (swap, no log)", timeit(
         lambda sp=sp, m_swap=m_swap: sp.processPacket(m_swap), 100)
 
+    if mixminion.Crypto.transform_packet is None:
+        return
+    save = mixminion.Crypto.transform_packet
+    try:
+        # Compare with the step-by-step implementation.
+        mixminion.Crypto.transform_packet = None
+        print "Server process (no swap, no log, no transform_packet)", timeit(
+            lambda sp=sp, m_noswap=m_noswap: sp.processPacket(m_noswap), 100)
+        print "Server process (swap, no log, no transform_packet)", timeit(
+            lambda sp=sp, m_swap=m_swap: sp.processPacket(m_swap), 100)
+    finally:
+        mixminion.Crypto.transform_packet = save
+
 def encodingTiming():
     print "#=============== END-TO-END ENCODING =================="
     shortP = "hello world"
@@ -729,6 +744,49 @@ def fileOpsTiming():
     t = time()-t1
     print "          (sync)", timestr(t/100)
 
+#----------------------------------------------------------------------
+def _timeThreaded(fn, iters, nThreads):
+    """Return the wall-clock time for nThreads threads to each call fn()
+       iters times."""
+    iters *= PRECISION_FACTOR
+    if iters < 1: iters = 1
+    def run(fn=fn, iters=iters):
+        for _ in xrange(iters): fn()
+    threads = [ threading.Thread(target=run) for _ in xrange(nThreads) ]
+    t = time()
+    for th in threads: th.start()
+    for th in threads: th.join()
+    return time()-t
+
+def threadScalingTiming():
+    print "#================= THREAD SCALING ======================"
+    # All of these release the GIL for their bulk work, so with N CPUs, N
+    # threads should get close to N times the throughput of one.
+
+    pk = pk_generate(2048)
+    enc = pk_encrypt(s70b, pk)
+    key = _ml.aes_key("X"*16)
+    lkeys = Keyset("X"*16).getLionessKeys(PAYLOAD_ENCRYPT_MODE)
+    fec = _ml.FEC_generate(20,25)
+    blocks = [ s28K ] * 20
+    tests = [ ("sha1 (28K)", lambda: _ml.sha1(s28K), 1000),
+              ("aes_ctr128_crypt (32K)",
+               lambda key=key: _ml.aes_ctr128_crypt(key, s32K, 0), 1000),
+              ("lioness_decrypt (28K)",
+               lambda lkeys=lkeys: lioness_decrypt(s28K, lkeys), 300),
+              ("pk_decrypt (2048 bits)",
+               lambda pk=pk, enc=enc: pk_decrypt(enc, pk), 50),
+              ("FEC encode (20/25)",
+               lambda fec=fec, blocks=blocks: fec.encode(21, blocks), 100) ]
+
+    for name, fn, iters in tests:
+        print name
+        base = _timeThreaded(fn, iters, 1)
+        for n in 1, 2, 4, 8:
+            t = _timeThreaded(fn, iters, n)
+            print "   %s thread(s): %s each; speedup %.2fx" % (
+                n, timestr(t/(iters*n*max(PRECISION_FACTOR,1))), base*n/t)
+
 #----------------------------------------------------------------------
 def fecTiming():
     print "#================= FEC =========================="
@@ -753,6 +811,29 @@ def fecTiming():
         tm = timeit_(lambda f=fec, m=missing_max: f.decode(m), it)
         print "            Decode (k-n missing):", timestr(tm)
         print "          (time/(k*28KB*(n-k))) =", timestr(tm/(k*28*(n-k))), "/ KB"
+
+    # Now time the batch interface on whole messages, as a server would
+    # use it to reassemble them.
+    for size in 100*1024, 1024*1024, 10*1024*1024:
+        params = mixminion.Fragments.FragmentationParams(size, 0)
+        k, n = params.k, params.n
+        blocks = [ r.getBytes(params.fragCapacity) for _ in xrange(k) ]
+        chunks = [ blocks ] * params.nChunks
+        frags = mixminion.Fragments.encodeChunks(k, n, chunks[:1])[0]
+        received = [ zip(range(n-k,n), frags[n-k:]) ] * params.nChunks
+        mb = params.paddedLen / (1024*1024.0)
+        print "FEC on a %sKB message (%s chunks of %s/%s)" % (
+            size//1024, params.nChunks, k, n)
+        for nThreads in 1, 2, 4:
+            mixminion.Fragments.configureFEC(nThreads=nThreads)
+            it = max(1, 20//params.nChunks)
+            tm = timeit_(lambda k=k, n=n, c=chunks:
+                         mixminion.Fragments.encodeChunks(k, n, c), it)
+            tm2 = timeit_(lambda k=k, n=n, c=received:
+                          mixminion.Fragments.decodeChunks(k, n, c), it)
+            print "   %s thread(s): encode %.2f MB/s; decode %.2f MB/s" % (
+                nThreads, mb/tm, mb/tm2)
+    mixminion.Fragments.configureFEC(nThreads=1)
 #----------------------------------------------------------------------
 def testLeaks1():
     print "Trying to leak (sha1,aes,xor,seed,oaep)"
@@ -1012,6 +1093,10 @@ def timeAll(name, args):
         timeEfficiency()
         return
 
+    if args == ['threads']:
+        threadScalingTiming()
+        return
+
     fecTiming()
     cryptoTiming()
     rsaTiming()
@@ -1021,6 +1106,7 @@ def timeAll(name, args):
     encodingTiming()
     serverQueueTiming()
     serverProcessTiming()
+    threadScalingTiming()
     hashlogTiming()
     timeEfficiency()
     #import profile
@@ -34,6 +34,14 @@ MAX_THREAD_IDLE = 5*60
 MAX_ENTRY_TTL = 30*60
 # ...and entries from the reverse cache after MAX_RENTRY_TTL seconds.
 MAX_RENTRY_TTL = 24*60*60
+# We re-resolve an answer in the background once it's more than
+# REFRESH_INTERVAL seconds old.  Until the new answer arrives, we keep
+# serving the old one.  (getaddrinfo doesn't tell us the real TTL.)
+REFRESH_INTERVAL = 10*60
+# When a name fails to resolve, we don't try it again for MIN_RETRY_DELAY
+# seconds.  Each further failure doubles the delay, up to MAX_RETRY_DELAY.
+MIN_RETRY_DELAY = 60
+MAX_RETRY_DELAY = 30*60
 
 class DNSCache:
     """Class to cache answers to DNS requests and manager DNS threads."""
@@ -44,6 +52,14 @@ class DNSCache:
     # rCache: map from (family,lowercase IP) to (hostname, time).
     # callbacks: map from name to list of callback functions. (See lookup
     #     for definition of callback.)
+    # prefetchNames: map from name to 1 for every name that we keep
+    #     resolved and fresh, whether anybody asks for it or not.
+    # refreshing: map from name to 1 for every name that has a cached
+    #     answer, and a lookup in progress to replace it.
+    # failures: map from name to a tuple of (number of consecutive failed
+    #     lookups, time before which we shouldn't look it up again).
+    # started: map from name to the time when we queued its current lookup.
+    # stats: map from statistic name to value.  See getStatistics.
     # lock: Lock to control access to this class's shared state.
     # nBusyThreads: Number of threads that are currently handling requests.
     # nLiveThreads: Number of threads that are currently running.
@@ -52,10 +68,16 @@ class DNSCache:
     # threads: List of DNSThreads, some of which may be dead.
     def __init__(self):
         """Create a new DNSCache"""
+        self.lock = threading.RLock()
         self.cache = {}
         self.rCache = {}
         self.callbacks = {}
-        self.lock = threading.RLock()
+        self.prefetchNames = {}
+        self.refreshing = {}
+        self.failures = {}
+        self.started = {}
+        self.stats = {}
+        self.resetStatistics()
         self.queue = TimeoutQueue()
         self.threads = []
         self.nLiveThreads = 0
@@ -99,6 +121,9 @@ class DNSCache:
            same form as the return value of NetUtils.getIP: either
            (Family, Address, Time) or ('NOENT', Reason, Time).
 
+           If we have an answer that's due to be refreshed, we pass it to
+           'cb' immediately, and refresh it in the background.
+
            Note: The callback may be invoked from a different thread.  Either
            this thread or a DNS thread will block until the callback finishes,
            so it shouldn't be especially time-consuming.
@@ -111,14 +136,25 @@ class DNSCache:
 
         try:
             self.lock.acquire()
+            now = time.time()
             v = self.cache.get(name)
-            # If we don't have a cached answer, add cb to self.callbacks
+            if (v is not None and v is not PENDING and v[0] == 'NOENT'
+                and self._mayRetry(name, now)):
+                # We had a failure, but it's time to try again.
+                v = None
             if v is None or v is PENDING:
+                # If we don't have a cached answer, add cb to self.callbacks
+                self.stats['misses'] += 1
                 self.callbacks.setdefault(name, []).append(cb)
-            # If we aren't looking up the answer, start looking it up.
-            if v is None:
-                LOG.trace("DNS cache starting lookup of %r", name)
-                self._beginLookup(name)
+                # If we aren't looking up the answer, start looking it up.
+                if v is None and not self.refreshing.has_key(name):
+                    LOG.trace("DNS cache starting lookup of %r", name)
+                    self._beginLookup(name)
+            else:
+                self.stats['hits'] += 1
+                if (v[0] != 'NOENT' and now-v[2] > REFRESH_INTERVAL):
+                    self.stats['staleHits'] += 1
+                    self._maybeRefresh(name, now)
         finally:
             self.lock.release()
         # If we _did_ have an answer, invoke the callback now.
@@ -134,7 +170,8 @@ class DNSCache:
             self.lock.acquire()
             self._isShutdown = 1
             self.queue.clear()
-            for _ in xrange(self.nLiveThreads*2):
+            # Some threads may not have started running yet.
+            for _ in xrange(max(self.nLiveThreads, len(self.threads))*2):
                 self.queue.put(None)
         finally:
             self.lock.release()
@@ -143,20 +180,71 @@ class DNSCache:
             for thr in self.threads:
                 thr.join()
 
+    def prefetch(self, names, now=None):
+        """Keep the names in the list 'names' resolved from now on: look
+           up any we don't know yet, and refresh them in the background
+           as they get old.  Replaces any earlier list of names."""
+        if now is None:
+            now = time.time()
+        try:
+            self.lock.acquire()
+            self.prefetchNames = {}
+            for name in names:
+                if mixminion.NetUtils.nameIsStaticIP(name) is not None:
+                    continue
+                self.prefetchNames[name] = 1
+                v = self.cache.get(name)
+                if v is None:
+                    self._beginLookup(name)
+                elif v is not PENDING:
+                    self._maybeRefresh(name, now)
+        finally:
+            self.lock.release()
+
+    def getStatistics(self):
+        """Return a dict describing how well this cache is working since
+           the last call to resetStatistics.  Its keys are: 'hits' (lookups
+           answered from the cache), 'staleHits' (hits that needed
+           refreshing), 'misses' (lookups that had to wait for a resolve),
+           'resolves' (completed resolves), 'failures' (resolves that
+           failed), 'totalLatency' and 'maxLatency' (seconds between queueing
+           a resolve and getting its answer)."""
+        try:
+            self.lock.acquire()
+            return self.stats.copy()
+        finally:
+            self.lock.release()
+
+    def resetStatistics(self):
+        """Set all of the statistics returned by getStatistics to zero."""
+        try:
+            self.lock.acquire()
+            self.stats = { 'hits' : 0, 'staleHits' : 0, 'misses' : 0,
+                           'resolves' : 0, 'failures' : 0,
+                           'totalLatency' : 0.0, 'maxLatency' : 0.0 }
+        finally:
+            self.lock.release()
+
     def cleanCache(self,now=None):
-        """Remove all expired entries from the cache."""
+        """Remove all expired entries from the cache, and begin refreshing
+           any prefetched names that are getting old."""
         if now is None:
             now = time.time()
         try:
             self.lock.acquire()
 
-            # Purge old entries from the caches.
+            # Purge old entries from the caches, and refresh the ones we
+            # want to keep.
             cache = self.cache
             for name in cache.keys():
                 v = cache[name]
                 if v is PENDING: continue
-                if now-v[2] > MAX_ENTRY_TTL:
+                if self.prefetchNames.has_key(name):
+                    self._maybeRefresh(name, now)
+                elif now-v[2] > MAX_ENTRY_TTL:
                     del cache[name]
+                    if self.failures.has_key(name):
+                        del self.failures[name]
             rCache = self.rCache
             for name in rCache.keys():
                 v=rCache[name]
@@ -168,24 +256,57 @@ class DNSCache:
             self.threads = liveThreads
 
             # Make sure we have enough threads.
-            if len(self.threads) < MIN_THREADS:
-                for _ in xrange(len(self.threads)-MIN_THREADS):
+            if len(self.threads) < MIN_THREADS and not self._isShutdown:
+                for _ in xrange(MIN_THREADS-len(self.threads)):
                     self.threads.append(DNSThread(self))
                     self.threads[-1].start()
         finally:
             self.lock.release()
 
+    def _mayRetry(self, name, now):
+        """Helper function: return true iff we're not backing off from
+           failed lookups of 'name'.
+
+           Caller must hold self.lock
+        """
+        f = self.failures.get(name)
+        return f is None or f[1] <= now
+
+    def _maybeRefresh(self, name, now):
+        """Helper function: if the cached answer for 'name' is old enough,
+           and we're not already refreshing it, begin looking it up again,
+           and keep the current answer until the new one arrives.
+
+           Caller must hold self.lock
+        """
+        v = self.cache[name]
+        if self.refreshing.has_key(name) or not self._mayRetry(name, now):
+            return
+        if v[0] != 'NOENT' and now-v[2] <= REFRESH_INTERVAL:
+            return
+        LOG.trace("DNS cache refreshing %r", name)
+        self.refreshing[name] = 1
+        self._queueLookup(name)
+
     def _beginLookup(self,name):
         """Helper function: Begin looking up 'name'.
 
            Caller must hold self.lock
         """
         self.cache[name] = PENDING
+        self._queueLookup(name)
+
+    def _queueLookup(self,name):
+        """Helper function: Tell a DNS thread to look up 'name'.
+
+           Caller must hold self.lock
+        """
         if self._isShutdown:
             # If we've shut down the threads, don't queue the request at
             # all; it'll stay pending indefinitely.
             return
         # Queue the request.
+        self.started[name] = time.time()
         self.queue.put(name)
         # If there aren't enough idle threads, and if we haven't maxed
         # out the threads, start a new one.
@@ -200,6 +321,33 @@ class DNSCache:
            """
         try:
             self.lock.acquire()
+            now = time.time()
+            stats = self.stats
+            stats['resolves'] += 1
+            started = self.started.get(name)
+            if started is not None:
+                del self.started[name]
+                latency = max(now-started, 0)
+                stats['totalLatency'] += latency
+                stats['maxLatency'] = max(stats['maxLatency'], latency)
+            if self.refreshing.has_key(name):
+                del self.refreshing[name]
+            old = self.cache.get(name)
+            if val[0] == 'NOENT':
+                # Back off before trying this name again.
+                stats['failures'] += 1
+                n = self.failures.get(name, (0,0))[0]
+                delay = min(MIN_RETRY_DELAY * (2**min(n,16)),
+                            MAX_RETRY_DELAY)
+                self.failures[name] = (n+1, now+delay)
+                LOG.trace("DNS lookup of %r failed; not retrying for %s sec",
+                          name, delay)
+                if (old is not None and old is not PENDING and
+                    old[0] != 'NOENT' and now-old[2] <= MAX_ENTRY_TTL):
+                    # Keep serving the last good answer for a while.
+                    val = old
+            elif self.failures.has_key(name):
+                del self.failures[name]
             # Insert the value in the cache.
             self.cache[name]=val
             # Insert the value in the reverse cache.
@@ -20,6 +20,8 @@ _EVENTS = [ 'ReceivedPacket',
 
             'AttemptedConnect', 'SuccessfulConnect', 'FailedConnect',
 
+            'FullHandshake', 'ResumedHandshake',
+
             'AttemptedRelay', 'SuccessfulRelay',
             'FailedRelay', 'UnretriableRelay',
 
@@ -68,6 +70,14 @@ class NilEventLog:
         """Called whenever we fail to connect to an MMTP server."""
         self._log("FailedConnect", arg)
 
+    def fullHandshake(self, arg=None):
+        """Called whenever we complete a TLS handshake with a new session."""
+        self._log("FullHandshake", arg)
+    def resumedHandshake(self, arg=None):
+        """Called whenever we complete a TLS handshake by resuming an
+           earlier session."""
+        self._log("ResumedHandshake", arg)
+
     def attemptedRelay(self, arg=None):
         """Called whenever we attempt to relay a packet via MMTP."""
         self._log("AttemptedRelay", arg)
@@ -5,18 +5,23 @@
    Persistent memory for the hashed secrets we've seen.  Used by
    PacketHandler to prevent replay attacks."""
 
+import binascii
+import mmap
 import os
+import struct
 import threading
+import whichdb
+
+import mixminion.Crypto
 import mixminion.Filestore
-from mixminion.Common import MixFatalError, LOG, secureDelete
+from mixminion.Common import MixFatalError, LOG, createPrivateDir, readFile, \
+     replaceFile, secureDelete, tryUnlink
 from mixminion.Packet import DIGEST_LEN
 
 __all__ = [ 'HashLog', 'getHashLog', 'deleteHashLog' ]
 
-# FFFF Mechanism to force a different default db module.
-
 # FFFF Two-copy journaling to protect against catastrophic failure that
-# FFFF underlying DB code can't handle.
+# FFFF the journal can't handle.
 
 # Lock to protect _OPEN_HASHLOGS
 _HASHLOG_DICT_LOCK = threading.RLock()
@@ -57,17 +62,18 @@ def deleteHashLog(filename):
         remove = []
         parent,name = os.path.split(filename)
         prefix1 = name+"."
-        prefix2 = name+"."
+        prefix2 = name+"_"
         if os.path.exists(parent):
             for fn in os.listdir(parent):
-                if fn.startswith(prefix1) or fn.startswith(prefix2):
+                if (fn == name or fn.startswith(prefix1) or
+                    fn.startswith(prefix2)):
                     remove.append(os.path.join(parent, fn))
         remove = [f for f in remove if os.path.exists(f)]
         secureDelete(remove, blocking=1)
     finally:
         _HASHLOG_DICT_LOCK.release()
 
-class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
+class HashLog:
     """A HashLog is a file containing a list of message digests that we've
        already processed.
 
@@ -83,32 +89,118 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
        the network.  On a restart, we reinsert all messages waiting in 'B'
        into the log.)
 
-       HashLogs are implemented using Python's anydbm interface.  This defaults
-       to using Berkeley DB, GDBM, or --if you have none of these-- a flat
-       text file."""
+       HashLogs are implemented as a memory-mapped open-addressing hash
+       table of digests, fronted by a small bloom filter so that the
+       common case (a hash we have never seen) rarely touches the table.
+       New hashes are appended to a journal file before they go into the
+       table, so that a crash between syncs loses nothing.  Hashlogs
+       written by older versions (using Python's anydbm interface) are
+       converted the first time they are opened."""
+    # Largest allowed number of journal entries before we flush the table
+    # to disk.
+    MAX_JOURNAL = 128
+    ## Fields:
+    # filename -- name of the file holding the hash table.
+    # keyid -- the keyid for this log.
+    # journalFileName -- filename to use for journal file.
+    # journalFile -- fd for the journal file
+    # journal -- map from hashes logged since the last sync to 1.
+    # table -- a _HashTable holding all the hashes we've seen.
+    # _lock -- lock to protect all of the above.
     def __init__(self, filename, keyid):
-        mixminion.Filestore.BooleanJournaledDBBase.__init__(self,
-                 filename, "digest hash", 20)
-
+        self._lock = threading.RLock()
+        self.filename = filename
         self.keyid = keyid
+        self.journalFileName = filename+"_jrnl"
+        self.journal = {}
+
+        parent = os.path.split(filename)[0]
+        createPrivateDir(parent)
+
+        if not _isHashTable(filename) and whichdb.whichdb(filename):
+            _migrateHashLog(filename, keyid)
+        else:
+            # If we crashed after converting an old-style log, but before
+            # removing the old database, finish the job.
+            _removeOldDatabase(filename)
+
         try:
-            if self.log["KEYID"] != keyid:
-                raise MixFatalError("Log KEYID does not match current KEYID")
-        except KeyError:
-            self.log["KEYID"] = keyid
-            self._syncLog()
+            st = os.stat(filename)
+        except OSError:
+            st = None
+        if st is None or st.st_size == 0:
+            if st is not None:
+                LOG.warn("Half-created hashlog %s found; cleaning up.",
+                         filename)
+            _createHashTable(filename, keyid, _INITIAL_CAPACITY)
+        self.table = _HashTable(filename)
+        if self.table.keyDigest != _keyDigest(keyid):
+            self.table.close()
+            raise MixFatalError("Log KEYID does not match current KEYID")
+
+        # If there's a journal file, replay it into the table.  (A partial
+        # entry at the end of the journal was never acknowledged, so we
+        # can ignore it.)
+        if os.path.exists(self.journalFileName):
+            j = readFile(self.journalFileName, 1)
+            for i in xrange(0, len(j)-DIGEST_LEN+1, DIGEST_LEN):
+                self.__insert(j[i:i+DIGEST_LEN])
+        self.journalFile = os.open(self.journalFileName,
+                    mixminion.Filestore._JOURNAL_OPEN_FLAGS|os.O_APPEND, 0600)
+
+        self.sync()
 
     def seenHash(self, hash):
-        return self.has_key(hash)
+        self._lock.acquire()
+        try:
+            return self.table.contains(hash)
+        finally:
+            self._lock.release()
 
     def logHash(self, hash):
         assert len(hash) == DIGEST_LEN
-        self[hash] = 1
+        self._lock.acquire()
+        try:
+            if self.table.contains(hash):
+                return
+            os.write(self.journalFile, hash)
+            self.journal[hash] = 1
+            self.__insert(hash)
+            if len(self.journal) > self.MAX_JOURNAL:
+                self.sync()
+        finally:
+            self._lock.release()
+
+    def __insert(self, hash):
+        """Helper: add 'hash' to the table, growing the table if it has
+           gotten too full."""
+        if self.table.isFull():
+            self.table = self.table.grow()
+        self.table.add(hash)
+
+    def sync(self):
+        """Flush all pending changes to disk"""
+        self._lock.acquire()
+        try:
+            self.table.flush()
+            os.close(self.journalFile)
+            self.journalFile = os.open(self.journalFileName,
+                    mixminion.Filestore._JOURNAL_OPEN_FLAGS|os.O_TRUNC, 0600)
+            self.journal = {}
+        finally:
+            self._lock.release()
 
     def close(self):
+        """Release resources associated with this hashlog."""
         try:
             _HASHLOG_DICT_LOCK.acquire()
-            mixminion.Filestore.JournaledDBBase.close(self)
+            self._lock.acquire()
+            try:
+                self.sync()
+                self.table.close()
+                os.close(self.journalFile)
+            finally:
+                self._lock.release()
             try:
                 del _OPEN_HASHLOGS[self.filename]
             except KeyError:
@@ -116,3 +208,252 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
         finally:
             _HASHLOG_DICT_LOCK.release()
 
+#----------------------------------------------------------------------
+# Hash table file format:
+#    Header     [_HEADER_LEN bytes]
+#       Magic         "MMHLOG01"
+#       KeyDigest     SHA1(keyid) [20 bytes]
+#       Salt          Random bytes, mixed into every slot index. [20 bytes]
+#       Capacity      Number of slots; always a power of 2. [4 bytes]
+#       Count         Number of occupied slots. [4 bytes]
+#       Flags         _FLAG_ZERO if the all-zero digest is present. [4 bytes]
+#       (Padding to _HEADER_LEN bytes)
+#    Bloom filter [Capacity bytes]
+#    Slots        [Capacity*DIGEST_LEN bytes]; empty slots are all-zero.
+#
+# All integers are big-endian.  Because the slot index and bloom bits are
+# derived from SHA1(salt+hash), an attacker who controls which digests we
+# see can't force long probe sequences.
+
+_MAGIC = "MMHLOG01"
+_HEADER_FMT = "!8s20s20sLLL"
+_HEADER_LEN = 64
+# Offset of the 'count' and 'flags' fields within the header.
+_COUNT_OFFSET = 52
+_FLAGS_OFFSET = 56
+# Flag set when the all-zero digest (which we use to mark empty slots) has
+# been logged.
+_FLAG_ZERO = 1
+# Number of slots in a newly created table.
+_INITIAL_CAPACITY = 1<<14
+# Number of bloom filter bits set for each hash.
+_BLOOM_K = 4
+# Contents of an empty slot.
+_EMPTY_SLOT = "\000"*DIGEST_LEN
+
+def _keyDigest(keyid):
+    """Return the digest of 'keyid' that we store in the table header."""
+    return mixminion.Crypto.sha1(keyid)
+
+def _isHashTable(filename):
+    """Return true iff 'filename' exists and holds a hash table in our
+       format."""
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return 0
+    try:
+        return f.read(len(_MAGIC)) == _MAGIC
+    finally:
+        f.close()
+
+def _createHashTable(filename, keyid, capacity, salt=None):
+    """Create a new, empty hash table for 'keyid' with 'capacity' slots in
+       'filename', replacing any file that was already there."""
+    assert capacity & (capacity-1) == 0
+    if salt is None:
+        salt = mixminion.Crypto.getCommonPRNG().getBytes(DIGEST_LEN)
+    header = struct.pack(_HEADER_FMT, _MAGIC, _keyDigest(keyid), salt,
+                         capacity, 0, 0)
+    header += "\000"*(_HEADER_LEN-len(header))
+    size = _HEADER_LEN + capacity + capacity*DIGEST_LEN
+    tmpname = filename+".new"
+    f = open(tmpname, 'wb')
+    try:
+        f.write(header)
+        f.seek(size-1)
+        f.write("\000")
+    finally:
+        f.close()
+    replaceFile(tmpname, filename)
+
+class _HashTable:
+    """Helper class: an open memory-mapped hash table file, as described
+       above.  Not threadsafe; callers must do their own locking."""
+    ## Fields:
+    # filename -- the name of the file holding this table.
+    # keyDigest, salt, capacity, count, flags -- as stored in the header.
+    # _file -- an open file object for 'filename'.
+    # _map -- an mmap object covering all of 'filename'.
+    # _mask -- capacity-1
+    # _nBits -- number of bits in the bloom filter.
+    # _slotsOffset -- offset of the first slot within the file.
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'r+b')
+        header = self._file.read(_HEADER_LEN)
+        if len(header) != _HEADER_LEN or not header.startswith(_MAGIC):
+            self._file.close()
+            raise MixFatalError("Corrupt hashlog header in %s"%filename)
+        (_, self.keyDigest, self.salt, self.capacity, self.count,
+         self.flags) = struct.unpack(_HEADER_FMT,
+                                     header[:struct.calcsize(_HEADER_FMT)])
+        size = _HEADER_LEN + self.capacity + self.capacity*DIGEST_LEN
+        if (self.capacity & (self.capacity-1) or
+            os.fstat(self._file.fileno()).st_size != size):
+            self._file.close()
+            raise MixFatalError("Corrupt hashlog %s: bad length"%filename)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._mask = self.capacity-1
+        self._nBits = self.capacity*8
+        self._slotsOffset = _HEADER_LEN + self.capacity
+
+    def __indices(self, hash):
+        """Return a tuple of: the first slot to probe for 'hash', and a list
+           of the bloom filter bits for 'hash'."""
+        d = struct.unpack("!5L", mixminion.Crypto.sha1(self.salt+hash))
+        nBits = self._nBits
+        return d[0] & self._mask, [ b % nBits for b in d[1:1+_BLOOM_K] ]
+
+    def __probe(self, hash, slot):
+        """Return the offset of the slot holding 'hash', or of the empty
+           slot where 'hash' belongs if it is not present."""
+        m = self._map
+        base = self._slotsOffset
+        mask = self._mask
+        while 1:
+            off = base + slot*DIGEST_LEN
+            v = m[off:off+DIGEST_LEN]
+            if v == hash or v == _EMPTY_SLOT:
+                return off
+            slot = (slot+1) & mask
+
+    def contains(self, hash):
+        """Return true iff 'hash' is in the table."""
+        if hash == _EMPTY_SLOT:
+            return self.flags & _FLAG_ZERO
+        slot, bits = self.__indices(hash)
+        m = self._map
+        for b in bits:
+            if not ord(m[_HEADER_LEN + (b>>3)]) & (1<<(b&7)):
+                return 0
+        off = self.__probe(hash, slot)
+        return m[off:off+DIGEST_LEN] == hash
+
+    def add(self, hash):
+        """Insert 'hash' into the table.  The table must not be full."""
+        m = self._map
+        if hash == _EMPTY_SLOT:
+            self.flags |= _FLAG_ZERO
+            m[_FLAGS_OFFSET:_FLAGS_OFFSET+4] = struct.pack("!L", self.flags)
+            return
+        slot, bits = self.__indices(hash)
+        off = self.__probe(hash, slot)
+        if m[off:off+DIGEST_LEN] == hash:
+            return
+        m[off:off+DIGEST_LEN] = hash
+        for b in bits:
+            idx = _HEADER_LEN + (b>>3)
+            m[idx] = chr(ord(m[idx]) | (1<<(b&7)))
+        self.count += 1
+        m[_COUNT_OFFSET:_COUNT_OFFSET+4] = struct.pack("!L", self.count)
+
+    def isFull(self):
+        """Return true iff the table is too loaded to accept another hash
+           without growing."""
+        return (self.count+1)*2 > self.capacity
+
+    def addAllTo(self, other):
+        """Insert every hash in this table into the _HashTable 'other'."""
+        if self.flags & _FLAG_ZERO:
+            other.add(_EMPTY_SLOT)
+        m = self._map
+        off = self._slotsOffset
+        for _ in xrange(self.capacity):
+            v = m[off:off+DIGEST_LEN]
+            if v != _EMPTY_SLOT:
+                other.add(v)
+            off += DIGEST_LEN
+
+    def grow(self):
+        """Close this table, replace it on disk with a copy of twice the
+           capacity, and return a _HashTable for the copy."""
+        LOG.debug("Growing hashlog %s to %s slots", self.filename,
+                  self.capacity*2)
+        tmpname = self.filename+".grow"
+        header = struct.pack(_HEADER_FMT, _MAGIC, self.keyDigest, self.salt,
+                             self.capacity*2, 0, 0)
+        header += "\000"*(_HEADER_LEN-len(header))
+        size = _HEADER_LEN + self.capacity*2*(1+DIGEST_LEN)
+        f = open(tmpname, 'wb')
+        try:
+            f.write(header)
+            f.seek(size-1)
+            f.write("\000")
+        finally:
+            f.close()
+        new = _HashTable(tmpname)
+        self.addAllTo(new)
+        new.close()
+        self.close()
+        replaceFile(tmpname, self.filename)
+        return _HashTable(self.filename)
+
+    def flush(self):
+        """Write all changes to disk."""
+        self._map.flush()
+
+    def close(self):
+        """Flush and release this table."""
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+def _migrateHashLog(filename, keyid):
+    """Convert the old-style (anydbm) hashlog stored at 'filename' into a
+       new hash table at the same location, and securely remove the old
+       database files."""
+    LOG.info("Converting hashlog %s to new format", filename)
+    # Opening the old log flushes its journal into the database.
+    old = mixminion.Filestore.BooleanJournaledDBBase(
+        filename, "digest hash", DIGEST_LEN)
+    try:
+        try:
+            if old.log["KEYID"] != keyid:
+                raise MixFatalError("Log KEYID does not match current KEYID")
+        except KeyError:
+            pass
+        hashes = [ binascii.a2b_hex(k) for k in old.log.keys()
+                   if k != "KEYID" ]
+    finally:
+        old.close()
+
+    capacity = _INITIAL_CAPACITY
+    while (len(hashes)+1)*2 > capacity:
+        capacity *= 2
+    tmpname = filename+".conv"
+    _createHashTable(tmpname, keyid, capacity)
+    t = _HashTable(tmpname)
+    for h in hashes:
+        t.add(h)
+    t.close()
+
+    # Move the new table into place before we destroy the old database, so
+    # that a crash here can't lose any hashes.  If the old database lives
+    # at 'filename' itself, keep a link to it so we can still shred it.
+    if os.path.exists(filename) and hasattr(os, 'link'):
+        tryUnlink(filename+".old")
+        os.link(filename, filename+".old")
+    replaceFile(tmpname, filename)
+    _removeOldDatabase(filename)
+    LOG.info("Converted %s hashes in %s", len(hashes), filename)
+
+def _removeOldDatabase(filename):
+    """Securely remove any files left over from an old-style hashlog at
+       'filename'.  We keep the journal; it has the same format as our
+       own."""
+    remove = [ filename+suffix for suffix in
+               (".old", ".db", ".dat", ".dir", ".bak", ".pag") ]
+    remove = [ f for f in remove if os.path.exists(f) ]
+    if remove:
+        secureDelete(remove, blocking=1)
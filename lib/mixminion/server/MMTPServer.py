@@ -19,6 +19,8 @@
 #    easier to use with TLS.
 
 import errno
+import heapq
+import os
 import socket
 import select
 import re
@@ -31,17 +33,218 @@ import mixminion.ServerInfo
 import mixminion.TLSConnection
 import mixminion._minionlib as _ml
 from mixminion.Common import MixError, MixFatalError, MixProtocolError, \
-     LOG, stringContains, floorDiv, UIError
-from mixminion.Crypto import sha1, getCommonPRNG
+     LOG, stringContains, UIError, createPrivateDir
+from mixminion.Crypto import sha1_new, sha1_with_suffix, getCommonPRNG
 from mixminion.Packet import PACKET_LEN, DIGEST_LEN, IPV4Info, MMTPHostInfo
-from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection
+from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection, \
+     TLSSessionCache
 from mixminion.NetUtils import getProtocolSupport, AF_INET, AF_INET6
 import mixminion.server.EventStats as EventStats
 from mixminion.Filestore import CorruptedFile
 from mixminion.ThreadUtils import MessageQueue, QueueEmpty
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection' ]
 
+class _TokenBucket:
+    """A token bucket that refills continuously: it holds up to 'burst'
+       bytes of bandwidth, and gains 'rate' bytes every second."""
+    ## Fields:
+    # rate: How many bytes do we gain per second?
+    # burst: The largest number of bytes the bucket can hold.
+    # level: The number of bytes in the bucket now.  May be negative if
+    #    connections have used more than they were allowed; the debt is
+    #    repaid by later refills.
+    # lastRefill: The time at which we last refilled the bucket.
+    def __init__(self, rate, burst, now=None):
+        if now is None:
+            now = time.time()
+        self.rate = rate
+        self.burst = burst
+        self.level = burst
+        self.lastRefill = now
+
+    def refill(self, now):
+        """Add the bandwidth that has accumulated since the last refill."""
+        elapsed = now - self.lastRefill
+        if elapsed > 0:
+            self.level = min(self.burst, self.level + elapsed*self.rate)
+        self.lastRefill = now
+
+    def spend(self, n):
+        """Remove 'n' bytes from the bucket."""
+        self.level -= n
+
+    def getDelay(self, n):
+        """Return the number of seconds until the bucket holds 'n' bytes."""
+        if self.level >= n:
+            return 0
+        return (n - self.level) / float(self.rate)
+
+class BandwidthScheduler:
+    """A BandwidthScheduler decides how much bandwidth each ready connection
+       may use.  Incoming and outgoing traffic have separate token buckets,
+       refilled continuously by the event loop.  Ready connections share the
+       available bandwidth by weighted deficit round robin: each time they
+       are ready, they earn QUANTUM bytes times their weight, and spend
+       what they actually transfer."""
+    ## Fields:
+    # inBucket, outBucket: _TokenBucket objects limiting the bytes we read
+    #    and write, or None if the direction is unlimited.
+    # deficit: A map from fd to the number of bytes that connection may
+    #    still transfer.  May be negative if it overspent.
+    # _round: A counter, so that a different connection goes first in
+    #    each round.
+    # peerUsage: A map from peer (as returned by a connection's getPeer
+    #    method) to a 2-element list of bytes read from and written to that
+    #    peer.
+
+    # How many bytes does a connection of weight 1 earn in each round?
+    QUANTUM = 8192
+    # A connection can't save up more than MAX_ROUNDS rounds' worth of
+    # bytes.
+    MAX_ROUNDS = 4
+    # When a direction is exhausted, we wait until it has at least this
+    # many bytes before using it again, so we don't wake up for every few
+    # bytes.
+    MIN_REFILL = 1024
+
+    def __init__(self):
+        self.inBucket = self.outBucket = None
+        self.deficit = {}
+        self._round = 0
+        self.peerUsage = {}
+
+    def setBandwidth(self, inbound, outbound, burst=None, now=None):
+        """Limit reading to 'inbound' bytes per second, and writing to
+           'outbound' bytes per second, with bursts of no more than
+           'burst' bytes (default: one second's worth).  A limit of None
+           means 'unlimited'."""
+        def bucket(rate, burst=burst, now=now):
+            if rate is None:
+                return None
+            if burst is None:
+                burst = rate
+            return _TokenBucket(rate, max(burst, BandwidthScheduler.QUANTUM),
+                                now)
+        self.inBucket = bucket(inbound)
+        self.outBucket = bucket(outbound)
+
+    def isLimited(self):
+        """Return true iff we're limiting bandwidth in either direction."""
+        return self.inBucket is not None or self.outBucket is not None
+
+    def refill(self, now):
+        """Refill the token buckets for the time elapsed since the last
+           refill."""
+        for b in self.inBucket, self.outBucket:
+            if b is not None:
+                b.refill(now)
+
+    def isExhausted(self):
+        """Return true iff we can neither read nor write anything."""
+        return (self.inBucket is not None and self.inBucket.level <= 0 and
+                self.outBucket is not None and self.outBucket.level <= 0)
+
+    def getDelay(self):
+        """Return the number of seconds until every exhausted direction can
+           transfer some more bytes."""
+        delay = 0
+        for b in self.inBucket, self.outBucket:
+            if b is not None and b.level <= 0:
+                delay = max(delay, b.getDelay(min(self.MIN_REFILL, b.burst)))
+        return delay
+
+    def schedule(self, events, connections):
+        """Given a list of (fd, r, w, x) tuples for the fds that have
+           read, write, or error events, return a list of (fd, connection,
+           r, w, x, cap) tuples for the connections that should be
+           processed now, in the order to process them.  Events in a
+           direction whose bucket is empty are masked; connections with
+           nothing left to do are omitted.  'cap' is the most bytes that
+           the connection should transfer, or None for no limit."""
+        inB, outB = self.inBucket, self.outBucket
+        readOK = inB is None or inB.level > 0
+        writeOK = outB is None or outB.level > 0
+        limited = inB is not None or outB is not None
+        events = events[:]
+        events.sort()
+        n = len(events)
+        if n:
+            start = self._round % n
+            events = events[start:]+events[:start]
+            self._round += 1
+        result = []
+        for fd, r, w, x in events:
+            c = connections.get(fd)
+            if c is None:
+                continue
+            weight = c.getBandwidthWeight()
+            if not limited or not weight:
+                result.append((fd, c, r, w, x, None))
+                continue
+            r = r and readOK
+            w = w and writeOK
+            if not (r or w or x):
+                continue
+            quantum = self.QUANTUM * weight
+            deficit = min(self.deficit.get(fd, 0) + quantum,
+                          quantum * self.MAX_ROUNDS)
+            self.deficit[fd] = deficit
+            if deficit <= 0 and not x:
+                continue
+            # We may use whatever is left in the buckets we're allowed to
+            # use, up to our deficit.
+            avail = 0
+            if r:
+                if inB is None: avail = deficit
+                else: avail = max(avail, inB.level)
+            if w:
+                if outB is None: avail = deficit
+                else: avail = max(avail, outB.level)
+            cap = int(max(min(deficit, avail), 0))
+            result.append((fd, c, r, w, x, cap))
+        return result
+
+    def charge(self, fd, c, nRead, nWritten, isClosed):
+        """Note that the connection 'c' at 'fd' has read 'nRead' bytes and
+           written 'nWritten' bytes.  If 'isClosed' is true, the connection
+           is gone, and we forget its deficit."""
+        if self.inBucket is not None:
+            self.inBucket.spend(nRead)
+        if self.outBucket is not None:
+            self.outBucket.spend(nWritten)
+        if isClosed:
+            try:
+                del self.deficit[fd]
+            except KeyError:
+                pass
+        elif self.deficit.has_key(fd):
+            self.deficit[fd] -= nRead+nWritten
+        if nRead or nWritten:
+            peer = c.getPeer()
+            try:
+                usage = self.peerUsage[peer]
+            except KeyError:
+                usage = self.peerUsage[peer] = [0, 0]
+            usage[0] += nRead
+            usage[1] += nWritten
+
+    def getPeerUsage(self, reset=0):
+        """Return a map from peer to a 2-tuple of the number of bytes read
+           from and written to that peer.  If 'reset' is true, start
+           counting again from zero."""
+        result = {}
+        for peer, (nRead, nWritten) in self.peerUsage.items():
+            result[peer] = (nRead, nWritten)
+        if reset:
+            self.peerUsage = {}
+        return result
+
 class SelectAsyncServer:
     """AsyncServer is the core of a general-purpose asynchronous
        select-based server loop.  AsyncServer maintains lists of
@@ -53,26 +256,26 @@ class SelectAsyncServer:
     # self.connections: a map from fd to Connection objects.
     # self.state: a map from fd to the latest wantRead,wantWrite tuples
     #    returned by the connection objects' process or getStatus methods.
-
-    # self.bandwidthPerTick: How many bytes of bandwidth do we use per tick,
-    #    on average?
-    # self.maxBucket: How many bytes of bandwidth are we willing to use in
-    #    a single 1-tick burst?
-    # self.bucket: How many bytes are we willing to use in the next tick?
-    #
-    #   (NOTE: if no bandwidth limitation is used, the 3 fields above are
-    #   set to None.)
-
-    # How many seconds pass between the 'ticks' at which we increment
-    # our bandwidth bucket?
-    TICK_INTERVAL = 1.0
+    # self._timeout: The number of seconds of inactivity to allow on a
+    #    connection before forcibly shutting it down, or None.
+    # self._timeoutHeap: a heap of (deadline, fd, connection) for every
+    #    connection that is subject to timeouts.  A connection can't time
+    #    out before its deadline, but may have seen activity since we
+    #    computed it.
+    # self._timeoutCons: a map from fd to the connection that has an entry
+    #    for that fd in _timeoutHeap.
+
+    # self.bandwidth: a BandwidthScheduler to share bandwidth among our
+    #    connections, and to account for the bandwidth they use.
 
     def __init__(self):
         """Create a new AsyncServer with no readers or writers."""
         self._timeout = None
+        self._timeoutHeap = []
+        self._timeoutCons = {}
         self.connections = {}
         self.state = {}
-        self.bandwidthPerTick = self.bucket = self.maxBucket = None
+        self.bandwidth = BandwidthScheduler()
 
     def process(self,timeout):
         """If any relevant file descriptors become available within
@@ -95,8 +298,7 @@ class SelectAsyncServer:
             time.sleep(timeout)
             return
 
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
+        if self._waitForBandwidth(timeout):
             return
 
         try:
@@ -110,29 +312,63 @@ class SelectAsyncServer:
 
         writefds += exfds
 
-        active = []
+        events = []
 
-        for fd, c in self.connections.items():
+        for fd in self.connections.keys():
             r = fd in readfds
             w = fd in writefds
             if not (r or w):
                 continue
-            active.append((c,r,w,fd))
-
-        if not active: return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket, len(active))
-        for c,r,w,fd in active:
-            wr, ww, isopen, nbytes = c.process(r,w,0,cap)
-            if cap is not None:
-                self.bucket -= nbytes
-            if not isopen:
-                del self.connections[fd]
-                del self.state[fd]
+            events.append((fd,r,w,0))
+
+        self._dispatch(events, timeout)
+
+    def _waitForBandwidth(self, timeout):
+        """Helper: if we can neither read nor write any bytes, sleep until
+           we can (but no more than 'timeout' seconds), and return true.
+           Otherwise return false."""
+        bw = self.bandwidth
+        if not bw.isLimited():
+            return 0
+        bw.refill(time.time())
+        if not bw.isExhausted():
+            return 0
+        time.sleep(min(timeout, bw.getDelay()))
+        return 1
+
+    def _dispatch(self, events, timeout):
+        """Helper: given a list of (fd, r, w, x) tuples for the fds with
+           read, write, or error events, process their connections as
+           far as our bandwidth limits allow, and update their state.  If
+           our limits keep us from processing anything, sleep until we have
+           more bandwidth, or for 'timeout' seconds."""
+        if not events:
+            return
+        bw = self.bandwidth
+        todo = bw.schedule(events, self.connections)
+        if not todo:
+            # We're not allowed to handle any of these events yet; wait
+            # for more bandwidth rather than spinning.
+            time.sleep(min(timeout, bw.getDelay()))
+            return
+        for fd, c, r, w, x, cap in todo:
+            if self.connections.get(fd) is not c:
+                # Removed by an earlier connection's callback.
                 continue
-            self.state[fd] = (wr,ww)
+            nRead, nWritten = c.getBytesTransferred()
+            wr, ww, isopen, _ = c.process(r,w,x,cap)
+            nRead2, nWritten2 = c.getBytesTransferred()
+            bw.charge(fd, c, nRead2-nRead, nWritten2-nWritten, not isopen)
+            self._updateConnection(fd, c, wr, ww, isopen)
+
+    def _updateConnection(self, fd, c, wr, ww, isopen):
+        """Helper: update our records after processing the connection 'c'
+           at 'fd'.  'wr', 'ww', and 'isopen' are as returned by process."""
+        if not isopen:
+            del self.connections[fd]
+            del self.state[fd]
+            return
+        self.state[fd] = (wr,ww)
 
     def register(self, c):
         """Add a connection to this server."""
@@ -141,6 +377,17 @@ class SelectAsyncServer:
         if not isopen: return
         self.connections[fd] = c
         self.state[fd] = (wr,ww)
+        self._addTimeout(fd, c)
+
+    def refresh(self, c):
+        """Update our records for the registered connection 'c' after its
+           read/write interest has changed outside of process() (for
+           example, because we queued a packet on an idle connection)."""
+        fd = c.fileno()
+        if self.connections.get(fd) is not c:
+            return
+        wr, ww, isopen = c.getStatus()
+        self._updateConnection(fd, c, wr, ww, isopen)
 
     def remove(self, c, fd=None):
         """Remove a connection from this server."""
@@ -149,6 +396,17 @@ class SelectAsyncServer:
         del self.connections[fd]
         del self.state[fd]
 
+    def _addTimeout(self, fd, c):
+        """Helper: make sure that the connection 'c', registered at 'fd',
+           has an entry in the timeout heap if it needs one."""
+        if self._timeout is None or self._timeoutCons.get(fd) is c:
+            return
+        last = c.getLastActivity()
+        if last is None:
+            return
+        self._timeoutCons[fd] = c
+        heapq.heappush(self._timeoutHeap, (last+self._timeout, fd, c))
+
     def tryTimeout(self, now=None):
         """Timeout any connection that is too old."""
         if self._timeout is None:
@@ -157,42 +415,44 @@ class SelectAsyncServer:
             now = time.time()
         # All connections older than 'cutoff' get purged.
         cutoff = now - self._timeout
-        # Maintain a set of filenos for connections we've checked, so we don't
-        # check any more than once.
-        for fd, con in self.connections.items():
+        # Only look at the connections whose deadlines have passed; the
+        # ones that have seen activity since go back in the heap.
+        heap = self._timeoutHeap
+        while heap and heap[0][0] <= now:
+            _, fd, con = heapq.heappop(heap)
+            if self._timeoutCons.get(fd) is con:
+                del self._timeoutCons[fd]
+            if self.connections.get(fd) is not con:
+                # Already removed.
+                continue
             if con.tryTimeout(cutoff):
                 self.remove(con,fd)
+            else:
+                self._addTimeout(fd, con)
+
+    def getNextTimeoutTime(self, now=None):
+        """Return the time at which we next purge connections, if we have
+           last done so at time 'now'."""
+        if now is None:
+            now = time.time()
+        if self._timeout is None:
+            return -1
+        if self._timeoutHeap:
+            return min(self._timeoutHeap[0][0], now+self._timeout)
+        return now + self._timeout
 
-    def setBandwidth(self, n, maxBucket=None):
+    def setBandwidth(self, inbound, outbound=None, maxBucket=None):
         """Set bandwidth limitations for this server
-              n -- maximum bytes-per-second to use, on average.
-              maxBucket -- maximum bytes to send in a single burst.
-                 Defaults to n*5.
-
-           Setting n to None removes bandwidth limiting."""
-        if n is None:
-            self.bandwidthPerTick = None
-            self.maxBucket = None
-        else:
-            self.bandwidthPerTick = int(n * self.TICK_INTERVAL)
-            if maxBucket is None:
-                self.maxBucket = self.bandwidthPerTick*5
-            else:
-                self.maxBucket = maxBucket
-
-    def tick(self):
-        """Tell the server that one unit of time has passed, and the bandwidth
-           limitations can be readjusted.  This method must be called once
-           every TICK_INTERVAL seconds."""
-        bwpt = self.bandwidthPerTick
-        if bwpt is None:
-            self.bucket = None
-        else:
-            bucket = (self.bucket or 0) + bwpt
-            if bucket > self.maxBucket:
-                self.bucket = self.maxBucket
-            else:
-                self.bucket = bucket
+              inbound -- maximum bytes-per-second to read, on average.
+              outbound -- maximum bytes-per-second to write, on average.
+                 Defaults to 'inbound'.
+              maxBucket -- maximum bytes to read or write in a single burst.
+                 Defaults to one second's worth.
+
+           Setting both limits to None removes bandwidth limiting."""
+        if outbound is None:
+            outbound = inbound
+        self.bandwidth.setBandwidth(inbound, outbound, maxBucket)
 
 class PollAsyncServer(SelectAsyncServer):
     """Subclass of SelectAsyncServer that uses 'poll' where available.  This
@@ -207,8 +467,7 @@ class PollAsyncServer(SelectAsyncServer):
                            (1,1): select.POLLIN+select.POLLOUT+select.POLLERR,
                            (1,2): select.POLLIN+select.POLLOUT+select.POLLERR }
     def process(self,timeout):
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
+        if self._waitForBandwidth(timeout):
             return
         try:
             # (watch out: poll takes a timeout in msec, but select takes a
@@ -219,27 +478,19 @@ class PollAsyncServer(SelectAsyncServer):
                 return
             else:
                 raise e
-        if not events:
-            return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket,len(events))
         #print events, self.connections.keys()
-        for fd, mask in events:
-            c = self.connections[fd]
-            wr,ww,isopen,n = c.process(mask&select.POLLIN, mask&select.POLLOUT,
-                                       mask&(select.POLLERR|select.POLLHUP),
-                                       cap)
-            if cap is not None:
-                self.bucket -= n
-            if not isopen:
-                #print "unregister",fd
-                self.poll.unregister(fd)
-                del self.connections[fd]
-                continue
-            #print "register",fd
-            self.poll.register(fd,self.EVENT_MASK[wr,ww])
+        self._dispatch([ (fd, mask&select.POLLIN, mask&select.POLLOUT,
+                          mask&(select.POLLERR|select.POLLHUP))
+                         for fd, mask in events ], timeout)
+
+    def _updateConnection(self, fd, c, wr, ww, isopen):
+        if not isopen:
+            #print "unregister",fd
+            self.poll.unregister(fd)
+            del self.connections[fd]
+            return
+        #print "register",fd
+        self.poll.register(fd,self.EVENT_MASK[wr,ww])
 
     def register(self,c):
         fd = c.fileno()
@@ -249,6 +500,7 @@ class PollAsyncServer(SelectAsyncServer):
         mask = self.EVENT_MASK[(wr,ww)]
         #print "register",fd
         self.poll.register(fd, mask)
+        self._addTimeout(fd, c)
     def remove(self,c,fd=None):
         if fd is None:
             fd = c.fileno()
@@ -256,7 +508,100 @@ class PollAsyncServer(SelectAsyncServer):
         self.poll.unregister(fd)
         del self.connections[fd]
 
-if hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
+class EpollAsyncServer(SelectAsyncServer):
+    """Subclass of SelectAsyncServer that uses Linux's 'epoll'.  Unlike
+       select and poll, epoll keeps our interest list in the kernel: we only
+       tell it about a connection when that connection's wantRead/wantWrite
+       status changes, and each call to process() only visits the
+       connections that are actually ready."""
+    ## Fields:
+    # epoll: a select.epoll object with every connection that wants to
+    #    read or write registered.
+    # self.state: as in SelectAsyncServer; used to tell when a connection's
+    #    interest has changed.
+    def __init__(self):
+        SelectAsyncServer.__init__(self)
+        self.epoll = select.epoll()
+        ERR = select.EPOLLERR|select.EPOLLHUP
+        self.EVENT_MASK = {(0,0): 0,
+                           (1,0): select.EPOLLIN|ERR,
+                           (0,1): select.EPOLLOUT|ERR,
+                           (0,2): select.EPOLLOUT|ERR,
+                           (1,1): select.EPOLLIN|select.EPOLLOUT|ERR,
+                           (1,2): select.EPOLLIN|select.EPOLLOUT|ERR }
+
+    def process(self,timeout):
+        if self._waitForBandwidth(timeout):
+            return
+        try:
+            events = self.epoll.poll(timeout)
+        except (select.error, IOError), e:
+            if e[0] == errno.EINTR:
+                return
+            else:
+                raise e
+        self._dispatch([ (fd, mask&select.EPOLLIN, mask&select.EPOLLOUT,
+                          mask&(select.EPOLLERR|select.EPOLLHUP))
+                         for fd, mask in events ], timeout)
+
+    def _updateConnection(self, fd, c, wr, ww, isopen):
+        if not isopen:
+            self.remove(c,fd)
+            return
+        old = self.state[fd]
+        if old != (wr,ww):
+            self.state[fd] = (wr,ww)
+            if not self.EVENT_MASK[old]:
+                self._epollRegister(fd, self.EVENT_MASK[wr,ww])
+            elif not self.EVENT_MASK[wr,ww]:
+                self._epollUnregister(fd)
+            else:
+                self.epoll.modify(fd,self.EVENT_MASK[wr,ww])
+
+    def _epollRegister(self, fd, mask):
+        """Helper: start watching 'fd' for the events in 'mask'.  We never
+           leave an fd in the epoll set with an empty mask: epoll always
+           reports EPOLLHUP and EPOLLERR, so a half-closed peer would
+           keep waking us up for a connection that wants nothing."""
+        if not mask:
+            self._epollUnregister(fd)
+            return
+        try:
+            self.epoll.register(fd, mask)
+        except (IOError, OSError), e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fd, mask)
+
+    def _epollUnregister(self, fd):
+        """Helper: stop watching 'fd', if we were."""
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # The kernel forgets about fds when they're closed.
+            pass
+
+    def register(self,c):
+        fd = c.fileno()
+        wr, ww, isopen = c.getStatus()
+        if not isopen: return
+        self._epollRegister(fd, self.EVENT_MASK[(wr,ww)])
+        self.connections[fd] = c
+        self.state[fd] = (wr,ww)
+        self._addTimeout(fd, c)
+
+    def remove(self,c,fd=None):
+        if fd is None:
+            fd = c.fileno()
+        self._epollUnregister(fd)
+        del self.connections[fd]
+        del self.state[fd]
+
+if hasattr(select,'epoll'):
+    # On Linux, epoll scales far better than poll or select once we have
+    # hundreds of open connections.
+    AsyncServer = EpollAsyncServer
+elif hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
     # Prefer 'poll' to 'select', except on MacOS and other platforms where
     # where 'poll' is just a wrapper around 'select'.  (The poll wrapper is
     # sometimes buggy.)
@@ -281,6 +626,23 @@ class Connection:
         """If this connection has seen no activity since 'cutoff', and it
            is subject to aging, shut it down."""
         pass
+    def getLastActivity(self):
+        """Return the time when this connection last saw any activity, or
+           None if this connection is not subject to aging."""
+        return None
+    def getBytesTransferred(self):
+        """Return a 2-tuple of the total number of bytes that this
+           connection has read and written on the network."""
+        return 0,0
+    def getPeer(self):
+        """Return a key identifying the host on the other side of this
+           connection, for bandwidth accounting."""
+        return None
+    def getBandwidthWeight(self):
+        """Return this connection's share of the available bandwidth,
+           relative to other connections, or 0 if the connection isn't
+           subject to bandwidth limits."""
+        return 1
 
 class ListenConnection(Connection):
     """A ListenConnection listens on a given port/ip combination, and calls
@@ -317,6 +679,10 @@ class ListenConnection(Connection):
         LOG.info("Listening at %s on port %s (fd %s)",
                  ip, port, self.sock.fileno())
 
+    def getBandwidthWeight(self):
+        # Accepting connections uses no bandwidth.
+        return 0
+
     def process(self, r, w, x, cap):
         #XXXX007 do something with x
         try:
@@ -339,6 +705,45 @@ class ListenConnection(Connection):
     def fileno(self):
         return self.sock.fileno()
 
+class WakeupConnection(Connection):
+    """A WakeupConnection is a pipe that other threads can write to in order
+       to make the main thread return from AsyncServer.process."""
+    ## Fields:
+    # readFd, writeFd: the two ends of a nonblocking pipe.
+    def __init__(self):
+        self.readFd, self.writeFd = os.pipe()
+        for fd in self.readFd, self.writeFd:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags|os.O_NONBLOCK)
+
+    def wakeup(self):
+        """Make the main thread's next (or current) call to process()
+           return.  It is safe to call this function from any thread."""
+        try:
+            os.write(self.writeFd, "\000")
+        except OSError, e:
+            # If the pipe is full, the main thread will wake up anyway.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def getBandwidthWeight(self):
+        return 0
+
+    def process(self, r, w, x, cap):
+        try:
+            while os.read(self.readFd, 1024):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return 1,0,1,0
+
+    def getStatus(self):
+        return 1,0,1
+
+    def fileno(self):
+        return self.readFd
+
 class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     """A TLSConnection that implements the server side of MMTP."""
     ##
@@ -348,9 +753,14 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     #   rejectCallback -- a callback to invoke whenever we've rejected a packet
     #   protocol -- the negotiated MMTP version
     #   rejectPackets -- flag: do we reject the packets we've received?
+    #   peerAddr -- the IP address of the other side, or None if unknown.
     MESSAGE_LEN = 6 + (1<<15) + 20
     PROTOCOL_VERSIONS = ['0.3']
     def __init__(self, sock, tls, consumer, rejectPackets=0, serverName=None):
+        try:
+            self.peerAddr = sock.getpeername()[0]
+        except socket.error:
+            self.peerAddr = None
         if serverName is None:
             addr,port = sock.getpeername()
             serverName = mixminion.ServerInfo.displayServerByAddress(addr,port)
@@ -366,7 +776,16 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
         self.rejectPackets = rejectPackets
         self.beginAccepting()
 
+    def getPeer(self):
+        if self.peerAddr is None:
+            return self.address
+        return self.peerAddr
+
     def onConnected(self):
+        if self.tls.session_reused():
+            EventStats.log.resumedHandshake()
+        else:
+            EventStats.log.fullHandshake()
         self.onRead = self.readProtocol
         self.beginReading()
 
@@ -406,28 +825,34 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
 
     def onDataRead(self):
         while self.inbuflen >= self.MESSAGE_LEN:
-            data = self.getInbuf(self.MESSAGE_LEN, clear=1)
-            control = data[:SEND_CONTROL_LEN]
-            pkt = data[SEND_CONTROL_LEN:-DIGEST_LEN]
-            digest = data[-DIGEST_LEN:]
+            # Pull each field straight out of the input buffer, rather than
+            # copying out the whole frame and then slicing it.  We hash the
+            # packet in place, once, and finish each digest we need from a
+            # copy of the hash state.
+            control = str(self.getInbufView(0, SEND_CONTROL_LEN))
+            pktView = self.getInbufView(SEND_CONTROL_LEN, PACKET_LEN)
+            digest = str(self.getInbufView(SEND_CONTROL_LEN+PACKET_LEN,
+                                           DIGEST_LEN))
+            h = sha1_new(pktView)
             if control == JUNK_CONTROL:
-                expectedDigest = sha1(pkt+"JUNK")
-                replyDigest = sha1(pkt+"RECEIVED JUNK")
+                expectedDigest = sha1_with_suffix(h, "JUNK")
+                replyDigest = sha1_with_suffix(h, "RECEIVED JUNK")
                 replyControl = RECEIVED_CONTROL
                 isJunk = 1
             elif control == SEND_CONTROL:
-                expectedDigest = sha1(pkt+"SEND")
+                expectedDigest = sha1_with_suffix(h, "SEND")
                 if self.rejectPackets:
-                    replyDigest = sha1(pkt+"REJECTED")
+                    replyDigest = sha1_with_suffix(h, "REJECTED")
                     replyControl = REJECTED_CONTROL
                 else:
-                    replyDigest = sha1(pkt+"RECEIVED")
+                    replyDigest = sha1_with_suffix(h, "RECEIVED")
                     replyControl = RECEIVED_CONTROL
                 isJunk = 0
             else:
                 LOG.warn("Unrecognized command (%r) from %s.  Closing connection.",
                          control, self.address)
                 #failed
+                self.clearInbuf()
                 self.startShutdown()
                 return
 
@@ -435,6 +860,7 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
                 LOG.warn("Invalid checksum from %s. Closing connection.",
                          self.address)
                 #failed
+                self.clearInbuf()
                 self.startShutdown()
                 return
             else:
@@ -445,12 +871,18 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
                     LOG.debug("Packet received from %s; Checksum valid.",
                               self.address)
 
-            # Make sure we process the packet before we queue the ack.
+            # Make sure we process the packet before we queue the ack.  (We
+            # only copy the packet out of the input buffer if we're keeping
+            # it.)
             if isJunk:
+                self.clearInbuf(self.MESSAGE_LEN)
                 self.junkCallback()
             elif self.rejectPackets:
+                self.clearInbuf(self.MESSAGE_LEN)
                 self.rejectCallback()
             else:
+                pkt = str(pktView)
+                self.clearInbuf(self.MESSAGE_LEN)
                 self.packetConsumer(pkt)
 
             # Queue the ack.
@@ -547,6 +979,22 @@ class _ClientCon(MMTPClientConnection):
             self._pingLog.connectFailed(self._identity)
         MMTPClientConnection._failPendingPackets(self)
 
+def getBandwidthLimits(config):
+    """Given a ServerConfig, return a 3-tuple of the inbound bandwidth
+       limit, the outbound bandwidth limit, and the burst size, in bytes
+       per second.  MaxBandwidthIn and MaxBandwidthOut default to
+       MaxBandwidth.  Any element may be None for 'unlimited' or
+       'default'."""
+    server = config['Server']
+    maxbw = server.get('MaxBandwidth')
+    maxbwin = server.get('MaxBandwidthIn')
+    if maxbwin is None:
+        maxbwin = maxbw
+    maxbwout = server.get('MaxBandwidthOut')
+    if maxbwout is None:
+        maxbwout = maxbw
+    return maxbwin, maxbwout, server.get('MaxBandwidthSpike')
+
 LISTEN_BACKLOG = 128
 class MMTPAsyncServer(AsyncServer):
     """A helper class to invoke AsyncServer, MMTPServerConnection, and
@@ -557,31 +1005,52 @@ class MMTPAsyncServer(AsyncServer):
     # clientContext: a TLSContext object to use for initiated connections.
     # clientConByAddr: A map from 3-tuples returned by MMTPClientConnection.
     #     getAddr, to MMTPClientConnection objects.
-    # certificateCache: A PeerCertificateCache object.
+    # certificateCache: A PeerCertificateCache object, saved in the work
+    #     directory so that we don't need to re-verify every peer's
+    #     certificate after a restart.
+    # sessionCache: A TLSSessionCache object holding sessions that we can
+    #     resume with other servers, or None if we don't resume sessions.
     # listeners: A list of ListenConnection objects.
     # _timeout: The number of seconds of inactivity to allow on a connection
     #     before formerly shutting it down.
     # dnsCache: An instance of mixminion.server.DNSFarm.DNSCache.
     # msgQueue: An instance of MessageQueue to receive notification from DNS
     #     DNS threads.  See _queueSendablePackets for more information.
+    # wakeupConnection: A WakeupConnection that we poke whenever we add to
+    #     msgQueue, so that the main loop notices right away.  None if
+    #     we can't make one on this platform.
     # _lock: protects only serverContext.
     # maxClientConnections: Number of client connections we're willing
     #     to have outgoing at any time.  If we try to deliver packets
     #     to a new server, but we already have this many open outgoing
     #     connections, we put the packets in pendingPackets.
     # pendingPackets: A list of tuples to serve as arguments for _sendPackets.
+    # idleTimeout: The number of seconds to keep an outgoing connection open
+    #     after it has delivered all its packets, so that later batches to
+    #     the same server can reuse it.  None if we close connections as
+    #     soon as they are done.
+    # _idleHeap: A heap of (time, addr, connection) tuples for idle client
+    #     connections, ordered by the time at which we might close them.
+    #     Entries for connections that have since been reused or closed are
+    #     discarded when they reach the front.
 
     def __init__(self, config, servercontext):
         AsyncServer.__init__(self)
 
         self.serverContext = servercontext
-        self.clientContext = _ml.TLSContext_new()
+        self.clientContext = _ml.TLSContext_new(
+            ecdh=config['Server'].get('UseECDHE', 0))
         self._lock = threading.Lock()
         self.maxClientConnections = config['Outgoing/MMTP'].get(
             'MaxConnections', 16)
-        maxbw = config['Server'].get('MaxBandwidth', None)
-        maxbwspike = config['Server'].get('MaxBandwidthSpike', None)
-        self.setBandwidth(maxbw, maxbwspike)
+        idle = config['Outgoing/MMTP'].get('IdleTimeout')
+        if idle is not None and idle.getSeconds() > 0:
+            self.idleTimeout = idle.getSeconds()
+        else:
+            self.idleTimeout = None
+        self._idleHeap = []
+        maxbwin, maxbwout, maxbwspike = getBandwidthLimits(config)
+        self.bandwidth.setBandwidth(maxbwin, maxbwout, maxbwspike)
 
         # Don't always listen; don't always retransmit!
         # FFFF Support listening on multiple IPs
@@ -618,9 +1087,22 @@ class MMTPAsyncServer(AsyncServer):
 
         self._timeout = config['Server']['Timeout'].getSeconds()
         self.clientConByAddr = {}
-        self.certificateCache = PeerCertificateCache()
+        tlsDir = os.path.join(config.getWorkDir(), "tls")
+        createPrivateDir(tlsDir)
+        self.certificateCache = PeerCertificateCache(
+            os.path.join(tlsDir, "certcache"))
+        lifetime = config['Server'].get('TLSSessionLifetime')
+        if lifetime is not None and lifetime.getSeconds() > 0:
+            self.sessionCache = TLSSessionCache(lifetime.getSeconds())
+        else:
+            self.sessionCache = None
         self.dnsCache = None
         self.msgQueue = MessageQueue()
+        if fcntl is not None:
+            self.wakeupConnection = WakeupConnection()
+            self.register(self.wakeupConnection)
+        else:
+            self.wakeupConnection = None
         self.pendingPackets = []
         self.pingLog = None
 
@@ -641,13 +1123,6 @@ class MMTPAsyncServer(AsyncServer):
         self.serverContext = servercontext
         self._lock.release()
 
-    def getNextTimeoutTime(self, now=None):
-        """Return the time at which we next purge connections, if we have
-           last done so at time 'now'."""
-        if now is None:
-            now = time.time()
-        return now + self._timeout
-
     def _newMMTPConnection(self, sock):
         """helper method.  Creates and registers a new server connection when
            the listener socket gets a hit."""
@@ -725,6 +1200,8 @@ class MMTPAsyncServer(AsyncServer):
            It is safe to call this function from any thread.
            """
         self.msgQueue.put((family,addr,port,keyID,deliverable,serverName))
+        if self.wakeupConnection is not None:
+            self.wakeupConnection.wakeup()
 
     def _sendQueuedPackets(self):
         """Helper function: Find all DNS lookup results and packets in
@@ -732,7 +1209,9 @@ class MMTPAsyncServer(AsyncServer):
 
            This function should only be called from the main thread.
         """
-        while len(self.clientConByAddr) < self.maxClientConnections and self.pendingPackets:
+        while self.pendingPackets and (
+            len(self.clientConByAddr) < self.maxClientConnections or
+            self._closeOldestIdleConnection()):
             args = self.pendingPackets.pop(0)
             LOG.debug("Sending %s delayed packets...",len(args[5]))
             self._sendPackets(*args)
@@ -764,9 +1243,11 @@ class MMTPAsyncServer(AsyncServer):
                           len(deliverable), con.address)
                 for d in deliverable:
                     con.addPacket(d)
+                self.refresh(con)
                 return
 
-        if len(self.clientConByAddr) >= self.maxClientConnections:
+        if (len(self.clientConByAddr) >= self.maxClientConnections and
+            not self._closeOldestIdleConnection()):
             LOG.debug("We already have %s open client connections; delaying %s packets for %s",
                       len(self.clientConByAddr), len(deliverable), serverName)
             self.pendingPackets.append((family,ip,port,keyID,deliverable,serverName))
@@ -778,14 +1259,18 @@ class MMTPAsyncServer(AsyncServer):
             finished = lambda addr=addr, self=self: self.__clientFinished(addr)
             con = _ClientCon(
                 family, ip, port, keyID, serverName=serverName,
-                context=self.clientContext, certCache=self.certificateCache)
+                context=self.clientContext, certCache=self.certificateCache,
+                keepAlive=(self.idleTimeout is not None),
+                sessionCache=self.sessionCache)
             nickname = mixminion.ServerInfo.getNicknameByKeyID(keyID)
             if nickname is not None:
                 # If we recognize this server, then we'll want to tell
                 # the ping log what happens to our connection attempt.
                 con.configurePingLog(self.pingLog, keyID)
-            #con.allPacketsSent = finished #XXXX007 wrong!
             con.onClosed = finished
+            if self.idleTimeout is not None:
+                con.allPacketsSent = (lambda addr=addr, self=self:
+                                      self.__clientIdle(addr))
         except (socket.error, MixProtocolError), e:
             LOG.error("Unexpected socket error connecting to %s: %s",
                       serverName, e)
@@ -814,6 +1299,77 @@ class MMTPAsyncServer(AsyncServer):
             LOG.warn("Didn't find client connection to %s in address map",
                      addr)
 
+    def __clientIdle(self, addr):
+        """Called when a pooled client connection has delivered all its
+           packets: remember to close it if nobody reuses it."""
+        con = self.clientConByAddr.get(addr)
+        if con is None or not con.isIdle():
+            return
+        heapq.heappush(self._idleHeap,
+                       (con.getLastActivity()+self.idleTimeout, addr, con))
+
+    def _closeIdleConnection(self, addr, con):
+        """Helper: shut down the idle client connection 'con' to 'addr', and
+           forget about it so that new packets for 'addr' get a fresh
+           connection.  Return true iff the connection was idle."""
+        if not con.startIdleShutdown():
+            return 0
+        self.refresh(con)
+        if self.clientConByAddr.get(addr) is con:
+            del self.clientConByAddr[addr]
+        # We've already forgotten about this connection.
+        con.onClosed = lambda: None
+        return 1
+
+    def _closeOldestIdleConnection(self):
+        """Helper: if we have any idle client connections, close the one
+           that has been idle longest, to make room for a new connection.
+           Return true iff we closed one."""
+        oldest = None
+        for addr, con in self.clientConByAddr.items():
+            if con.isIdle() and (oldest is None or
+                   con.getLastActivity() < oldest[1].getLastActivity()):
+                oldest = addr, con
+        if oldest is None:
+            return 0
+        return self._closeIdleConnection(*oldest)
+
+    def closeIdleConnections(self, now=None):
+        """Shut down every pooled client connection that has been idle for
+           longer than self.idleTimeout."""
+        if now is None:
+            now = time.time()
+        heap = self._idleHeap
+        while heap and heap[0][0] <= now:
+            _, addr, con = heapq.heappop(heap)
+            if self.clientConByAddr.get(addr) is not con or not con.isIdle():
+                # Reused, or already closed.
+                continue
+            deadline = con.getLastActivity()+self.idleTimeout
+            if deadline > now:
+                heapq.heappush(heap, (deadline, addr, con))
+            else:
+                self._closeIdleConnection(addr, con)
+
+    def tryTimeout(self, now=None):
+        """Timeout any connection that is too old, close any pooled
+           connection that has been idle for too long, and forget any TLS
+           session that is too old to resume.  Save any newly verified
+           certificates."""
+        if now is None:
+            now = time.time()
+        AsyncServer.tryTimeout(self, now)
+        self.closeIdleConnections(now)
+        if self.sessionCache is not None:
+            self.sessionCache.clean(now)
+        self.certificateCache.save()
+
+    def getNextTimeoutTime(self, now=None):
+        t = AsyncServer.getNextTimeoutTime(self, now)
+        if self._idleHeap and (t < 0 or self._idleHeap[0][0] < t):
+            t = self._idleHeap[0][0]
+        return t
+
     def onPacketReceived(self, pkt):
         """Abstract function.  Called when we get a packet"""
         pass
@@ -823,4 +1379,8 @@ class MMTPAsyncServer(AsyncServer):
            checking fd status.
         """
         self._sendQueuedPackets()
+        if self.wakeupConnection is None:
+            # Nobody can wake us up when DNS lookups finish, so check
+            # for them at least once a second.
+            timeout = min(timeout, 1)
         AsyncServer.process(self, timeout)
@@ -8,15 +8,19 @@
 # FFFF We may, someday, want to support non-exit modules here.
 # FFFF Maybe we should refactor MMTP delivery here too.
 
-__all__ = ['ModuleManager', 'DeliveryModule',
+__all__ = ['ModuleManager', 'DeliveryModule', 'SMTPSessionPool',
+           'ModuleWorkerPool', 'ModuleBacklogFull',
            'DELIVER_OK', 'DELIVER_FAIL_RETRY', 'DELIVER_FAIL_NORETRY']
 
+import binascii
+import cStringIO
 import errno
 import os
 import re
 import sys
 import smtplib
 import socket
+import struct
 import subprocess
 import threading
 import time
@@ -38,8 +42,9 @@ import mixminion.server.PacketHandler
 from mixminion.Config import ConfigError
 from mixminion.Common import LOG, MixError, ceilDiv, createPrivateDir, \
     encodeBase64, floorDiv, isPrintingAscii, isSMTPMailbox, previousMidnight,\
-    readFile, waitForChildren
-from mixminion.Packet import ParseError, CompressedDataTooLong, uncompressData
+    readFile, secureDelete, waitForChildren
+from mixminion.Packet import ParseError, CompressedDataTooLong, \
+    uncompressFile
 
 # Return values for processMessage
 DELIVER_OK = 1
@@ -77,6 +82,13 @@ class DeliveryModule:
            in ServerQueue.DeliveryQueue.setRetrySchedule."""
         return None
 
+    def getDeliveryThreads(self):
+        """Return the number of threads that should deliver this module's
+           messages at once, unless the configuration says otherwise.
+           Modules whose processMessage is slow and safe to call from
+           several threads at once should return more than 1."""
+        return 1
+
     def getConfigSyntax(self):
         """Return a map from section names to section syntax, as described
            in Config.py"""
@@ -194,89 +206,345 @@ class SimpleModuleDeliveryQueue(mixminion.server.ServerQueue.DeliveryQueue):
        don't care about batching messages to like addresses."""
     # Fields:
     # module: the underlying module.
+    # workers: None, or a ModuleWorkerPool whose threads deliver our
+    #    messages in the background.
     def __init__(self, module, directory, retrySchedule=None):
         mixminion.server.ServerQueue.DeliveryQueue.__init__(self, directory,
                                                             retrySchedule)
         self.module = module
+        self.workers = None
 
     def getPriority(self):
         return 0
 
+    def setWorkerPool(self, workers):
+        """Deliver messages from this queue with the threads of 'workers',
+           rather than one at a time from sendReadyMessages."""
+        self.workers = workers
+
+    def queueDeliveryMessage(self, packet, address=None, now=None):
+        # Messages reassembled from fragments keep their contents in a
+        # spool file outside the queue; remember it, so that we remove it
+        # along with the message.
+        spoolFile = None
+        if isinstance(packet, _FragmentedDeliveryMessage):
+            spoolFile = packet.fname
+        return mixminion.server.ServerQueue.DeliveryQueue.queueDeliveryMessage(
+            self, packet, address, now, spoolFile)
+
     def _deliverMessages(self, msgList):
+        if self.workers is not None:
+            self.workers.addMessages(msgList)
+            return
         for handle in msgList:
+            self._deliverMessage(handle)
+
+    def _deliverMessage(self, handle):
+        """Try to deliver a single PendingMessage via our module, and
+           mark it as succeeded or failed as appropriate."""
+        try:
+            dh = handle.getHandle()  # display handle
+            EventStats.log.attemptedDelivery()  # FFFF
             try:
-                dh = handle.getHandle()  # display handle
-                EventStats.log.attemptedDelivery()  # FFFF
-                try:
-                    packet = handle.getMessage()
-                except mixminion.Filestore.CorruptedFile:
-                    packet = None
-                if packet:
-                    result = self.module.processMessage(packet)
-                if not packet:
-                    pass  # Python<2.1 doesn't allow 'continue' inside 'try'.
-                elif result == DELIVER_OK:
-                    LOG.debug("Successfully delivered message MOD:%s", dh)
-                    handle.succeeded()
-                    EventStats.log.successfulDelivery()  # FFFF
-                elif result == DELIVER_FAIL_RETRY:
-                    LOG.debug("Unable to deliver message MOD:%s; will retry",
-                              dh)
-                    handle.failed(1)
-                    EventStats.log.failedDelivery()  # FFFF
-                else:
-                    assert result == DELIVER_FAIL_NORETRY
-                    LOG.error("Unable to deliver message MOD:%s; giving up",
-                              dh)
-                    handle.failed(0)
-                    EventStats.log.unretriableDelivery()  # FFFF
-            except:
-                LOG.error_exc(sys.exc_info(),
-                              "Exception delivering message")
+                packet = handle.getMessage()
+            except mixminion.Filestore.CorruptedFile:
+                packet = None
+            if packet:
+                result = self.module.processMessage(packet)
+            if not packet:
+                pass  # Python<2.1 doesn't allow 'continue' inside 'try'.
+            elif result == DELIVER_OK:
+                LOG.debug("Successfully delivered message MOD:%s", dh)
+                handle.succeeded()
+                EventStats.log.successfulDelivery()  # FFFF
+            elif result == DELIVER_FAIL_RETRY:
+                LOG.debug("Unable to deliver message MOD:%s; will retry",
+                          dh)
+                handle.failed(1)
+                EventStats.log.failedDelivery()  # FFFF
+            else:
+                assert result == DELIVER_FAIL_NORETRY
+                LOG.error("Unable to deliver message MOD:%s; giving up",
+                          dh)
                 handle.failed(0)
                 EventStats.log.unretriableDelivery()  # FFFF
+        except:
+            LOG.error_exc(sys.exc_info(),
+                          "Exception delivering message")
+            handle.failed(0)
+            EventStats.log.unretriableDelivery()  # FFFF
 
 
-class DeliveryThread(threading.Thread):
-    """A thread object used by ModuleManager to send messages in the
-       background; delegates to ModuleManager._sendReadyMessages."""
+class SMTPDeliveryQueue(SimpleModuleDeliveryQueue):
+    """Delivery queue for modules that send mail through an
+       SMTPSessionPool.  Same as SimpleModuleDeliveryQueue, except that we
+       deliver each batch with several threads at once, so that one slow
+       message doesn't hold up the others.  (If we have a ModuleWorkerPool,
+       its threads do this instead.)  The pool enforces the limit on
+       concurrent sessions; each message is still retried or dropped on its
+       own."""
     # Fields:
-    # moduleManager -- a ModuleManager object.
-    # event -- an Event that is set when we have messages to deliver, or
-    #    when we're stopping.
-    # __stoppingEvent -- an event that is set when we're shutting down.
-    def __init__(self, moduleManager):
-        """Create a new DeliveryThread."""
-        threading.Thread.__init__(self)
-        self.moduleManager = moduleManager
-        self.event = threading.Event()
-        self.__stoppingevent = threading.Event()
-
-    def beginSending(self):
-        """Tell this thread that there are messages ready to be sent."""
-        self.event.set()
+    # pool: the module's SMTPSessionPool.
+    def __init__(self, module, directory, retrySchedule=None):
+        SimpleModuleDeliveryQueue.__init__(self, module, directory,
+                                           retrySchedule)
+        self.pool = module.smtpPool
+
+    def _deliverMessages(self, msgList):
+        self.pool.clean()
+        nThreads = min(len(msgList), self.pool.getMaxConnections())
+        if nThreads <= 1 or self.workers is not None:
+            SimpleModuleDeliveryQueue._deliverMessages(self, msgList)
+            return
+
+        LOG.debug("Delivering %s messages with %s threads",
+                  len(msgList), nThreads)
+        todo = msgList[:]
+        todo.reverse()
+        lock = threading.Lock()
+
+        def worker(todo=todo, lock=lock, self=self):
+            while 1:
+                lock.acquire()
+                try:
+                    if not todo:
+                        return
+                    handle = todo.pop()
+                finally:
+                    lock.release()
+                self._deliverMessage(handle)
+
+        threads = []
+        for _ in xrange(nThreads):
+            t = threading.Thread(target=worker)
+            threads.append(t)
+            t.start()
+        for t in threads:
+            t.join()
+
+
+class ModuleBacklogFull(MixError):
+    """Exception raised by ModuleManager.queueDecodedMessage when the
+       module that should deliver a message already has too many messages
+       waiting for its delivery threads.  The caller should hold on to the
+       message and try again later."""
+
+
+class ModuleWorkerPool:
+    """A set of threads that deliver messages for a single module's queue
+       in the background, so that one slow module can't hold up the others.
+
+       The threads do two kinds of work: flushing the queue (calling its
+       sendReadyMessages method), and delivering individual PendingMessage
+       objects that a SimpleModuleDeliveryQueue hands us via addMessages.
+       At most one thread flushes the queue at a time; up to nThreads
+       messages are delivered at once.
+    """
+    ## Fields:
+    # name: the name of the module whose queue we serve.
+    # queue: the module's delivery queue.
+    # nThreads: the number of threads we run.
+    # maxBacklog: the largest number of messages that may be waiting for
+    #    our threads before we stop accepting new ones, or None for no
+    #    limit.
+    # onFlushed: None, or a function to call after every flush of our
+    #    queue.
+    # threads: a list of our threading.Thread objects.
+    # _cond: a threading.Condition that must be held when accessing any of
+    #    the fields below.
+    # _jobs: a list of PendingMessage objects waiting for a thread.
+    # _nBusy: the number of threads currently delivering a message.
+    # _nArrived: the number of messages queued since the last flush began.
+    # _flushRequested: true iff we've been asked to flush our queue, and no
+    #    thread has started doing so.
+    # _flushing: true iff a thread is flushing our queue right now.
+    # _stopping: true iff we're shutting down.
+    # _stats: a map from statistic name to value.  See getStatistics.
+    def __init__(self, name, queue, nThreads=1, maxBacklog=None,
+                 onFlushed=None):
+        """Create a new ModuleWorkerPool to deliver the messages in
+           'queue', the queue for the module called 'name'.  Doesn't start
+           any threads."""
+        self.name = name
+        self.queue = queue
+        self.nThreads = nThreads
+        self.maxBacklog = maxBacklog
+        self.onFlushed = onFlushed
+        self.threads = []
+        self._cond = threading.Condition()
+        self._jobs = []
+        self._nBusy = 0
+        self._nArrived = 0
+        self._flushRequested = 0
+        self._flushing = 0
+        self._stopping = 0
+        self._stats = {}
+        self.resetStatistics()
+
+    def start(self):
+        """Start our threads.  Should only be called once."""
+        for i in xrange(self.nThreads):
+            t = threading.Thread(target=self._run,
+                                 name="%s delivery %s" % (self.name, i))
+            self.threads.append(t)
+            t.start()
 
     def shutdown(self):
-        """Tell this thread to shut down after sending further messages."""
-        LOG.info("Telling delivery thread to shut down.")
-        self.__stoppingevent.set()
-        self.event.set()
+        """Tell our threads to stop once they're done with the message
+           they're delivering now.  Messages that are still waiting for a
+           thread stay pending in the queue, and are retried next time we
+           start."""
+        self._cond.acquire()
+        try:
+            self._stopping = 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def join(self):
+        """Wait for all of our threads to finish."""
+        for t in self.threads:
+            t.join()
+
+    def isAlive(self):
+        """Return true iff all of our threads are still running."""
+        for t in self.threads:
+            if not t.isAlive():
+                return 0
+        return 1
+
+    def flush(self):
+        """Tell one of our threads to flush the queue.  If a flush is
+           already waiting for a thread, do nothing."""
+        self._cond.acquire()
+        try:
+            self._flushRequested = 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def addMessages(self, msgList):
+        """Add a list of PendingMessage objects for our threads to deliver."""
+        if not msgList:
+            return
+        self._cond.acquire()
+        try:
+            self._jobs.extend(msgList)
+            self._stats['maxBacklog'] = max(self._stats['maxBacklog'],
+                                            self._getBacklog())
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
 
-    def run(self):
+    def noteArrival(self):
+        """Called when a new message is queued for our module.  If the
+           module's backlog is already full, raise ModuleBacklogFull."""
+        self._cond.acquire()
+        try:
+            if (self.maxBacklog is not None and
+                self._getBacklog() >= self.maxBacklog):
+                self._stats['deferred'] += 1
+                raise ModuleBacklogFull("Too many messages waiting for "
+                                        "module %s" % self.name)
+            self._nArrived += 1
+        finally:
+            self._cond.release()
+
+    def getBacklog(self):
+        """Return the number of messages that are waiting to be delivered
+           by our threads, or are being delivered now."""
+        self._cond.acquire()
+        try:
+            return self._getBacklog()
+        finally:
+            self._cond.release()
+
+    def _getBacklog(self):
+        """As getBacklog, but the caller must hold self._cond."""
+        return len(self._jobs) + self._nBusy + self._nArrived
+
+    def getStatistics(self):
+        """Return a dict of statistics for this pool since the last call to
+           resetStatistics.  Keys are: 'backlog' (the current backlog, as
+           returned by getBacklog), 'maxBacklog' (the largest backlog
+           we've seen), 'delivered' (the number of delivery attempts),
+           'totalLatency' and 'maxLatency' (the total and largest time
+           spent on a single delivery attempt, in seconds), 'flushes' (the
+           number of times we've flushed the queue), and 'deferred' (the
+           number of messages we refused because our backlog was full)."""
+        self._cond.acquire()
+        try:
+            stats = self._stats.copy()
+            stats['backlog'] = self._getBacklog()
+            return stats
+        finally:
+            self._cond.release()
+
+    def resetStatistics(self):
+        """Set all statistics returned by getStatistics to 0."""
+        self._cond.acquire()
+        try:
+            self._stats = { 'maxBacklog' : self._getBacklog(),
+                            'delivered' : 0,
+                            'totalLatency' : 0.0,
+                            'maxLatency' : 0.0,
+                            'flushes' : 0,
+                            'deferred' : 0 }
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        """Main loop for our threads."""
         try:
             while 1:
-                self.event.wait()
-                self.event.clear()
-                stop = self.__stoppingevent.isSet()
-                if stop:
-                    LOG.info("Delivery thread shutting down.")
-                    self.moduleManager.close()
-                    return
-                self.moduleManager._sendReadyMessages()
-                waitForChildren(blocking=0)
+                self._cond.acquire()
+                try:
+                    while not (self._stopping or self._jobs or
+                               (self._flushRequested and not self._flushing)):
+                        self._cond.wait()
+                    if self._stopping:
+                        return
+                    if self._jobs:
+                        job = self._jobs.pop(0)
+                        self._nBusy += 1
+                    else:
+                        job = None
+                        self._flushRequested = 0
+                        self._flushing = 1
+                        self._nArrived = 0
+                finally:
+                    self._cond.release()
+
+                start = time.time()
+                try:
+                    if job is not None:
+                        self.queue._deliverMessage(job)
+                    else:
+                        self.queue.sendReadyMessages()
+                        waitForChildren(blocking=0)
+                finally:
+                    elapsed = time.time() - start
+                    self._cond.acquire()
+                    try:
+                        if job is not None:
+                            self._nBusy -= 1
+                            self._stats['delivered'] += 1
+                            self._stats['totalLatency'] += elapsed
+                            self._stats['maxLatency'] = max(
+                                self._stats['maxLatency'], elapsed)
+                        else:
+                            self._flushing = 0
+                            self._stats['flushes'] += 1
+                        self._cond.notifyAll()
+                    finally:
+                        self._cond.release()
+
+                if job is None and self.onFlushed is not None:
+                    self.onFlushed()
         except:
             LOG.error_exc(sys.exc_info(),
-                          "Exception in delivery; shutting down thread.")
+                          "Exception delivering messages for module %s; "
+                          "shutting down thread.", self.name)
 
 
 class ModuleManager:
@@ -294,6 +562,10 @@ class ModuleManager:
 
        To send messages, call 'queueMessage' for each message to send, then
        call 'sendReadyMessages'.
+
+       Once startThreading has been called, every module's queue is flushed
+       by its own ModuleWorkerPool, so that a slow module can't delay the
+       others.
        """
     ##
     # Fields
@@ -302,13 +574,25 @@ class ModuleManager:
     #    enabled: a set of enabled DeliveryModule names.
     #    nameToModule: Map from module name to module
     #    typeToModule: a map from delivery type to enabled deliverymodule.
+    #    moduleSections: a map from module name to the list of
+    #            [Delivery/...] config sections that the module defines.
     #    path: search path for python modules.
     #    queueRoot: directory where all the queues go.
     #    queues: a map from module name to queue (Queue objects must support
     #            queueMessage and sendReadyMessages as in DeliveryQueue.)
     #    _isConfigured: flag: has this modulemanager's configure method been
     #            called?
-    #    thread: None, or a DeliveryThread object.
+    #    workerConfig: a map from module name to a (nThreads, maxBacklog)
+    #            tuple, for modules whose configuration overrides the
+    #            defaults.  Either element may be None.
+    #    workers: a map from module name to ModuleWorkerPool.  Empty unless
+    #            we're threading.
+
+    # Options that we add to every [Delivery/...] section.
+    WORKER_OPTIONS = {
+        'DeliveryThreads': ('ALLOW', "int", None),
+        'MaxBacklog': ('ALLOW', "int", None),
+        }
 
     def __init__(self):
         "Create a new ModuleManager"
@@ -318,6 +602,7 @@ class ModuleManager:
 
         self.nameToModule = {}
         self.typeToModule = {}
+        self.moduleSections = {}
         self.path = []
         self.queueRoot = None
         self.queues = {}
@@ -329,13 +614,44 @@ class ModuleManager:
         self.registerModule(FragmentModule())
 
         self._isConfigured = 0
-        self.thread = None
+        self.workerConfig = {}
+        self.workers = {}
 
     def startThreading(self):
-        """Begin delivering messages in a separate thread.  Should only
-           be called once."""
-        self.thread = DeliveryThread(self)
-        self.thread.start()
+        """Begin delivering messages in the background, with one
+           ModuleWorkerPool for each enabled module.  Should only be called
+           once."""
+        for name, queue in self.queues.items():
+            nThreads, maxBacklog = self.workerConfig.get(name, (None, None))
+            if not hasattr(queue, 'setWorkerPool'):
+                # This queue can only deliver from sendReadyMessages, so
+                # there's no point in having more than one thread.
+                nThreads = 1
+            elif nThreads is None:
+                nThreads = self.nameToModule[name].getDeliveryThreads()
+            onFlushed = None
+            if queue.getPriority() < 0:
+                # This queue can insert messages into other modules' queues;
+                # give them a chance to deliver those messages right away.
+                onFlushed = lambda self=self, p=queue.getPriority(): \
+                            self._flushQueues(minPriority=p+1)
+            workers = ModuleWorkerPool(name, queue, nThreads, maxBacklog,
+                                       onFlushed)
+            if hasattr(queue, 'setWorkerPool'):
+                queue.setWorkerPool(workers)
+            LOG.debug("Delivering messages for module %s with %s threads",
+                      name, nThreads)
+            self.workers[name] = workers
+        for workers in self.workers.values():
+            workers.start()
+
+    def isAlive(self):
+        """Return true iff all of our delivery threads are running (or we
+           aren't threading)."""
+        for workers in self.workers.values():
+            if not workers.isAlive():
+                return 0
+        return 1
 
     def isConfigured(self):
         """Return true iff this object's configure method has been called"""
@@ -357,12 +673,21 @@ class ModuleManager:
         LOG.info("Loading module %s", module.getName())
         self.modules.append(module)
         syn = module.getConfigSyntax()
+        sections = []
         for sec, rules in syn.items():
             if sec in self.syntax:
                 raise ConfigError("Multiple modules want to define [%s]"
                                   % sec)
+            if sec.startswith("Delivery/"):
+                rules = rules.copy()
+                for k, v in self.WORKER_OPTIONS.items():
+                    if not rules.has_key(k):
+                        rules[k] = v
+                syn[sec] = rules
+                sections.append(sec)
         self.syntax.update(syn)
         self.nameToModule[module.getName()] = module
+        self.moduleSections[module.getName()] = sections
 
     def setPath(self, path):
         """Sets the search path for Python modules"""
@@ -401,12 +726,24 @@ class ModuleManager:
         # (As in ServerConfig)
         for m in self.modules:
             m.validateConfig(config, lines, contents)
+            for sec in self.moduleSections.get(m.getName(), []):
+                for opt in self.WORKER_OPTIONS.keys():
+                    v = config.get(sec, {}).get(opt)
+                    if v is not None and v < 1:
+                        raise ConfigError("%s in [%s] must be at least 1."
+                                          % (opt, sec))
 
     def configure(self, config):
         self._setQueueRoot(os.path.join(config.getQueueDir(), 'deliver'))
         createPrivateDir(self.queueRoot)
+        self.workerConfig = {}
         for m in self.modules:
             m.configure(config, self)
+            for sec in self.moduleSections.get(m.getName(), []):
+                nThreads = config.get(sec, {}).get('DeliveryThreads')
+                maxBacklog = config.get(sec, {}).get('MaxBacklog')
+                if nThreads is not None or maxBacklog is not None:
+                    self.workerConfig[m.getName()] = (nThreads, maxBacklog)
         self._isConfigured = 1
 
     def enableModule(self, module):
@@ -467,30 +804,58 @@ class ModuleManager:
             return "<nil>"
 
         queue = self.queues[mod.getName()]
-        LOG.debug("Delivering packet %r (type %04x) via module %s",
-                  packet.getContents()[:8], exitType, mod.getName())
+        workers = self.workers.get(mod.getName())
+        if workers is not None:
+            # Raises ModuleBacklogFull if the module can't keep up.
+            workers.noteArrival()
+        # (Don't log the start of the contents here: for a reassembled
+        # message, that would mean reading it back from disk.)
+        LOG.debug("Delivering packet (type %04x) via module %s",
+                  exitType, mod.getName())
 
         return queue.queueDeliveryMessage(packet)
 
     def shutdown(self):
-        """Tell the delivery thread (if any) to stop."""
-        if self.thread is not None:
-            self.thread.shutdown()
+        """Tell the delivery threads (if any) to stop."""
+        if self.workers:
+            LOG.info("Telling delivery threads to shut down.")
+        for workers in self.workers.values():
+            workers.shutdown()
 
     def join(self):
-        """Wait for the delivery thread (if any) to finish shutting down."""
-        if self.thread is not None:
-            self.thread.join()
+        """Wait for the delivery threads (if any) to finish shutting down."""
+        for workers in self.workers.values():
+            workers.join()
 
     def sendReadyMessages(self):
         """Begin message delivery, either by telling every module's queue to
            try sending its pending messages, or by telling the delivery
-           thread to do so if we're threading."""
-        if self.thread is not None:
-            self.thread.beginSending()
+           threads to do so if we're threading."""
+        if self.workers:
+            self._flushQueues()
         else:
             self._sendReadyMessages()
 
+    def _flushQueues(self, minPriority=None):
+        """Tell the worker pool of every queue whose priority is at least
+           minPriority to flush its queue."""
+        for name, workers in self.workers.items():
+            if (minPriority is None or
+                workers.queue.getPriority() >= minPriority):
+                workers.flush()
+
+    def getStatistics(self, reset=0):
+        """Return a map from module name to the statistics for that
+           module's ModuleWorkerPool, as returned by
+           ModuleWorkerPool.getStatistics.  If 'reset' is true, reset the
+           statistics afterwards."""
+        result = {}
+        for name, workers in self.workers.items():
+            result[name] = workers.getStatistics()
+            if reset:
+                workers.resetStatistics()
+        return result
+
     def _sendReadyMessages(self):
         """Actual implementation of message delivery. Tells every module's
            queue to send pending messages.  This is called directly if
@@ -689,11 +1054,15 @@ class FragmentDeliveryQueue:
     # Fields:
     # module: the FragmentModule.
     # directory: location used for the FragmentPool
+    # spoolDirectory: location where we write reassembled messages until
+    #    they are delivered.
     # pool: instance of FragmentPool
     def __init__(self, module, directory, manager):
         self.module = module
         self.directory = directory
+        self.spoolDirectory = directory+"_spool"
         self.manager = manager
+        createPrivateDir(self.spoolDirectory)
         self.pool = mixminion.Fragments.FragmentPool(self.directory)
         self.lock = self.module.lock
 
@@ -736,23 +1105,31 @@ class FragmentDeliveryQueue:
             self.pool.unchunkMessages()
             ready = self.pool.listReadyMessages()
             for msgid in ready:
-                msg = self.pool.getReadyMessage(msgid)
                 try:
-                    ssfm = mixminion.Packet.parseServerSideFragmentedMessage(
-                        msg)
-                    del msg
+                    fm = self._spoolReadyMessage(msgid)
                 except ParseError:
                     LOG.warn("Dropping malformed server-side fragmented "
                              "message")
                     self.pool.markMessageCompleted(msgid, rejected=1)
                     continue
-                if len(ssfm.compressedContents) > self.module.maxMessageSize:
+                if fm is None:
                     LOG.warn("Dropping over-long fragmented message")
                     self.pool.markMessageCompleted(msgid, rejected=1)
                     continue
 
-                fm = _FragmentedDeliveryMessage(ssfm)
-                self.manager.queueDecodedMessage(fm)
+                try:
+                    h = self.manager.queueDecodedMessage(fm)
+                except ModuleBacklogFull, e:
+                    # Leave this message (and the rest) in the pool until
+                    # the module has caught up.
+                    LOG.debug("Not delivering reassembled message yet: %s",
+                              e)
+                    fm.discard()
+                    break
+                if h == "<nil>":
+                    # The message was delivered immediately, or dropped;
+                    # either way, no queue is holding on to its spool file.
+                    fm.discard()
                 self.pool.markMessageCompleted(msgid)
 
             cutoff = previousMidnight(time.time()) - self.module.maxInterval
@@ -760,27 +1137,158 @@ class FragmentDeliveryQueue:
         finally:
             self.lock.release()
 
+    def _spoolReadyMessage(self, msgid):
+        """Reassemble the message with ID 'msgid' from the pool, and write
+           its uncompressed contents to a file in our spool directory,
+           never holding more than a single chunk of it in memory.  Return
+           a _FragmentedDeliveryMessage for the result, or None if the
+           message is too long to deliver.  Raise ParseError if the message
+           is malformed."""
+        base = os.path.join(self.spoolDirectory, binascii.b2a_hex(msgid))
+        rawName = base+".raw"
+        tmpName = base+".tmp"
+        msgName = base+".msg"
+
+        # First, unwhiten the message into rawName.  It's still compressed,
+        # and begins with its real exit type and address.
+        raw = open(rawName, 'w+b')
+        try:
+            tmp = open(tmpName, 'w+b')
+            try:
+                self.pool.writeReadyMessage(msgid, raw, tmp)
+            finally:
+                tmp.close()
+                secureDelete([tmpName])
+
+            raw.seek(0)
+            prefix = raw.read(mixminion.Packet.SSF_PREFIX_LEN)
+            if len(prefix) < mixminion.Packet.SSF_PREFIX_LEN:
+                raise ParseError("Server-side fragmented message too short")
+            rt, rl = struct.unpack(mixminion.Packet.SSF_UNPACK_PATTERN,
+                                   prefix)
+            ri = raw.read(rl)
+            if len(ri) < rl:
+                raise ParseError("Server-side fragmented message too short")
+            offset = mixminion.Packet.SSF_PREFIX_LEN + rl
+            raw.seek(0, 2)
+            compressedLen = raw.tell() - offset
+            if compressedLen > self.module.maxMessageSize:
+                raw.close()
+                secureDelete([rawName])
+                return None
+
+            # Now uncompress the contents into msgName.
+            raw.seek(offset)
+            out = open(msgName, 'wb')
+            try:
+                try:
+                    uncompressFile(raw, out, 20*compressedLen)
+                    tp = 'plain'
+                except CompressedDataTooLong:
+                    tp = 'long'
+                except MixError, e:
+                    tp = 'err'
+                    error = str(e)
+            finally:
+                out.close()
+            raw.close()
+        except:
+            raw.close()
+            secureDelete([n for n in (rawName, msgName)
+                          if os.path.exists(n)])
+            raise
+
+        if tp == 'plain':
+            secureDelete([rawName])
+            f = open(msgName, 'rb')
+            try:
+                bodyOffset, headers = _parseHeadersFromFile(f)
+            finally:
+                f.close()
+            return _FragmentedDeliveryMessage(rt, ri, tp, msgName,
+                                              bodyOffset, headers)
+        elif tp == 'long':
+            # Deliver the compressed contents as they are.
+            secureDelete([msgName])
+            return _FragmentedDeliveryMessage(rt, ri, tp, rawName, offset)
+        else:
+            secureDelete([msgName, rawName])
+            return _FragmentedDeliveryMessage(rt, ri, tp, error=error)
+
+# Largest number of bytes at the start of a reassembled message that we
+# examine for headers.  Each header is under 1K, and clients send only a
+# few, so this is plenty.
+_MAX_HEADERS_LEN = 64*1024
+
+def _parseHeadersFromFile(f):
+    """Given a file open to the start of a reassembled message, return a
+       2-tuple containing the offset of the message body within the file,
+       and a dictionary mapping header names to header values, as for
+       mixminion.Packet.parseMessageAndHeaders."""
+    s = f.read(_MAX_HEADERS_LEN)
+    if not s:
+        return 0, {}
+    try:
+        body, headers = mixminion.Packet.parseMessageAndHeaders(s)
+    except IndexError:
+        # Nothing but headers; parseMessageAndHeaders ran off the end.
+        return 0, {}
+    # If the headers were unparseable, body is s, and the offset is 0.
+    return len(s)-len(body), headers
 
 class _FragmentedDeliveryMessage:
     """Helper class: obeys the interface of mixminion.server.PacketHandler.
        DeliveryMessage, but contains a long message reassembled from
-       fragments."""
+       fragments.  The contents of the message are kept in a spool file,
+       so that they need not be read into memory by modules that can use
+       openContents."""
     # Fields:
-    # m: an instance of ServerSideFragmentedMessage.
     # exitType, address: the routing type and routing info for this message
-    # contents: None, or the uncompressed contents off the message if it's
-    #    been decoded.
-    # headers: None, or a dict of the message's headers.
     # tp: 'plain' or 'err' or 'long'.
-    def __init__(self, ssfm):
-        """Create a _FragmentedDeliveryMessage object from an instance of
-           mixminion.Packet.ServerSideFragmentedMessage."""
-        self.m = ssfm
-        self.exitType = self.m.routingtype
-        self.address = self.m.routinginfo
+    # fname: the name of the spool file holding the contents of the
+    #    message, or None if tp is 'err'.
+    # offset: the position within fname where the contents begin.
+    # headers: a dict of the message's headers.
+    # error: None, or a string describing why we couldn't decode the
+    #    message if tp is 'err'.
+    # contents: None, or the contents of the message, if they've been
+    #    read from the spool file.  Not pickled.
+    # printable: None, or a boolean: are the contents printing characters?
+    def __init__(self, exitType, address, tp, fname=None, offset=0,
+                 headers=None, error=None):
+        """Create a _FragmentedDeliveryMessage object for a message with
+           a given exit type and address.  The message's contents are
+           stored starting at 'offset' in the file 'fname'."""
+        self.exitType = exitType
+        self.address = address
+        self.tp = tp
+        self.fname = fname
+        self.offset = offset
+        if headers is None:
+            headers = {}
+        self.headers = headers
+        self.error = error
         self.contents = None
-        self.tp = None
-        self.headers = None
+        self.printable = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.fname is not None:
+            state['contents'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not state.has_key('fname'):
+            # Queued by an older version, which kept the (already decoded)
+            # contents in memory.
+            self.fname = None
+            self.offset = 0
+            self.printable = None
+            if self.tp == 'err':
+                self.error = self.contents
+            else:
+                self.error = None
 
     def setTagged(self, tagged=1):
         pass
@@ -794,14 +1302,32 @@ class _FragmentedDeliveryMessage:
     def getAddress(self):
         return self.address
 
+    def openContents(self):
+        """Return a file object open for reading the contents of this
+           message."""
+        if self.tp == 'err':
+            return cStringIO.StringIO(self.error)
+        elif self.fname is None:
+            return cStringIO.StringIO(self.contents)
+        f = open(self.fname, 'rb')
+        f.seek(self.offset)
+        return f
+
     def getContents(self):
         if self.contents is None:
-            self.decode()
+            f = self.openContents()
+            try:
+                self.contents = f.read()
+            finally:
+                f.close()
         return self.contents
 
+    def discard(self):
+        """Remove the spool file holding this message's contents."""
+        if self.fname is not None and os.path.exists(self.fname):
+            secureDelete([self.fname])
+
     def isPlaintext(self):
-        if self.contents is None:
-            self.decode()
         return self.tp == 'plain'
 
     def isFragment(self):
@@ -811,32 +1337,39 @@ class _FragmentedDeliveryMessage:
         return 0
 
     def isError(self):
-        if self.contents is None:
-            self.decode()
         return self.tp == 'err'
 
     def isOvercompressed(self):
-        if self.contents is None:
-            self.decode()
         return self.tp == 'long'
 
     def isPrintingAscii(self):
-        if self.contents is None:
-            self.decode()
-        return isPrintingAscii(self.contents, allowISO=1)
+        if self.printable is None:
+            if self.contents is not None:
+                self.printable = isPrintingAscii(self.contents, allowISO=1)
+            else:
+                # Check a block at a time, rather than reading the whole
+                # message.
+                self.printable = 1
+                f = self.openContents()
+                try:
+                    while 1:
+                        s = f.read(mixminion.Packet.UNCOMPRESS_BLOCK_LEN)
+                        if not s:
+                            break
+                        if not isPrintingAscii(s, allowISO=1):
+                            self.printable = 0
+                            break
+                finally:
+                    f.close()
+        return self.printable
 
     def getAsciiContents(self):
-        if self.contents is None:
-            self.decode()
-        if isPrintingAscii(self.contents, allowISO=1):
-            return self.contents
+        if self.isPrintingAscii():
+            return self.getContents()
         else:
-            return encodeBase64(self.contents)
+            return encodeBase64(self.getContents())
 
     def getHeaders(self):
-        if self.contents is None:
-            self.decode()
-        assert self.headers is not None
         return self.headers
 
     def getTextEncodedMessage(self):
@@ -846,25 +1379,8 @@ class _FragmentedDeliveryMessage:
             tp = 'TXT'
         else:
             tp = 'BIN'
-        return mixminion.Packet.TextEncodedMessage(self.contents, tp, None)
-
-    def decode(self):
-        maxLen = 20*len(self.m.compressedContents)
-        try:
-            c = uncompressData(self.m.compressedContents, maxLen)
-            self.contents, self.headers = \
-                mixminion.Packet.parseMessageAndHeaders(c)
-            self.tp = 'plain'
-        except CompressedDataTooLong:
-            self.contents = self.m.compressedContents
-            self.tp = 'long'
-            self.headers = {}
-            return
-        except MixError, e:
-            self.contents = str(e)
-            self.headers = {}
-            self.tp = 'err'
-        del self.m
+        return mixminion.Packet.TextEncodedMessage(self.getContents(), tp,
+                                                   None)
 
 
 # ----------------------------------------------------------------------
@@ -1050,6 +1566,13 @@ class MailBase:
         'ReturnAddress': ('ALLOW', None, None),
         }
 
+    # Options used by modules that deliver through an SMTPSessionPool.
+    SMTP_POOL_OPTIONS = {
+        'MaxConnections': ('ALLOW', "int", "4"),
+        'MessagesPerConnection': ('ALLOW', "int", "100"),
+        'IdleTimeout': ('ALLOW', "interval", "1 min"),
+        }
+
     def _formatEmailMessage(self, address, packet):
         """Given a RFC822 mailbox (delivery address), and an instance of
            DeliveryMessage, return a string containing a message to be sent
@@ -1118,6 +1641,38 @@ class MailBase:
 
         self.header = "".join(header)
 
+    def initializeSMTPPool(self, sec):
+        """Create self.smtpPool, an SMTPSessionPool that delivers mail as
+           configured in the section 'sec'."""
+        if getattr(self, 'smtpPool', None) is not None:
+            self.smtpPool.close()
+        idle = sec.get('IdleTimeout')
+        if idle is None:
+            idle = 60
+        else:
+            idle = idle.getSeconds()
+        self.smtpPool = SMTPSessionPool(
+            server=sec.get('SMTPServer') or 'localhost',
+            sendmailCommand=sec.get('SendmailCommand'),
+            maxConnections=sec.get('MaxConnections', 4),
+            messagesPerConnection=sec.get('MessagesPerConnection', 100),
+            idleTimeout=idle)
+
+    def closeSMTPPool(self):
+        """Close all open sessions in self.smtpPool."""
+        if getattr(self, 'smtpPool', None) is not None:
+            self.smtpPool.close()
+
+
+def _validateSMTPPoolOptions(sec, secName):
+    """Raise ConfigError if the SMTP_POOL_OPTIONS in the section 'sec'
+       (named 'secName') are unreasonable."""
+    for opt in 'MaxConnections', 'MessagesPerConnection':
+        v = sec.get(opt)
+        if v is not None and v < 1:
+            raise ConfigError("%s in [%s] must be at least 1."
+                              % (opt, secName))
+
 
 # ----------------------------------------------------------------------
 class MBoxModule(DeliveryModule, MailBase):
@@ -1138,6 +1693,7 @@ class MBoxModule(DeliveryModule, MailBase):
     #   contact: the contact address we mention in our boilerplate
     #   nickname: our server nickname; for use in our boilerplate
     #   addr: our IP address, or "<Unknown IP>": for use in our boilerplate.
+    #   smtpPool: an SMTPSessionPool used to deliver outgoing messages.
     def __init__(self):
         DeliveryModule.__init__(self)
         self.maxMessageSize = None
@@ -1157,6 +1713,7 @@ class MBoxModule(DeliveryModule, MailBase):
                'SendmailCommand': ('ALLOW', "command", None),
                'Advertise': ('ALLOW', "boolean", "yes")}
         cfg.update(MailBase.COMMON_OPTIONS)
+        cfg.update(MailBase.SMTP_POOL_OPTIONS)
         return {"Delivery/MBOX": cfg}
 
     def validateConfig(self, config, lines, contents):
@@ -1178,6 +1735,7 @@ class MBoxModule(DeliveryModule, MailBase):
                 sec['SendmailCommand'] is not None):
             raise ConfigError("Cannot specify both SMTPServer and "
                               "SendmailCommand")
+        _validateSMTPPoolOptions(sec, "Delivery/MBOX")
         config.validateRetrySchedule("Delivery/MBOX")
 
     def configure(self, config, moduleManager):
@@ -1205,6 +1763,7 @@ class MBoxModule(DeliveryModule, MailBase):
 
         # These fields are needed by MailBase
         self.initializeHeaders(sec)
+        self.initializeSMTPPool(sec)
         self.fromTag = "[Anon]"
 
         # Parse the address file.
@@ -1251,6 +1810,16 @@ class MBoxModule(DeliveryModule, MailBase):
     def getName(self):
         return "MBOX"
 
+    def createDeliveryQueue(self, queueDir):
+        return SMTPDeliveryQueue(self, queueDir,
+                                 retrySchedule=self.getRetrySchedule())
+
+    def getDeliveryThreads(self):
+        return self.smtpPool.getMaxConnections()
+
+    def close(self):
+        self.closeSMTPPool()
+
     def getExitTypes(self):
         return [mixminion.Packet.MBOX_TYPE]
 
@@ -1274,7 +1843,8 @@ class MBoxModule(DeliveryModule, MailBase):
         return sendSMTPMessage(self.cfgSection,
                                [address],
                                self.returnAddress,
-                               msg)
+                               msg,
+                               self.smtpPool)
 
 
 # ----------------------------------------------------------------------
@@ -1313,12 +1883,23 @@ class DirectSMTPModule(SMTPModule):
     # returnAddress -- The address to use in the "From:" line.
     # blacklist -- An EmailAddressSet of addresses to which we refuse
     #   to deliver messages.
+    # smtpPool -- An SMTPSessionPool used to deliver outgoing messages.
     def __init__(self):
         SMTPModule.__init__(self)
 
     def getRetrySchedule(self):
         return self.retrySchedule
 
+    def createDeliveryQueue(self, queueDir):
+        return SMTPDeliveryQueue(self, queueDir,
+                                 retrySchedule=self.getRetrySchedule())
+
+    def getDeliveryThreads(self):
+        return self.smtpPool.getMaxConnections()
+
+    def close(self):
+        self.closeSMTPPool()
+
     def getConfigSyntax(self):
         cfg = {'Enabled': ('REQUIRE', "boolean", "no"),
                'Advertise': ('ALLOW', "boolean", "yes"),
@@ -1328,6 +1909,7 @@ class DirectSMTPModule(SMTPModule):
                'SendmailCommand': ('ALLOW', "command", None),
                }
         cfg.update(MailBase.COMMON_OPTIONS)
+        cfg.update(MailBase.SMTP_POOL_OPTIONS)
         return {"Delivery/SMTP": cfg}
 
     def validateConfig(self, config, lines, contents):
@@ -1348,6 +1930,7 @@ class DirectSMTPModule(SMTPModule):
                 sec['SendmailCommand'] is not None):
             raise ConfigError("Cannot specify both SMTPServer and "
                               "SendmailCommand")
+        _validateSMTPPoolOptions(sec, "Delivery/SMTP")
         config.validateRetrySchedule("Delivery/SMTP")
 
     def configure(self, config, manager):
@@ -1368,6 +1951,7 @@ class DirectSMTPModule(SMTPModule):
         self.allowFromAddr = sec['AllowFromAddress']
 
         self.initializeHeaders(sec)
+        self.initializeSMTPPool(sec)
 
         self.maxMessageSize = _cleanMaxSize(sec['MaximumSize'],
                                             "Delivery/SMTP")
@@ -1398,7 +1982,8 @@ class DirectSMTPModule(SMTPModule):
         return sendSMTPMessage(self.cfgSection,
                                [address],
                                self.returnAddress,
-                               msg)
+                               msg,
+                               self.smtpPool)
 
 
 class MixmasterSMTPModule(SMTPModule):
@@ -1466,7 +2051,9 @@ class MixmasterSMTPModule(SMTPModule):
     def createDeliveryQueue(self, queueDir):
         # We create a temporary queue so we can hold files there for a little
         # while before passing their names to mixmaster.
-        self.tmpQueue = mixminion.Filestore.StringStore(queueDir+"_tmp", 1, 1)
+        # The mixmaster binary needs real files, so don't use segments here.
+        self.tmpQueue = mixminion.Filestore.StringStore(
+            queueDir+"_tmp", 1, 1, backend=mixminion.Filestore.BACKEND_FILES)
         self.tmpQueue.removeAll()
         return _MixmasterSMTPModuleDeliveryQueue(self, queueDir)
 
@@ -1522,7 +2109,10 @@ class _MixmasterSMTPModuleDeliveryQueue(SimpleModuleDeliveryQueue):
        SimpleModuleDeliveryQueue, except that we must call flushMixmasterPool
        after queueing messages for Mixmaster."""
     def _deliverMessages(self, msgList):
-        SimpleModuleDeliveryQueue._deliverMessages(self, msgList)
+        # We can't hand these messages to our worker pool: Mixmaster needs
+        # to have them all before we flush it.
+        for handle in msgList:
+            self._deliverMessage(handle)
         self.module.flushMixmasterPool()
 
 # ----------------------------------------------------------------------
@@ -1544,47 +2134,224 @@ def checkMailHeaders(headers):
 
 # ----------------------------------------------------------------------
 
-def sendSMTPMessage(cfgSection, toList, fromAddr, message):
+def sendSMTPMessage(cfgSection, toList, fromAddr, message, pool=None):
     """Send a single SMTP message.  The message will be delivered to
-       toList, and seem to originate from fromAddr.  We use 'server' as an
-       MTA.
-       DOCDOC
+       toList, and seem to originate from fromAddr.  If 'pool' is given,
+       it is the SMTPSessionPool to deliver through; otherwise, we use the
+       SendmailCommand or SMTPServer configured in cfgSection, with a
+       session that we close when we're done.
+
+       Returns DELIVER_OK or DELIVER_FAIL_RETRY.
     """
-    # FFFF This implementation can stall badly if we don't have a fast
-    # FFFF local MTA.
-
-    # FFFF We should leave the connection open if we're going to send many
-    # FFFF messages in a row.
-    if cfgSection['SendmailCommand'] is not None:
-        cmd, args = cfgSection['SendmailCommand']
-        args.insert(0, cmd)
-        LOG.debug("Using Sendmail Command: %s", " ".join(args))
-        p = subprocess.Popen(args,
+    if pool is not None:
+        return pool.sendMessage(toList, fromAddr, message)
+
+    pool = SMTPSessionPool(server=cfgSection.get('SMTPServer') or 'localhost',
+                           sendmailCommand=cfgSection.get('SendmailCommand'),
+                           maxConnections=1, messagesPerConnection=1)
+    try:
+        return pool.sendMessage(toList, fromAddr, message)
+    finally:
+        pool.close()
+
+
+def _runSendmail(command, message):
+    """Helper: deliver 'message' by piping it to a sendmail-style command.
+       'command' is a (cmd, args) tuple, as returned for "command" config
+       entries.  Returns DELIVER_OK or DELIVER_FAIL_RETRY."""
+    cmd, args = command
+    argv = [cmd] + list(args)
+    LOG.debug("Using Sendmail Command: %s", " ".join(argv))
+    try:
+        p = subprocess.Popen(argv,
                              stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
-        out, err = p.communicate(message)
-        if len(out) > 0:
-            LOG.warn("%s said on stdout: %s", cmd, out)
-        if len(err) > 0:
-            LOG.warn("%s said on stderr: %s", cmd, out)
-        res = DELIVER_OK
-    else:
-        server = cfgSection.get('SMTPServer', 'localhost')
-        LOG.debug("Sending message via SMTP host %s to %s", server, toList)
-        con = smtplib.SMTP(server)
+    except OSError, e:
+        if e.errno not in (errno.EAGAIN, errno.ENOMEM):
+            raise
+        LOG.warn("Transient error while running %s: %s", cmd, e)
+        return DELIVER_FAIL_RETRY
+    out, err = p.communicate(message)
+    if len(out) > 0:
+        LOG.warn("%s said on stdout: %s", cmd, out)
+    if len(err) > 0:
+        LOG.warn("%s said on stderr: %s", cmd, err)
+    return DELIVER_OK
+
+
+class SMTPSessionPool:
+    """A set of persistent SMTP sessions to a single MTA.  Rather than
+       opening a new connection for every outgoing message, we keep up to
+       'maxConnections' sessions open at once, send up to
+       'messagesPerConnection' messages over each one, and close sessions
+       that have been idle for longer than 'idleTimeout' seconds.
+
+       If we deliver with a sendmail command instead, there is nothing to
+       reuse, but we still never run more than 'maxConnections' copies of
+       the command at once.
+
+       Any number of threads may call sendMessage at once; they block while
+       all of our sessions are busy.
+    """
+    ## Fields:
+    # server: the hostname (optionally followed by :port) of our MTA.
+    # sendmailCommand: a (cmd, args) tuple, or None if we speak SMTP.
+    # maxConnections: the largest number of sessions (or sendmail
+    #    processes) that may be in use at once.
+    # messagesPerConnection: how many messages we send over a single
+    #    session before we close it.
+    # idleTimeout: how long, in seconds, we keep an unused session open.
+    # _idle: a list of [smtplib.SMTP, nMessagesSent, lastUsed] lists for
+    #    sessions that are open but not in use.  The most recently used
+    #    session is last.
+    # _nActive: the number of sessions currently in use.
+    # _cond: a threading.Condition that must be held when accessing
+    #    _idle or _nActive.
+    def __init__(self, server='localhost', sendmailCommand=None,
+                 maxConnections=4, messagesPerConnection=100,
+                 idleTimeout=60):
+        self.server = server
+        self.sendmailCommand = sendmailCommand
+        self.maxConnections = maxConnections
+        self.messagesPerConnection = messagesPerConnection
+        self.idleTimeout = idleTimeout
+        self._idle = []
+        self._nActive = 0
+        self._cond = threading.Condition()
+
+    def getMaxConnections(self):
+        """Return the largest number of messages we will try to deliver
+           at once."""
+        return self.maxConnections
+
+    def sendMessage(self, toList, fromAddr, message):
+        """Deliver 'message' to every address in toList, with the envelope
+           sender fromAddr.  Blocks until a session is available.  Returns
+           DELIVER_OK or DELIVER_FAIL_RETRY."""
+        if self.sendmailCommand is not None:
+            self._acquire()
+            try:
+                return _runSendmail(self.sendmailCommand, message)
+            finally:
+                self._release(None)
+
+        ent = self._acquire()
+        result = None
+        try:
+            while result is None:
+                reused = ent is not None
+                try:
+                    if ent is None:
+                        LOG.debug("Opening SMTP session to %s", self.server)
+                        ent = [smtplib.SMTP(self.server), 0, 0]
+                    LOG.debug("Sending message via SMTP host %s to %s",
+                              self.server, toList)
+                    ent[0].sendmail(fromAddr, toList, message)
+                    ent[1] += 1
+                    result = DELIVER_OK
+                except (smtplib.SMTPServerDisconnected, socket.error), e:
+                    if ent is not None:
+                        self._closeSession(ent)
+                        ent = None
+                    if reused:
+                        # The server probably closed this session while it
+                        # was idle.  Try again with a new one.
+                        LOG.debug("Cached SMTP session to %s failed (%s); "
+                                  "reconnecting", self.server, e)
+                    else:
+                        LOG.warn("Unsuccessful SMTP connection to %s: %s",
+                                 self.server, str(e))
+                        result = DELIVER_FAIL_RETRY
+                except smtplib.SMTPException, e:
+                    # The server refused this message, but (since smtplib
+                    # resets the session on failure) it can still be used
+                    # for others.
+                    LOG.warn("Unsuccessful SMTP connection to %s: %s",
+                             self.server, str(e))
+                    result = DELIVER_FAIL_RETRY
+        finally:
+            if result is None and ent is not None:
+                # We got an unexpected exception; don't trust this session.
+                self._closeSession(ent)
+                ent = None
+            self._release(ent)
+
+        return result
+
+    def clean(self, now=None):
+        """Close all sessions that have been idle for too long."""
+        if now is None:
+            now = time.time()
+        stale = []
+        self._cond.acquire()
         try:
-            con.sendmail(fromAddr, toList, message)
-            res = DELIVER_OK
-        except (smtplib.SMTPException, socket.error), e:
-            LOG.warn("Unsuccessful SMTP connection to %s: %s",
-                     server, str(e))
-            res = DELIVER_FAIL_RETRY
+            cutoff = now - self.idleTimeout
+            while self._idle and self._idle[0][2] < cutoff:
+                stale.append(self._idle.pop(0))
+        finally:
+            self._cond.release()
+        for ent in stale:
+            self._closeSession(ent)
 
-        con.quit()
-        con.close()
+    def close(self):
+        """Close all idle sessions."""
+        self._cond.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._cond.release()
+        for ent in idle:
+            self._closeSession(ent)
+
+    def _acquire(self):
+        """Helper: wait until fewer than maxConnections sessions are in use,
+           and claim a slot.  Return the most recently used idle session,
+           or None if there is none we can use."""
+        result = None
+        stale = []
+        self._cond.acquire()
+        try:
+            while self._nActive >= self.maxConnections:
+                self._cond.wait()
+            self._nActive += 1
+            cutoff = time.time() - self.idleTimeout
+            while self._idle:
+                ent = self._idle.pop()
+                if ent[2] >= cutoff:
+                    result = ent
+                    break
+                stale.append(ent)
+        finally:
+            self._cond.release()
+        for ent in stale:
+            self._closeSession(ent)
+        return result
+
+    def _release(self, ent):
+        """Helper: give up a slot claimed by _acquire.  If 'ent' is not None,
+           it is a session that is still usable."""
+        if ent is not None and ent[1] >= self.messagesPerConnection:
+            self._closeSession(ent)
+            ent = None
+        self._cond.acquire()
+        try:
+            self._nActive -= 1
+            if ent is not None:
+                ent[2] = time.time()
+                self._idle.append(ent)
+            self._cond.notify()
+        finally:
+            self._cond.release()
 
-    return res
+    def _closeSession(self, ent):
+        """Helper: politely close the session in 'ent'."""
+        try:
+            ent[0].quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        ent[0].close()
 
 
 # ----------------------------------------------------------------------
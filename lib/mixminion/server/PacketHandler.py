@@ -3,9 +3,17 @@
 """mixminion.server.PacketHandler: Code to process mixminion packets"""
 
 import binascii
+import cStringIO
+import signal
 import threading
 import types
 
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5 and earlier
+    multiprocessing = None
+
 from mixminion.Common import encodeBase64, formatBase64, LOG
 import mixminion.Crypto as Crypto
 import mixminion.Packet as Packet
@@ -14,7 +22,8 @@ import mixminion.BuildMessage
 from mixminion.ServerInfo import PACKET_KEY_BYTES
 from mixminion.Common import MixError, MixFatalError, isPrintingAscii
 
-__all__ = [ 'PacketHandler', 'ContentError', 'DeliveryPacket', 'RelayedPacket']
+__all__ = [ 'PacketHandler', 'ContentError', 'DeliveryPacket', 'RelayedPacket',
+            'PacketProcessingPool' ]
 
 class ContentError(MixError):
     """Exception raised when a packed is malformatted or unacceptable."""
@@ -30,6 +39,10 @@ class PacketHandler:
     # privatekeys: a list of 2-tuples of
     #      (1) a RSA private key that we accept
     #      (2) a HashLog objects corresponding to the given key
+    # hashlogsByKeyID: a map from the SHA1 hash of each public key in
+    #      privatekeys to the corresponding HashLog.
+    # generation: a counter, incremented whenever the keys change.
+    # lock: a lock to protect privatekeys, hashlogsByKeyID, and generation.
     def __init__(self, privatekeys=(), hashlogs=()):
         """Constructs a new packet handler, given a sequence of
            private key object for header encryption, and a sequence of
@@ -41,6 +54,8 @@ class PacketHandler:
            the corresponding entry of the hashlog list.
         """
         self.privatekeys = []
+        self.hashlogsByKeyID = {}
+        self.generation = 0
         self.lock = threading.Lock()
 
         assert type(privatekeys) in (types.ListType, types.TupleType)
@@ -67,6 +82,11 @@ class PacketHandler:
                     h.close()
             # Now, set the keys.
             self.privatekeys = zip(keys, hashlogs)
+            self.hashlogsByKeyID = {}
+            for k, h in self.privatekeys:
+                keyID = Crypto.sha1(Crypto.pk_encode_public_key(k))
+                self.hashlogsByKeyID[keyID] = h
+            self.generation += 1
         finally:
             self.lock.release()
 
@@ -105,138 +125,407 @@ class PacketHandler:
            packets, and exit packets are all processed faster than
            forwarded packets.  You must prevent timing attacks elsewhere."""
 
-        # Break into headers and payload
-        pkt = Packet.parsePacket(msg)
-        header1 = Packet.parseHeader(pkt.header1)
-        encSubh = header1[:Packet.ENC_SUBHEADER_LEN]
-        header1 = header1[Packet.ENC_SUBHEADER_LEN:]
-
-        assert len(header1) == Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
-        assert len(header1) == (128*16) - 256 == 1792
-
-        # Try to decrypt the first subheader.  Try each private key in
-        # order.  Only fail if all private keys fail.
-        subh = None
-        e = None
+        # Try to decrypt the first subheader.  Only fail if all private
+        # keys fail.
         self.lock.acquire()
         try:
-            for pk, hashlog in self.privatekeys:
-                try:
-                    subh = Crypto.pk_decrypt(encSubh, pk)
-                    break
-                except Crypto.CryptoError, err:
-                    e = err
+            idx, replayhash, state = _decryptSubheader(
+                msg, [ pk for pk, _ in self.privatekeys ])
+            hashlog = self.privatekeys[idx][1]
         finally:
             self.lock.release()
-        if not subh:
-            # Nobody managed to get us the first subheader.  Raise the
-            # most-recently-received error.
-            raise e
-
-        if len(subh) != Packet.MAX_SUBHEADER_LEN:
-            raise ContentError("Bad length in RSA-encrypted part of subheader")
-
-        subh = Packet.parseSubheader(subh) #may raise ParseError
-
-        # Check the version: can we read it?
-        if subh.major != Packet.MAJOR_NO or subh.minor != Packet.MINOR_NO:
-            raise ContentError("Invalid protocol version")
-
-        # Check the digest of all of header1 but the first subheader.
-        if subh.digest != Crypto.sha1(header1):
-            raise ContentError("Invalid digest")
-
-        # Get ready to generate packet keys.
-        keys = Crypto.Keyset(subh.secret)
 
         # Replay prevention
-        replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN)
-        if hashlog.seenHash(replayhash):
-            raise ContentError("Duplicate packet detected.")
-        else:
-            hashlog.logHash(replayhash)
-
-        # If we're meant to drop, drop now.
-        rt = subh.routingtype
-        if rt == Packet.DROP_TYPE:
-            return None
+        _checkAndLogHash(hashlog, replayhash)
 
-        # Prepare the key to decrypt the header in counter mode.  We'll be
-        # using this more than once.
-        header_sec_key = Crypto.aes_key(keys.get(Crypto.HEADER_SECRET_MODE))
+        return _processDecryptedPacket(state)
 
-        # Prepare key to generate padding
-        junk_key = Crypto.aes_key(keys.get(Crypto.RANDOM_JUNK_MODE))
+    def getKeyGeneration(self):
+        """Return a number that changes every time the keys of this
+           PacketHandler are changed."""
+        return self.generation
 
-        # Pad the rest of header 1
-        header1 += Crypto.prng(junk_key,
-                               Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN
-                               + subh.routinglen)
-
-        assert len(header1) == (Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
-                             + Packet.OAEP_OVERHEAD+Packet.MIN_SUBHEADER_LEN
-                                + subh.routinglen)
-        assert len(header1) == 1792 + 42 + 42 + subh.routinglen == \
-               1876 + subh.routinglen
-
-        # Decrypt the rest of header 1, encrypting the padding.
-        header1 = Crypto.ctr_crypt(header1, header_sec_key)
-
-        # If the subheader says that we have extra routing info that didn't
-        # fit in the RSA-encrypted part, get it now.
-        overflowLength = subh.getOverflowLength()
-        if overflowLength:
-            subh.appendOverflow(header1[:overflowLength])
-            header1 = header1[overflowLength:]
-
-        assert len(header1) == (
-            1876 + subh.routinglen
-            - max(0,subh.routinglen-Packet.MAX_ROUTING_INFO_LEN))
-
-        header1 = subh.underflow + header1
-
-        assert len(header1) == Packet.HEADER_LEN
-
-        # Decrypt the payload.
-        payload = Crypto.lioness_decrypt(pkt.payload,
-                              keys.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE))
-
-        # If we're an exit node, there's no need to process the headers
-        # further.
-        if rt >= Packet.MIN_EXIT_TYPE:
-            return DeliveryPacket(rt, subh.getExitAddress(0),
-                                  keys.get(Crypto.APPLICATION_KEY_MODE),
-                                  payload)
-
-        # If we're not an exit node, make sure that what we recognize our
-        # routing type.
-        if rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
-                      Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
-            raise ContentError("Unrecognized Mixminion routing type")
-
-        # Decrypt header 2.
-        header2 = Crypto.lioness_decrypt(pkt.header2,
-                           keys.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE))
+    def getEncodedKeys(self):
+        """Return a 2-tuple of the current key generation, and a list of
+           the ASN.1-encoded private keys that this PacketHandler
+           accepts."""
+        self.lock.acquire()
+        try:
+            return (self.generation,
+                    [ Crypto.pk_encode_private_key(pk)
+                      for pk, _ in self.privatekeys ])
+        finally:
+            self.lock.release()
 
-        # If we're the swap node, (1) decrypt the payload with a hash of
-        # header2... (2) decrypt header2 with a hash of the payload...
-        # (3) and swap the headers.
-        if Packet.typeIsSwap(rt):
-            hkey = Crypto.lioness_keys_from_header(header2)
-            payload = Crypto.lioness_decrypt(payload, hkey)
+    def checkReplay(self, keyID, replayhash):
+        """Given the keyID of one of our private keys, and the replay
+           prevention hash of a packet that was decrypted with that key
+           (possibly in another process), raise ContentError if we have
+           seen the packet before.  Otherwise, log the hash in the
+           corresponding HashLog."""
+        self.lock.acquire()
+        try:
+            hashlog = self.hashlogsByKeyID.get(keyID)
+        finally:
+            self.lock.release()
+        if hashlog is None:
+            # The key was retired while the packet was being processed.
+            raise ContentError("Packet was encrypted to an unknown key")
+
+        _checkAndLogHash(hashlog, replayhash)
+
+def _checkAndLogHash(hashlog, replayhash):
+    """Helper: raise ContentError if 'replayhash' is present in 'hashlog';
+       otherwise add it."""
+    if hashlog.seenHash(replayhash):
+        raise ContentError("Duplicate packet detected.")
+    else:
+        hashlog.logHash(replayhash)
+
+def _decryptSubheader(msg, privatekeys):
+    """Helper for processPacket: Given a 32K packet and a list of private
+       keys, decrypt and check the first subheader of the packet.  Return a
+       3-tuple of: the index of the key in 'privatekeys' that decrypted the
+       packet; the packet's replay-prevention hash; and an opaque state
+       object to pass to _processDecryptedPacket.
+
+       May raise CryptoError, ParseError, or ContentError."""
+
+    # Break into headers and payload
+    pkt = Packet.parsePacket(msg)
+    header1 = Packet.parseHeader(pkt.header1)
+    encSubh = header1[:Packet.ENC_SUBHEADER_LEN]
+    header1 = header1[Packet.ENC_SUBHEADER_LEN:]
+
+    assert len(header1) == Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
+    assert len(header1) == (128*16) - 256 == 1792
+
+    # Try to decrypt the first subheader.  Try each private key in
+    # order.  Only fail if all private keys fail.
+    subh = None
+    e = None
+    for idx in range(len(privatekeys)):
+        try:
+            subh = Crypto.pk_decrypt(encSubh, privatekeys[idx])
+            break
+        except Crypto.CryptoError, err:
+            e = err
+    if not subh:
+        # Nobody managed to get us the first subheader.  Raise the
+        # most-recently-received error.
+        raise e
+
+    if len(subh) != Packet.MAX_SUBHEADER_LEN:
+        raise ContentError("Bad length in RSA-encrypted part of subheader")
+
+    subh = Packet.parseSubheader(subh) #may raise ParseError
 
-            hkey = Crypto.lioness_keys_from_payload(payload)
-            header2 = Crypto.lioness_decrypt(header2, hkey)
+    # Check the version: can we read it?
+    if subh.major != Packet.MAJOR_NO or subh.minor != Packet.MINOR_NO:
+        raise ContentError("Invalid protocol version")
 
-            header1, header2 = header2, header1
+    # Check the digest of all of header1 but the first subheader.
+    if subh.digest != Crypto.sha1(header1):
+        raise ContentError("Invalid digest")
 
-        # Build the address object for the next hop
-        address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
+    # Get ready to generate packet keys.
+    keys = Crypto.Keyset(subh.secret)
+
+    replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN)
+
+    return idx, replayhash, (msg, pkt, header1, subh, keys)
+
+def _processDecryptedPacket((msg, pkt, header1, subh, keys)):
+    """Helper for processPacket: Given the state returned by
+       _decryptSubheader for a packet that is not a replay, finish
+       processing the packet.  Returns as PacketHandler.processPacket."""
+
+    # If we're meant to drop, drop now.
+    rt = subh.routingtype
+    if rt == Packet.DROP_TYPE:
+        return None
+
+    if Crypto.transform_packet is not None:
+        return _transformPacket(msg, subh, keys)
+
+    # Prepare the key to decrypt the header in counter mode.  We'll be
+    # using this more than once.
+    header_sec_key = Crypto.aes_key(keys.get(Crypto.HEADER_SECRET_MODE))
+
+    # Prepare key to generate padding
+    junk_key = Crypto.aes_key(keys.get(Crypto.RANDOM_JUNK_MODE))
+
+    # Pad the rest of header 1
+    header1 += Crypto.prng(junk_key,
+                           Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN
+                           + subh.routinglen)
+
+    assert len(header1) == (Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
+                         + Packet.OAEP_OVERHEAD+Packet.MIN_SUBHEADER_LEN
+                            + subh.routinglen)
+    assert len(header1) == 1792 + 42 + 42 + subh.routinglen == \
+           1876 + subh.routinglen
+
+    # Decrypt the rest of header 1, encrypting the padding.
+    header1 = Crypto.ctr_crypt(header1, header_sec_key)
+
+    # If the subheader says that we have extra routing info that didn't
+    # fit in the RSA-encrypted part, get it now.
+    overflowLength = subh.getOverflowLength()
+    if overflowLength:
+        subh.appendOverflow(header1[:overflowLength])
+        header1 = header1[overflowLength:]
+
+    assert len(header1) == (
+        1876 + subh.routinglen
+        - max(0,subh.routinglen-Packet.MAX_ROUTING_INFO_LEN))
+
+    header1 = subh.underflow + header1
+
+    assert len(header1) == Packet.HEADER_LEN
+
+    # Decrypt the payload.
+    payload = Crypto.lioness_decrypt(pkt.payload,
+                          keys.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE))
+
+    # If we're an exit node, there's no need to process the headers
+    # further.
+    if rt >= Packet.MIN_EXIT_TYPE:
+        return DeliveryPacket(rt, subh.getExitAddress(0),
+                              keys.get(Crypto.APPLICATION_KEY_MODE),
+                              payload)
+
+    # If we're not an exit node, make sure that what we recognize our
+    # routing type.
+    if rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
+                  Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
+        raise ContentError("Unrecognized Mixminion routing type")
+
+    # Decrypt header 2.
+    header2 = Crypto.lioness_decrypt(pkt.header2,
+                       keys.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE))
+
+    # If we're the swap node, (1) decrypt the payload with a hash of
+    # header2... (2) decrypt header2 with a hash of the payload...
+    # (3) and swap the headers.
+    if Packet.typeIsSwap(rt):
+        hkey = Crypto.lioness_keys_from_header(header2)
+        payload = Crypto.lioness_decrypt(payload, hkey)
+
+        hkey = Crypto.lioness_keys_from_payload(payload)
+        header2 = Crypto.lioness_decrypt(header2, hkey)
+
+        header1, header2 = header2, header1
+
+    # Build the address object for the next hop
+    address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
+
+    # Construct the packet for the next hop.
+    pkt = Packet.Packet(header1, header2, payload).pack()
+
+    return RelayedPacket(address, pkt)
+
+def _transformPacket(msg, subh, keys):
+    """Helper for _processDecryptedPacket: does the same work, but uses
+       Crypto.transform_packet to do all the symmetric crypto in a single
+       call."""
+    rt = subh.routingtype
+    if rt >= Packet.MIN_EXIT_TYPE:
+        mode = 0
+    elif rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
+                    Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
+        raise ContentError("Unrecognized Mixminion routing type")
+    elif Packet.typeIsSwap(rt):
+        mode = 2
+    else:
+        mode = 1
+
+    overflow, res = Crypto.transform_packet(
+        subh.secret, msg,
+        Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN + subh.routinglen,
+        subh.getOverflowLength(), subh.underflow, mode)
+    if overflow:
+        subh.appendOverflow(overflow)
+
+    if mode == 0:
+        return DeliveryPacket(rt, subh.getExitAddress(0),
+                              keys.get(Crypto.APPLICATION_KEY_MODE),
+                              res)
+
+    address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
+    return RelayedPacket(address, res)
+
+#----------------------------------------------------------------------
+# Multiprocess packet handling
+
+# State for worker processes: a list of private keys, and a parallel list of
+# their keyIDs.  Set by _initWorker.
+_WORKER_KEYS = None
+_WORKER_KEYIDS = None
+
+def _initWorker(encodedKeys):
+    """Called in each worker process of a PacketProcessingPool when it
+       starts.  Decodes the private keys we will use, and makes sure the
+       worker doesn't react to the signals meant for the server."""
+    global _WORKER_KEYS
+    global _WORKER_KEYIDS
+    # The server handles SIGTERM and SIGHUP by setting flags for its main
+    # loop; workers should just exit.  SIGINT goes to the whole process
+    # group, so leave it to the server.
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Every worker is forked with the same OpenSSL RNG state; reseed so
+    # they don't all use the same RSA blinding values.
+    Crypto.openssl_seed(40)
+    _WORKER_KEYS = [ Crypto.pk_decode_private_key(k) for k in encodedKeys ]
+    _WORKER_KEYIDS = [ Crypto.sha1(Crypto.pk_encode_public_key(k))
+                       for k in _WORKER_KEYS ]
+
+def _workerProcessPacket(msg):
+    """Called in a worker process: process a single packet, without checking
+       for replays.  Return a 4-tuple of (keyID, replay hash, result,
+       exception).  The first two are None if the packet was not
+       decrypted; the last two are None on failure or success
+       respectively."""
+    try:
+        idx, replayhash, state = _decryptSubheader(msg, _WORKER_KEYS)
+    except (MixError, Crypto.CryptoError), e:
+        return None, None, None, e
+    except Exception, e:
+        return None, None, None, MixError(
+            "Unexpected error in packet worker: %s"%e)
+
+    # Errors past this point must still be reported along with the replay
+    # hash: in the single-process case, we log the hash of any packet
+    # whose subheader decrypted, whether or not we could process the rest.
+    keyID = _WORKER_KEYIDS[idx]
+    try:
+        return keyID, replayhash, _processDecryptedPacket(state), None
+    except (MixError, Crypto.CryptoError), e:
+        return keyID, replayhash, None, e
+    except Exception, e:
+        return keyID, replayhash, None, MixError(
+            "Unexpected error in packet worker: %s"%e)
+
+class PacketProcessingPool:
+    """Runs the CPU-intensive part of PacketHandler.processPacket (RSA,
+       LIONESS, and key derivation) in a pool of worker processes.
+
+       The workers never see the HashLogs.  Instead, each one reports the
+       replay-prevention hash of its packet along with its result, and the
+       caller must pass the result to finishPacket, which checks and logs
+       the hash through the PacketHandler.  As long as finishPacket is only
+       called from one thread, replay detection stays serialized.
+
+       When the PacketHandler's keys change, we start a new set of workers
+       for the new keys, and let the old set finish its pending work.
+    """
+    ## Fields:
+    # packetHandler -- the PacketHandler whose keys and HashLogs we use.
+    # nWorkers -- the number of worker processes to run.
+    # pool -- a multiprocessing.Pool for the current keys, or None if we
+    #    have not started one yet.
+    # generation -- the key generation of packetHandler when we started
+    #    'pool'.
+    # oldPools -- a list of pools that we have stopped feeding because
+    #    the keys changed, but whose workers may still be busy.
+    # nPending -- a map from each pool in 'pool' or 'oldPools' to the
+    #    number of packets we have given it that haven't come back yet.
+    # lock -- a lock to protect 'pool', 'generation', 'oldPools', and
+    #    'nPending'.
+    def __init__(self, packetHandler, nWorkers):
+        """Create a new PacketProcessingPool to process packets for
+           'packetHandler' using 'nWorkers' processes.  Workers are not
+           started until the first packet arrives."""
+        if multiprocessing is None:
+            raise MixFatalError(
+                "Multiprocess packet handling requires Python 2.6 or later")
+        assert nWorkers >= 1
+        self.packetHandler = packetHandler
+        self.nWorkers = nWorkers
+        self.pool = None
+        self.generation = None
+        self.oldPools = []
+        self.nPending = {}
+        self.lock = threading.Lock()
 
-        # Construct the packet for the next hop.
-        pkt = Packet.Packet(header1, header2, payload).pack()
+    def processPacket(self, msg, callback):
+        """Begin processing the 32K packet 'msg' in a worker process.  When
+           the worker is done, call 'callback' with an opaque result object,
+           which should be passed to finishPacket.  Note that 'callback' is
+           invoked from a thread internal to the pool, and must not block."""
+        self.lock.acquire()
+        try:
+            pool = self.__getPool()
+            self.nPending[pool] += 1
+        finally:
+            self.lock.release()
+        def done(outcome, self=self, pool=pool, callback=callback):
+            self.lock.acquire()
+            try:
+                self.nPending[pool] -= 1
+            finally:
+                self.lock.release()
+            callback(outcome)
+        pool.apply_async(_workerProcessPacket, (msg,), callback=done)
+
+    def finishPacket(self, outcome):
+        """Given a result object from processPacket, check whether the packet
+           was a replay, and return or raise as
+           PacketHandler.processPacket."""
+        keyID, replayhash, result, error = outcome
+        if keyID is not None:
+            self.packetHandler.checkReplay(keyID, replayhash)
+        if error is not None:
+            raise error
+        return result
 
-        return RelayedPacket(address, pkt)
+    def close(self):
+        """Stop all worker processes.  Packets that are still being processed
+           are abandoned."""
+        self.lock.acquire()
+        try:
+            pools = self.oldPools
+            if self.pool is not None:
+                pools.append(self.pool)
+            self.pool = None
+            self.oldPools = []
+            self.nPending = {}
+        finally:
+            self.lock.release()
+        for p in pools:
+            p.terminate()
+            p.join()
+
+    def __getPool(self):
+        """Return a pool of workers that know the current keys, starting one
+           if necessary.  Stop any old pool that has finished its work.
+           Caller must hold self.lock."""
+        if (self.pool is None or
+            self.generation != self.packetHandler.getKeyGeneration()):
+            if self.pool is not None:
+                LOG.debug("Keys changed; restarting packet workers")
+                self.pool.close()
+                self.oldPools.append(self.pool)
+            self.generation, keys = self.packetHandler.getEncodedKeys()
+            LOG.debug("Starting %s packet processing workers",
+                      self.nWorkers)
+            self.pool = multiprocessing.Pool(self.nWorkers, _initWorker,
+                                             (keys,))
+            self.nPending[self.pool] = 0
+        if self.oldPools:
+            busy = []
+            for p in self.oldPools:
+                if self.nPending[p]:
+                    busy.append(p)
+                else:
+                    # We've already closed this pool, so its workers exit
+                    # as soon as they're idle.
+                    p.join()
+                    del self.nPending[p]
+            self.oldPools = busy
+        return self.pool
 
 class RelayedPacket:
     """A packet that is to be relayed to another server; returned by
@@ -348,6 +637,11 @@ class DeliveryPacket:
         if self.type is None: self.decode()
         return self.contents
 
+    def openContents(self):
+        """Return a file object open for reading the decoded contents of
+           this packet."""
+        return cStringIO.StringIO(self.getContents())
+
     def getDecodedPayload(self):
         """Return an instance of mixminion.Packet.Payload for this packet."""
         if self.type is None: self.decode()
@@ -8,8 +8,10 @@ __all__ = [ "ServerConfig" ]
 
 import operator
 import os
+import sys
 
 import mixminion.Config
+import mixminion.Filestore
 import mixminion.server.Modules
 from mixminion.Config import ConfigError
 from mixminion.Common import LOG
@@ -83,6 +85,15 @@ class ServerConfig(mixminion.Config._ConfigFile):
             if minSize < 0:
                 raise ConfigError("MixPoolMinSize %s must be nonnegative.")
 
+        if server.get('FECThreads', 1) < 1:
+            raise ConfigError("FECThreads must be at least 1.")
+
+        nWorkers = server.get('PacketWorkers', 0)
+        if nWorkers < 0:
+            raise ConfigError("PacketWorkers must be nonnegative.")
+        if nWorkers and sys.version_info < (2,6):
+            raise ConfigError("PacketWorkers requires Python 2.6 or later.")
+
         if not self['Incoming/MMTP'].get('Enabled'):
             LOG.warn("Disabling incoming MMTP is not yet supported.")
         if [e for e in self._sectionEntries['Incoming/MMTP']
@@ -97,10 +108,18 @@ class ServerConfig(mixminion.Config._ConfigFile):
         mc = self['Outgoing/MMTP'].get('MaxConnections')
         if mc is not None and mc < 1:
             raise ConfigError("MaxConnections must be at least 1.")
+        idle = self['Outgoing/MMTP'].get('IdleTimeout')
+        if idle is not None and (idle.getSeconds() >=
+                                 self['Server']['Timeout'].getSeconds()):
+            raise ConfigError("IdleTimeout must be shorter than Timeout.")
         bw = self['Outgoing/MMTP'].get('MaxBandwidth')
         if bw is not None and bw < 4096:
             #XXXX007 this is completely arbitrary. :P
             raise ConfigError("MaxBandwidth must be at least 4KB.")
+        for opt in 'MaxBandwidth', 'MaxBandwidthIn', 'MaxBandwidthOut':
+            bw = self['Server'].get(opt)
+            if bw is not None and bw < 4096:
+                raise ConfigError("%s must be at least 4KB."%opt)
 
         self.validateRetrySchedule("Outgoing/MMTP")
 
@@ -302,6 +321,15 @@ def _parseMixRule(s):
         raise ConfigError("Unrecognized mix algorithm %s"%s)
     return v
 
+def _parseQueueBackend(s):
+    """Validation function.  Given the name of a filestore backend, return
+       the corresponding mixminion.Filestore.BACKEND_* value."""
+    name = s.strip().lower()
+    if name not in (mixminion.Filestore.BACKEND_FILES,
+                    mixminion.Filestore.BACKEND_SEGMENTS):
+        raise ConfigError("Unrecognized queue backend %s"%s)
+    return name
+
 def _parseFraction(frac):
     """Validation function.  Converts a percentage or a number into a
        number between 0 and 1."""
@@ -356,8 +384,15 @@ SERVER_SYNTAX =  {
                      'MixPoolRate' : ('ALLOW', "fraction", "60%"),
                      'MixPoolMinSize' : ('ALLOW', "int", "5"),
 		     'Timeout' : ('ALLOW', "interval", "5 min"),
+                     'FECThreads' : ('ALLOW', "int", "1"),
                      'MaxBandwidth' : ('ALLOW', "size", None),
+                     'MaxBandwidthIn' : ('ALLOW', "size", None),
+                     'MaxBandwidthOut' : ('ALLOW', "size", None),
                      'MaxBandwidthSpike' : ('ALLOW', "size", None),
+                     'PacketWorkers' : ('ALLOW', "int", "0"),
+                     'QueueBackend' : ('ALLOW', "queueBackend", "files"),
+                     'TLSSessionLifetime' : ('ALLOW', "interval", "30 min"),
+                     'UseECDHE' : ('ALLOW', "boolean", "no"),
                      },
         #DOCDOC
         'Pinging' : { 'Enabled' : ('ALLOW', 'boolean', 'yes'),
@@ -393,6 +428,7 @@ SERVER_SYNTAX =  {
                             'Retry' : ('ALLOW', "intervalList",
                               "every 1 hour for 1 day, 7 hours for 5 days"),
                            'MaxConnections' : ('ALLOW', 'int', '16'),
+                           'IdleTimeout' : ('ALLOW', "interval", "0 sec"),
                            'Allow' : ('ALLOW*', "addressSet_allow", None),
                            'Deny' : ('ALLOW*', "addressSet_deny", None) },
         # FFFF Missing: Queue-Size / Queue config options
@@ -401,5 +437,6 @@ SERVER_SYNTAX =  {
 
 CODING_FNS = mixminion.Config._ConfigFile.CODING_FNS.copy()
 CODING_FNS.update({'mixRule':(_parseMixRule,str),
+                   'queueBackend':(_parseQueueBackend,str),
                    'fraction':(_parseFraction,
                                lambda r: "%.2f%%"%(100.*r))})
@@ -507,10 +507,18 @@ class ServerKeyring:
                           self.nickname, certStarts, certEnds)
         replaceFile(tmpName, self.certFile)
 
+        lifetime = self.config['Server'].get('TLSSessionLifetime')
+        if lifetime is not None:
+            lifetime = lifetime.getSeconds()
+        else:
+            lifetime = 0
+        ecdh = self.config['Server'].get('UseECDHE', 0)
+
         self._tlsContext = (
                     mixminion._minionlib.TLSContext_new(self.certFile,
                                                         mmtpKey,
-                                                        self._getDHFile()))
+                                                        self._getDHFile(),
+                                                        lifetime, ecdh))
         self._tlsContextExpires = expires
         return self._tlsContext
 
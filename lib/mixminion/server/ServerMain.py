@@ -61,6 +61,7 @@ import mixminion.ClientDirectory
 import mixminion.Config
 import mixminion.Crypto
 import mixminion.Filestore
+import mixminion.Fragments
 import mixminion.server.DNSFarm
 import mixminion.server.MMTPServer
 import mixminion.server.Modules
@@ -153,14 +154,18 @@ class IncomingQueue(mixminion.Filestore.StringStore):
        can read them."""
     ## Fields:
     # packetHandler -- an instance of PacketHandler.
+    # packetPool -- an instance of PacketProcessingPool, or None if we
+    #     process packets in the processing thread.
     # mixPool -- an instance of MixPool
     # processingThread -- an instance of ProcessingThread
     # pingLog -- an instance of pingLog, or None
-    def __init__(self, location, packetHandler):
+    def __init__(self, location, packetHandler, packetPool=None):
         """Create an IncomingQueue that stores its packets in <location>
-           and processes them through <packetHandler>."""
+           and processes them through <packetHandler>.  If <packetPool> is
+           provided, do the expensive part of packet processing there."""
         mixminion.Filestore.StringStore.__init__(self, location, create=1)
         self.packetHandler = packetHandler
+        self.packetPool = packetPool
         self.mixPool = None
         self.pingLog = None
 
@@ -170,8 +175,14 @@ class IncomingQueue(mixminion.Filestore.StringStore):
         self.processingThread = processingThread
         for h in self.getAllMessages():
             assert h is not None
-            self.processingThread.addJob(
-                lambda self=self, h=h: self.__deliverPacket(h))
+            if self.packetPool is not None:
+                # FFFF We hand the whole backlog to the pool at once; on a
+                # FFFF server with a huge incoming queue, we might want to
+                # FFFF feed it gradually instead.
+                self.__startPacket(h, self.messageContents(h))
+            else:
+                self.processingThread.addJob(
+                    lambda self=self, h=h: self.__deliverPacket(h))
 
     def setPingLog(self, pingLog):
         """Configure this queue to inform 'pingLog' about received
@@ -184,8 +195,11 @@ class IncomingQueue(mixminion.Filestore.StringStore):
         h = mixminion.Filestore.StringStore.queueMessage(self, pkt)
         LOG.trace("Inserting packet IN:%s into incoming queue", h)
         assert h is not None
-        self.processingThread.addJob(
-            lambda self=self, h=h: self.__deliverPacket(h))
+        if self.packetPool is not None:
+            self.__startPacket(h, pkt)
+        else:
+            self.processingThread.addJob(
+                lambda self=self, h=h: self.__deliverPacket(h))
 
     def queueMessage(self, m):
         # Never call this directly.
@@ -195,10 +209,28 @@ class IncomingQueue(mixminion.Filestore.StringStore):
         """Process a single packet with a given handle, and insert it into
            the Mix pool.  This function is called from within the processing
            thread."""
-        ph = self.packetHandler
         packet = self.messageContents(handle)
+        self.__handleResult(handle, self.packetHandler.processPacket, packet)
+
+    def __startPacket(self, handle, packet):
+        """Begin processing the packet <packet>, with a given handle, in
+           our PacketProcessingPool.  When the pool is done with it, the
+           processing thread checks it for replays and inserts it into the
+           Mix pool."""
+        def callback(outcome, self=self, handle=handle):
+            self.processingThread.addJob(
+                lambda self=self, handle=handle, outcome=outcome:
+                self.__handleResult(handle, self.packetPool.finishPacket,
+                                    outcome))
+        self.packetPool.processPacket(packet, callback)
+
+    def __handleResult(self, handle, processFn, arg):
+        """Helper: call processFn(arg) to get the result of processing the
+           packet with a given handle, and insert the result into the Mix
+           pool.  This function is called from within the processing
+           thread."""
         try:
-            res = ph.processPacket(packet)
+            res = processFn(arg)
             if res is None:
                 # Drop padding before it gets to the mix.
                 LOG.debug("Padding packet IN:%s dropped", handle)
@@ -311,7 +343,14 @@ class MixPool:
             except mixminion.Filestore.CorruptedFile:
                 continue
             if packet.isDelivery():
-                h2 = self.moduleManager.queueDecodedMessage(packet)
+                try:
+                    h2 = self.moduleManager.queueDecodedMessage(packet)
+                except mixminion.server.Modules.ModuleBacklogFull, e:
+                    # Leave the packet in the pool; we'll try again at the
+                    # next mix.
+                    LOG.debug("  (keeping packet MIX:%s in the pool: %s)",
+                              h, e)
+                    continue
                 if h2:
                     LOG.debug("  (sending packet MIX:%s to exit modules as MOD:%s)"
                               , h, h2)
@@ -485,6 +524,11 @@ class CleaningThread(threading.Thread):
 
                 secureDelete(delNames, blocking=1)
 
+            stats = mixminion.Common.getShredStats()
+            if stats:
+                LOG.info("Shredded %s files (%s bytes) at %.0f bytes/sec",
+                         stats['files'], stats['bytes'],
+                         stats['bytesPerSecond'])
             LOG.info("Cleanup thread shutting down.")
         except:
             LOG.error_exc(sys.exc_info(),
@@ -529,6 +573,9 @@ class MixminionServer(Scheduler):
     #    and places them in mixPool.
     # packetHandler: Instance of PacketHandler.  Used by incomingQueue to
     #    decrypt, check, and re-pad received packets.
+    # packetPool: Instance of PacketProcessingPool, or None.  If present,
+    #    used by incomingQueue to do packetHandler's work in worker
+    #    processes.
     # mixPool: Instance of MixPool.  Holds processed packets, and
     #    periodically decides which ones to deliver, according to some
     #    batching algorithm.
@@ -612,6 +659,15 @@ class MixminionServer(Scheduler):
 
         LOG.debug("Initializing packet handler")
         self.packetHandler = mixminion.server.PacketHandler.PacketHandler()
+        nWorkers = config['Server'].get('PacketWorkers', 0)
+        if nWorkers:
+            LOG.debug("Initializing pool of %s packet workers", nWorkers)
+            PPP = mixminion.server.PacketHandler.PacketProcessingPool
+            self.packetPool = PPP(self.packetHandler, nWorkers)
+        else:
+            self.packetPool = None
+        mixminion.Fragments.configureFEC(
+            nThreads=config['Server'].get('FECThreads', 1))
         LOG.debug("Initializing MMTP server")
         self.mmtpServer = _MMTPServer(config, None)
         LOG.debug("Initializing keys")
@@ -642,7 +698,8 @@ class MixminionServer(Scheduler):
 
         incomingDir = os.path.join(queueDir, "incoming")
         LOG.debug("Initializing incoming queue")
-        self.incomingQueue = IncomingQueue(incomingDir, self.packetHandler)
+        self.incomingQueue = IncomingQueue(incomingDir, self.packetHandler,
+                                           self.packetPool)
         LOG.debug("Found %d pending packets in incoming queue",
                   self.incomingQueue.count())
 
@@ -752,6 +809,29 @@ class MixminionServer(Scheduler):
         finally:
             self.keyring.unlock()
 
+    def prefetchHostnames(self):
+        """Tell the DNS cache to keep every server hostname in the current
+           directory resolved, so that we don't need to wait for DNS when
+           we relay packets to them."""
+        stats = self.dnsCache.getStatistics()
+        self.dnsCache.resetStatistics()
+        if stats['resolves']:
+            avgLatency = stats['totalLatency'] / stats['resolves']
+        else:
+            avgLatency = 0
+        LOG.debug("DNS cache: %s hits (%s stale), %s misses; %s resolves "
+                  "(%s failed), %.3f sec average latency, %.3f sec max",
+                  stats['hits'], stats['staleHits'], stats['misses'],
+                  stats['resolves'], stats['failures'], avgLatency,
+                  stats['maxLatency'])
+        names = {}
+        for s in self.dirClient.getAllServers():
+            hostname = s.getHostname()
+            if hostname:
+                names[hostname] = 1
+        LOG.debug("Prefetching DNS for %s server hostnames", len(names))
+        self.dnsCache.prefetch(names.keys())
+
     def updateDirectoryClient(self, reschedulePings=1):
         try:
             self.dirClient.update()
@@ -773,6 +853,8 @@ class MixminionServer(Scheduler):
                              time.time()+3600)
             reschedulePings = 0
 
+        self.prefetchHostnames()
+
         if reschedulePings:
             if self.pingGenerator:
                 self.pingGenerator.directoryUpdated()
@@ -872,40 +954,38 @@ class MixminionServer(Scheduler):
         if self.config['Server'].get("Daemon",1):
             closeUnusedFDs()
 
-        SCHEDULE_INTERVAL = 60
-        TICK_INTERVAL = self.mmtpServer.TICK_INTERVAL
+        # The longest we sleep at a time, so that we notice halted threads
+        # and events scheduled by other threads.  (The MMTP server wakes
+        # itself up when DNS threads hand it packets to send.)
+        MAX_SLEEP = 60
         while 1:
+            # Sleep until the next event is due.  (If we're rate-limited,
+            # the MMTP server refills its bandwidth buckets as it goes.)
             now = time.time()
-            nextEvent = now + SCHEDULE_INTERVAL
-            timeLeft = SCHEDULE_INTERVAL
-            nextTick = now+TICK_INTERVAL
-            while timeLeft > 0:
-                # Handle pending network events
-                self.mmtpServer.process(TICK_INTERVAL)
-                # Check for signals
-                if STOPPING:
-                    LOG.info("Caught SIGTERM; shutting down.")
-                    return
-                elif GOT_HUP:
-                    LOG.info("Caught SIGHUP")
-                    self.doReset()
-                    GOT_HUP = 0
-                # Make sure that our worker threads are still running.
-                if not (self.cleaningThread.isAlive() and
-                        self.processingThread.isAlive() and
-                        self.moduleManager.thread.isAlive()):
-                    LOG.fatal("One of our threads has halted; shutting down.")
-                    return
-
-                # Calculate remaining time until the next event.
-                now = time.time()
-                if now > nextTick:
-                    self.mmtpServer.tick()
-                    nextTick = now+TICK_INTERVAL
-                timeLeft = nextEvent - now
-
-            # An event has fired.
-            self.processEvents()
+            wakeAt = self.firstEventTime()
+            if wakeAt == -1 or wakeAt > now+MAX_SLEEP:
+                wakeAt = now+MAX_SLEEP
+            # Handle pending network events
+            self.mmtpServer.process(max(wakeAt-now, 0))
+            # Check for signals
+            if STOPPING:
+                LOG.info("Caught SIGTERM; shutting down.")
+                return
+            elif GOT_HUP:
+                LOG.info("Caught SIGHUP")
+                self.doReset()
+                GOT_HUP = 0
+            # Make sure that our worker threads are still running.
+            if not (self.cleaningThread.isAlive() and
+                    self.processingThread.isAlive() and
+                    self.moduleManager.isAlive()):
+                LOG.fatal("One of our threads has halted; shutting down.")
+                return
+
+            now = time.time()
+
+            # Run any events that have come due.
+            self.processEvents(now)
 
     def doReset(self):
         """Called when server receives SIGHUP.  Flushes logs to disk,
@@ -958,19 +1038,47 @@ class MixminionServer(Scheduler):
         # we schedule old files to get deleted in the background, rather than
         # blocking while they're deleted.
         df = self.cleaningThread.deleteFiles
+        stats = mixminion.Common.getShredStats()
+        if stats and stats['backlog']:
+            LOG.debug("%s files waiting to be shredded; shredding at "
+                      "%.0f bytes/sec", stats['backlog'],
+                      stats['bytesPerSecond'])
         self.incomingQueue.cleanQueue(df)
         self.mixPool.queue.cleanQueue(df)
         self.outgoingQueue.cleanQueue(df)
         self.moduleManager.cleanQueues(df)
+        self.logModuleStatistics()
         if self.pingLog:
             now = time.time()
             self.pingLog.rotate(now-self.config['Pinging']['RetainData'].getSeconds(),
                                 now-self.config['Pinging']['RetainResults'].getSeconds())
 
+    def logModuleStatistics(self):
+        """Log the backlog and delivery latency of every exit module since
+           the last time we were called."""
+        stats = self.moduleManager.getStatistics(reset=1)
+        names = stats.keys()
+        names.sort()
+        for name in names:
+            st = stats[name]
+            if st['delivered']:
+                avgLatency = st['totalLatency'] / st['delivered']
+            else:
+                avgLatency = 0
+            LOG.debug("Module %s: %s waiting (at most %s); %s delivered, "
+                      "%.3f sec average latency, %.3f sec max; %s flushes; "
+                      "%s deferred", name, st['backlog'], st['maxBacklog'],
+                      st['delivered'], avgLatency, st['maxLatency'],
+                      st['flushes'], st['deferred'])
+
     def close(self):
         """Release all resources; close all files."""
         if self.pingLog is not None:
             self.pingLog.shutdown()
+        if self.packetPool is not None:
+            # Any packets still in the pool stay in the incoming queue, and
+            # get processed when we restart.
+            self.packetPool.close()
         self.cleaningThread.shutdown()
         self.processingThread.shutdown()
         self.moduleManager.shutdown()
@@ -984,6 +1092,7 @@ class MixminionServer(Scheduler):
         self.packetHandler.close()
         self.moduleManager.close()
         self.outgoingQueue.close()
+        self.mmtpServer.certificateCache.save()
         if self.pingLog:
             if hasattr(self.pingLog, '_baseObject'):
                 self.pingLog._baseObject.close()
@@ -1198,6 +1307,7 @@ def runServer(cmd, args):
     try:
         mixminion.Common.configureShredCommand(config)
         mixminion.Common.configureFileParanoia(config)
+        mixminion.Filestore.configureStoreBackend(config)
         mixminion.Crypto.init_crypto(config)
 
         server = MixminionServer(config)
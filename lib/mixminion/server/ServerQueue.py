@@ -6,15 +6,20 @@
    """
 
 import cPickle
+import heapq
 import math
 import os
 import operator
 import time
 import stat
+import struct
 import sys
 import threading
+import types
 
 import mixminion.Filestore
+import mixminion.Packet
+import mixminion.server.PacketHandler as PacketHandler
 
 from mixminion.Common import MixError, MixFatalError, secureDelete, LOG, \
      createPrivateDir, readPickled, writePickled, formatTime, readFile, \
@@ -23,7 +28,8 @@ from mixminion.Crypto import getCommonPRNG
 from mixminion.Filestore import CorruptedFile
 
 __all__ = [ 'DeliveryQueue', 'TimedMixPool', 'CottrellMixPool',
-            'BinomialCottrellMixPool', 'PerAddressDeliveryQueue' ]
+            'BinomialCottrellMixPool', 'PerAddressDeliveryQueue',
+            'QueueCodec' ]
 
 def _calculateNext(lastAttempt, firstAttempt, retrySchedule, canDrop, now):
     """DOCDOC"""
@@ -74,7 +80,10 @@ class _DeliveryState:
     #    this message.  This field is invalid until someone calls
     #    setNextAttempt.  If the time is in the past, delivery can
     #    be tried now.  If None, the message may be removable.
-    def __init__(self, queuedTime=None, lastAttempt=None, address=None):
+    # spoolFile: None, or the name of a file outside the queue that holds
+    #    the message's contents.  We remove it along with the message.
+    def __init__(self, queuedTime=None, lastAttempt=None, address=None,
+                 spoolFile=None):
         """Create a new _DeliveryState for a message received at
            queuedTime (default now), whose last delivery attempt was
            at lastAttempt (default never)."""
@@ -83,6 +92,7 @@ class _DeliveryState:
         self.queuedTime = queuedTime
         self.lastAttempt = lastAttempt
         self.address = address
+        self.spoolFile = spoolFile
         self.pending = None
         self.nextAttempt = None
         self.remove = 0
@@ -110,7 +120,10 @@ class _DeliveryState:
     def __getstate__(self):
         # For pickling.  All future versions of deliverystate will pickle
         #   to a tuple, whose first element will be a version string.
-        return ("V1", self.queuedTime, self.lastAttempt, self.address)
+        if self.spoolFile is None:
+            return ("V1", self.queuedTime, self.lastAttempt, self.address)
+        return ("V2", self.queuedTime, self.lastAttempt, self.address,
+                self.spoolFile)
 
     def __setstate__(self, state):
         # For pickling.
@@ -118,6 +131,12 @@ class _DeliveryState:
             self.queuedTime = state[1]
             self.lastAttempt = state[2]
             self.address = state[3]
+            self.spoolFile = None
+        elif state[0] == "V2":
+            self.queuedTime = state[1]
+            self.lastAttempt = state[2]
+            self.address = state[3]
+            self.spoolFile = state[4]
         else:
             #XXXX008 This is way too extreme.
             raise MixFatalError("Unrecognized delivery state")
@@ -225,6 +244,7 @@ class DeliveryQueue:
            name used in log messages."""
         self.store = mixminion.Filestore.ObjectMetadataStore(
             location,create=1,scrub=1)
+        self.store.codec = QUEUE_CODEC
         self._lock = self.store._lock
         if name is None:
             self.qname = os.path.split(location)[1]
@@ -314,14 +334,17 @@ class DeliveryQueue:
         finally:
             self._lock.release()
 
-    def queueDeliveryMessage(self, msg, address=None, now=None):
+    def queueDeliveryMessage(self, msg, address=None, now=None,
+                             spoolFile=None):
         """Schedule a message for delivery.
              msg -- the message.  This can be any pickleable object.
+             spoolFile -- if provided, the name of a file holding the
+                message's contents, to be removed along with the message.
         """
         assert self.retrySchedule is not None
         try:
             self._lock.acquire()
-            ds = _DeliveryState(now,None,address)
+            ds = _DeliveryState(now,None,address,spoolFile)
             ds.setNextAttempt(self.retrySchedule, now)
             handle = self.store.queueObjectAndMetadata(msg, ds)
             LOG.trace("DeliveryQueue got message %s for %s",
@@ -410,7 +433,13 @@ class DeliveryQueue:
         raise NotImplementedError("_deliverMessages")
 
     def removeMessage(self, handle):
+        try:
+            spoolFile = self.store.getMetadata(handle).spoolFile
+        except (KeyError, CorruptedFile):
+            spoolFile = None
         self.store.removeMessage(handle)
+        if spoolFile is not None and os.path.exists(spoolFile):
+            secureDelete([spoolFile])
 
     def cleanQueue(self, secureDeleteFn=None):
         self.store.cleanQueue(secureDeleteFn)
@@ -418,7 +447,19 @@ class DeliveryQueue:
     def removeAll(self, secureDeleteFn=None):
         try:
             self._lock.acquire()
+            spoolFiles = []
+            for h in self.store.getAllMessages():
+                try:
+                    spoolFile = self.store.getMetadata(h).spoolFile
+                except (KeyError, CorruptedFile):
+                    continue
+                if spoolFile is not None and os.path.exists(spoolFile):
+                    spoolFiles.append(spoolFile)
             self.store.removeAll(secureDeleteFn)
+            if spoolFiles and secureDeleteFn:
+                secureDeleteFn(spoolFiles)
+            elif spoolFiles:
+                secureDelete(spoolFiles, blocking=1)
             self.cleanQueue()
         finally:
             self._lock.release()
@@ -543,6 +584,239 @@ class _AddressState:
             self.firstFailure = attempt
         self.lastFailure = attempt
 
+#----------------------------------------------------------------------
+# Binary record encoding for queued objects.
+#
+# Packets in the mix pool and the delivery queues, and the delivery state
+# we keep for them, used to be stored as pickles.  Pickling a 32K packet
+# costs far more than copying it, so we store the classes we know about
+# as fixed-layout records instead:
+#
+#    RECORD_MAGIC   [3 bytes]
+#    version        [1 byte: currently 1]
+#    kind           [1 byte: 'R', 'D', 'S', or 'A']
+#    body           [depends on kind]
+#
+# Strings in the body are stored as a 4-byte length and the string itself;
+# a length of 0xFFFFFFFF means None.  Times are stored as a flag byte and
+# an 8-byte double; a flag of 0 means None.  Addresses are stored as a
+# one-byte tag and a string; see _packAddress.
+#
+# A pickle never starts with RECORD_MAGIC, so anything else is decoded as
+# a legacy pickle.  Objects that don't fit one of the layouts below are
+# pickled as before.
+
+RECORD_MAGIC = "\0MQ"
+RECORD_VERSION = "\x01"
+# Fields of a DeliveryPacket that we know how to encode.
+_DELIVERY_FIELDS = [ 'exitType', 'address', 'key', 'tag', 'payload',
+                     'contents', 'type', 'headers', 'isfrag', 'dPayload',
+                     'error' ]
+_DELIVERY_FIELDS.sort()
+_NONE_LEN = 0xFFFFFFFFL
+# Used to construct DeliveryPacket objects whose payload we then replace.
+_EMPTY_PAYLOAD = "\0"*(28*1024)
+
+class _CannotEncode(Exception):
+    """Raised internally when an object doesn't fit a record layout."""
+    pass
+
+def _packStr(s):
+    """Return the record encoding of a string or None."""
+    if s is None:
+        return struct.pack("!L", _NONE_LEN)
+    elif type(s) != types.StringType:
+        raise _CannotEncode()
+    return struct.pack("!L", len(s)) + s
+
+def _packTime(t):
+    """Return the record encoding of a time or None."""
+    if t is None:
+        return "\0"+struct.pack("!d", 0)
+    return "\1"+struct.pack("!d", t)
+
+def _packAddress(addr):
+    """Return the record encoding of an address, as used by _DeliveryState
+       and _AddressState."""
+    if addr is None:
+        return "N"+_packStr("")
+    elif type(addr) == types.StringType:
+        return "S"+_packStr(addr)
+    elif isinstance(addr, mixminion.Packet.IPV4Info):
+        return "I"+_packStr(addr.pack())
+    elif isinstance(addr, mixminion.Packet.MMTPHostInfo):
+        return "H"+_packStr(addr.pack())
+    else:
+        return "P"+_packStr(cPickle.dumps(addr, 1))
+
+class _RecordReader:
+    """Helper class: walks over the body of an encoded record."""
+    ## Fields:
+    # s: the encoded record.
+    # pos: the offset of the next field to read.
+    def __init__(self, s, pos):
+        self.s = s
+        self.pos = pos
+
+    def getStr(self):
+        n, = struct.unpack("!L", self.s[self.pos:self.pos+4])
+        self.pos += 4
+        if n == _NONE_LEN:
+            return None
+        if self.pos+n > len(self.s):
+            raise ValueError("Truncated record")
+        r = self.s[self.pos:self.pos+n]
+        self.pos += n
+        return r
+
+    def getTime(self):
+        flag, t = struct.unpack("!cd", self.s[self.pos:self.pos+9])
+        self.pos += 9
+        if flag == "\0":
+            return None
+        return t
+
+    def getAddress(self):
+        tag = self.s[self.pos:self.pos+1]
+        self.pos += 1
+        v = self.getStr()
+        if tag == "N":
+            return None
+        elif tag == "S":
+            return v
+        elif tag == "I":
+            return mixminion.Packet.parseIPV4Info(v)
+        elif tag == "H":
+            return mixminion.Packet.parseMMTPHostInfo(v)
+        elif tag == "P":
+            return cPickle.loads(v)
+        raise ValueError("Unrecognized address tag %r" % tag)
+
+    def getRest(self):
+        r = self.s[self.pos:]
+        self.pos = len(self.s)
+        return r
+
+class QueueCodec(mixminion.Filestore.PickleCodec):
+    """A codec that stores RelayedPacket, DeliveryPacket, _DeliveryState,
+       and _AddressState objects as binary records, and everything else
+       as pickles.  Decodes legacy pickles transparently."""
+    def encode(self, obj):
+        cls = getattr(obj, '__class__', None)
+        try:
+            if cls is PacketHandler.RelayedPacket:
+                return self._encodeRelayed(obj)
+            elif cls is PacketHandler.DeliveryPacket:
+                return self._encodeDelivery(obj)
+            elif cls is _DeliveryState:
+                return "".join([RECORD_MAGIC, RECORD_VERSION, "S",
+                                _packTime(obj.queuedTime),
+                                _packTime(obj.lastAttempt),
+                                _packAddress(obj.address),
+                                _packStr(obj.spoolFile)])
+            elif cls is _AddressState:
+                return "".join([RECORD_MAGIC, RECORD_VERSION, "A",
+                                _packAddress(obj.address),
+                                _packTime(obj.lastSuccess),
+                                _packTime(obj.lastFailure),
+                                _packTime(obj.firstFailure)])
+        except _CannotEncode:
+            pass
+        return cPickle.dumps(obj, 1)
+
+    def decode(self, s):
+        if s[:3] != RECORD_MAGIC:
+            return cPickle.loads(s)
+        if s[3:4] != RECORD_VERSION:
+            raise ValueError("Unrecognized record version %r" % s[3:4])
+        kind = s[4:5]
+        r = _RecordReader(s, 5)
+        try:
+            if kind == "R":
+                address = r.getAddress()
+                return PacketHandler.RelayedPacket(address, r.getRest())
+            elif kind == "D":
+                return self._decodeDelivery(r)
+            elif kind == "S":
+                queuedTime = r.getTime()
+                lastAttempt = r.getTime()
+                address = r.getAddress()
+                # Older records end here.
+                spoolFile = None
+                if r.pos < len(s):
+                    spoolFile = r.getStr()
+                return _DeliveryState(queuedTime, lastAttempt, address,
+                                      spoolFile)
+            elif kind == "A":
+                st = _AddressState(r.getAddress())
+                st.lastSuccess = r.getTime()
+                st.lastFailure = r.getTime()
+                st.firstFailure = r.getTime()
+                return st
+        except mixminion.Packet.ParseError, e:
+            raise ValueError(str(e))
+        raise ValueError("Unrecognized record kind %r" % kind)
+
+    def _encodeRelayed(self, p):
+        addr = p.address
+        if not (isinstance(addr, mixminion.Packet.IPV4Info) or
+                isinstance(addr, mixminion.Packet.MMTPHostInfo)):
+            raise _CannotEncode()
+        return "".join([RECORD_MAGIC, RECORD_VERSION, "R",
+                        _packAddress(addr), p.msg])
+
+    def _encodeDelivery(self, p):
+        fields = p.__dict__.keys()
+        fields.sort()
+        if fields != _DELIVERY_FIELDS:
+            raise _CannotEncode()
+        if p.headers is None:
+            headers = [ struct.pack("!L", _NONE_LEN) ]
+        else:
+            headers = [ struct.pack("!L", len(p.headers)) ]
+            for k, v in p.headers.items():
+                headers.append(_packStr(k))
+                headers.append(_packStr(v))
+        if p.dPayload is None:
+            dPayload = None
+        else:
+            dPayload = p.dPayload.pack()
+        return "".join([RECORD_MAGIC, RECORD_VERSION, "D",
+                        struct.pack("!HB", p.exitType, p.isfrag and 1 or 0),
+                        _packStr(p.address), _packStr(p.key),
+                        _packStr(p.tag), _packStr(p.type),
+                        _packStr(p.error), _packStr(dPayload),
+                        "".join(headers),
+                        _packStr(p.contents), _packStr(p.payload)])
+
+    def _decodeDelivery(self, r):
+        exitType, isfrag = struct.unpack("!HB", r.s[r.pos:r.pos+3])
+        r.pos += 3
+        address = r.getStr()
+        key = r.getStr()
+        p = PacketHandler.DeliveryPacket(exitType, address, key,
+                                         _EMPTY_PAYLOAD)
+        p.isfrag = isfrag
+        p.tag = r.getStr()
+        p.type = r.getStr()
+        p.error = r.getStr()
+        dPayload = r.getStr()
+        if dPayload is not None:
+            p.dPayload = mixminion.Packet.parsePayload(dPayload)
+        nHeaders, = struct.unpack("!L", r.s[r.pos:r.pos+4])
+        r.pos += 4
+        if nHeaders != _NONE_LEN:
+            p.headers = {}
+            for _ in xrange(nHeaders):
+                k = r.getStr()
+                p.headers[k] = r.getStr()
+        p.contents = r.getStr()
+        p.payload = r.getStr()
+        return p
+
+# Codec used by all of our delivery queues and mix pools.
+QUEUE_CODEC = QueueCodec()
+
 class PerAddressDeliveryQueue(DeliveryQueue):
 
     """Implementats the same interface as DeliveryQueue, but retries
@@ -587,11 +861,38 @@ class PerAddressDeliveryQueue(DeliveryQueue):
     # correctly: most (all?) MTAs use a retry algorithm equivalent to
     # this one.
 
-    # DOCDOC 
+    # To avoid looking at every message whenever we send, we index the
+    # messages by address, and keep a heap of the times at which each
+    # address will next be ready.  Expiry is driven by a second heap,
+    # ordered by the time at which each message was queued.  Both heaps
+    # are lazy: entries that no longer match the queue are discarded
+    # when they reach the front.
+
+    ## Fields:
+    # addressStateDB: a WritethroughDict mapping str(address) to the
+    #    _AddressState for that address.
+    # totalLifetime: the number of seconds for which we retry a message
+    #    before giving up.
+    # _handlesByAddr: a map from str(address) to a map whose keys are the
+    #    handles of all the messages queued for that address.
+    # _addrOfHandle: a map from handle to str(address) for every message
+    #    in _handlesByAddr.
+    # _addrHeap: a heap of (nextAttempt, str(address)) tuples.  An entry
+    #    is live only if _addrScheduled maps its address to its time.
+    # _addrScheduled: a map from str(address) to the time of its live
+    #    entry in _addrHeap.  Addresses that are ready and have already
+    #    been popped from the heap don't appear here.
+    # _expiryHeap: a heap of (queuedTime, handle) tuples for every message
+    #    we might need to expire.
     def __init__(self, location, retrySchedule=None, now=None, name=None):
         self.addressStateDB = mixminion.Filestore.WritethroughDict(
             filename=os.path.join(location,"addressStatus.db"),
-            purpose="address state")
+            purpose="address state", codec=QUEUE_CODEC)
+        self._handlesByAddr = {}
+        self._addrOfHandle = {}
+        self._addrHeap = []
+        self._addrScheduled = {}
+        self._expiryHeap = []
         if retrySchedule is None:
             retrySchedule = [3600]
         DeliveryQueue.__init__(self, location=location,
@@ -614,41 +915,120 @@ class PerAddressDeliveryQueue(DeliveryQueue):
     def _rebuildNextAttempt(self, now=None):
         self._lock.acquire()
         try:
-            for ds in self.store._metadata_cache.values():
+            self._handlesByAddr = {}
+            self._addrOfHandle = {}
+            self._addrHeap = []
+            self._addrScheduled = {}
+            self._expiryHeap = []
+            for h, ds in self.store._metadata_cache.items():
                 if not self.addressStateDB.has_key(str(ds.address)):
                     as_ = _AddressState(ds.address)
                     self.addressStateDB[str(ds.address)] = as_
+                self._indexMessage(h, ds)
             if not self.retrySchedule:
                 rs = [3600]
                 self.totalLifetime = 3600
             else:
                 rs = self.retrySchedule
                 self.totalLifetime = reduce(operator.add,self.retrySchedule,0)
-            for addr_state in self.addressStateDB.values():
+            for k, addr_state in self.addressStateDB.items():
                 addr_state.setNextAttempt(rs, now)
+                if self._handlesByAddr.has_key(k):
+                    self._scheduleAddress(k, addr_state)
             self._repOK()
         finally:
             self._lock.release()
 
+    def _repOK(self):
+        DeliveryQueue._repOK(self)
+        self._lock.acquire()
+        try:
+            # Every message must be indexed under its address.  (The index
+            # may also hold messages that the store has since discarded
+            # as corrupt; we drop those when we come across them.)
+            for h, ds in self.store._metadata_cache.items():
+                k = str(ds.address)
+                assert self._addrOfHandle.get(h) == k
+                assert self._handlesByAddr[k].has_key(h)
+        finally:
+            self._lock.release()
+
+    def _indexMessage(self, handle, ds):
+        """Helper: add the message 'handle', whose _DeliveryState is 'ds',
+           to our indices.  Callers must hold self._lock."""
+        k = str(ds.address)
+        self._handlesByAddr.setdefault(k, {})[handle] = 1
+        self._addrOfHandle[handle] = k
+        heapq.heappush(self._expiryHeap, (ds.queuedTime, handle))
+
+    def _unindexMessage(self, handle):
+        """Helper: remove the message 'handle' from our indices.  Its entry
+           in _expiryHeap is left to be discarded lazily.  Callers must
+           hold self._lock."""
+        try:
+            k = self._addrOfHandle[handle]
+        except KeyError:
+            return
+        del self._addrOfHandle[handle]
+        hs = self._handlesByAddr[k]
+        del hs[handle]
+        if not hs:
+            del self._handlesByAddr[k]
+
+    def _scheduleAddress(self, key, addr_state):
+        """Helper: make sure that sendReadyMessages will look at the address
+           whose key is 'key' once addr_state.nextAttempt arrives.  Callers
+           must hold self._lock."""
+        t = addr_state.nextAttempt
+        if self._addrScheduled.get(key) != t:
+            self._addrScheduled[key] = t
+            heapq.heappush(self._addrHeap, (t, key))
+
+    def _expireMessages(self, now, skipPending=0):
+        """Helper: remove every message queued more than totalLifetime
+           seconds before 'now'.  If 'skipPending' is true, leave messages
+           that we're currently delivering in the queue.  Callers must hold
+           self._lock."""
+        heap = self._expiryHeap
+        cutoff = now - self.totalLifetime
+        deferred = []
+        while heap and heap[0][0] < cutoff:
+            item = heapq.heappop(heap)
+            h = item[1]
+            if not self._addrOfHandle.has_key(h):
+                continue
+            if skipPending:
+                ds = self.store._metadata_cache.get(h)
+                if ds is not None and ds.isPending():
+                    deferred.append(item)
+                    continue
+            #LOG.trace("     [%s] is expired", h)
+            self.removeMessage(h)
+        for item in deferred:
+            heapq.heappush(heap, item)
+
     def removeExpiredMessages(self, now=None):
-        """DOCDOC"""
+        """Remove every message that has outlived the retry schedule, and
+           forget every address with no messages that has been inactive for
+           as long."""
         assert self.retrySchedule is not None
+        if now is None:
+            now = time.time()
         self._lock.acquire()
         try:
-            have = {}
-            for h, ds in self.store._metadata_cache.items():
-                if ds.queuedTime + self.totalLifetime < now:
-                    self.removeMessage(h)
-                else:
-                    have[ds.address]=1
+            self._expireMessages(now)
 
             for k, addr_state in self.addressStateDB.items():
-                if have.has_key(addr_state.address):
+                if self._handlesByAddr.has_key(k):
                     continue
                 lastActivity = addr_state.getLastActivity()
                 if lastActivity and (
                     lastActivity + self.totalLifetime < now):
                     del self.addressStateDB[k]
+                    try:
+                        del self._addrScheduled[k]
+                    except KeyError:
+                        pass
         finally:
             self._lock.release()
 
@@ -661,41 +1041,64 @@ class PerAddressDeliveryQueue(DeliveryQueue):
         return addr_state
 
     def queueDeliveryMessage(self, msg, address, now=None):
-        self._getAddressState(address, now=now)
-        return DeliveryQueue.queueDeliveryMessage(self,msg,address,now)
+        self._lock.acquire()
+        try:
+            addr_state = self._getAddressState(address, now=now)
+            handle = DeliveryQueue.queueDeliveryMessage(self,msg,address,now)
+            self._indexMessage(handle, self.store.getMetadata(handle))
+            self._scheduleAddress(str(address), addr_state)
+            return handle
+        finally:
+            self._lock.release()
 
     def sendReadyMessages(self, now=None):
         if now is None:
             now = time.time()
         self._lock.acquire()
         try:
+            self._expireMessages(now, skipPending=1)
             messages = []
-            for h in self.store._metadata_cache.keys():
-                try:
-                    state = self.store.getMetadata(h)
-                except CorruptedFile:
-                    continue
-                if state.isPending():
-                    #LOG.trace("     [%s] is pending delivery", h)
-                    continue
-                elif state.queuedTime + self.totalLifetime < now:
-                    #LOG.trace("     [%s] is expired", h)
-                    self.removeMessage(h)
+            heap = self._addrHeap
+            cache = self.store._metadata_cache
+            while heap and heap[0][0] <= now:
+                t, k = heapq.heappop(heap)
+                if self._addrScheduled.get(k) != t:
+                    # Stale entry; the address was rescheduled or removed.
                     continue
-                addressState = self._getAddressState(state.address, now)
-                if addressState.nextAttempt <= now:
-                    #LOG.trace("     [%s] is ready for next attempt on %s", h,
-                    #          state.address)
+                del self._addrScheduled[k]
+                #LOG.trace("     [%s] is ready for next attempt", k)
+                for h in self._handlesByAddr.get(k, {}).keys():
+                    state = cache.get(h)
+                    if state is None:
+                        self._unindexMessage(h)
+                        continue
+                    if state.isPending():
+                        #LOG.trace("     [%s] is pending delivery", h)
+                        continue
                     messages.append(PendingMessage(h,self,state.address))
                     state.setPending(now)
-                else:
-                    #LOG.trace("     [%s] will wait for next attempt on %s",h,
-                    #          state.address)
-                    continue
         finally:
             self._lock.release()
 
-            self._deliverMessages(messages)
+        self._deliverMessages(messages)
+
+    def removeMessage(self, handle):
+        self._lock.acquire()
+        try:
+            self._unindexMessage(handle)
+            DeliveryQueue.removeMessage(self, handle)
+        finally:
+            self._lock.release()
+
+    def removeAll(self, secureDeleteFn=None):
+        self._lock.acquire()
+        try:
+            DeliveryQueue.removeAll(self, secureDeleteFn)
+            self._handlesByAddr = {}
+            self._addrOfHandle = {}
+            self._expiryHeap = []
+        finally:
+            self._lock.release()
 
     def cleanQueue(self, secureDeleteFn=None):
         self.sync()
@@ -719,6 +1122,7 @@ class PerAddressDeliveryQueue(DeliveryQueue):
                 aState.succeeded(now=now)
                 aState.setNextAttempt(self.retrySchedule, now)
                 self.addressStateDB[str(mState.address)] = aState
+                self._scheduleAddress(str(mState.address), aState)
 
             self.removeMessage(handle)
         finally:
@@ -757,6 +1161,7 @@ class PerAddressDeliveryQueue(DeliveryQueue):
             aState.failed(attempt=last,now=now)
             aState.setNextAttempt(self.retrySchedule,now=now)
             self.addressStateDB[str(aState.address)] = aState # flush to db.
+            self._scheduleAddress(str(aState.address), aState)
         finally:
             self._lock.release()
 
@@ -791,6 +1196,8 @@ class TimedMixPool(mixminion.Filestore.ObjectStore):
        of messages every N seconds."""
     ## Fields:
     #   interval: scanning interval, in seconds.
+    codec = QUEUE_CODEC
+
     def __init__(self, location, interval=600):
         """Create a TimedMixPool that sends its entire batch of messages
            every 'interval' seconds."""
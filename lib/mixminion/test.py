@@ -18,6 +18,7 @@ import gzip
 import operator
 import os
 import re
+import select
 import socket
 import stat
 import struct
@@ -25,6 +26,7 @@ import sys
 import threading
 import time
 import types
+import UserDict
 from string import atoi
 
 # Not every post-2.0 version of Python has a working 'unittest' module, so
@@ -837,6 +839,35 @@ World!
             self.assertEquals(lst, tst)
             tst.append("unterminated line")
 
+    def test_shredEngine(self):
+        d1 = mix_mktemp()
+        d2 = mix_mktemp()
+        createPrivateDir(d1)
+        createPrivateDir(d2)
+        fnames = []
+        for i in xrange(100):
+            for d in d1, d2:
+                fn = os.path.join(d, "f%s"%i)
+                writeFile(fn, "x"*(i*100))
+                fnames.append(fn)
+        eng = mixminion.Common.ShredEngine(nThreads=3)
+        self.assertEquals(eng.getStats()['files'], 0)
+        # Blocking shreds are done when shred() returns.
+        eng.shred(fnames[:50], blocking=1)
+        self.assertEquals(eng.getStats()['files'], 50)
+        for fn in fnames[:50]:
+            self.failIf(os.path.exists(fn))
+        # Nonblocking shreds are done when wait() returns.  Missing files
+        # are skipped.
+        eng.shred(fnames[50:]+[os.path.join(d1, "nonesuch")])
+        eng.wait()
+        stats = eng.getStats()
+        self.assertEquals(stats['files'], 200)
+        self.assertEquals(stats['backlog'], 0)
+        self.failUnless(stats['bytes'] >= 99*100*100)
+        self.assertEquals(os.listdir(d1), [])
+        self.assertEquals(os.listdir(d2), [])
+
 #----------------------------------------------------------------------
 
 class MinionlibCryptoTests(TestCase):
@@ -856,6 +887,29 @@ class MinionlibCryptoTests(TestCase):
         # Make sure that we fail gracefully on non-string input.
         self.failUnlessRaises(TypeError, s1, 1)
 
+    def test_sha1_new(self):
+        s = "abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq"
+        self.assertEquals(_ml.sha1_new().digest(), _ml.sha1(""))
+        h = _ml.sha1_new(s[:10])
+        h.update(s[10:30])
+        # digest() doesn't change the state.
+        self.assertEquals(h.digest(), _ml.sha1(s[:30]))
+        h.update(s[30:])
+        self.assertEquals(h.digest(),
+               hexread("84983E441C3BD26EBAAE4AA1F95129E5E54670F1"))
+        # Copies are independent.
+        h2 = h.copy()
+        h2.update("SEND")
+        self.assertEquals(h2.digest(), _ml.sha1(s+"SEND"))
+        self.assertEquals(h.digest(), _ml.sha1(s))
+        self.assertEquals(Crypto.sha1_with_suffix(h, "RECEIVED"),
+                          _ml.sha1(s+"RECEIVED"))
+        self.assertEquals(h.digest(), _ml.sha1(s))
+        # Buffer objects are hashed without copying.
+        self.assertEquals(_ml.sha1_new(buffer(s, 3, 20)).digest(),
+                          _ml.sha1(s[3:23]))
+        self.failUnlessRaises(TypeError, h.update, 1)
+
     def test_xor(self):
         xor = _ml.strxor
 
@@ -1240,6 +1294,21 @@ class CryptoTests(TestCase):
         self.assertNotEquals(w, u)
         self.assertEquals(unwhiten(w), u)
 
+        # Check the file-based versions, with message lengths that don't
+        # line up with the block size.
+        bl = Crypto.FILE_BLOCK_LEN
+        for n in (21, 1000, bl, 3*bl+7):
+            u = AESCounterPRNG().getBytes(n)
+            w = whiten(u)
+            out, tmp = cStringIO.StringIO(), cStringIO.StringIO()
+            self.assertEquals(n, unwhiten_file(cStringIO.StringIO(w),
+                                               out, tmp))
+            self.assertLongStringEq(u, out.getvalue())
+            out = cStringIO.StringIO()
+            lioness_decrypt_file(cStringIO.StringIO(u), out,
+                                 cStringIO.StringIO(), key)
+            self.assertLongStringEq(dec(u, key), out.getvalue())
+
     def test_bear(self):
         enc = bear_encrypt
         dec = bear_decrypt
@@ -1784,6 +1853,96 @@ class HashLogTests(TestCase):
 
         h[0].close()
 
+        # Wrong keyid.
+        self.assertRaises(MixFatalError, HashLog, fname, "Plugh")
+
+    def test_hashlog_grow(self):
+        fname = mix_mktemp(".db")
+        h = HashLog(fname, "Xyzzy")
+        cap = h.table.capacity
+        hashes = [ Crypto.getCommonPRNG().getBytes(20)
+                   for _ in xrange(cap) ]
+        for hash_ in hashes:
+            h.logHash(hash_)
+        # The table grew, and kept everything.
+        self.assert_(h.table.capacity > cap)
+        self.assertEquals(cap, h.table.count)
+        for hash_ in hashes:
+            self.assert_(h.seenHash(hash_))
+        self.assert_(not h.seenHash("Z"*20))
+        h.close()
+        self.assertEquals([], [ fn for fn in os.listdir(os.path.split(fname)[0])
+                                if fn.endswith(".grow") ])
+        h = HashLog(fname, "Xyzzy")
+        for hash_ in hashes:
+            self.assert_(h.seenHash(hash_))
+        h.close()
+
+    def test_hashlog_journal(self):
+        # Make sure that hashes survive a crash before sync.
+        fname = mix_mktemp(".db")
+        h = HashLog(fname, "Xyzzy")
+        h.logHash("a"*20)
+        h.sync()
+        h.logHash("b"*20)
+        h.logHash("\000"*20)
+        self.assertEquals(2, len(h.journal))
+        # Simulate a crash: drop the journal fd and table without syncing.
+        os.close(h.journalFile)
+        h.table._map.close()
+        h.table._file.close()
+        mixminion.server.HashLog._OPEN_HASHLOGS.clear()
+        h = HashLog(fname, "Xyzzy")
+        self.assert_(h.seenHash("a"*20))
+        self.assert_(h.seenHash("b"*20))
+        self.assert_(h.seenHash("\000"*20))
+        self.assert_(not h.seenHash("c"*20))
+        h.close()
+
+    def test_hashlog_migrate(self):
+        # Build a hashlog in the old, anydbm-based format.
+        fname = mix_mktemp(".db")
+        old = mixminion.Filestore.BooleanJournaledDBBase(
+            fname, "digest hash", 20)
+        old.log["KEYID"] = "Xyzzy"
+        old["a"*20] = 1
+        old["\000"*20] = 1
+        old.sync()
+        # Leave this one in the journal.
+        old["b"*20] = 1
+        old.log.close()
+        os.close(old.journalFile)
+
+        # A different keyid is still rejected.
+        self.assertRaises(MixFatalError, HashLog, fname, "Plugh")
+
+        h = HashLog(fname, "Xyzzy")
+        self.assert_(mixminion.server.HashLog._isHashTable(fname))
+        self.assert_(h.seenHash("a"*20))
+        self.assert_(h.seenHash("b"*20))
+        self.assert_(h.seenHash("\000"*20))
+        self.assert_(not h.seenHash("c"*20))
+        h.close()
+        parent, name = os.path.split(fname)
+        def listHashLogFiles(parent=parent, name=name):
+            # os.listdir's order depends on the filesystem.
+            fns = [ fn for fn in os.listdir(parent) if fn.startswith(name) ]
+            fns.sort()
+            return fns
+        self.assertEquals([name, name+"_jrnl"], listHashLogFiles())
+
+        # If we crashed before removing the old database, we remove it
+        # next time.
+        writeFile(fname+".old", "xyzzy")
+        writeFile(fname+".dat", "xyzzy")
+        h = HashLog(fname, "Xyzzy")
+        self.assert_(h.seenHash("a"*20))
+        h.close()
+        self.assertEquals([name, name+"_jrnl"], listHashLogFiles())
+
+        mixminion.server.HashLog.deleteHashLog(fname)
+        self.assertEquals([], listHashLogFiles())
+
 #----------------------------------------------------------------------
 class NetUtilTests(TestCase):
     def testGetIP(self):
@@ -1923,6 +2082,19 @@ class BuildMessageTests(TestCase):
 
         self.failUnlessRaises(ParseError, uncompressData, "3")
 
+        # Make sure uncompressFile agrees with uncompressData.
+        m = longMsg*1000
+        c = BuildMessage.compressData(m)
+        out = cStringIO.StringIO()
+        self.assertEquals(len(m),
+                    uncompressFile(cStringIO.StringIO(c), out, len(m)))
+        self.assertLongStringEq(m, out.getvalue())
+        self.failUnlessRaises(CompressedDataTooLong, uncompressFile,
+                              cStringIO.StringIO(c), cStringIO.StringIO(),
+                              len(m)-1)
+        self.failUnlessRaises(ParseError, uncompressFile,
+                              cStringIO.StringIO("3"), cStringIO.StringIO())
+
         for _ in xrange(20):
             for _ in xrange(20):
                 m = p.getBytes(p.getInt(1000))
@@ -2503,6 +2675,103 @@ class BuildMessageTests(TestCase):
         p3 = BuildMessage.decodePayload(payloads[2], "")
         self.assert_(None not in [p1, p2, p3])
 
+    def test_message_encoder(self):
+        ME = BuildMessage.MessageEncoder
+        # Short messages come out exactly as from encodeMessage.
+        msg = "Hello, world. "*50
+        enc = ME(cStringIO.StringIO(msg), 0, "Prefix!", AESCounterPRNG(" "*16))
+        self.assertEquals(enc.getLength(), len(msg))
+        self.assertEquals(enc.getNPackets(), 1)
+        self.assertEquals(enc.getNextPayloads(),
+                          BuildMessage.encodeMessage(msg, 0, "Prefix!",
+                                                     AESCounterPRNG(" "*16)))
+        self.assertEquals(enc.getNextPayloads(), [])
+
+        # Long messages come out a chunk at a time, and reassemble to the
+        # original message.
+        msg = Crypto.getCommonPRNG().getBytes(200000)
+        enc = ME(cStringIO.StringIO(msg), 0, "")
+        n = enc.getNPackets()
+        self.assertEquals(n, BuildMessage.getNPacketsToEncode(msg, 0, ""))
+        payloads = []
+        while 1:
+            p = enc.getNextPayloads()
+            if not p:
+                break
+            payloads.extend(p)
+        self.assertEquals(n, len(payloads))
+
+        # Given the same randomness, they come out exactly as from
+        # encodeMessage.  (The message ID and the fragment padding come from
+        # the common PRNG.)
+        thread = threading.currentThread()
+        oldPRNG = Crypto.getCommonPRNG()
+        try:
+            thread.minion_shared_PRNG = AESCounterPRNG("A"*16)
+            expected = BuildMessage.encodeMessage(msg, 0, "Prefix!",
+                                                  AESCounterPRNG(" "*16))
+            thread.minion_shared_PRNG = AESCounterPRNG("A"*16)
+            enc = ME(cStringIO.StringIO(msg), 0, "Prefix!",
+                     AESCounterPRNG(" "*16))
+            got = []
+            while 1:
+                p = enc.getNextPayloads()
+                if not p:
+                    break
+                got.extend(p)
+        finally:
+            thread.minion_shared_PRNG = oldPRNG
+        self.assertEquals(len(expected), len(got))
+        for p1, p2 in zip(expected, got):
+            self.assertLongStringEq(p1, p2)
+        pool = mixminion.Fragments.FragmentPool(mix_mktemp())
+        for p in payloads:
+            pool.addFragment(mixminion.Packet.parsePayload(p))
+        pool.unchunkMessages()
+        self.assertEquals(1, len(pool.listReadyMessages()))
+        mid = pool.listReadyMessages()[0]
+        self.assertLongStringEq(msg, uncompressData(pool.getReadyMessage(mid)))
+        pool.close()
+
+    def test_packet_build_pool(self):
+        payloads = [ BuildMessage.encodeMessage("Hello #%s"%i, 0)[0]
+                     for i in xrange(4) ]
+        paths = [ ([self.server1, self.server2], [self.server3, self.server2]),
+                  ([self.server2], [self.server3]) ] * 2
+        nWorkers = [ 1 ]
+        if BuildMessage.multiprocessing is not None and hasattr(os, 'fork'):
+            nWorkers.append(2)
+        for n in nWorkers:
+            pool = BuildMessage.PacketBuildPool(n, paths, 500, "Goodbye")
+            try:
+                if n > 1:
+                    # Workers that are started after the pool, such as
+                    # replacements for workers that have exited, can still
+                    # find the pool's state.
+                    pool.pool.terminate()
+                    pool.pool.join()
+                    pool.pool = BuildMessage.multiprocessing.Pool(
+                        1, BuildMessage._initBuildWorker, (), 1)
+                result = pool.buildPackets([ (i, payloads[i])
+                                             for i in (3, 0, 2, 1) ])
+            finally:
+                pool.close()
+            self.assertEquals({}, BuildMessage._BUILD_STATES)
+            # Results come back in the order we asked for them.
+            self.assertEquals(4, len(result))
+            for (pkt, firstHop), i in zip(result, (3, 0, 2, 1)):
+                self.assert_(firstHop is paths[i][0][0])
+            self.do_message_test(result[1][0],
+                             ( (self.pk1, self.pk2), None,
+                               (FWD_HOST_TYPE, SWAP_FWD_HOST_TYPE),
+                               (self.server2.getRoutingInfo().pack(),
+                                self.server3.getRoutingInfo().pack()) ),
+                             ( (self.pk3, self.pk2), None,
+                               (FWD_HOST_TYPE, 500),
+                               (self.server2.getRoutingInfo().pack(),
+                                "Goodbye") ),
+                             "Hello #0")
+
     def test_decoding(self):
         # Now we create a bunch of fake payloads and try to decode them.
 
@@ -2954,6 +3223,98 @@ class PacketHandlerTests(TestCase):
         m_x = self.sp2.processPacket(m_x).getPacket()
         self.failUnlessRaises(CryptoError, self.sp3.processPacket, m_x)
 
+    def test_transformPacket(self):
+        # The native transform_packet must give the same results as the
+        # step-by-step implementation.
+        if Crypto.transform_packet is None:
+            return
+        bfm = BuildMessage.buildForwardPacket
+        h = HashLog(mix_mktemp(".db"), "Z"*20)
+        slow = [ PacketHandler([pk], [h])
+                 for pk in (self.pk1, self.pk2, self.pk3) ]
+        fast = [ self.sp1, self.sp2, self.sp3 ]
+        payload = BuildMessage.encodeMessage("\nHello",0)[0]
+        try:
+            for addr in ("nobody@invalid", "f"*300+"@invalid"):
+                # Path: 1, 2, (swap), 3, 1.
+                m = m2 = bfm(payload, SMTP_TYPE, addr,
+                             [self.server1, self.server2],
+                             [self.server3, self.server1])
+                for idx in 0, 1, 2, 0:
+                    res = fast[idx].processPacket(m)
+                    save = Crypto.transform_packet
+                    try:
+                        Crypto.transform_packet = None
+                        res2 = slow[idx].processPacket(m2)
+                    finally:
+                        Crypto.transform_packet = save
+                    if res.isDelivery():
+                        self.assert_(res2.isDelivery())
+                        self.assertEquals(res.getAddress(), res2.getAddress())
+                        self.assertEquals(res.getApplicationKey(),
+                                          res2.getApplicationKey())
+                        self.assertEquals(res.getPayload(), res2.getPayload())
+                        self.assertEndsWith(res.getAddress(), addr)
+                    else:
+                        self.failIf(res2.isDelivery())
+                        self.assertEquals(res.getAddress().pack(),
+                                          res2.getAddress().pack())
+                        self.assertEquals(res.getPacket(), res2.getPacket())
+                        m, m2 = res.getPacket(), res2.getPacket()
+                self.assert_(res.isDelivery())
+        finally:
+            h.close()
+
+    def test_processingPool(self):
+        if sys.version_info < (2,6):
+            return
+        bfm = BuildMessage.buildForwardPacket
+        zPayload = BuildMessage.encodeMessage("Z",0)[0]
+        h1, h2, h3 = [ HashLog(mix_mktemp(".db"), "Z"*20) for _ in 1,2,3 ]
+        sp = PacketHandler([self.pk2, self.pk3], [h2, h3])
+        pool = PacketProcessingPool(sp, 2)
+        try:
+            outcomes = mixminion.ThreadUtils.MessageQueue()
+            def process(m, pool=pool, outcomes=outcomes):
+                pool.processPacket(m, outcomes.put)
+                return pool.finishPacket(outcomes.get(timeout=30))
+
+            # Relay and exit packets come back as they would from
+            # processPacket.
+            m = bfm(zPayload, SMTP_TYPE, "nobody@invalid",
+                    [self.server2], [self.server3])
+            res = process(m)
+            self.failIf(res.isDelivery())
+            self.assertEquals(res.getAddress().pack(),
+                              self.server3.getRoutingInfo().pack())
+            res = process(res.getPacket())
+            self.assert_(res.isDelivery())
+            self.assertEquals(res.getExitType(), SMTP_TYPE)
+
+            # Replays are caught, whether they go through the pool or not.
+            self.failUnlessRaises(ContentError, process, m)
+            self.failUnlessRaises(ContentError, sp.processPacket, m)
+            m = bfm(zPayload, SMTP_TYPE, "nobody@invalid",
+                    [self.server2], [self.server3])
+            sp.processPacket(m)
+            self.failUnlessRaises(ContentError, process, m)
+
+            # Errors come back too.
+            m = bfm(zPayload, DROP_TYPE, "", [self.server1], [self.server2])
+            self.failUnlessRaises(CryptoError, process, m)
+            self.failUnlessRaises(ParseError, process, m+"Z")
+
+            # When keys change, new workers pick up the new keys.
+            sp.setKeys([self.pk1], [h1])
+            m = bfm(zPayload, DROP_TYPE, "", [self.server1], [self.server2])
+            self.assert_(process(m) is not None)
+            # The old workers were idle, so they've been stopped.
+            self.assertEquals([], pool.oldPools)
+            self.assertEquals([pool.pool], pool.nPending.keys())
+        finally:
+            pool.close()
+            sp.close()
+
 #----------------------------------------------------------------------
 # FILESTORE and QUEUE
 
@@ -2977,6 +3338,13 @@ class TestPerAddressDeliveryQueue(PerAddressDeliveryQueue):
     def _deliverMessages(self, msgList):
         self._msgs = msgList
 
+class _NoScanDict(UserDict.UserDict):
+    """Wraps a dictionary, and refuses to list its contents."""
+    def __init__(self, d): self.data = d
+    def keys(self): raise AssertionError("Scanned dictionary")
+    def items(self): raise AssertionError("Scanned dictionary")
+    def values(self): raise AssertionError("Scanned dictionary")
+
 class FStoreTestBase(TestCase):
     def unlink(self, fns):
         for f in fns:
@@ -3116,8 +3484,41 @@ class FilestoreTests(FStoreTestBase):
         # Scrub both queues.
         queue1.removeAll(self.unlink)
         queue2.removeAll(self.unlink)
-        queue1.cleanQueue(self.unlink)
-        queue2.cleanQueue(self.unlink)
+        self.assertEquals(0, queue1.cleanQueue(self.unlink))
+        self.assertEquals(0, queue2.cleanQueue(self.unlink))
+
+    def testHandleIndex(self):
+        queue = mixminion.Filestore.StringStore(self.d1, create=1, scrub=1)
+        handles = [queue.queueMessage("Message %s"%i) for i in range(50)]
+        for h in handles[:10]:
+            queue.removeMessage(h)
+
+        # None of these operations should need to list the directory.
+        replaceFunction(os, "listdir")
+        try:
+            self.assertEquals(queue.count(), 40)
+            self.assertUnorderedEq(queue.getAllMessages(), handles[10:])
+            for i in range(20):
+                batch = queue.pickRandom(5)
+                self.assertEquals(len(batch), 5)
+                for h in batch:
+                    self.failUnless(queue.messageExists(h))
+            self.assertUnorderedEq(queue.pickRandom(), handles[10:])
+            self.assertUnorderedEq(queue.getAllMessages(), handles[10:])
+            queue.cleanQueue(self.unlink)
+            self.assertEquals(getReplacedFunctionCallLog(), [])
+        finally:
+            undoReplacedAttributes()
+            clearReplacedFunctionCallLog()
+        self.failIf(os.path.exists(os.path.join(self.d1, "rmv_"+handles[0])))
+
+        # Recounting rebuilds the index from the directory.
+        for h in handles[10:20]:
+            queue.removeMessage(h)
+        self.assertUnorderedEq(queue.getAllMessages(), handles[20:])
+        os.unlink(os.path.join(self.d1, "msg_"+handles[20]))
+        self.assertEquals(queue.count(1), 29)
+        self.assertUnorderedEq(queue.getAllMessages(), handles[21:])
 
     def testMetadataStores(self):
         d_d = mix_mktemp("q_md")
@@ -3152,6 +3553,97 @@ class FilestoreTests(FStoreTestBase):
         self.assert_(not os.path.exists(os.path.join(d_d, "rmvm_"+h2)))
         self.assert_(not os.path.exists(os.path.join(d_d, "rmv_"+h2)))
 
+    def testSegmentStores(self):
+        d_s = mix_mktemp("q_seg")
+        SEG = mixminion.Filestore.BACKEND_SEGMENTS
+        Store = mixminion.Filestore.MixedMetadataStore
+
+        queue = Store(d_s, create=1, backend=SEG)
+        h1 = queue.queueMessageAndMetadata("Sample message 1", [1])
+        h2 = queue.queueObjectAndMetadata(("obj", 2), None)
+        h3 = queue.queueMessageAndMetadata("Z"*50000, "big")
+        self.assertEquals(os.listdir(d_s), ["seg_000000"])
+        self.assertEquals(queue.count(), 3)
+        self.assertUnorderedEq(queue.getAllMessages(), [h1,h2,h3])
+        self.assertEquals(queue.messageContents(h1), "Sample message 1")
+        self.assertEquals(queue.getObject(h2), ("obj", 2))
+        self.assertEquals(queue.openMessage(h3).read(), "Z"*50000)
+        self.failUnlessRaises(MixError, queue.getMessagePath, h1)
+
+        # Aborted and unfinished messages don't appear.
+        f, h4 = queue.openNewMessage()
+        f.write("abandoned")
+        self.failUnlessRaises(IOError, queue.messageContents, h4)
+        queue.abortMessage(f, h4)
+        self.failIf(queue.messageExists(h4))
+
+        # Metadata too large for its run moves the message.
+        queue.setMetadata(h1, "x"*100000)
+        queue.setMetadata(h2, [2])
+        queue.removeMessage(h3)
+        self.assertEquals(queue.count(), 2)
+        self.failUnless(readFile(os.path.join(d_s, "seg_000000"),1)
+                        .find("Z"*1000) >= 0)
+        queue.cleanQueue()
+        self.assertEquals(readFile(os.path.join(d_s, "seg_000000"),1)
+                          .find("Z"*1000), -1)
+
+        # Reopen: the index is rebuilt from the segment files.
+        queue = Store(d_s, backend=SEG)
+        self.assertUnorderedEq(queue.getAllMessages(), [h1,h2])
+        self.assertEquals(queue.getMetadata(h1), "x"*100000)
+        self.assertEquals(queue.getMetadata(h2), [2])
+        self.assertEquals(queue.messageContents(h1), "Sample message 1")
+
+        # Switching backends moves the messages.
+        queue = Store(d_s, backend=mixminion.Filestore.BACKEND_FILES)
+        self.assertUnorderedEq(os.listdir(d_s), ["msg_"+h1, "meta_"+h1,
+                                                 "msg_"+h2, "meta_"+h2])
+        self.assertEquals(queue.getMetadata(h1), "x"*100000)
+        queue = Store(d_s, backend=SEG)
+        self.assertEquals(os.listdir(d_s), ["seg_000000"])
+        self.assertEquals(queue.getObject(h2), ("obj", 2))
+        queue.removeAll()
+        self.assertEquals(queue.count(), 0)
+
+        # Rewriting metadata is crash-safe: until the new run is marked as
+        # replacing the old one, the old one is in effect; afterwards, the
+        # new one is.
+        d_s = mix_mktemp("q_seg")
+        os.mkdir(d_s, 0700)
+        SegmentSet = mixminion.Filestore._SegmentSet
+        ss = SegmentSet(d_s)
+        ss.reserve("handle01")
+        ss.writeMetadata("handle01", "meta1")
+        ss.store("handle01", "contents")
+        # Each step of the switch reaches the disk before the next.
+        events = []
+        def fsync(fd, events=events): events.append("sync")
+        def writeAt(fd, offset, s, events=events,
+                    _writeAt=mixminion.Filestore._writeAt):
+            if len(s) == 1:
+                events.append(s)
+            _writeAt(fd, offset, s)
+        replaceAttribute(os, 'fsync', fsync)
+        replaceAttribute(mixminion.Filestore, '_writeAt', writeAt)
+        try:
+            ss.writeMetadata("handle01", "meta2")
+        finally:
+            undoReplacedAttributes()
+        self.assertEquals(["sync", "n", "sync", "r", "sync", "m"], events)
+        self.assertEquals(1, len(ss.dead))
+        ss.reserved["handle01"] = "meta3"
+        ss.store("handle01", "contents", "i")
+        ss = SegmentSet(d_s)
+        self.assertEquals("meta2", ss.readMetadata("handle01"))
+        ss.reserved["handle01"] = "meta4"
+        ss.store("handle01", "contents", "n")
+        for _ in 1, 2:
+            ss = SegmentSet(d_s)
+            self.assertEquals(["handle01"], ss.index.keys())
+            self.assertEquals("meta4", ss.readMetadata("handle01"))
+            self.assertEquals("contents", ss.read("handle01"))
+
     def testDBWrappers(self):
         d_parent = mix_mktemp("db")
         loc = os.path.join(d_parent, "db0")
@@ -3422,6 +3914,25 @@ class QueueTests(FStoreTestBase):
         # Now Message 2 is timed out.
         self.assertEquals([], queue.getAllMessages())
 
+        # Spool files are removed along with their messages, even after
+        # we reload the queue.
+        spool = [ mix_mktemp("spool") for _ in 1,2 ]
+        for fn in spool:
+            writeFile(fn, "Contents")
+        h1 = queue.queueDeliveryMessage("Message 1", now=now,
+                                        spoolFile=spool[0])
+        h2 = queue.queueDeliveryMessage("Message 2", now=now,
+                                        spoolFile=spool[1])
+        queue = TestDeliveryQueue(d_d, now)
+        queue.setRetrySchedule([10, 10, 10, 10])
+        queue.sendReadyMessages(now)
+        queue.deliverySucceeded(h1)
+        waitForChildren()
+        self.failIf(os.path.exists(spool[0]))
+        self.assert_(os.path.exists(spool[1]))
+        queue.removeAll(self.unlink)
+        self.failIf(os.path.exists(spool[1]))
+
         queue.removeAll(self.unlink)
         queue.cleanQueue(self.unlink)
 
@@ -3557,6 +4068,59 @@ class QueueTests(FStoreTestBase):
         self.assertEquals(msgs[hB].getAddress(),A3)
         q.close()
 
+    def testPerAddressIndex(self):
+        PADQ = TestPerAddressDeliveryQueue
+        A1 = _TestAddr("FirstAddress")
+        A2 = _TestAddr("SecondAddress")
+        HOUR = 60*60
+        start = time.time()
+        q = PADQ(mix_mktemp(),now=start)
+        q.setRetrySchedule([HOUR, HOUR], now=start)
+        h1 = q.queueDeliveryMessage("Message one", A1, start)
+        h2 = q.queueDeliveryMessage("Message two", A2, start)
+        q.sendReadyMessages(start+10)
+        msgs = self._pendingMsgDict(q._msgs)
+        msgs[h1].failed(now=start+20, retriable=1)
+        h3 = q.queueDeliveryMessage("Message three", A1, start+30)
+        h4 = q.queueDeliveryMessage("Message four", A2, start+30)
+        self.assertUnorderedEq(q._handlesByAddr[str(A1)].keys(), [h1,h3])
+        self.assertUnorderedEq(q._handlesByAddr[str(A2)].keys(), [h2,h4])
+        q._repOK()
+
+        # Sending and expiry must not look at every message in the queue.
+        cache = q.store._metadata_cache
+        q.store._metadata_cache = _NoScanDict(cache)
+        try:
+            # A2 is ready, but h2 is still pending; A1 must wait an hour.
+            q.sendReadyMessages(start+60)
+            msgs = self._pendingMsgDict(q._msgs)
+            self.assertEquals(msgs.keys(), [h4])
+            msgs[h4].succeeded(now=start+70)
+            q.deliverySucceeded(h2, now=start+70)
+            q.sendReadyMessages(start+HOUR)
+            self.assertEquals(q._msgs, [])
+            q.sendReadyMessages(start+HOUR+20)
+            msgs = self._pendingMsgDict(q._msgs)
+            self.assertUnorderedEq(msgs.keys(), [h1,h3])
+            # h1 has expired, but we don't drop it while it's pending.
+            q.sendReadyMessages(start+2*HOUR+10)
+            self.assertEquals(q._msgs, [])
+            self.assertEquals(2, q.count())
+            msgs[h1].failed(now=start+2*HOUR+15, retriable=1)
+            msgs[h3].failed(now=start+2*HOUR+15, retriable=1)
+            # Now it goes, and h3 is retried.
+            q.sendReadyMessages(start+2*HOUR+20)
+            self.assertEquals([m.getHandle() for m in q._msgs], [h3])
+            self.assertEquals([h3], q.store.getAllMessages())
+            q.removeExpiredMessages(start+2*HOUR+40)
+            self.assertEquals(0, q.count())
+        finally:
+            q.store._metadata_cache = cache
+        self.assertEquals({}, q._handlesByAddr)
+        self.assertEquals({}, q._addrOfHandle)
+        q._repOK()
+        q.close()
+
     def _pendingMsgDict(self, lst):
         d = {}
         for m in lst:
@@ -3618,6 +4182,101 @@ class QueueTests(FStoreTestBase):
         bcmq.removeAll(self.unlink)
         bcmq.cleanQueue(self.unlink)
 
+    def testQueueCodec(self):
+        SQ = mixminion.server.ServerQueue
+        PH = mixminion.server.PacketHandler
+        codec = QueueCodec()
+        host = MMTPHostInfo("mix.example.com", 48099, "Z"*20)
+        ip = IPV4Info("10.0.0.1", 48099, "Y"*20)
+        pkt = "x"*(1<<15)
+
+        # Relayed packets
+        for addr in host, ip:
+            s = codec.encode(PH.RelayedPacket(addr, pkt))
+            self.assertStartsWith(s, SQ.RECORD_MAGIC+"\x01R")
+            p = codec.decode(s)
+            self.assertEquals(p.__class__, PH.RelayedPacket)
+            self.assertEquals(p.getAddress(), addr)
+            self.assertEquals(p.getPacket(), pkt)
+
+        # Delivery packets, before and after decoding.
+        dp = PH.DeliveryPacket(100, "T"*20+"addr", "K"*16, "y"*(28*1024))
+        dp.setTagged()
+        dp2 = codec.decode(codec.encode(dp))
+        self.assertEquals(dp2.__class__, PH.DeliveryPacket)
+        self.assertEquals(dp2.__dict__, dp.__dict__)
+        data = "Hello"+"\0"*(28*1024-SINGLETON_PAYLOAD_OVERHEAD-5)
+        dp.dPayload = SingletonPayload(5, "H"*20, data)
+        dp.payload = None
+        dp.type = 'plain'
+        dp.contents = "Hello"
+        dp.headers = { "FROM" : "Alice", "SUBJECT" : "Hi" }
+        dp2 = codec.decode(codec.encode(dp))
+        self.assertEquals(dp2.dPayload.pack(), dp.dPayload.pack())
+        dp.dPayload = dp2.dPayload = None
+        self.assertEquals(dp2.__dict__, dp.__dict__)
+
+        # Delivery and address state.
+        for addr in None, "foo", host, ip, ("a", 1):
+            ds = SQ._DeliveryState(1000, None, addr)
+            ds2 = codec.decode(codec.encode(ds))
+            self.assertEquals(ds2.__getstate__(), ds.__getstate__())
+            ds = SQ._DeliveryState(1000, None, addr, "/spool/x")
+            ds2 = codec.decode(codec.encode(ds))
+            self.assertEquals(ds2.__getstate__(), ds.__getstate__())
+            # Records from before we had spool files still decode.
+            ds = SQ._DeliveryState(1000, None, addr)
+            ds2 = codec.decode(codec.encode(ds)[:-4])
+            self.assertEquals(ds2.__getstate__(), ds.__getstate__())
+            self.assertEquals((ds2.pending,ds2.nextAttempt,ds2.remove),
+                              (None,None,0))
+            as_ = SQ._AddressState(addr)
+            as_.failed(2000, now=2500)
+            as2 = codec.decode(codec.encode(as_))
+            self.assertEquals(as2.__getstate__(), as_.__getstate__())
+
+        # Legacy pickles, and objects we don't know how to encode.
+        ds = SQ._DeliveryState(1000, 1010, host)
+        self.assertEquals(codec.decode(cPickle.dumps(ds,1)).__getstate__(),
+                          ds.__getstate__())
+        self.assertEquals(codec.decode(cPickle.dumps(dp,1)).__dict__,
+                          dp.__dict__)
+        s = codec.encode({ 'a' : [1,2] })
+        self.assertEquals(s, cPickle.dumps({ 'a' : [1,2] }, 1))
+        self.assertEquals(codec.decode(s), { 'a' : [1,2] })
+
+        # Damaged records
+        s = codec.encode(PH.RelayedPacket(host, pkt))
+        self.assertRaises(ValueError, codec.decode, s[:10])
+        self.assertRaises(ValueError, codec.decode, s[:3]+"\x09"+s[4:])
+        self.assertRaises(ValueError, codec.decode, s[:4]+"Q"+s[5:])
+
+        # Mix pools and delivery queues use the codec.
+        d_m = mix_mktemp("qc")
+        pool = TimedMixPool(d_m)
+        h = pool.queueObject(PH.RelayedPacket(host, pkt))
+        self.assertStartsWith(readFile(pool.getMessagePath(h)),
+                              SQ.RECORD_MAGIC)
+        self.assertEquals(pool.getObject(h).getPacket(), pkt)
+        writeFile(os.path.join(d_m, "msg_"+h), s[:10])
+        suspendLog()
+        try:
+            self.assertRaises(mixminion.Filestore.CorruptedFile,
+                              pool.getObject, h)
+        finally:
+            resumeLog()
+        d_q = mix_mktemp("qc")
+        queue = PerAddressDeliveryQueue(d_q)
+        h = queue.queueDeliveryMessage(PH.RelayedPacket(ip, pkt), ip)
+        queue.addressStateDB.close()
+        queue = PerAddressDeliveryQueue(d_q)
+        o = queue._inspect(h)[0]
+        self.assertEquals(o.getAddress(), ip)
+        self.assertEquals(queue.addressStateDB[str(ip)].address, ip)
+        queue.removeAll(self.unlink)
+        queue.cleanQueue(self.unlink)
+        queue.addressStateDB.close()
+
 #---------------------------------------------------------------------
 # LOGGING
 class LogTests(TestCase):
@@ -3895,7 +4554,7 @@ TEST_PORT = 40199
 
 dhfile = pkfile = certfile = None
 
-def _getTLSContext(isServer):
+def _getTLSContext(isServer, sessionTimeout=0):
     "Helper function: create a new TLSContext object."
     global dhfile
     global pkfile
@@ -3937,7 +4596,7 @@ def _getTLSContext(isServer):
                               time.time(), time.time()+365*24*60*60)
 
         pk = _ml.rsa_PEM_read_key(open(pkfile, 'r'), 0)
-        return _ml.TLSContext_new(certfile, pk, dhfile)
+        return _ml.TLSContext_new(certfile, pk, dhfile, sessionTimeout)
     else:
         return _ml.TLSContext_new()
 
@@ -3946,7 +4605,7 @@ def _getTLSContextKeyID():
     keyid = sha1(ident.encode_key(1))
     return keyid
 
-def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT):
+def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT,sessionTimeout=0):
     """Helper function: create a new MMTP server with a listener connection
        Return a tuple of AsyncServer, ListenerConnection, list of received
        messages, and keyid."""
@@ -3956,7 +4615,7 @@ def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT):
         m.append(pkt)
     server.nJunkPackets = 0
     def junkCallback(server=server): server.nJunkPackets += 1
-    def conFactory(sock, context=_getTLSContext(1),
+    def conFactory(sock, context=_getTLSContext(1, sessionTimeout),
                    receiveMessage=receivedHook,junkCallback=junkCallback,
                    reject=reject,server=server):
         tls = context.sock(sock, serverMode=1)
@@ -4033,6 +4692,278 @@ class MMTPTests(TestCase):
     def testRejected(self):
         self.doTest(self._testRejected)
 
+    def testKeepAlive(self):
+        self.doTest(self._testKeepAlive)
+
+    def testDeliveryEngine(self):
+        self.doTest(self._testDeliveryEngine)
+
+    def _testDeliveryEngine(self):
+        # One server accepts packets; the other rejects them.
+        server, listener, packetsIn, keyid = _getMMTPServer()
+        self.listener = listener
+        self.server = server
+        server2, listener2, packetsIn2, _ = _getMMTPServer(reject=1,
+                                                   port=TEST_PORT+1)
+        try:
+            engine = mixminion.MMTPClient.ClientDeliveryEngine(
+                timeout=30, maxConnections=4, maxPerServer=2)
+            routing1 = IPV4Info("127.0.0.1", TEST_PORT, keyid)
+            routing2 = IPV4Info("127.0.0.1", TEST_PORT+1, keyid)
+            packets = ["helloxxx"*4096, "helloyyy"*4096, "hellozzz"*4096]
+            sent1 = []
+            engine.addPackets(routing1, packets, sent1.append)
+            engine.addPackets(routing2, packets[:2], lambda idx: None)
+
+            result = []
+            t = threading.Thread(None, lambda e=engine, r=result:
+                                 r.extend(e.run()))
+            t.start()
+            while t.isAlive():
+                server.process(0.1)
+                server2.process(0.1)
+            t.join()
+
+            # Each server is reported separately, in the order we added it.
+            self.assertEquals(2, len(result))
+            self.assertEquals((routing1, 3, None), result[0])
+            self.assertEquals(routing2, result[1][0])
+            self.assertEquals(0, result[1][1])
+            self.assert_(result[1][2])
+            sent1.sort()
+            self.assertEquals([0,1,2], sent1)
+            packetsIn.sort()
+            self.assertEquals(packets, packetsIn)
+            self.assertEquals([], packetsIn2)
+        finally:
+            server2.remove(listener2)
+            listener2.shutdown()
+            for _ in xrange(10):
+                server2.process(0.1)
+
+    def testDeliveryEngineLookups(self):
+        # Each hostname is looked up once, before we connect anywhere.
+        lookups = []
+        def getIP(name, lookups=lookups):
+            lookups.append(name)
+            if name == "nowhere.noplace":
+                return ("NOENT", "No such host", 0)
+            return (socket.AF_INET, "127.0.0.1", 0)
+        engine = mixminion.MMTPClient.ClientDeliveryEngine(maxPerServer=2)
+        for name in "a.example.com", "nowhere.noplace", "a.example.com":
+            engine.addPackets(MMTPHostInfo(name, 48099, "Z"*20),
+                              ["JUNK", "JUNK", "JUNK"])
+        engine.addPackets(IPV4Info("10.0.0.1", 48099, "Z"*20), ["JUNK"])
+        getIP_orig = mixminion.NetUtils.getIP
+        try:
+            mixminion.NetUtils.getIP = getIP
+            engine._resolveHostnames()
+        finally:
+            mixminion.NetUtils.getIP = getIP_orig
+        self.assertEquals(["a.example.com", "nowhere.noplace"], lookups)
+        d1, d2, d3, d4 = engine.destinations
+        self.assertEquals((socket.AF_INET, "127.0.0.1"), (d1.family, d1.addr))
+        self.assertEquals((socket.AF_INET, "127.0.0.1"), (d3.family, d3.addr))
+        self.assertEquals((socket.AF_INET, "10.0.0.1"), (d4.family, d4.addr))
+        # Packets for hostnames we can't resolve fail right away.
+        self.assertEquals([], d2.groups)
+        for p in d2.deliverables:
+            self.assert_(p._failed)
+        self.assertEquals((0, "Couldn't resolve hostname nowhere.noplace: "
+                           "No such host"), d2.getResult())
+
+    def _testKeepAlive(self):
+        server, listener, packetsIn, keyid = _getMMTPServer()
+        self.listener = listener
+        self.server = server
+        tlscon = mixminion.TLSConnection.TLSConnection
+
+        packets = ["helloxxx"*4096, "helloyyy"*4096]
+        deliv = [FakeDeliverable(p) for p in packets]
+        async = mixminion.server.MMTPServer.AsyncServer()
+        clientcon = mixminion.server.MMTPServer.MMTPClientConnection(
+            socket.AF_INET, "127.0.0.1", TEST_PORT, keyid, keepAlive=1)
+        idle = []
+        clientcon.allPacketsSent = lambda idle=idle: idle.append(1)
+        clientcon.addPacket(deliv[0])
+        async.register(clientcon)
+
+        # Deliver the first packet; the connection stays open.
+        count = 0
+        while not idle and count < 100:
+            server.process(0.1)
+            async.process(0.1)
+            count += 1
+        self.assertEquals([1], idle)
+        self.assert_(deliv[0]._succeeded)
+        self.assert_(clientcon.isIdle())
+        self.assert_(clientcon.isActive())
+        self.failIf(clientcon.isShutdown())
+
+        # The second packet goes over the same connection, once the
+        # server notices that the connection wants to write again.
+        clientcon.addPacket(deliv[1])
+        async.refresh(clientcon)
+        self.failIf(clientcon.isIdle())
+        count = 0
+        while len(idle) < 2 and count < 100:
+            server.process(0.1)
+            async.process(0.1)
+            count += 1
+        self.assertEquals([1,1], idle)
+        self.assertEquals(packetsIn, packets)
+        self.assert_(deliv[1]._succeeded)
+        self.assertEquals(1, len([c for c in server.connections.values()
+                                  if isinstance(c, tlscon)]))
+
+        # Now close it.
+        self.assert_(clientcon.startIdleShutdown())
+        async.refresh(clientcon)
+        self.failIf(clientcon.isActive())
+        self.failIf(clientcon.startIdleShutdown())
+        count = 0
+        while clientcon.sock is not None and count < 100:
+            server.process(0.1)
+            async.process(0.1)
+            count += 1
+        self.assertEquals(None, clientcon.sock)
+
+    def testSessionCache(self):
+        TLSSessionCache = mixminion.MMTPClient.TLSSessionCache
+        cache = TLSSessionCache(lifetime=100)
+        k1, k2 = "a"*20, "b"*20
+        self.assertEquals(None, cache.get(k1))
+        cache.add(k1, "session1", now=1000)
+        cache.add(k2, "session2", now=1050)
+        self.assertEquals("session1", cache.get(k1, now=1099))
+        self.assertEquals("session2", cache.get(k2, now=1099))
+        # Expired sessions are forgotten.
+        self.assertEquals(None, cache.get(k1, now=1100))
+        self.assertEquals(None, cache.get(k1, now=1000))
+        cache.remove(k2)
+        cache.remove(k2)
+        self.assertEquals(None, cache.get(k2, now=1060))
+        cache.add(k1, "session1", now=2000)
+        cache.add(k2, "session2", now=2050)
+        cache.clean(now=2120)
+        self.assertEquals({k2 : ("session2", 2150)}, cache.sessions)
+
+    def testPeerCertificateCache(self):
+        PCC = mixminion.MMTPClient.PeerCertificateCache
+        class FakeKey:
+            def __init__(self, s): self.s = s
+            def encode_key(self, public): return self.s
+        class FakeTLS:
+            def __init__(self, link, ident, notAfter):
+                self.link = FakeKey(link)
+                self.ident = FakeKey(ident)
+                self.notAfter = notAfter
+                self.nVerified = 0
+            def check_cert_alive(self): pass
+            def get_peer_cert_pk(self): return self.link
+            def get_cert_lifetime(self): return ("", self.notAfter)
+            def verify_cert_and_get_identity_pk(self):
+                self.nVerified += 1
+                return self.ident
+        identity = sha1("identity")
+        fn = mix_mktemp()
+        cache = PCC(fn)
+        tls1 = FakeTLS("link1", "identity", "Jan  5 12:00:00 2037 GMT")
+        cache.check(tls1, identity, "srv")
+        cache.check(tls1, identity, "srv")
+        self.assertEquals(1, tls1.nVerified)
+        self.assertEquals({(identity, sha1("link1")) : 2114769600},
+                          cache.cache)
+        self.assert_(cache.knows(identity))
+        self.failIf(cache.knows(identity, now=2114769600))
+        self.failIf(cache.knows("x"*20))
+        # The wrong identity is never cached.
+        self.assertRaises(MixProtocolError, cache.check, tls1, "x"*20,
+                          "srv")
+        self.assertRaises(MixProtocolError, cache.check, tls1, "x"*20,
+                          "srv")
+        self.assertEquals(3, tls1.nVerified)
+
+        # After a restart, we remember the certificate.
+        cache.save()
+        cache = PCC(fn)
+        tls1.nVerified = 0
+        cache.check(tls1, identity, "srv")
+        self.assertEquals(0, tls1.nVerified)
+
+        # A new link key replaces the old one.
+        tls2 = FakeTLS("link2", "identity", "Feb 10 00:00:00 2037 GMT")
+        cache.check(tls2, identity, "srv")
+        self.assertEquals(1, tls2.nVerified)
+        self.assertEquals([(identity, sha1("link2"))], cache.cache.keys())
+
+        # Expired certificates are forgotten.
+        tls3 = FakeTLS("link3", "identity", "Mar  1 00:00:00 2000 GMT")
+        cache.check(tls3, identity, "srv")
+        cache.check(tls3, identity, "srv")
+        self.assertEquals(2, tls3.nVerified)
+        cache.save()
+        self.assertEquals({}, PCC(fn).cache)
+
+        # Unparseable caches are ignored.
+        writeFile(fn, "xyzzy")
+        suspendLog()
+        try:
+            self.assertEquals({}, PCC(fn).cache)
+        finally:
+            s = resumeLog()
+        self.assertIn("Couldn't read certificate cache", s)
+
+    def testSessionResumption(self):
+        self.doTest(self._testSessionResumption)
+
+    def _testSessionResumption(self):
+        server, listener, packetsIn, keyid = _getMMTPServer(
+            sessionTimeout=600)
+        self.listener = listener
+        self.server = server
+        cache = mixminion.MMTPClient.TLSSessionCache()
+        PeerCertificateCache = mixminion.MMTPClient.PeerCertificateCache
+        certCache = PeerCertificateCache()
+        packets = ["helloxxx"*4096, "helloyyy"*4096, "hellozzz"*4096]
+        async = mixminion.server.MMTPServer.AsyncServer()
+
+        # The first connection performs a full handshake, and the second
+        # resumes the session that the first one negotiated.  The third
+        # doesn't resume it, since a resumed session carries no
+        # certificates, and its certificate cache can't vouch for the
+        # server.
+        reused = []
+        for p, cc in zip(packets, [certCache, certCache,
+                                   PeerCertificateCache()]):
+            deliv = FakeDeliverable(p)
+            clientcon = mixminion.server.MMTPServer.MMTPClientConnection(
+                socket.AF_INET, "127.0.0.1", TEST_PORT, keyid,
+                certCache=cc, sessionCache=cache)
+            clientcon.addPacket(deliv)
+            async.register(clientcon)
+            tls = clientcon.tls
+            count = 0
+            while clientcon.sock is not None and count < 100:
+                server.process(0.1)
+                async.process(0.1)
+                count += 1
+            self.assert_(deliv._succeeded)
+            reused.append(tls.session_reused())
+            self.assertNotEquals(None, cache.get(keyid))
+
+        self.assertEquals(packets, packetsIn)
+        self.assertEquals([0, 1, 0], reused)
+
+        # A bogus session is discarded; we fall back to a full handshake.
+        cache.sessions.clear()
+        cache.add(keyid, "not a session")
+        clientcon = mixminion.server.MMTPServer.MMTPClientConnection(
+            socket.AF_INET, "127.0.0.1", TEST_PORT, keyid,
+            certCache=certCache, sessionCache=cache)
+        self.assertEquals(None, cache.get(keyid))
+        clientcon.sock.close()
+
     def _testBlockingTransmission(self):
         server, listener, packetsIn, keyid = _getMMTPServer()
         self.listener = listener
@@ -4318,6 +5249,249 @@ class MMTPTests(TestCase):
         self.assertEquals(deliv[0]._retriable, 1)
         self.assertEquals(deliv[1]._retriable, 1)
 
+    def testInputBuffer(self):
+        _InputBuffer = mixminion.TLSConnection._InputBuffer
+        class FakeTLS:
+            def __init__(self, data):
+                self.data = data
+            def read_into(self, buf, offset, n):
+                n = min(n, len(self.data))
+                buf[offset:offset+n] = self.data[:n]
+                self.data = self.data[n:]
+                return n
+        data = "".join([ chr(i%251) for i in xrange(20000) ])
+        tls = FakeTLS(data)
+        b = _InputBuffer(4096)
+        self.assertEquals(0, len(b))
+        self.assertEquals(3000, b.readFrom(tls, 3000))
+        self.assertEquals(3000, len(b))
+        self.assertEquals(data[10:20], str(b.view(10,10)))
+        self.assertEquals(data[:100], b.get(100))
+        b.consume(2500)
+        self.assertEquals(data[2500:2600], b.get(100))
+        # Reading more slides the data down, then grows the buffer.
+        got = [ b.get(len(b)) ]
+        b.consume(len(b))
+        while tls.data:
+            b.readFrom(tls, 10000)
+            n = min(len(b), 1500)
+            got.append(b.get(n))
+            b.consume(n)
+        got.append(b.get(len(b)))
+        self.assertEquals(data[2500:], "".join(got))
+        b.clear()
+        self.assertEquals(0, len(b))
+
+    def testEpollServer(self):
+        if not hasattr(select, 'epoll'):
+            return
+        MMTPServer = mixminion.server.MMTPServer
+        self.assert_(MMTPServer.AsyncServer is MMTPServer.EpollAsyncServer)
+
+        class FakeCon(MMTPServer.Connection):
+            def __init__(self, sock):
+                self.sock = sock
+                self.status = (1,0)
+                self.events = []
+            def fileno(self):
+                return self.sock.fileno()
+            def getStatus(self):
+                return self.status+(1,)
+            def process(self, r, w, x, cap):
+                self.events.append((not not r, not not w))
+                if r: self.sock.recv(1024)
+                return self.status+(1,0)
+
+        a1, a2 = socket.socketpair()
+        b1, b2 = socket.socketpair()
+        server = MMTPServer.EpollAsyncServer()
+        ca, cb = FakeCon(a1), FakeCon(b1)
+        server.register(ca)
+        server.register(cb)
+        # Nothing is ready yet.
+        server.process(0.01)
+        self.assertEquals([], ca.events+cb.events)
+        # Only the ready connection gets called.
+        a2.send("x")
+        server.process(0.5)
+        self.assertEquals([(1,0)], ca.events)
+        self.assertEquals([], cb.events)
+        # Changing interest takes effect on re-registration.
+        cb.status = (0,1)
+        server.register(cb)
+        server.process(0.5)
+        self.assertEquals([(0,1)], cb.events)
+        self.assertEquals((0,1), server.state[b1.fileno()])
+        # A connection that wants nothing isn't woken by a closed peer...
+        ca.status = (0,0)
+        a2.send("x")
+        server.process(0.5)
+        self.assertEquals([(1,0),(1,0)], ca.events)
+        a2.close()
+        server.process(0.1)
+        self.assertEquals([(1,0),(1,0)], ca.events)
+        # ...but hears about it once it wants to read again.
+        ca.status = (1,0)
+        server.refresh(ca)
+        server.process(0.5)
+        self.assertEquals([(1,0),(1,0),(1,0)], ca.events)
+        # Removal works even after the socket is closed.
+        fd = b1.fileno()
+        b1.close()
+        server.remove(cb, fd)
+        self.assertEquals([a1.fileno()], server.connections.keys())
+        server.remove(ca)
+        for s in a1, a2, b2:
+            s.close()
+
+    def testWakeupConnection(self):
+        MMTPServer = mixminion.server.MMTPServer
+        if MMTPServer.fcntl is None:
+            return
+        server = MMTPServer.AsyncServer()
+        wake = MMTPServer.WakeupConnection()
+        server.register(wake)
+        # Another thread can interrupt a long wait.
+        t = threading.Thread(None, lambda w=wake: (time.sleep(0.2),
+                                                   w.wakeup()))
+        start = time.time()
+        t.start()
+        server.process(10)
+        t.join()
+        self.assert_(time.time()-start < 5)
+        # Many wakeups are drained at once, and don't fill the pipe.
+        for _ in xrange(100000):
+            wake.wakeup()
+        server.process(0)
+        start = time.time()
+        server.process(0.3)
+        self.assert_(time.time()-start >= 0.25)
+        server.remove(wake)
+        os.close(wake.readFd)
+        os.close(wake.writeFd)
+
+    def testProtocolErrorClearsInput(self):
+        MMTPServer = mixminion.server.MMTPServer
+        class FakeTLS:
+            def __init__(self, s): self.s = s
+            def read_into(self, buf, off, n):
+                n = min(n, len(self.s))
+                buf[off:off+n] = self.s[:n]
+                self.s = self.s[n:]
+                return n
+        class FakeConnection(MMTPServer.MMTPServerConnection):
+            def __init__(self):
+                self.inbuf = mixminion.TLSConnection._InputBuffer()
+                self.inbuflen = 0
+                self.address = "<test>"
+                self.rejectPackets = 0
+                self.isShutdown = 0
+            def startShutdown(self):
+                self.isShutdown = 1
+        pkt = "X"*(1<<15)
+        for frame in ("XXXXXX"+pkt+"Z"*20,
+                      "SEND\r\n"+pkt+"Z"*20):
+            con = FakeConnection()
+            data = frame+"extra"
+            self.assertEquals(len(data),
+                              con.inbuf.readFrom(FakeTLS(data), len(data)))
+            con.inbuflen = len(data)
+            suspendLog()
+            try:
+                con.onDataRead()
+            finally:
+                m = resumeLog()
+            self.assert_(m.find("Closing connection") >= 0)
+            self.assertEquals(1, con.isShutdown)
+            self.assertEquals(0, con.inbuflen)
+            self.assertEquals(0, len(con.inbuf))
+
+    def testBandwidthScheduler(self):
+        MMTPServer = mixminion.server.MMTPServer
+        # Token buckets refill continuously, up to their burst size.
+        b = MMTPServer._TokenBucket(1000, 2000, now=100)
+        self.assertEquals(2000, b.level)
+        b.spend(2500)
+        self.assertEquals(-500, b.level)
+        self.assertFloatEq(0.6, b.getDelay(100))
+        b.refill(100.25)
+        self.assertFloatEq(-250, b.level)
+        self.assertEquals(0, b.getDelay(-300))
+        b.refill(110)
+        self.assertEquals(2000, b.level)
+
+        class FakeCon(MMTPServer.Connection):
+            def __init__(self, peer, weight=1):
+                self.peer = peer
+                self.weight = weight
+            def getPeer(self): return self.peer
+            def getBandwidthWeight(self): return self.weight
+        sched = MMTPServer.BandwidthScheduler()
+        Q = sched.QUANTUM
+        cons = { 1 : FakeCon("A"), 2 : FakeCon("B", 2), 3 : FakeCon("C", 0) }
+        events = [ (3,1,0,0), (1,1,1,0), (2,1,0,0), (4,1,0,0) ]
+        def caps(res):
+            return [ (fd,r,w,cap) for fd,c,r,w,x,cap in res ]
+        # Without limits, everything goes, with no caps.  Unknown fds are
+        # skipped.
+        self.failIf(sched.isLimited())
+        self.assertEquals([(1,1,1,None), (2,1,0,None), (3,1,0,None)],
+                          caps(sched.schedule(events, cons)))
+
+        # With limits, connections get deficits according to their
+        # weights, and take turns going first.  Connections with no weight
+        # aren't limited.
+        sched.setBandwidth(2*Q, Q, now=1000)
+        self.assert_(sched.isLimited())
+        self.assertEquals([(2,1,0,2*Q), (3,1,0,None), (1,1,1,Q)],
+                          caps(sched.schedule(events, cons)))
+        sched.charge(1, cons[1], 1000, Q, 0)
+        sched.charge(2, cons[2], 2*Q-1000, 0, 0)
+        self.assertEquals({1 : -1000, 2 : 1000}, sched.deficit)
+        self.assert_(sched.isExhausted())
+        self.assertFloatEq(sched.MIN_REFILL/float(Q), sched.getDelay())
+        # When both buckets are empty, only unlimited connections go.
+        self.assertEquals([(3,1,0,None)], caps(sched.schedule(events, cons)))
+
+        # Half a second later, we can read Q bytes and write Q/2.
+        sched.refill(1000.5)
+        self.failIf(sched.isExhausted())
+        self.assertEquals([(1,1,1,Q-1000), (2,1,0,Q), (3,1,0,None)],
+                          caps(sched.schedule(events, cons)))
+        # An empty direction is masked.
+        sched.charge(1, cons[1], 0, Q, 0)
+        self.assertEquals([(2,1,0,Q), (3,1,0,None)],
+                          caps(sched.schedule([(1,0,1,0),(2,1,0,0),(3,1,0,0)],
+                                              cons)))
+
+        # Usage is accounted by peer.
+        self.assertEquals({ "A" : (1000, 2*Q), "B" : (2*Q-1000, 0) },
+                          sched.getPeerUsage(reset=1))
+        self.assertEquals({}, sched.getPeerUsage())
+        # Closed connections are forgotten.
+        sched.charge(1, cons[1], 0, 0, 1)
+        self.failIf(sched.deficit.has_key(1))
+
+        # MaxBandwidthIn and MaxBandwidthOut default to MaxBandwidth.
+        def limits(extra):
+            try:
+                suspendLog()
+                conf = mixminion.server.ServerConfig.ServerConfig(
+                    string=(SERVER_CONFIG_SHORT%mix_mktemp())+extra)
+            finally:
+                resumeLog()
+            try:
+                return MMTPServer.getBandwidthLimits(conf)
+            finally:
+                conf.getModuleManager().close()
+        self.assertEquals((None, None, None), limits(""))
+        self.assertEquals((20*1024, 20*1024, None),
+                          limits("MaxBandwidth: 20 KB\n"))
+        self.assertEquals((20*1024, 8192, 65536),
+                          limits("MaxBandwidth: 20 KB\n"
+                                 "MaxBandwidthOut: 8 KB\n"
+                                 "MaxBandwidthSpike: 64 KB\n"))
+
 #----------------------------------------------------------------------
 # Config files
 
@@ -4560,6 +5734,10 @@ IntRS=5
             self.assertEquals(c[1], [])
             self.assertEquals(C._parseCommand("/bin/ls"), ("/bin/ls", []))
             self.failUnless(C._parseCommand(sys.executable)[0] is not None)
+            self.assertEquals(C._parseShredCommand("/bin/ls -l"),
+                              ("/bin/ls", ["-l"]))
+        self.assertEquals(C._parseShredCommand(" Internal "), (None, []))
+        self.assertEquals(C._unparseShredCommand((None, [])), "internal")
 
         # Base64
         self.assertEquals(C._parseBase64(" YW\nJj"), "abc")
@@ -5477,6 +6655,8 @@ class EventStatsTests(TestCase):
   AttemptedConnect: 0
   SuccessfulConnect: 0
   FailedConnect: 0
+  FullHandshake: 0
+  ResumedHandshake: 0
   AttemptedRelay: 1
   SuccessfulRelay: 0
   FailedRelay: 1
@@ -6169,6 +7349,199 @@ Free to hide no more.
             undoReplacedAttributes()
             clearReplacedFunctionCallLog()
 
+    def testSMTPSessionPool(self):
+        """Check out SMTPSessionPool, using a fake smtplib.SMTP."""
+        import smtplib
+        Modules = mixminion.server.Modules
+        DELIVER_OK = Modules.DELIVER_OK
+        DELIVER_FAIL_RETRY = Modules.DELIVER_FAIL_RETRY
+        sessions = []
+        state = { 'active' : 0, 'maxActive' : 0 }
+        lock = threading.Lock()
+        class FakeSMTP:
+            def __init__(self, server):
+                if server == "unreachable":
+                    raise socket.error("Connection refused")
+                self.server = server
+                self.sent = []
+                self.closed = self.dropped = 0
+                sessions.append(self)
+            def sendmail(self, fromAddr, toList, message):
+                if self.dropped:
+                    raise smtplib.SMTPServerDisconnected("gone")
+                if "refused@x" in toList:
+                    raise smtplib.SMTPRecipientsRefused({})
+                lock.acquire()
+                state['active'] += 1
+                state['maxActive'] = max(state['active'], state['maxActive'])
+                lock.release()
+                time.sleep(.01)
+                lock.acquire()
+                state['active'] -= 1
+                lock.release()
+                self.sent.append((fromAddr, toList, message))
+            def quit(self):
+                self.closed = 1
+            def close(self):
+                self.closed = 1
+        replaceAttribute(smtplib, 'SMTP', FakeSMTP)
+        try:
+            # Many messages go over a single session.
+            pool = Modules.SMTPSessionPool("mta", maxConnections=2,
+                                           messagesPerConnection=3)
+            for i in range(5):
+                self.assertEquals(DELIVER_OK,
+                       pool.sendMessage(["a@x"], "me@y", "msg%d"%i))
+            self.assertEquals(2, len(sessions))
+            self.assertEquals(3, len(sessions[0].sent))
+            self.assert_(sessions[0].closed)
+            self.assertEquals(2, len(sessions[1].sent))
+            self.assert_(not sessions[1].closed)
+            self.assertEquals(("me@y", ["a@x"], "msg3"), sessions[1].sent[0])
+
+            # A refused message is retried later, but the session survives.
+            suspendLog()
+            try:
+                self.assertEquals(DELIVER_FAIL_RETRY,
+                         pool.sendMessage(["refused@x"], "me@y", "msg"))
+            finally:
+                s = resumeLog()
+            self.assert_(stringContains(s, "Unsuccessful SMTP connection"))
+            self.assertEquals(2, len(sessions))
+            self.assert_(not sessions[1].closed)
+
+            # If the server drops an idle session, we reconnect quietly.
+            sessions[1].dropped = 1
+            self.assertEquals(DELIVER_OK,
+                              pool.sendMessage(["b@x"], "me@y", "msg"))
+            self.assertEquals(3, len(sessions))
+            self.assert_(sessions[1].closed)
+            self.assertEquals(1, len(sessions[2].sent))
+
+            # Idle sessions get closed.
+            pool.clean(time.time()+120)
+            self.assert_(sessions[2].closed)
+            self.assertEquals([], pool._idle)
+
+            # Concurrent senders never use more than maxConnections sessions.
+            del sessions[:]
+            results = []
+            def send(pool=pool, results=results):
+                results.append(pool.sendMessage(["c@x"], "me@y", "msg"))
+            threads = [ threading.Thread(target=send) for _ in range(10) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals([DELIVER_OK]*10, results)
+            self.assert_(state['maxActive'] <= 2)
+            self.assert_(len(sessions) <= 4)
+            pool.close()
+            for s in sessions:
+                self.assert_(s.closed)
+
+            # An unreachable server means we retry later.
+            pool = Modules.SMTPSessionPool("unreachable")
+            suspendLog()
+            try:
+                self.assertEquals(DELIVER_FAIL_RETRY,
+                                  pool.sendMessage(["a@x"], "me@y", "msg"))
+            finally:
+                resumeLog()
+            self.assertEquals(0, pool._nActive)
+        finally:
+            undoReplacedAttributes()
+
+    def testModuleWorkerPool(self):
+        """Check out ModuleWorkerPool, with fake delivery queues."""
+        Modules = mixminion.server.Modules
+        class FakeQueue:
+            def __init__(self, messages, blockOn=None):
+                self.messages = messages
+                self.blockOn = blockOn
+                self.delivered = []
+                self.workers = None
+                self.lock = threading.Lock()
+                self.active = self.maxActive = 0
+            def getPriority(self):
+                return 0
+            def setWorkerPool(self, workers):
+                self.workers = workers
+            def sendReadyMessages(self):
+                msgs = self.messages
+                self.messages = []
+                self.workers.addMessages(msgs)
+            def _deliverMessage(self, handle):
+                self.lock.acquire()
+                self.active += 1
+                self.maxActive = max(self.active, self.maxActive)
+                self.lock.release()
+                if self.blockOn is not None:
+                    self.blockOn.wait()
+                else:
+                    time.sleep(.02)
+                self.lock.acquire()
+                self.active -= 1
+                self.delivered.append(handle)
+                self.lock.release()
+        def waitFor(fn):
+            deadline = time.time()+10
+            while not fn() and time.time() < deadline:
+                time.sleep(.01)
+
+        blocker = threading.Event()
+        slowQueue = FakeQueue(["s1", "s2"], blockOn=blocker)
+        fastQueue = FakeQueue(range(9))
+        slow = Modules.ModuleWorkerPool("SLOW", slowQueue, 1)
+        fast = Modules.ModuleWorkerPool("FAST", fastQueue, 3, maxBacklog=4)
+        for q, w in (slowQueue, slow), (fastQueue, fast):
+            q.setWorkerPool(w)
+            w.start()
+        try:
+            self.assert_(slow.isAlive() and fast.isAlive())
+            # A stuck module doesn't keep the others from delivering.
+            slow.flush()
+            fast.flush()
+            waitFor(lambda: len(fastQueue.delivered) == 9)
+            delivered = fastQueue.delivered[:]
+            delivered.sort()
+            self.assertEquals(range(9), delivered)
+            self.assert_(1 < fastQueue.maxActive <= 3)
+            self.assertEquals([], slowQueue.delivered)
+            st = fast.getStatistics()
+            self.assertEquals(9, st['delivered'])
+            self.assertEquals(1, st['flushes'])
+            self.assertEquals(0, st['backlog'])
+            self.assert_(st['maxBacklog'] >= 6)
+            self.assert_(st['maxLatency'] >= .02)
+            self.assertEquals(2, slow.getBacklog())
+
+            # Once the backlog is full, new messages are refused until the
+            # next flush.
+            for _ in range(4):
+                fast.noteArrival()
+            self.assertRaises(Modules.ModuleBacklogFull, fast.noteArrival)
+            self.assertEquals(4, fast.getBacklog())
+            self.assertEquals(1, fast.getStatistics()['deferred'])
+            fast.flush()
+            waitFor(lambda: fast.getStatistics()['flushes'] == 2)
+            self.assertEquals(0, fast.getBacklog())
+            fast.noteArrival()
+            fast.resetStatistics()
+            st = fast.getStatistics()
+            self.assertEquals((0,0,1), (st['delivered'], st['deferred'],
+                                        st['backlog']))
+
+            blocker.set()
+            waitFor(lambda: len(slowQueue.delivered) == 2)
+            self.assertEquals(["s1", "s2"], slowQueue.delivered)
+        finally:
+            blocker.set()
+            for w in slow, fast:
+                w.shutdown()
+                w.join()
+        self.assert_(not fast.isAlive())
+
     def testDirectoryDump(self):
         """Check out the DirectoryStoreModule that we use for testing on
            machines with unreliable/nonexistent SMTP."""
@@ -6549,6 +7922,93 @@ class DNSFarmTests(TestCase):
             undoReplacedAttributes()
             mixminion.NetUtils._PROTOCOL_SUPPORT = None
 
+    def testDNSCachePrefetch(self):
+        import mixminion.server.DNSFarm
+        DNSFarm = mixminion.server.DNSFarm
+        cache = DNSFarm.DNSCache()
+        receiveDict = {}
+        def callback(name,val,receiveDict=receiveDict):
+            receiveDict[name]=val
+        def waitFor(fn):
+            count = 0
+            while not fn() and count < 200:
+                time.sleep(0.05)
+                count += 1
+        try:
+            dns = {'foo' : '10.2.4.11', 'bar' : '10.2.4.12'}
+            overrideDNS(dns, delay=0.05)
+            mixminion.NetUtils._PROTOCOL_SUPPORT = (1,1)
+
+            # Prefetch some names; static IPs are ignored.
+            cache.prefetch(['foo', 'bar', 'nowhere.noplace', '1.2.3.4'])
+            self.assertEquals(3, len(cache.prefetchNames))
+            waitFor(lambda c=cache: c.getStatistics()['resolves'] == 3)
+            self.assertEquals(cache.getNonblocking('foo')[:2],
+                              (socket.AF_INET, '10.2.4.11'))
+            self.assertEquals(cache.getNonblocking('nowhere.noplace')[0],
+                              'NOENT')
+            self.assertEquals(1, cache.failures['nowhere.noplace'][0])
+            stats = cache.getStatistics()
+            self.assertEquals(1, stats['failures'])
+            self.assertEquals(0, stats['hits']+stats['misses'])
+            self.assert_(0 < stats['maxLatency'] <= stats['totalLatency'])
+
+            # The first lookup doesn't wait for DNS, and failures aren't
+            # retried until the backoff has elapsed.
+            cache.lookup('foo', callback)
+            cache.lookup('nowhere.noplace', callback)
+            self.assertEquals(receiveDict['foo'], cache.getNonblocking('foo'))
+            self.assertEquals(receiveDict['nowhere.noplace'][0], 'NOENT')
+            self.assertEquals(2, cache.getStatistics()['hits'])
+            self.assertEquals({}, cache.refreshing)
+
+            # A stale answer is returned at once, and refreshed in the
+            # background.
+            now = time.time()
+            old = (socket.AF_INET, '10.2.4.11',
+                   now-DNSFarm.REFRESH_INTERVAL-1)
+            cache.cache['foo'] = old
+            dns['foo'] = '10.2.4.99'
+            cache.lookup('foo', callback)
+            self.assertEquals(receiveDict['foo'], old)
+            self.assertEquals(1, cache.getStatistics()['staleHits'])
+            waitFor(lambda c=cache: not c.refreshing)
+            self.assertEquals(cache.getNonblocking('foo')[:2],
+                              (socket.AF_INET, '10.2.4.99'))
+
+            # If a refresh fails, we keep the last good answer, and back off.
+            old = (socket.AF_INET, '10.2.4.12',
+                   now-DNSFarm.REFRESH_INTERVAL-1)
+            cache.cache['bar'] = old
+            del dns['bar']
+            cache.cleanCache(now)
+            self.assert_(cache.refreshing.has_key('bar'))
+            waitFor(lambda c=cache: not c.refreshing)
+            self.assertEquals(old, cache.getNonblocking('bar'))
+            self.assertEquals(1, cache.failures['bar'][0])
+            cache.cleanCache(now)
+            self.assertEquals({}, cache.refreshing)
+
+            # Once the backoff is over, a failed name is looked up again.
+            dns['nowhere.noplace'] = '10.9.9.9'
+            cache.failures['nowhere.noplace'] = (1, now-1)
+            del receiveDict['nowhere.noplace']
+            cache.lookup('nowhere.noplace', callback)
+            self.assertEquals(DNSFarm.PENDING,
+                              cache.getNonblocking('nowhere.noplace'))
+            waitFor(lambda r=receiveDict: r.has_key('nowhere.noplace'))
+            self.assertEquals(receiveDict['nowhere.noplace'][:2],
+                              (socket.AF_INET, '10.9.9.9'))
+            self.failIf(cache.failures.has_key('nowhere.noplace'))
+
+            # Prefetched names don't expire.
+            cache.cleanCache(now+DNSFarm.MAX_ENTRY_TTL*2)
+            self.assertNotEquals(None, cache.getNonblocking('foo'))
+            cache.shutdown(wait=1)
+        finally:
+            undoReplacedAttributes()
+            mixminion.NetUtils._PROTOCOL_SUPPORT = None
+
 #----------------------------------------------------------------------
 
 class ServerMainTests(TestCase):
@@ -6582,6 +8042,80 @@ class ServerMainTests(TestCase):
         s.processEvents(tm+5)
         self.assertEquals(["c", "d", "b", "c" ], lst)
 
+    def testSchedulerPostponed(self):
+        ScheduleUtils = mixminion.ScheduleUtils
+        s = ScheduleUtils.Scheduler()
+        lst = []
+        tm = time.time()
+        # An event that moves itself later is noticed when it comes due.
+        e = ScheduleUtils.OneTimeEvent(tm+1, lambda lst=lst: lst.append('e'))
+        s.scheduleEvent(e)
+        s.scheduleOnce(tm+2, "F", lambda lst=lst: lst.append('f'))
+        e.when = tm+3
+        self.assertEquals(tm+2, s.firstEventTime())
+        s.processEvents(tm+2.5)
+        self.assertEquals(['f'], lst)
+        s.processEvents(tm+3)
+        self.assertEquals(['f', 'e'], lst)
+        self.assertEquals(-1, s.firstEventTime())
+        self.assertEquals([], s.scheduledEvents)
+
+        # Background events have no known time while they're running.
+        jobs = []
+        bg = ScheduleUtils.RecurringBackgroundEvent(
+            tm+1, jobs.append, lambda lst=lst: lst.append('bg'), 10)
+        s.scheduleEvent(bg)
+        s.processEvents(tm+1)
+        self.assertEquals(1, len(jobs))
+        self.assertEquals(-1, s.firstEventTime())
+        self.assertEquals([bg], s.unknownEvents)
+        bg.when = tm+5
+        jobs[0]()
+        self.assertEquals(['f', 'e', 'bg'], lst)
+        self.assert_(s.firstEventTime() > time.time())
+        self.assertEquals([], s.unknownEvents)
+
+    def testConnectionTimeouts(self):
+        MMTPServer = mixminion.server.MMTPServer
+        class FakeCon(MMTPServer.Connection):
+            def __init__(self, fd, last):
+                self.fd = fd
+                self.last = last
+                self.nChecked = 0
+            def fileno(self): return self.fd
+            def getStatus(self): return 1,0,1
+            def getLastActivity(self): return self.last
+            def tryTimeout(self, cutoff):
+                self.nChecked += 1
+                return self.last <= cutoff
+        server = MMTPServer.SelectAsyncServer()
+        server._timeout = 10
+        now = time.time()
+        c1, c2, c3 = FakeCon(1, now), FakeCon(2, now+5), FakeCon(3, now)
+        for c in c1, c2, c3:
+            server.register(c)
+        # Connections without a last-activity time don't time out.
+        listener = FakeCon(4, None)
+        server.register(listener)
+        self.assertEquals(now+10, server.getNextTimeoutTime(now))
+        # Nothing is due yet, so nothing gets checked.
+        server.tryTimeout(now+9)
+        self.assertEquals(0, c1.nChecked+c2.nChecked+c3.nChecked)
+        # c3 saw activity; only c1 times out.
+        c3.last = now+8
+        server.tryTimeout(now+10)
+        self.assertEquals([1,0,1], [c1.nChecked,c2.nChecked,c3.nChecked])
+        fds = server.connections.keys()
+        fds.sort()
+        self.assertEquals([2,3,4], fds)
+        self.assertEquals(now+15, server.getNextTimeoutTime(now+10))
+        # A removed connection is forgotten.
+        server.remove(c2)
+        server.tryTimeout(now+20)
+        self.assertEquals([1,0,2], [c1.nChecked,c2.nChecked,c3.nChecked])
+        self.assertEquals([4], server.connections.keys())
+        self.assertEquals(0, listener.nChecked)
+
     def testMixPool(self):
         ServerConfig = mixminion.server.ServerConfig.ServerConfig
         MixPool = mixminion.server.ServerMain.MixPool
@@ -7532,6 +9066,40 @@ class ClientDirectoryTests(TestCase):
                 return 0
         return ds[0] == ds[1]
 
+class FakeDeliveryEngine:
+    """Stands in for mixminion.MMTPClient.ClientDeliveryEngine, so that we
+       can test the client without touching the network."""
+    ## Class fields:
+    # engines -- a list of every FakeDeliveryEngine created, in order.
+    # failures -- a map from hostname to the number of packets that the
+    #    host accepts before its connection fails.
+    # error -- None, or an exception for run() to raise.
+    engines = []
+    failures = {}
+    error = None
+    def __init__(self, timeout, maxConnections=16, maxPerServer=1):
+        self.timeout = timeout
+        self.batches = []
+        FakeDeliveryEngine.engines.append(self)
+    def addPackets(self, routing, packetList, callback=None):
+        self.batches.append((routing, packetList, callback))
+    def run(self):
+        if self.error is not None:
+            raise self.error
+        result = []
+        for routing, packetList, callback in self.batches:
+            nGood = self.failures.get(getattr(routing, 'hostname', None),
+                                      len(packetList))
+            nGood = min(nGood, len(packetList))
+            for i in xrange(nGood):
+                if callback is not None:
+                    callback(i)
+            if nGood < len(packetList):
+                result.append((routing, nGood, "Connection failed"))
+            else:
+                result.append((routing, nGood, None))
+        return result
+
 class ClientMainTests(TestCase):
     def testAddress(self):
         def parseEq(s, tp, addr, server, eq=self.assertEquals):
@@ -7702,16 +9270,13 @@ class ClientMainTests(TestCase):
 
         ### Now try some failing cases for generateForwardPackets
 
-        # Temporarily replace BlockingClientConnection so we can try the client
+        # Temporarily replace ClientDeliveryEngine so we can try the client
         # without hitting the network.
-        args = []
-        def fakeSendPackets(routing,packetList,timeout=300,callback=None,
-                            args=args):
-            args.append((routing,packetList,timeout,callback))
-            for i in xrange(len(packetList)):
-                callback(i)
-
-        replaceAttribute(mixminion.MMTPClient, "sendPackets", fakeSendPackets)
+        FakeDeliveryEngine.engines = []
+        FakeDeliveryEngine.failures = {}
+        FakeDeliveryEngine.error = None
+        replaceAttribute(mixminion.MMTPClient, "ClientDeliveryEngine",
+                         FakeDeliveryEngine)
         overrideDNS({'alice' : "10.0.0.100"})
         try:
             client.sendForwardMessage(
@@ -7721,17 +9286,87 @@ class ClientMainTests(TestCase):
                 "You only give me your information.",
                 time.time(), time.time()+300)
 
-            r,p,t,c = args[0]
+            self.assertEquals(1, len(FakeDeliveryEngine.engines))
+            self.assertEquals(1, len(FakeDeliveryEngine.engines[0].batches))
+            r,p,c = FakeDeliveryEngine.engines[0].batches[0]
             # first hop is alice
             self.assertEquals(r.hostname, "alice")
             self.assertEquals(r.port, 48099)
             self.assertEquals(1, len(p))
             self.assertEquals(32*1024, len(p[0]))
+            self.assertEquals([], client.queue.getHandles())
 
         finally:
             undoReplacedAttributes()
             clearCalls()
 
+    def testSendPacketsToMany(self):
+        userdir = mix_mktemp()
+        usercfgstr = "[User]\nUserDir: %s\n[DirectoryServers]\n"%userdir
+        usercfg = mixminion.Config.ClientConfig(string=usercfgstr)
+        client = mixminion.ClientMain.MixminionClient(usercfg)
+        queue = client.queue
+        MMTPHostInfo = mixminion.Packet.MMTPHostInfo
+        r1 = MMTPHostInfo("alice", 48099, "a"*20)
+        r2 = MMTPHostInfo("bob", 48099, "b"*20)
+        p1 = [ "A%s"%i*8192 for i in "123" ]
+        p2 = [ "B%s"%i*8192 for i in "12" ]
+        batches = [ (r1, p1), (r2, p2) ]
+        def queuedPackets(queue=queue):
+            pkts = []
+            for h in queue.getHandles():
+                pkt, routing, _ = queue.getPacket(h)
+                pkts.append((routing, pkt))
+            pkts.sort()
+            return pkts
+
+        FakeDeliveryEngine.engines = []
+        FakeDeliveryEngine.failures = {}
+        FakeDeliveryEngine.error = None
+        replaceAttribute(mixminion.MMTPClient, "ClientDeliveryEngine",
+                         FakeDeliveryEngine)
+        suspendLog()
+        try:
+            # All the batches go through a single engine.
+            self.assertEquals(5, client.sendPacketsToMany(batches))
+            self.assertEquals(1, len(FakeDeliveryEngine.engines))
+            self.assertEquals([(r1, p1), (r2, p2)],
+                              [ (r, p) for r, p, _ in
+                                FakeDeliveryEngine.engines[0].batches ])
+            self.assertEquals([], queuedPackets())
+
+            # If one server fails, only its undelivered packets stay queued.
+            FakeDeliveryEngine.failures = { "bob" : 1 }
+            self.assertEquals(4, client.sendPacketsToMany(batches))
+            self.assertEquals([(r2, p2[1])], queuedPackets())
+            for h in queue.getHandles():
+                queue.removePacket(h)
+
+            # With lazyQueue, we only queue the packets that failed.
+            FakeDeliveryEngine.failures = { "alice" : 2, "bob" : 0 }
+            self.assertEquals(2, client.sendPacketsToMany(batches,
+                                                          lazyQueue=1))
+            self.assertEquals([(r1, p1[2]), (r2, p2[0]), (r2, p2[1])],
+                              queuedPackets())
+            for h in queue.getHandles():
+                queue.removePacket(h)
+
+            # With noQueue, failed packets are lost.
+            self.assertEquals(2, client.sendPacketsToMany(batches,
+                                                          noQueue=1))
+            self.assertEquals([], queuedPackets())
+
+            # If the engine itself fails, every batch fails, and all the
+            # packets stay queued.
+            FakeDeliveryEngine.failures = {}
+            FakeDeliveryEngine.error = MixProtocolError("Oops")
+            self.assertEquals(0, client.sendPacketsToMany(batches))
+            self.assertEquals([(r1, p) for p in p1] + [(r2, p) for p in p2],
+                              queuedPackets())
+        finally:
+            resumeLog()
+            undoReplacedAttributes()
+
 #----------------------------------------------------------------------
 class FragmentTests(TestCase):
     def testFragmentParams(self):
@@ -7802,6 +9437,43 @@ class FragmentTests(TestCase):
             chunks.append("".join(fec.decode(receivedBlocks)))
         self.assertLongStringEq(msg, unwhiten(("".join(chunks))[:len(msg)]))
 
+    def testFECBatch(self):
+        Fr = mixminion.Fragments
+        prng = Crypto.getCommonPRNG()
+        chunks = [ [ prng.getBytes(1024) for _ in xrange(4) ]
+                   for _ in xrange(5) ]
+        fec = Fr._getFEC(4, 6)
+        expected = [ [ fec.encode(i, blocks) for i in xrange(6) ]
+                     for blocks in chunks ]
+        try:
+            for nThreads in 1, 3:
+                Fr.configureFEC(nThreads=nThreads)
+                self.assertEquals(nThreads, Fr.getFECThreads())
+                encoded = Fr.encodeChunks(4, 6, chunks)
+                self.assertEquals(expected, encoded)
+                received = [ zip(range(2,6), fs[2:]) for fs in encoded ]
+                self.assertEquals(chunks, Fr.decodeChunks(4, 6, received))
+                # Errors in any chunk are reported.
+                received[3] = received[3][:-1]
+                self.failUnlessRaises(_ml.FECError, Fr.decodeChunks,
+                                      4, 6, received)
+            self.failUnlessRaises(MixError, Fr.configureFEC, 0)
+        finally:
+            Fr.configureFEC(nThreads=1)
+
+        # Check the LRU behavior of the FEC cache.
+        cache = Fr._FECCache(2)
+        f1 = cache.get(2, 3)
+        f2 = cache.get(4, 6)
+        self.assert_(cache.get(2, 3) is f1)
+        f3 = cache.get(8, 11)
+        self.assertEquals((8, 11), f3.getParameters())
+        self.assertUnorderedEq([(2, 3), (8, 11)], cache.fecs.keys())
+        self.assert_(cache.get(2, 3) is f1)
+        self.assert_(cache.get(4, 6) is not f2)
+        cache.setMaxEntries(1)
+        self.assertEquals([(4, 6)], cache.fecs.keys())
+
     def testFragmentPool(self):
         em = mixminion.BuildMessage.encodeMessage
         pp = mixminion.Packet.parsePayload
@@ -7855,6 +9527,13 @@ class FragmentTests(TestCase):
         self.assertEquals(len(pool.listReadyMessages()), 1)
         mid = pool.listReadyMessages()[0]
         self.assertLongStringEq(M2, uncompressData(pool.getReadyMessage(mid)))
+        # Reassembling to a file gives the same result.
+        out = cStringIO.StringIO()
+        self.assertEquals(len(pool.getReadyMessage(mid)),
+                          pool.writeReadyMessage(mid, out,
+                                                 cStringIO.StringIO()))
+        self.assertLongStringEq(M2, uncompressData(out.getvalue()))
+        self.assertEquals(None, pool.writeReadyMessage("X"*20, out, out))
         pool.markMessageCompleted(mid)
         pool.close()
         pool = mixminion.Fragments.FragmentPool(loc)
@@ -34,6 +34,8 @@ void mm_aes_counter128(const char *in, char *out, unsigned int len,
  */
 void mm_SSL_ERR(int crypto);
 
+extern PyTypeObject mm_SHA1_Type;
+
 extern PyTypeObject mm_RSA_Type;
 typedef struct mm_RSA {
         PyObject_HEAD
@@ -62,10 +64,12 @@ extern PyTypeObject mm_FEC_Type;
 /* Functions from crypt.c */
 FUNC_DOC(mm_sha1);
 FUNC_DOC(mm_sha1);
+FUNC_DOC(mm_sha1_new);
 FUNC_DOC(mm_aes_key);
 FUNC_DOC(mm_aes_ctr128_crypt);
 FUNC_DOC(mm_aes128_block_crypt);
 FUNC_DOC(mm_strxor);
+FUNC_DOC(mm_transform_packet);
 FUNC_DOC(mm_openssl_seed);
 #ifdef MS_WINDOWS
 FUNC_DOC(mm_win32_openssl_seed);
@@ -100,6 +100,152 @@ mm_sha1(PyObject *self, PyObject *args, PyObject *kwdict)
         return output;
 }
 
+typedef struct mm_SHA1 {
+        PyObject_HEAD
+        SHA_CTX ctx;
+} mm_SHA1;
+#define mm_SHA1_Check(v) ((v)->ob_type == &mm_SHA1_Type)
+
+static void
+mm_SHA1_dealloc(mm_SHA1 *self)
+{
+        memset(&self->ctx, 0, sizeof(self->ctx));
+        PyObject_DEL(self);
+}
+
+const char mm_sha1_new__doc__[] =
+  "sha1_new([s]) -> SHA1\n\n"
+  "Returns a new SHA1 object for computing the SHA-1 hash of a string\n"
+  "incrementally.  If 's' is provided, it is hashed first.\n";
+
+PyObject*
+mm_sha1_new(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "string", NULL};
+        unsigned char *cp = NULL;
+        int len = 0;
+        mm_SHA1 *result;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict, "|s#:sha1_new", kwlist,
+                                         &cp, &len))
+                return NULL;
+        if (!(result = PyObject_NEW(mm_SHA1, &mm_SHA1_Type)))
+                return NULL;
+
+        Py_BEGIN_ALLOW_THREADS
+        SHA1_Init(&result->ctx);
+        if (len)
+                SHA1_Update(&result->ctx, cp, len);
+        Py_END_ALLOW_THREADS
+
+        return (PyObject*)result;
+}
+
+static const char mm_SHA1_update__doc__[] =
+  "sha1.update(s)\n\n"
+  "Adds the string 's' to the data hashed by this object.\n";
+
+static PyObject*
+mm_SHA1_update(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "string", NULL};
+        unsigned char *cp = NULL;
+        int len;
+
+        assert(mm_SHA1_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict, "s#:update", kwlist,
+                                         &cp, &len))
+                return NULL;
+
+        Py_BEGIN_ALLOW_THREADS
+        SHA1_Update(&((mm_SHA1*)self)->ctx, cp, len);
+        Py_END_ALLOW_THREADS
+
+        Py_INCREF(Py_None);
+        return Py_None;
+}
+
+static const char mm_SHA1_copy__doc__[] =
+  "sha1.copy() -> SHA1\n\n"
+  "Returns a new SHA1 object with the same state as this one.\n";
+
+static PyObject*
+mm_SHA1_copy(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { NULL };
+        mm_SHA1 *result;
+
+        assert(mm_SHA1_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict, ":copy", kwlist))
+                return NULL;
+        if (!(result = PyObject_NEW(mm_SHA1, &mm_SHA1_Type)))
+                return NULL;
+        memcpy(&result->ctx, &((mm_SHA1*)self)->ctx, sizeof(SHA_CTX));
+
+        return (PyObject*)result;
+}
+
+static const char mm_SHA1_digest__doc__[] =
+  "sha1.digest() -> str\n\n"
+  "Returns the SHA-1 hash of all the data passed to this object so far.\n"
+  "The object's state is not changed, so more data may be added later.\n";
+
+static PyObject*
+mm_SHA1_digest(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { NULL };
+        SHA_CTX ctx;
+        PyObject *output;
+
+        assert(mm_SHA1_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict, ":digest", kwlist))
+                return NULL;
+        if (!(output = PyString_FromStringAndSize(NULL, SHA_DIGEST_LENGTH))) {
+                PyErr_NoMemory();
+                return NULL;
+        }
+
+        memcpy(&ctx, &((mm_SHA1*)self)->ctx, sizeof(SHA_CTX));
+        SHA1_Final(PyString_AS_USTRING(output),&ctx);
+        memset(&ctx,0,sizeof(ctx));
+
+        return output;
+}
+
+static PyMethodDef mm_SHA1_methods[] = {
+        METHOD(mm_SHA1, update),
+        METHOD(mm_SHA1, copy),
+        METHOD(mm_SHA1, digest),
+        { NULL, NULL }
+};
+
+static PyObject*
+mm_SHA1_getattr(PyObject *self, char *name)
+{
+        return Py_FindMethod(mm_SHA1_methods, self, name);
+}
+
+static const char mm_SHA1_Type__doc__[] =
+  "An incremental SHA-1 hash object.";
+
+PyTypeObject mm_SHA1_Type = {
+        PyObject_HEAD_INIT(/*&PyType_Type*/ 0)
+        0,                                  /*ob_size*/
+        "mixminion._minionlib.SHA1",        /*tp_name*/
+        sizeof(mm_SHA1),                    /*tp_basicsize*/
+        0,                                  /*tp_itemsize*/
+        /* methods */
+        (destructor)mm_SHA1_dealloc,        /*tp_dealloc*/
+        (printfunc)0,                       /*tp_print*/
+        (getattrfunc)mm_SHA1_getattr,       /*tp_getattr*/
+        (setattrfunc)0,                     /*tp_setattr*/
+        0,0,
+        0,0,0,
+        0,0,0,0,0,
+        0,0,
+        (char*)mm_SHA1_Type__doc__
+};
+
 static char aes_descriptor[] = "AES key objects descriptor";
 
 /* Destructor of PyCObject
@@ -259,11 +405,13 @@ mm_aes128_block_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
                 PyErr_NoMemory();
                 return NULL;
         }
+        Py_BEGIN_ALLOW_THREADS
         if (encrypt) {
                 AES_encrypt(input, PyString_AS_USTRING(result), aes_key);
         } else {
                 AES_decrypt(input, PyString_AS_USTRING(result), aes_key);
         }
+        Py_END_ALLOW_THREADS
 
         return result;
 }
@@ -306,6 +454,234 @@ mm_strxor(PyObject *self, PyObject *args, PyObject *kwdict)
         return output;
 }
 
+/* Sizes used by mm_transform_packet.  These must match Packet.py. */
+#define MM_PACKET_LEN 32768
+#define MM_HEADER_LEN 2048
+#define MM_PAYLOAD_LEN (MM_PACKET_LEN - 2*MM_HEADER_LEN)
+#define MM_ENC_SUBHEADER_LEN 256
+
+/* Key-derivation modes used by mm_transform_packet.  These must match
+ * Crypto.py. */
+#define MODE_HEADER_SECRET "HEADER SECRET KEY"
+#define MODE_RANDOM_JUNK "RANDOM JUNK"
+#define MODE_HEADER_ENCRYPT "HEADER ENCRYPT"
+#define MODE_PAYLOAD_ENCRYPT "PAYLOAD ENCRYPT"
+#define MODE_HIDE_HEADER "HIDE HEADER"
+#define MODE_HIDE_PAYLOAD "HIDE PAYLOAD"
+
+/* Helper: set 'out' to SHA1(secret | mode), as in Crypto.Keyset.get. */
+static void
+mm_derive_key(const unsigned char *secret, int secretlen, const char *mode,
+              unsigned char *out)
+{
+        SHA_CTX ctx;
+        SHA1_Init(&ctx);
+        SHA1_Update(&ctx, secret, secretlen);
+        SHA1_Update(&ctx, mode, strlen(mode));
+        SHA1_Final(out, &ctx);
+        memset(&ctx, 0, sizeof(ctx));
+}
+
+/* Helper: set 'out' to SHA1(key | s | key), as used by LIONESS. */
+static void
+mm_sha1_keyed(const unsigned char *key, const unsigned char *s, int slen,
+              unsigned char *out)
+{
+        SHA_CTX ctx;
+        SHA1_Init(&ctx);
+        SHA1_Update(&ctx, key, SHA_DIGEST_LENGTH);
+        SHA1_Update(&ctx, s, slen);
+        SHA1_Update(&ctx, key, SHA_DIGEST_LENGTH);
+        SHA1_Final(out, &ctx);
+        memset(&ctx, 0, sizeof(ctx));
+}
+
+/* Helper: LIONESS-decrypt the 'len'-byte buffer 'buf' in place, using the
+ * four keys derived from the 20-byte 'key1' as in Crypto.Keyset.
+ * getLionessKeys.  This is the same computation as Crypto.lioness_decrypt.
+ */
+static void
+mm_lioness_decrypt_inplace(const unsigned char *key1, unsigned char *buf,
+                           int len)
+{
+        unsigned char keys[4][SHA_DIGEST_LENGTH];
+        unsigned char digest[SHA_DIGEST_LENGTH];
+        unsigned char *left = buf, *right = buf+SHA_DIGEST_LENGTH;
+        int rightlen = len - SHA_DIGEST_LENGTH;
+        AES_KEY aes_key;
+        int i, k;
+
+        for (k = 0; k < 4; ++k) {
+                memcpy(keys[k], key1, SHA_DIGEST_LENGTH);
+                keys[k][SHA_DIGEST_LENGTH-1] ^= k;
+        }
+
+        /* left = strxor(left,  sha1(key4 | right | key4)) */
+        mm_sha1_keyed(keys[3], right, rightlen, digest);
+        for (i = 0; i < SHA_DIGEST_LENGTH; ++i) left[i] ^= digest[i];
+        /* right = ctr_crypt(right, sha1(key3 | left | key3)[:16]) */
+        mm_sha1_keyed(keys[2], left, SHA_DIGEST_LENGTH, digest);
+        AES_set_encrypt_key(digest, 128, &aes_key);
+        mm_aes_counter128((char*)right, (char*)right, rightlen, &aes_key, 0);
+        /* left = strxor(left,  sha1(key2 | right | key2)) */
+        mm_sha1_keyed(keys[1], right, rightlen, digest);
+        for (i = 0; i < SHA_DIGEST_LENGTH; ++i) left[i] ^= digest[i];
+        /* right = ctr_crypt(right, sha1(key1 | left | key1)[:16]) */
+        mm_sha1_keyed(keys[0], left, SHA_DIGEST_LENGTH, digest);
+        AES_set_encrypt_key(digest, 128, &aes_key);
+        mm_aes_counter128((char*)right, (char*)right, rightlen, &aes_key, 0);
+
+        memset(keys, 0, sizeof(keys));
+        memset(digest, 0, sizeof(digest));
+        memset(&aes_key, 0, sizeof(aes_key));
+}
+
+/* Helper: LIONESS-decrypt the 'len'-byte buffer 'buf' in place, using keys
+ * derived from the hash of 'keysrc', as in Crypto.lioness_keys_from_header
+ * and Crypto.lioness_keys_from_payload. */
+static void
+mm_lioness_decrypt_hidden(const unsigned char *keysrc, int keysrclen,
+                          const char *mode, unsigned char *buf, int len)
+{
+        unsigned char digest[SHA_DIGEST_LENGTH];
+        unsigned char key1[SHA_DIGEST_LENGTH];
+        SHA1(keysrc, keysrclen, digest);
+        mm_derive_key(digest, SHA_DIGEST_LENGTH, mode, key1);
+        mm_lioness_decrypt_inplace(key1, buf, len);
+        memset(digest, 0, sizeof(digest));
+        memset(key1, 0, sizeof(key1));
+}
+
+const char mm_transform_packet__doc__[]=
+  "transform_packet(secret, packet, padlen, overflowlen, underflow, mode)\n"
+  "   -> (overflow, result)\n\n"
+  "Performs all of the symmetric cryptography a server needs to process\n"
+  "a 32K packet, given the master secret from the packet's first\n"
+  "subheader.  Equivalent to the corresponding steps in\n"
+  "PacketHandler.processPacket, but works in a single buffer.\n\n"
+  "Header 1 (less its encrypted subheader) is padded with padlen bytes of\n"
+  "junk and decrypted; its first overflowlen bytes are returned as\n"
+  "'overflow', and the rest is prefixed with 'underflow' to make the new\n"
+  "header 1.  If mode is 0 (exit), 'result' is the decrypted 28K payload.\n"
+  "If mode is 1 (forward), 'result' is the 32K packet for the next hop.\n"
+  "If mode is 2 (swap), header 2 and the payload are also decrypted with\n"
+  "each other's hashes, and the headers are swapped.\n";
+
+PyObject*
+mm_transform_packet(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "secret", "packet", "padlen", "overflowlen",
+                                  "underflow", "mode", NULL };
+        unsigned char *secret, *packet, *underflow;
+        int secretlen, packetlen, padlen, overflowlen, underflowlen, mode;
+        int h1len;
+        unsigned char *h1 = NULL, *out, *h1p, *h2p, *payloadp;
+        unsigned char key[SHA_DIGEST_LENGTH];
+        AES_KEY aes_key;
+        PyObject *overflow = NULL, *result = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "s#s#iis#i:transform_packet", kwlist,
+                                         &secret, &secretlen,
+                                         &packet, &packetlen,
+                                         &padlen, &overflowlen,
+                                         &underflow, &underflowlen, &mode))
+                return NULL;
+
+        if (packetlen != MM_PACKET_LEN) {
+                TYPE_ERR("transform_packet requires a 32K packet");
+                return NULL;
+        }
+        if (mode < 0 || mode > 2) {
+                TYPE_ERR("Unrecognized mode for transform_packet");
+                return NULL;
+        }
+        h1len = MM_HEADER_LEN - MM_ENC_SUBHEADER_LEN + padlen;
+        if (padlen < 0 || overflowlen < 0 || overflowlen > h1len ||
+            h1len - overflowlen + underflowlen != MM_HEADER_LEN) {
+                TYPE_ERR("Mismatched header lengths in transform_packet");
+                return NULL;
+        }
+
+        if (!(h1 = malloc(h1len))) {
+                PyErr_NoMemory(); return NULL;
+        }
+        if (!(overflow = PyString_FromStringAndSize(NULL, overflowlen)))
+                goto err;
+        if (!(result = PyString_FromStringAndSize(NULL,
+                          mode ? MM_PACKET_LEN : MM_PAYLOAD_LEN)))
+                goto err;
+
+        out = PyString_AS_USTRING(result);
+        if (mode == 0) {
+                payloadp = out;
+                h1p = h2p = NULL;
+        } else {
+                payloadp = out + 2*MM_HEADER_LEN;
+                if (mode == 2) {
+                        h2p = out;
+                        h1p = out + MM_HEADER_LEN;
+                } else {
+                        h1p = out;
+                        h2p = out + MM_HEADER_LEN;
+                }
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        /* Pad the rest of header 1 with junk, then decrypt it. */
+        memcpy(h1, packet+MM_ENC_SUBHEADER_LEN,
+               MM_HEADER_LEN-MM_ENC_SUBHEADER_LEN);
+        memset(h1+MM_HEADER_LEN-MM_ENC_SUBHEADER_LEN, 0, padlen);
+        mm_derive_key(secret, secretlen, MODE_RANDOM_JUNK, key);
+        AES_set_encrypt_key(key, 128, &aes_key);
+        mm_aes_counter128((char*)h1+MM_HEADER_LEN-MM_ENC_SUBHEADER_LEN,
+                          (char*)h1+MM_HEADER_LEN-MM_ENC_SUBHEADER_LEN,
+                          padlen, &aes_key, 0);
+        mm_derive_key(secret, secretlen, MODE_HEADER_SECRET, key);
+        AES_set_encrypt_key(key, 128, &aes_key);
+        mm_aes_counter128((char*)h1, (char*)h1, h1len, &aes_key, 0);
+        memcpy(PyString_AS_STRING(overflow), h1, overflowlen);
+        if (h1p) {
+                memcpy(h1p, underflow, underflowlen);
+                memcpy(h1p+underflowlen, h1+overflowlen, h1len-overflowlen);
+        }
+
+        /* Decrypt the payload. */
+        memcpy(payloadp, packet+2*MM_HEADER_LEN, MM_PAYLOAD_LEN);
+        mm_derive_key(secret, secretlen, MODE_PAYLOAD_ENCRYPT, key);
+        mm_lioness_decrypt_inplace(key, payloadp, MM_PAYLOAD_LEN);
+
+        if (h2p) {
+                /* Decrypt header 2. */
+                memcpy(h2p, packet+MM_HEADER_LEN, MM_HEADER_LEN);
+                mm_derive_key(secret, secretlen, MODE_HEADER_ENCRYPT, key);
+                mm_lioness_decrypt_inplace(key, h2p, MM_HEADER_LEN);
+        }
+        if (mode == 2) {
+                /* At the swap point, decrypt the payload with a hash of
+                 * header 2, and header 2 with a hash of the payload.  The
+                 * headers are already in swapped positions. */
+                mm_lioness_decrypt_hidden(h2p, MM_HEADER_LEN,
+                                          MODE_HIDE_PAYLOAD,
+                                          payloadp, MM_PAYLOAD_LEN);
+                mm_lioness_decrypt_hidden(payloadp, MM_PAYLOAD_LEN,
+                                          MODE_HIDE_HEADER,
+                                          h2p, MM_HEADER_LEN);
+        }
+        memset(key, 0, sizeof(key));
+        memset(&aes_key, 0, sizeof(aes_key));
+        memset(h1, 0, h1len);
+        Py_END_ALLOW_THREADS
+
+        free(h1);
+        return Py_BuildValue("NN", overflow, result);
+ err:
+        Py_XDECREF(overflow);
+        Py_XDECREF(result);
+        if (h1) free(h1);
+        return NULL;
+}
+
 const char mm_openssl_seed__doc__[]=
   "openssl_seed(str)\n\n"
   "Seeds OpenSSL\'s internal random number generator with a provided source\n"
@@ -742,10 +1118,7 @@ mm_RSA_PEM_write_key(PyObject *self, PyObject *args, PyObject *kwdict)
         }
 
         ok = 1;
-        goto done;
  error:
-        mm_SSL_ERR(1);
- done:
         if (rsa && !public)
                 RSA_free(rsa);
         if (pkey)
@@ -756,6 +1129,8 @@ mm_RSA_PEM_write_key(PyObject *self, PyObject *args, PyObject *kwdict)
                 Py_INCREF(Py_None);
                 return Py_None;
         }
+        /* We can only set the Python exception once we hold the GIL again. */
+        mm_SSL_ERR(1);
         return NULL;
 }
 
@@ -1173,10 +1548,10 @@ const char mm_generate_dh_parameters__doc__[] =
 PyObject *
 mm_generate_dh_parameters(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-        /* ???? should be threadified? */
         static char *kwlist[] = { "filename", "verbose", "bits", NULL };
         char *filename;
         int bits=2048, verbose=0;
+        int ok = 0;
 
         BIO *out = NULL;
         DH *dh = NULL;
@@ -1187,26 +1562,27 @@ mm_generate_dh_parameters(PyObject *self, PyObject *args, PyObject *kwargs)
                                          &filename, &verbose, &bits))
                 return NULL;
 
+        /* This can take a long time; let other threads run. */
+        Py_BEGIN_ALLOW_THREADS
         out = BIO_new_file(filename, "w");
         if (out)
                 dh = DH_generate_parameters(bits, 2,
                                             verbose?gen_dh_callback:NULL,
                                             NULL);
-        if (out && dh)
-        if (!PEM_write_bio_DHparams(out, dh))
-                goto error;
-        BIO_free(out);
-        DH_free(dh);
-        Py_INCREF(Py_None);
-        return Py_None;
-
- error:
+        if (out && dh && PEM_write_bio_DHparams(out, dh))
+                ok = 1;
         if (out)
                 BIO_free(out);
         if (dh)
                 DH_free(dh);
-        mm_SSL_ERR(0);
-        return NULL;
+        Py_END_ALLOW_THREADS
+
+        if (!ok) {
+                mm_SSL_ERR(0);
+                return NULL;
+        }
+        Py_INCREF(Py_None);
+        return Py_None;
 }
 
 const char mm_generate_cert__doc__[] =
@@ -1245,7 +1621,7 @@ mm_generate_cert(PyObject *self, PyObject *args, PyObject *kwargs)
         X509_NAME *name = NULL;
         X509_NAME *name_issuer = NULL;
         int nid;
-        PyObject *retval;
+        int ok = 0;
         time_t _time;
 
         if (!PyArg_ParseTupleAndKeywords(args, kwargs,
@@ -1320,14 +1696,9 @@ mm_generate_cert(PyObject *self, PyObject *args, PyObject *kwargs)
         if (!(PEM_write_bio_X509(out, x509)))
                 goto error;
 
-        retval = Py_None;
-        Py_INCREF(Py_None);
-        goto done;
+        ok = 1;
 
 error:
-        retval = NULL;
-        mm_SSL_ERR(1);
- done:
         if (out)
                 BIO_free(out);
         if (name)
@@ -1346,7 +1717,13 @@ error:
                 EVP_PKEY_free(pkey_sign);
 
         Py_END_ALLOW_THREADS
-        return retval;
+        if (ok) {
+                Py_INCREF(Py_None);
+                return Py_None;
+        }
+        /* We can only set the Python exception once we hold the GIL again. */
+        mm_SSL_ERR(1);
+        return NULL;
 }
 
 /*
@@ -822,6 +822,10 @@ mm_FEC_generate(PyObject *self, PyObject *args, PyObject *kwargs)
 		return NULL;
 
 	output->fec = NULL;
+	/* Build the shared GF tables while we still hold the GIL, so that two
+	 * threads can't race to initialize them. */
+	if (fec_initialized == 0)
+		init_fec();
 	Py_BEGIN_ALLOW_THREADS
 	output->fec = fec_new(k,n);
 	Py_END_ALLOW_THREADS
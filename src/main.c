@@ -7,15 +7,18 @@
 */
 
 #include "_minionlib.h"
+#include "pythread.h"
 
 #ifndef TRUNCATED_OPENSSL_INCLUDES
 #include <openssl/ssl.h>
 #include <openssl/err.h>
 #include <openssl/rsa.h>
+#include <openssl/crypto.h>
 #else
 #include <ssl.h>
 #include <err.h>
 #include <rsa.h>
+#include <crypto.h>
 #endif
 
 #ifdef MS_WINDOWS
@@ -52,10 +55,12 @@
 
 static struct PyMethodDef _mixcryptlib_functions[] = {
         ENTRY(sha1),
+        ENTRY(sha1_new),
         ENTRY(aes_key),
         ENTRY(aes_ctr128_crypt),
         ENTRY(aes128_block_crypt),
         ENTRY(strxor),
+        ENTRY(transform_packet),
         ENTRY(openssl_seed),
         ENTRY(openssl_rand),
 #ifdef MS_WINDOWS
@@ -115,6 +120,50 @@ exc(PyObject *module_dict, PyObject **exception, char *longName,
         return 0;
 }
 
+#if (OPENSSL_VERSION_NUMBER < 0x10100000L)
+/* Our functions release the GIL around their calls into OpenSSL, so
+ * OpenSSL can be entered from several threads at once.  Older versions of
+ * OpenSSL are only thread-safe if the application gives them a set of
+ * locks, and a way to tell threads apart.  We use Python's portable thread
+ * primitives for both. */
+static PyThread_type_lock *openssl_locks = NULL;
+
+static void
+openssl_locking_cb(int mode, int n, const char *file, int line)
+{
+        if (mode & CRYPTO_LOCK)
+                PyThread_acquire_lock(openssl_locks[n], WAIT_LOCK);
+        else
+                PyThread_release_lock(openssl_locks[n]);
+}
+
+static unsigned long
+openssl_id_cb(void)
+{
+        return PyThread_get_thread_ident();
+}
+
+/* Install OpenSSL's locking callbacks, unless somebody (e.g. Python's
+ * _ssl module) already has.  Returns 1 on failure; 0 on success. */
+static int
+setup_openssl_threading(void)
+{
+        int i, n;
+        if (CRYPTO_get_locking_callback())
+                return 0;
+        n = CRYPTO_num_locks();
+        if (!(openssl_locks = malloc(n * sizeof(PyThread_type_lock))))
+                return 1;
+        for (i = 0; i < n; ++i) {
+                if (!(openssl_locks[i] = PyThread_allocate_lock()))
+                        return 1;
+        }
+        CRYPTO_set_id_callback(openssl_id_cb);
+        CRYPTO_set_locking_callback(openssl_locking_cb);
+        return 0;
+}
+#endif
+
 /* Required by Python: magic method to tell the Python runtime about our
  * new module and its contents.  Also initializes OpenSSL as needed.
  */
@@ -134,6 +183,13 @@ init_minionlib(void)
 
         OpenSSL_add_all_algorithms();
 
+#if (OPENSSL_VERSION_NUMBER < 0x10100000L)
+        if (setup_openssl_threading()) {
+                PyErr_NoMemory();
+                return;
+        }
+#endif
+
         if (exc(d, &mm_CryptoError, "mixminion._minionlib.CryptoError",
                 "CryptoError", mm_CryptoError__doc__))
                 return;
@@ -155,7 +211,8 @@ init_minionlib(void)
 
         /* We set ob_type here so that Cygwin and Win32 are happy. */
         mm_RSA_Type.ob_type = mm_TLSContext_Type.ob_type =
-                mm_TLSSock_Type.ob_type = mm_FEC_Type.ob_type = &PyType_Type;
+                mm_TLSSock_Type.ob_type = mm_FEC_Type.ob_type =
+                mm_SHA1_Type.ob_type = &PyType_Type;
 
         Py_INCREF(&mm_RSA_Type);
         if (PyDict_SetItemString(d, "RSA", (PyObject*)&mm_RSA_Type) < 0)
@@ -176,6 +233,11 @@ init_minionlib(void)
                                  (PyObject*)&mm_FEC_Type) < 0)
                 return;
 
+        Py_INCREF(&mm_SHA1_Type);
+        if (PyDict_SetItemString(d, "SHA1",
+                                 (PyObject*)&mm_SHA1_Type) < 0)
+                return;
+
 
         /* For some reason, Python's socket module doesn't export
          * IPTOS_*.  IPTOS_THROUGHPUT should always be "0x08" on any
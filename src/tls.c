@@ -13,6 +13,16 @@
 #include <bio.h>
 #endif
 
+/* Do we know how to negotiate ephemeral elliptic-curve DH? */
+#if !defined(OPENSSL_NO_ECDH) && defined(NID_X9_62_prime256v1) && \
+    defined(TLS1_TXT_ECDHE_RSA_WITH_AES_128_CBC_SHA)
+#define MM_HAVE_ECDHE
+#define MM_ECDHE_CIPHERS TLS1_TXT_ECDHE_RSA_WITH_AES_128_CBC_SHA ":"
+#endif
+
+/* Session ID context for server-side session caches. */
+#define MM_SESSION_ID_CONTEXT "mixminion-mmtp"
+
 char mm_TLSError__doc__[] =
   "mixminion._minionlib.TLSError\n\n"
   "Exception raised for error in underlying TLS/SSL library.\n";
@@ -94,6 +104,8 @@ tls_error(SSL *ssl, int r, int flags)
 typedef struct mm_TLSContext {
         PyObject_HEAD
         SSL_CTX *ctx;
+        /* True iff we should offer ECDHE ciphersuites. */
+        int ecdh;
 } mm_TLSContext;
 #define mm_TLSContext_Check(v) ((v)->ob_type == &mm_TLSContext_Type)
 
@@ -108,20 +120,30 @@ typedef struct mm_TLSSock {
 #define mm_TLSSock_Check(v) ((v)->ob_type == &mm_TLSSock_Type)
 
 const char mm_TLSContext_new__doc__[] =
-   "TLSContext([certfile, [rsa, [dhfile] ] ] )\n\n"
+   "TLSContext([certfile, [rsa, [dhfile, [sessionTimeout, [ecdh] ] ] ] ] )\n\n"
    "Allocates a new TLSContext object.  The files, if provided, are used\n"
    "contain the PEM-encoded X509 public keys, private key, and DH\n"
    "parameters for this context.\n\n"
    "If a cert is provided, assume we're working in server mode, and allow\n\n"
+   "If sessionTimeout is positive, server-mode contexts remember sessions\n"
+   "for that many seconds so that clients can resume them.  If ecdh is\n"
+   "true, prefer ephemeral elliptic-curve DH ciphersuites where the peer\n"
+   "supports them.\n\n"
    "LIMITATION: We don\'t expose any more features than Mixminion needs.\n";
 
 PyObject*
 mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-        static char *kwlist[] = { "certfile", "rsa", "dhfile", NULL };
+        static char *kwlist[] = { "certfile", "rsa", "dhfile",
+                                  "sessionTimeout", "ecdh", NULL };
         char *certfile = NULL, *dhfile=NULL;
         mm_RSA *rsa = NULL;
+        int sessionTimeout = 0, ecdh = 0;
         int err = 0;
+        const char *ciphers = TLS1_TXT_DHE_RSA_WITH_AES_128_SHA;
+#ifdef MM_HAVE_ECDHE
+        EC_KEY *ec = NULL;
+#endif
 
         SSL_METHOD *method = NULL;
         SSL_CTX *ctx = NULL;
@@ -131,12 +153,22 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
         EVP_PKEY *pkey = NULL;
         mm_TLSContext *result;
 
-        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|sO!s:TLSContext_new",
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "|zO!zii:TLSContext_new",
                                          kwlist,
                                          &certfile,
                                          &mm_RSA_Type, &rsa,
-                                         &dhfile))
+                                         &dhfile, &sessionTimeout, &ecdh))
                 return NULL;
+#ifdef MM_HAVE_ECDHE
+        if (ecdh)
+                ciphers = MM_ECDHE_CIPHERS TLS1_TXT_DHE_RSA_WITH_AES_128_SHA;
+#else
+        if (ecdh) {
+                MM_TLS_ERR("This version of OpenSSL does not support ECDHE");
+                return NULL;
+        }
+#endif
 
         Py_BEGIN_ALLOW_THREADS;
 
@@ -155,14 +187,24 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
                 /*SSL_CTX_set_options(ctx, SSL_OP_NO_SSLv2);*/
                 SSL_CTX_set_options(ctx, SSL_OP_SINGLE_ECDH_USE|SSL_OP_SINGLE_DH_USE|SSL_OP_NO_SSLv2|SSL_OP_NO_SSLv3);
         }
-        if (!err && !SSL_CTX_set_cipher_list(ctx,
-                                       TLS1_TXT_DHE_RSA_WITH_AES_128_SHA))
+        if (!err && !SSL_CTX_set_cipher_list(ctx, ciphers))
                 err = 1;
         if (!err && certfile &&
             !SSL_CTX_use_certificate_chain_file(ctx,certfile))
                 err = 1;
-        if (!err)
+        if (!err && certfile && sessionTimeout > 0) {
+                /* Remember sessions so that clients can resume them
+                   without a full handshake. */
+                SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_SERVER);
+                SSL_CTX_set_timeout(ctx, sessionTimeout);
+                if (!SSL_CTX_set_session_id_context(ctx,
+                          (const unsigned char*)MM_SESSION_ID_CONTEXT,
+                          sizeof(MM_SESSION_ID_CONTEXT)-1))
+                        err = 1;
+        } else if (!err) {
+                /* Clients resume sessions by hand, with set_session. */
                 SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_OFF);
+        }
         if (!err && rsa) {
                 if (!(_rsa = RSAPrivateKey_dup(rsa->rsa)) ||
                     !(pkey = EVP_PKEY_new()))
@@ -198,6 +240,18 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
                         bio = NULL;
                 }
         }
+#ifdef MM_HAVE_ECDHE
+        if (!err && ecdh && certfile) {
+                if (!(ec = EC_KEY_new_by_curve_name(NID_X9_62_prime256v1)))
+                        err = 1;
+                if (!err && !SSL_CTX_set_tmp_ecdh(ctx, ec))
+                        err = 1;
+                if (ec) {
+                        EC_KEY_free(ec);
+                        ec = NULL;
+                }
+        }
+#endif
         if (!err)
                 SSL_CTX_set_verify(ctx, SSL_VERIFY_NONE, NULL);
         if (!err)
@@ -211,6 +265,7 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
                         SSL_CTX_free(ctx); return NULL;
                 }
                 result->ctx = ctx;
+                result->ecdh = ecdh;
                 return (PyObject*)result;
         } else {
                 if (dh) DH_free(dh);
@@ -266,6 +321,11 @@ mm_TLSContext_sock(PyObject *self, PyObject *args, PyObject *kwargs)
                 err = 1;
 
         if (!err && serverMode && !SSL_set_cipher_list(ssl,
+#ifdef MM_HAVE_ECDHE
+                    ((mm_TLSContext*)self)->ecdh ?
+                    MM_ECDHE_CIPHERS TLS1_TXT_DHE_RSA_WITH_AES_128_SHA ":"
+                    SSL3_TXT_RSA_DES_192_CBC3_SHA :
+#endif
                     TLS1_TXT_DHE_RSA_WITH_AES_128_SHA ":"
                     SSL3_TXT_RSA_DES_192_CBC3_SHA))
                 err = 1;
@@ -455,6 +515,82 @@ mm_TLSSock_read(PyObject *self, PyObject *args, PyObject *kwargs)
         }
 }
 
+static char mm_TLSSock_read_into__doc__[] =
+   "tlssock.read_into(buffer, offset, size)\n\n"
+   "Tries to read [up to] size bytes from this socket into the writable\n"
+   "buffer object 'buffer' (such as a bytearray), starting at 'offset'.\n"
+   "Returns the number of bytes read if the read was successful.  Returns 0\n"
+   "if the connection has been closed.  Raises TLSWantRead or TLSWantWrite\n"
+   "if the underlying nonblocking socket would block on one of these\n"
+   "operations.\n";
+
+static PyObject*
+mm_TLSSock_read_into(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        static char *kwlist[] = { "buffer", "offset", "size", NULL };
+        char *buf;
+        int offset;
+        int n;
+        SSL *ssl;
+        int r;
+        PyObject *result;
+#if PY_VERSION_HEX >= 0x02060000
+        /* bytearray only supports the new buffer interface, so we need
+         * "w*" here. */
+        Py_buffer view;
+        Py_ssize_t buflen;
+
+        assert(mm_TLSSock_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "w*ii:read_into",
+                                         kwlist, &view, &offset, &n))
+                return NULL;
+        buf = view.buf;
+        buflen = view.len;
+#define RELEASE_BUFFER() PyBuffer_Release(&view)
+#else
+        int buflen;
+
+        assert(mm_TLSSock_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "w#ii:read_into",
+                                         kwlist, &buf, &buflen, &offset, &n))
+                return NULL;
+#define RELEASE_BUFFER() do {} while (0)
+#endif
+        if (offset < 0 || n <= 0 || offset > buflen || n > buflen-offset) {
+                RELEASE_BUFFER();
+                TYPE_ERR("Read would overflow buffer");
+                return NULL;
+        }
+
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        /* The caller must not resize 'buffer' from another thread while
+         * we're reading into it. */
+        Py_BEGIN_ALLOW_THREADS
+        r = SSL_read(ssl, buf+offset, n);
+        Py_END_ALLOW_THREADS
+        if (r > 0) {
+                result = PyInt_FromLong(r);
+        } else {
+                switch (tls_error(ssl, r, IGNORE_ZERO_RETURN)) {
+                    case NO_ERROR:
+                            Py_INCREF(Py_None);
+                            result = Py_None;
+                            break;
+                    case ZERO_RETURN:
+                            result = PyInt_FromLong(0);
+                            break;
+                    case ERROR:
+                    default:
+                            result = NULL;
+                            break;
+                }
+        }
+        RELEASE_BUFFER();
+        return result;
+#undef RELEASE_BUFFER
+}
+
 static char mm_TLSSock_write__doc__[] =
    "tlssock.write(string)\n\n"
    "Try to write to a TLS socket.\n"
@@ -815,11 +951,118 @@ mm_TLSSock_get_num_bytes_raw(PyObject *self, PyObject* args, PyObject *kwargs)
         return PyInt_FromLong((long)(r+w));
 }
 
+static char mm_TLSSock_get_num_bytes_read_written__doc__[] =
+"tlssock.get_num_bytes_read_written()\n\n"
+"Return a 2-tuple of the total number of bytes read and the total number\n"
+"of bytes written for this TLS connection.\n";
+
+static PyObject*
+mm_TLSSock_get_num_bytes_read_written(PyObject *self, PyObject* args,
+                                      PyObject *kwargs)
+{
+        SSL *ssl;
+        unsigned long r, w;
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        ssl = ((mm_TLSSock*)self)->ssl;
+        r = BIO_number_read(SSL_get_rbio(ssl));
+        w = BIO_number_written(SSL_get_wbio(ssl));
+        return Py_BuildValue("ll", (long)r, (long)w);
+}
+
+static char mm_TLSSock_get_session__doc__[] =
+"tlssock.get_session()\n\n"
+"Return a string encoding the TLS session negotiated on this connection,\n"
+"suitable for passing to set_session on a later connection to the same\n"
+"server.  Return None if there is no session.\n";
+
+static PyObject*
+mm_TLSSock_get_session(PyObject *self, PyObject* args, PyObject *kwargs)
+{
+        SSL *ssl;
+        SSL_SESSION *sess;
+        unsigned char *p;
+        PyObject *result;
+        int len;
+
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        if (!(sess = SSL_get_session(ssl))) {
+                Py_INCREF(Py_None);
+                return Py_None;
+        }
+        if ((len = i2d_SSL_SESSION(sess, NULL)) <= 0) {
+                mm_SSL_ERR(0); return NULL;
+        }
+        if (!(result = PyString_FromStringAndSize(NULL, len)))
+                return NULL;
+        p = (unsigned char*)PyString_AS_STRING(result);
+        if (i2d_SSL_SESSION(sess, &p) != len) {
+                Py_DECREF(result);
+                MM_TLS_ERR("Session changed length while encoding");
+                return NULL;
+        }
+        return result;
+}
+
+static char mm_TLSSock_set_session__doc__[] =
+"tlssock.set_session(session)\n\n"
+"Before connecting, ask to resume the session encoded in the string\n"
+"'session', as returned by get_session.  If the server doesn\'t\n"
+"remember the session, we fall back to a full handshake.\n";
+
+static PyObject*
+mm_TLSSock_set_session(PyObject *self, PyObject* args, PyObject *kwargs)
+{
+        static char *kwlist[] = { "session", NULL };
+        SSL *ssl;
+        SSL_SESSION *sess;
+        const unsigned char *p;
+        char *s;
+        int len, r;
+
+        assert(mm_TLSSock_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#:set_session",
+                                         kwlist, &s, &len))
+                return NULL;
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        p = (const unsigned char*)s;
+        if (!(sess = d2i_SSL_SESSION(NULL, &p, len))) {
+                mm_SSL_ERR(0); return NULL;
+        }
+        r = SSL_set_session(ssl, sess);
+        SSL_SESSION_free(sess);
+        if (!r) {
+                mm_SSL_ERR(0); return NULL;
+        }
+        Py_INCREF(Py_None);
+        return Py_None;
+}
+
+static char mm_TLSSock_session_reused__doc__[] =
+"tlssock.session_reused()\n\n"
+"Return true iff the handshake on this connection resumed an earlier\n"
+"session instead of performing a full key exchange.\n";
+
+static PyObject*
+mm_TLSSock_session_reused(PyObject *self, PyObject* args, PyObject *kwargs)
+{
+        SSL *ssl;
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        ssl = ((mm_TLSSock*)self)->ssl;
+        return PyInt_FromLong(SSL_session_reused(ssl) ? 1 : 0);
+}
+
 static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, accept),
         METHOD(mm_TLSSock, connect),
         METHOD(mm_TLSSock, pending),
         METHOD(mm_TLSSock, read),
+        METHOD(mm_TLSSock, read_into),
         METHOD(mm_TLSSock, write),
         METHOD(mm_TLSSock, shutdown),
         METHOD(mm_TLSSock, get_peer_cert_pk),
@@ -829,7 +1072,11 @@ static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, do_handshake),
         METHOD(mm_TLSSock, renegotiate),
         METHOD(mm_TLSSock, get_num_bytes_raw),
+        METHOD(mm_TLSSock, get_num_bytes_read_written),
         METHOD(mm_TLSSock, get_cert_lifetime),
+        METHOD(mm_TLSSock, get_session),
+        METHOD(mm_TLSSock, set_session),
+        METHOD(mm_TLSSock, session_reused),
         { NULL, NULL }
 };
 